@@ -0,0 +1,347 @@
+from functools import reduce
+from operator import or_
+from migen import *
+
+from .struct import *
+from .tlp import *
+
+
+__all__ = ["PCIeConfigSpace"]
+
+
+# Offsets of the capabilities, in dwords.
+_MSI_CAP  = 0x40 // 4
+_PCIE_CAP = 0x50 // 4
+
+
+def _l0s_exit_latency(n_fts):
+    # Exiting L0s takes N_FTS FTS ordered sets followed by a SKP ordered set, of 4 symbols each,
+    # which are 4 ns long at 2.5 GT/s. The Link Capabilities register encodes the latency as
+    # less than 64 ns, then ranges doubling from 64 ns up to 4 us, and then more than 4 us.
+    latency = (n_fts + 1) * 4 * 4
+    for encoding in range(7):
+        if latency < 64 << encoding:
+            return encoding
+    return 7
+
+
+class PCIeConfigSpace(Module):
+    """
+    PCIe Type 0 configuration space of a single function endpoint. Answers CfgRd0 and CfgWr0
+    requests with completions, and decodes memory addresses to BARs.
+
+    The configuration space consists of the standard header, with 32-bit non-prefetchable
+    memory BARs, an MSI capability with 64-bit addresses at 0x40, and a PCI Express capability
+    at 0x50. Registers that are not implemented read as zero, and writes to them are ignored.
+    The Link Status register reflects the width and rate negotiated by the LTSSM.
+
+    Requests are processed one at a time; a request is only accepted once the completion of
+    the previous one is transmitted. The requests must be routed to the configuration space by
+    the transaction layer; the type of the request is not checked beyond telling reads and
+    writes apart.
+
+    BARs are decoded by comparing the address with every BAR at once, so that ``bar_hit`` and
+    ``bar_index`` are valid in the same cycle as ``bar_adr``.
+
+    Parameters
+    ----------
+    vendor_id : int
+        Vendor ID.
+    device_id : int
+        Device ID.
+    class_code : int
+        Class code, including the programming interface.
+    revision_id : int
+        Revision ID.
+    subsystem_vendor_id : int
+        Subsystem vendor ID.
+    subsystem_id : int
+        Subsystem ID.
+    bars : list of int or None
+        Sizes of BAR 0 to 5, in bytes; at most 6. Every size must be a power of 2, at least 16.
+        ``None`` stands for an unimplemented BAR.
+    msi_vectors : int
+        Number of MSI vectors requested. Must be a power of 2, at most 32.
+    max_link_width : int
+        Maximum link width, in lanes.
+    gen2 : bool
+        Whether 5 GT/s is supported.
+    n_fts : int
+        Number of FTS ordered sets the receiver of the PHY requires to exit L0s; see
+        :class:`PCIePHY`. Determines the L0s exit latency advertised in Link Capabilities,
+        at 2.5 GT/s.
+
+    Attributes
+    ----------
+    i : Record(tlp_layout)
+        Input. Dword of a configuration request, if ``i.valid`` is asserted. Must be held until
+        accepted.
+    i_ready : Signal
+        Output. Strobe. Asserted if ``i`` is accepted.
+    o : Record(tlp_layout)
+        Output. Dword of a completion, if ``o.valid`` is asserted.
+    o_ready : Signal
+        Input. Strobe. Assert if ``o`` is accepted.
+    link_width : Signal(6)
+        Input. Negotiated link width, in lanes.
+    link_rate : Signal
+        Input. Negotiated link rate. Deasserted for 2.5 GT/s, asserted for 5 GT/s.
+    id : Signal(16)
+        Output. Bus, device and function number, captured from CfgWr0 requests.
+    memory_enable : Signal
+        Output. Memory Space Enable bit of the Command register.
+    bus_master_enable : Signal
+        Output. Bus Master Enable bit of the Command register.
+    max_payload_size : Signal(3)
+        Output. Max_Payload_Size field of the Device Control register.
+    max_read_request_size : Signal(3)
+        Output. Max_Read_Request_Size field of the Device Control register.
+    rcb : Signal
+        Output. Read Completion Boundary bit of the Link Control register. Deasserted for
+        64 bytes, asserted for 128 bytes.
+    msi_enable : Signal
+        Output. MSI Enable bit of the MSI capability.
+    msi_vectors : Signal(3)
+        Output. Multiple Message Enable field of the MSI capability, i.e. the base 2 logarithm
+        of the number of MSI vectors allocated.
+    msi_address : Signal(64)
+        Output. Message Address of the MSI capability.
+    msi_data : Signal(16)
+        Output. Message Data of the MSI capability.
+    bar_adr : Signal(32)
+        Input. Memory address to decode.
+    bar_hit : Signal
+        Output. Asserted if ``bar_adr`` is within an implemented BAR, and memory space is
+        enabled.
+    bar_index : Signal(max=6)
+        Output. Number of the BAR ``bar_adr`` is within. Valid while ``bar_hit`` is asserted.
+    bar_offset : Signal(32)
+        Output. Offset of ``bar_adr`` within the BAR. Valid while ``bar_hit`` is asserted.
+    """
+    def __init__(self, vendor_id, device_id, class_code, revision_id=0,
+                 subsystem_vendor_id=0, subsystem_id=0, bars=[], msi_vectors=1,
+                 max_link_width=1, gen2=False, n_fts=0xff):
+        if len(bars) > 6:
+            raise ValueError("At most 6 BARs may be implemented, not {}".format(len(bars)))
+        for size in bars:
+            if size is not None and (size < 16 or size & (size - 1)):
+                raise ValueError("BAR size must be a power of 2 and at least 16, not {}"
+                                 .format(size))
+        if msi_vectors > 32 or msi_vectors & (msi_vectors - 1):
+            raise ValueError("MSI vector count must be a power of 2 no greater than 32, not {}"
+                             .format(msi_vectors))
+        if not 0 <= n_fts <= 255:
+            raise ValueError("N_FTS must be between 0 and 255, not {}".format(n_fts))
+
+        self.i         = Record(tlp_layout)
+        self.i_ready   = Signal()
+        self.o         = Record(tlp_layout)
+        self.o_ready   = Signal()
+
+        self.link_width = Signal(6)
+        self.link_rate  = Signal()
+
+        self.id                    = Signal(16)
+        self.memory_enable         = Signal()
+        self.bus_master_enable     = Signal()
+        self.max_payload_size      = Signal(3)
+        self.max_read_request_size = Signal(3)
+        self.rcb                   = Signal()
+        self.msi_enable            = Signal()
+        self.msi_vectors           = Signal(3)
+        self.msi_address           = Signal(64)
+        self.msi_data              = Signal(16)
+
+        self.bar_adr    = Signal(32)
+        self.bar_hit    = Signal()
+        self.bar_index  = Signal(max=6)
+        self.bar_offset = Signal(32)
+
+        ###
+
+        # Registers. Every dword is read as a concatenation of fields, and writable fields are
+        # written through a mask of writable bits.
+        command      = Signal(16)
+        cache_line   = Signal(8)
+        bar_bases    = [Signal(32, name="bar{}_base".format(n)) for n in range(len(bars))]
+        int_line     = Signal(8)
+        msi_control  = Signal(16)
+        msi_addr_lo  = Signal(32)
+        msi_addr_hi  = Signal(32)
+        dev_control  = Signal(16, reset=0x2810)
+        link_control = Signal(16)
+        link_speed   = Signal(4)
+        self.comb += link_speed.eq(1 + self.link_rate)
+
+        registers = {
+            0x00: Cat(C(vendor_id, 16), C(device_id, 16)),
+            # Capabilities List in Status.
+            0x01: Cat(command, C(0x0010, 16)),
+            0x02: Cat(C(revision_id, 8), C(class_code, 24)),
+            0x03: Cat(cache_line, C(0, 24)),
+            0x0b: Cat(C(subsystem_vendor_id, 16), C(subsystem_id, 16)),
+            0x0d: C(_MSI_CAP * 4, 32),
+            0x0f: Cat(int_line, C(0, 24)),
+            _MSI_CAP + 0: Cat(C(0x05, 8), C(_PCIE_CAP * 4, 8),
+                              msi_control[0:1], C(log2_int(msi_vectors), 3),
+                              msi_control[4:7], C(1, 1), C(0, 8)),
+            _MSI_CAP + 1: msi_addr_lo,
+            _MSI_CAP + 2: msi_addr_hi,
+            _MSI_CAP + 3: Cat(self.msi_data, C(0, 16)),
+            # Version 2, PCI Express Endpoint.
+            _PCIE_CAP + 0: Cat(C(0x10, 8), C(0, 8), C(0x0002, 16)),
+            # Max_Payload_Size of 128 bytes; Role-Based Error Reporting.
+            _PCIE_CAP + 1: C(1 << 15, 32),
+            _PCIE_CAP + 2: Cat(dev_control, C(0, 16)),
+            # L0s supported.
+            _PCIE_CAP + 3: Cat(C(2 if gen2 else 1, 4), C(max_link_width, 6), C(0b01, 2),
+                               C(_l0s_exit_latency(n_fts), 3), C(0, 17)),
+            _PCIE_CAP + 4: Cat(link_control, link_speed, self.link_width, C(0, 6)),
+            _PCIE_CAP + 11: C(0b110 if gen2 else 0b010, 32),
+            _PCIE_CAP + 12: Cat(C(2 if gen2 else 1, 16), C(0, 16)),
+        }
+        for n, size in enumerate(bars):
+            if size is not None:
+                registers[0x04 + n] = bar_bases[n]
+
+        # Writable bits of every register, by dword.
+        writable = {
+            # Memory Space Enable, Bus Master Enable, Parity Error Response, SERR# Enable,
+            # Interrupt Disable.
+            0x01: [(command,      0, 0x0546)],
+            0x03: [(cache_line,   0, 0xff)],
+            0x0f: [(int_line,     0, 0xff)],
+            _MSI_CAP + 0:  [(msi_control, 16, 0x0071)],
+            _MSI_CAP + 1:  [(msi_addr_lo,  0, 0xfffffffc)],
+            _MSI_CAP + 2:  [(msi_addr_hi,  0, 0xffffffff)],
+            _MSI_CAP + 3:  [(self.msi_data, 0, 0xffff)],
+            _PCIE_CAP + 2: [(dev_control,  0, 0x7fff)],
+            # ASPM Control, Read Completion Boundary, Common Clock Configuration,
+            # Extended Synch.
+            _PCIE_CAP + 4: [(link_control, 0, 0x00cb)],
+        }
+        for n, size in enumerate(bars):
+            if size is not None:
+                writable[0x04 + n] = [(bar_bases[n], 0, 0xffffffff & ~(size - 1))]
+
+        self.comb += [
+            self.memory_enable.eq(command[1]),
+            self.bus_master_enable.eq(command[2]),
+            self.max_payload_size.eq(dev_control[5:8]),
+            self.max_read_request_size.eq(dev_control[12:15]),
+            self.rcb.eq(link_control[3]),
+            self.msi_enable.eq(msi_control[0]),
+            self.msi_vectors.eq(msi_control[4:7]),
+            self.msi_address.eq(Cat(msi_addr_lo, msi_addr_hi)),
+        ]
+
+        # Receiving requests. The header is followed by a dword of data for CfgWr0.
+        req_dword     = Signal(2)
+        req_write     = Signal()
+        req_tc        = Signal(3)
+        req_attr      = Signal(2)
+        req_requester = Signal(16)
+        req_tag       = Signal(8)
+        req_be        = Signal(4)
+        req_register  = Signal(10)
+        req_data      = Signal(32)
+        req_done      = Signal()
+
+        self.comb += self.i_ready.eq(self.i.valid & ~req_done & ~self.o.valid)
+        self.sync += [
+            req_done.eq(0),
+            If(self.i_ready,
+                req_dword.eq(req_dword + 1),
+                Case(req_dword, {
+                    0: [
+                        req_write.eq(self.i.data[0:8] == TLP_CFG_WR0),
+                        req_tc.eq(self.i.data[12:15]),
+                        req_attr.eq(self.i.data[20:22]),
+                    ],
+                    1: [
+                        req_requester.eq(tlp_requester_id(self.i.data)),
+                        req_tag.eq(self.i.data[16:24]),
+                        req_be.eq(self.i.data[24:28]),
+                    ],
+                    2: [
+                        req_register.eq(Cat(self.i.data[26:32], self.i.data[16:20])),
+                        If(req_write,
+                            self.id.eq(Cat(self.i.data[8:16], self.i.data[0:8]))
+                        )
+                    ],
+                    3: req_data.eq(self.i.data),
+                }),
+                If(self.i.last,
+                    req_dword.eq(0),
+                    req_done.eq(1)
+                )
+            )
+        ]
+
+        # Accessing registers.
+        read_data  = Signal(32)
+        write_mask = Signal(32)
+        self.comb += [
+            Case(req_register, {
+                register: read_data.eq(value)
+                for register, value in registers.items()
+            }),
+            write_mask.eq(Cat(*[Replicate(req_be[n], 8) for n in range(4)])),
+        ]
+        self.sync += [
+            If(req_done & req_write,
+                Case(req_register, {
+                    register: [
+                        signal.eq((signal & ~(mask & write_mask[offset:offset + len(signal)])) |
+                                  (req_data[offset:offset + len(signal)] &
+                                   mask & write_mask[offset:offset + len(signal)]))
+                        for signal, offset, mask in fields
+                    ]
+                    for register, fields in writable.items()
+                })
+            )
+        ]
+
+        # Transmitting completions. CplD carries the register for reads; Cpl has no data.
+        cpl_dword = Signal(2)
+        cpl_data  = Signal(32)
+        cpl_last  = Signal()
+        self.comb += [
+            Case(cpl_dword, {
+                0: self.o.data.eq(tlp_dw0(Mux(req_write, TLP_CPL, TLP_CPLD), ~req_write,
+                                          req_tc, req_attr)),
+                1: self.o.data.eq(tlp_cpl_dw1(self.id, CPL_SC, 4)),
+                2: self.o.data.eq(tlp_cpl_dw2(req_requester, req_tag)),
+                3: self.o.data.eq(cpl_data),
+            }),
+            cpl_last.eq(Mux(req_write, cpl_dword == 2, cpl_dword == 3)),
+            self.o.last.eq(cpl_last),
+        ]
+        self.sync += [
+            If(req_done,
+                self.o.valid.eq(1),
+                cpl_data.eq(read_data)
+            ),
+            If(self.o_ready,
+                cpl_dword.eq(cpl_dword + 1),
+                If(cpl_last,
+                    cpl_dword.eq(0),
+                    self.o.valid.eq(0)
+                )
+            )
+        ]
+
+        # Decoding BARs.
+        bar_hits = [Signal(name="bar{}_hit".format(n)) for n in range(len(bars))]
+        for n, size in enumerate(bars):
+            if size is not None:
+                self.comb += bar_hits[n].eq(
+                    self.bar_adr[log2_int(size):] == bar_bases[n][log2_int(size):])
+        for n, size in reversed(list(enumerate(bars))):
+            if size is not None:
+                self.comb += If(bar_hits[n],
+                    self.bar_index.eq(n),
+                    self.bar_offset.eq(self.bar_adr[:log2_int(size)])
+                )
+        if bar_hits:
+            self.comb += self.bar_hit.eq(self.memory_enable & reduce(or_, bar_hits))
@@ -0,0 +1,168 @@
+from migen import *
+
+
+__all__ = ["PCIeCRC", "PCIeCRCWord"]
+
+
+def _crc_advance(state, data, poly):
+    """
+    Advance a CRC register with the generator polynomial ``poly`` by the bits of ``data``
+    symbolically. ``state`` and ``data`` are lists of bit masks, each bit of which stands for
+    a bit of the initial state or of the input. Returns the list of bit masks of the new state.
+    """
+    width = len(state)
+    for bit in data:
+        feedback = state[width - 1] ^ bit
+        state = [
+            (state[n - 1] if n > 0 else 0) ^ (feedback if poly & (1 << n) else 0)
+            for n in range(width)
+        ]
+    return state
+
+
+def _xor_tree(values):
+    """
+    Return the XOR of ``values`` as a balanced tree, which is much shallower than a chain.
+    """
+    if len(values) == 1:
+        return values[0]
+    return _xor_tree(values[:len(values) // 2]) ^ _xor_tree(values[len(values) // 2:])
+
+
+class PCIeCRC:
+    """
+    PCIe CRC, as used for DLLPs (16-bit CRC) and TLPs (32-bit LCRC).
+
+    The CRC register is seeded with all ones, and every byte is processed starting with bit 0.
+    The CRC is complemented and the bit order of each of its bytes is reversed when it is
+    transmitted, most significant byte first.
+
+    The register can be advanced by any number of bytes at once; the equations for every bit are
+    unrolled at elaboration time, so e.g. a whole word is processed in a single cycle. The results
+    are expressions that refer to every bit of the inputs; to keep the expressions small, they
+    should be assigned to signals before being used again.
+
+    Parameters
+    ----------
+    width : int
+        CRC width, in bits.
+    poly : int
+        Generator polynomial, without the ``x^width`` term.
+
+    Attributes
+    ----------
+    init : int
+        Seed of the CRC register.
+    """
+    def __init__(self, width, poly):
+        self.width = width
+        self.poly  = poly
+        self.init  = (1 << width) - 1
+        # input width -> bit masks of the new state
+        self._masks = {}
+
+    def compute(self, data, crc=None):
+        """
+        Return the value of the CRC register after processing the bytes ``data``, starting with
+        the value ``crc`` (by default, the seed).
+        """
+        if crc is None:
+            crc = self.init
+        state = _crc_advance(
+            state=[(crc >> n) & 1 for n in range(self.width)],
+            data=[(byte >> n) & 1 for byte in data for n in range(8)],
+            poly=self.poly)
+        return sum(bit << n for n, bit in enumerate(state))
+
+    def residue(self, inverted=False):
+        """
+        Return the value of the CRC register after processing any bytes followed by their
+        transmitted CRC, or, if ``inverted`` is true, by its complement, as e.g. in a nullified
+        TLP.
+        """
+        # The CRC of no bytes, as transmitted.
+        crc = [int("{:08b}".format(~self.init >> (n * 8) & 0xff)[::-1], 2)
+               for n in reversed(range(self.width // 8))]
+        if inverted:
+            crc = [byte ^ 0xff for byte in crc]
+        return self.compute(crc)
+
+    def advance_bits(self, crc, data):
+        """
+        Return the bits of the value of the CRC register ``crc`` after processing ``data``,
+        a value of a whole number of bytes, starting with its least significant byte.
+        """
+        crc, data = wrap(crc), wrap(data)
+        if len(data) % 8 != 0:
+            raise ValueError("Data width must be a multiple of 8, not {}".format(len(data)))
+        if len(data) not in self._masks:
+            self._masks[len(data)] = _crc_advance(
+                state=[1 << n for n in range(self.width)],
+                data=[1 << (self.width + n) for n in range(len(data))],
+                poly=self.poly)
+
+        bits = [crc[n] for n in range(self.width)] + [data[n] for n in range(len(data))]
+        return [_xor_tree([bits[n] for n in range(len(bits)) if mask & (1 << n)])
+                for mask in self._masks[len(data)]]
+
+    def advance(self, crc, data):
+        """
+        Return the value of the CRC register ``crc`` after processing ``data``, a value
+        of a whole number of bytes, starting with its least significant byte.
+        """
+        return Cat(self.advance_bits(crc, data))
+
+    def transmit(self, crc):
+        """
+        Return the bytes of the CRC register ``crc`` as transmitted, the first byte in
+        the least significant bits.
+        """
+        crc = wrap(crc)
+        return Cat(~crc[n * 8 + 7 - m]
+                   for n in reversed(range(self.width // 8)) for m in range(8))
+
+
+class PCIeCRCWord(Module):
+    """
+    PCIe CRC register that is advanced by the bytes in any slots of a word every cycle. The byte
+    in every slot is processed by its own unrolled equations, chained through the slots of
+    the word, so the register keeps up with a word of packet data per cycle regardless of where
+    the packet starts or ends within the word.
+
+    Parameters
+    ----------
+    crc : PCIeCRC
+        CRC to compute.
+    word_size : int
+        Word size, in bytes.
+
+    Attributes
+    ----------
+    i : Signal(8 * word_size)
+        Input. Bytes of the word.
+    start : Signal(word_size)
+        Input. If a bit is asserted, the register is seeded before processing the byte
+        in the corresponding slot.
+    enable : Signal(word_size)
+        Input. If a bit is asserted, the byte in the corresponding slot is processed.
+    values : list of Signal(crc.width)
+        Output. Value of the register at the beginning of every slot, and at the end of the word.
+    """
+    def __init__(self, crc, word_size):
+        self.i      = Signal(8 * word_size)
+        self.start  = Signal(word_size)
+        self.enable = Signal(word_size)
+        self.values = [Signal(crc.width, name="value{}".format(n)) for n in range(word_size + 1)]
+
+        ###
+
+        self.sync += self.values[0].eq(self.values[-1])
+        for n in range(word_size):
+            value_in  = Signal(crc.width, name="value_in{}".format(n))
+            value_out = Signal(crc.width, name="value_out{}".format(n))
+            self.comb += [
+                value_in.eq(Mux(self.start[n], crc.init, self.values[n])),
+                [value_out[m].eq(bit)
+                 for m, bit in enumerate(crc.advance_bits(value_in, self.i.part(8 * n, 8)))],
+                self.values[n + 1].eq(Mux(self.enable[n], value_out, self.values[n])),
+            ]
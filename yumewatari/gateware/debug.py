@@ -1,11 +1,73 @@
 from migen import *
 
 
-__all__ = ["RingLog"]
+__all__ = ["TRIGGER_EXTERNAL", "TRIGGER_MATCH", "TRIGGER_EDGE", "RingLog", "StateStatistics"]
+
+
+TRIGGER_EXTERNAL = 0
+TRIGGER_MATCH    = 1
+TRIGGER_EDGE     = 2
 
 
 class RingLog(Module):
+    """
+    Log of a signal. An entry, consisting of a timestamp and the new value, is written to
+    a ring buffer in a memory every time the signal changes.
+
+    The log runs freely until it is armed. Once armed, it waits for the trigger condition,
+    logs ``post_trigger`` more entries, and stops, so the window before the trigger holds up to
+    ``depth - post_trigger`` entries. Asserting ``trigger`` stops the log immediately.
+
+    While the log is stopped, it is read out starting with the oldest entry.
+
+    Parameters
+    ----------
+    timestamp_width : int
+        Width of the timestamps. Timestamps wrap around.
+    data_width : int
+        Width of the logged signal.
+    depth : int
+        Number of entries. Must be a power of 2.
+
+    Attributes
+    ----------
+    data_i : Signal(data_width)
+        Input. Logged signal.
+    trigger : Signal
+        Input. Stop the log while asserted, e.g. to read it out.
+    time_o : Signal(timestamp_width)
+        Output. Timestamp of the entry being read out.
+    data_o : Signal(data_width)
+        Output. Value of the entry being read out.
+    next : Signal
+        Input. Strobe. Advance to the next entry while the log is stopped. ``time_o`` and
+        ``data_o`` are updated in the following cycle.
+    trigger_mode : Signal(2)
+        Input. Trigger condition: ``TRIGGER_EXTERNAL`` triggers while ``trigger_i`` is
+        asserted, ``TRIGGER_MATCH`` while ``data_i`` masked with ``match_mask`` equals
+        ``match_value``, and ``TRIGGER_EDGE`` once it becomes equal.
+    trigger_i : Signal
+        Input. External trigger.
+    match_value : Signal(data_width)
+        Input. Value to match.
+    match_mask : Signal(data_width)
+        Input. Bits of ``data_i`` to match.
+    post_trigger : Signal(max=depth + 1)
+        Input. Number of entries to log after the trigger.
+    arm : Signal
+        Input. Strobe. Restart the log, and wait for the trigger condition.
+    armed : Signal
+        Output. Asserted while waiting for the trigger condition.
+    triggered : Signal
+        Output. Asserted once the trigger condition occured, until the log is armed again.
+    done : Signal
+        Output. Asserted once ``post_trigger`` entries have been logged after the trigger,
+        until the log is armed again. The log is stopped while asserted.
+    """
     def __init__(self, timestamp_width, data_width, depth):
+        if depth < 2 or depth & (depth - 1):
+            raise ValueError("Depth must be a power of 2, not {}".format(depth))
+
         self.width     = timestamp_width + data_width
         self.depth     = depth
 
@@ -16,6 +78,17 @@ class RingLog(Module):
         self.data_o    = Signal(data_width)
         self.next      = Signal()
 
+        self.trigger_mode = Signal(2)
+        self.trigger_i    = Signal()
+        self.match_value  = Signal(data_width)
+        self.match_mask   = Signal(data_width)
+        self.post_trigger = Signal(max=depth + 1)
+
+        self.arm       = Signal()
+        self.armed     = Signal()
+        self.triggered = Signal()
+        self.done      = Signal()
+
         ###
 
         timestamp = Signal(timestamp_width)
@@ -24,25 +97,56 @@ class RingLog(Module):
         data_i_l = Signal.like(self.data_i)
         self.sync += data_i_l.eq(self.data_i)
 
+        match   = Signal()
+        match_l = Signal()
+        fire    = Signal()
+        self.comb += [
+            match.eq((self.data_i & self.match_mask) == self.match_value),
+            Case(self.trigger_mode, {
+                TRIGGER_EXTERNAL: fire.eq(self.trigger_i),
+                TRIGGER_MATCH:    fire.eq(match),
+                TRIGGER_EDGE:     fire.eq(match & ~match_l),
+                "default":        fire.eq(0),
+            })
+        ]
+        self.sync += match_l.eq(match)
+
+        stopped = Signal()
+        self.comb += stopped.eq(self.trigger | self.done)
+
         storage = Memory(width=self.width, depth=self.depth)
         self.specials += storage
 
         wrport = storage.get_port(write_capable=True)
         self.specials += wrport
         self.comb += [
-            wrport.we.eq(~self.trigger & (self.data_i != data_i_l)),
+            wrport.we.eq(~stopped & (self.data_i != data_i_l)),
             wrport.dat_w.eq(Cat(timestamp, self.data_i))
         ]
         self.sync += [
-            If(~self.trigger,
-                If(self.data_i != data_i_l,
-                    wrport.adr.eq(wrport.adr + 1)
-                )
+            If(wrport.we,
+                wrport.adr.eq(wrport.adr + 1)
             )
         ]
 
-        trigger_s = Signal.like(self.trigger)
-        self.sync += trigger_s.eq(self.trigger)
+        remaining = Signal.like(self.post_trigger)
+        self.sync += [
+            If(self.arm,
+                self.armed.eq(1),
+                self.triggered.eq(0),
+                self.done.eq(0)
+            ).Elif(self.armed & fire,
+                self.armed.eq(0),
+                self.triggered.eq(1),
+                self.done.eq(self.post_trigger == 0),
+                remaining.eq(self.post_trigger)
+            ).Elif(self.triggered & ~self.done & wrport.we,
+                remaining.eq(remaining - 1),
+                If(remaining == 1,
+                    self.done.eq(1)
+                )
+            )
+        ]
 
         rdport = storage.get_port()
         self.specials += rdport
@@ -50,9 +154,92 @@ class RingLog(Module):
             Cat(self.time_o, self.data_o).eq(rdport.dat_r),
         ]
         self.sync += [
-            If(~self.trigger,
-                rdport.adr.eq(wrport.adr + 1)
+            If(~stopped,
+                rdport.adr.eq(wrport.adr + wrport.we)
             ).Elif(self.next,
                 rdport.adr.eq(rdport.adr + 1)
             )
         ]
+
+
+class StateStatistics(Module):
+    """
+    Statistics of a state machine: the number of cycles spent in every state, and the number of
+    times every state was left. Both saturate.
+
+    The counts are stored in a memory, and updated once the state machine leaves a state; the
+    cycles spent in the current state so far are added when it is read out.
+
+    Parameters
+    ----------
+    states : int
+        Number of states.
+    cycles_width : int
+        Width of the cycle counts.
+    transitions_width : int
+        Width of the transition counts.
+
+    Attributes
+    ----------
+    state_i : Signal(max=states)
+        Input. Number of the current state.
+    index : Signal(max=states)
+        Input. Number of the state to read out.
+    cycles_o : Signal(cycles_width)
+        Output. Number of cycles spent in state ``index``.
+    transitions_o : Signal(transitions_width)
+        Output. Number of times state ``index`` was left.
+    """
+    def __init__(self, states, cycles_width=32, transitions_width=16):
+        self.states = states
+
+        self.state_i       = Signal(max=max(states, 2))
+        self.index         = Signal(max=max(states, 2))
+        self.cycles_o      = Signal(cycles_width)
+        self.transitions_o = Signal(transitions_width)
+
+        ###
+
+        def saturating_add(a, b, width):
+            total = Signal(width + 1)
+            self.comb += total.eq(a + b)
+            return Mux(total[width], (1 << width) - 1, total[:width])
+
+        # Cycles spent in the current state that are not stored yet.
+        state_l = Signal.like(self.state_i)
+        started = Signal()
+        run     = Signal(cycles_width)
+        self.sync += [
+            started.eq(1),
+            state_l.eq(self.state_i),
+            If(self.state_i != state_l,
+                run.eq(1)
+            ).Elif(run != (1 << cycles_width) - 1,
+                run.eq(run + 1)
+            )
+        ]
+
+        storage = Memory(width=cycles_width + transitions_width, depth=states)
+        self.specials += storage
+
+        wrport = storage.get_port(write_capable=True, async_read=True)
+        self.specials += wrport
+        stored_cycles      = Signal(cycles_width)
+        stored_transitions = Signal(transitions_width)
+        self.comb += [
+            wrport.adr.eq(state_l),
+            Cat(stored_cycles, stored_transitions).eq(wrport.dat_r),
+            wrport.we.eq(started & (self.state_i != state_l)),
+            wrport.dat_w.eq(Cat(saturating_add(stored_cycles, run, cycles_width),
+                                saturating_add(stored_transitions, 1, transitions_width))),
+        ]
+
+        rdport = storage.get_port(async_read=True)
+        self.specials += rdport
+        read_cycles = Signal(cycles_width)
+        self.comb += [
+            rdport.adr.eq(self.index),
+            Cat(read_cycles, self.transitions_o).eq(rdport.dat_r),
+            self.cycles_o.eq(saturating_add(read_cycles, Mux(self.index == state_l, run, 0),
+                                            cycles_width)),
+        ]
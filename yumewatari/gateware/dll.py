@@ -0,0 +1,242 @@
+from migen import *
+
+from .struct import *
+from .dll_rx import *
+from .dll_tx import *
+from .dll_replay import *
+from .dll_fc import *
+
+
+__all__ = ["PCIeDLL"]
+
+
+class PCIeDLL(Module):
+    """
+    PCIe data link layer. Transmits and receives DLLPs and TLPs through the data path of a PHY,
+    and implements the ACK/NAK protocol.
+
+    Transmitted TLPs are stored in a replay buffer until the link partner acknowledges them,
+    and are transmitted again if it does not. If the same TLPs are transmitted again for the
+    fourth time, the link is retrained.
+
+    Received TLPs that are accepted are acknowledged by ACK DLLPs. ACK DLLPs are coalesced:
+    an ACK DLLP is only transmitted once ``ack_coalesce`` TLPs are accepted, or once
+    the AckNak latency timer expires, so that the link partner is kept informed without spending
+    a DLLP on every TLP. A received TLP that is duplicate is acknowledged immediately. A received
+    TLP that is corrupted, or out of sequence, is discarded and answered with a NAK DLLP, unless
+    a NAK DLLP was already sent and no TLP was accepted since.
+
+    Once the link is up, flow control is initialized, and TLPs are only transmitted once
+    the link partner has advertised enough credits for them. Received TLPs use the credits
+    indicated by ``rx_tlp_credits``, which must be released through ``rx_fc_release`` once
+    the TLP is processed. ACK and NAK DLLPs take priority over flow control DLLPs.
+
+    The state of the data link layer is reset while the link is down.
+
+    Parameters
+    ----------
+    phy : PCIePHY
+        PHY to use for the link. Its data path must be at most 8 symbols wide.
+    state_encoding : str
+        Encoding of the receiver parser and transmitter emitter FSM states;
+        see :class:`EncodedFSM`.
+    replay_depth : int
+        Size of the replay buffer, in dwords. Must be a power of 2. If the data path is more than
+        4 symbols wide, TLPs are stored in beats of two dwords, and a TLP with an odd number of
+        dwords takes as much space as one with a dword more.
+    replay_tlps : int
+        Maximum number of TLPs in the replay buffer. Must be a power of 2, and at most 2048.
+    replay_timeout : int
+        REPLAY_TIMER limit, in symbol times.
+    ack_latency : int
+        AckNak latency timer limit, in symbol times.
+    ack_coalesce : int
+        Number of accepted TLPs after which an ACK DLLP is transmitted without waiting for
+        the AckNak latency timer.
+    rx_credits : dict of str to int
+        Credits advertised for received TLPs; see :class:`PCIeFlowControl`. Defaults to
+        16 posted and non-posted request headers, 128 posted and 16 non-posted data credits,
+        and infinite completion credits.
+    fc_update_threshold : dict of str to int
+        Number of released credits after which they are advertised; see
+        :class:`PCIeFlowControl`.
+    fc_update_period : int
+        Maximum interval between UpdateFC DLLPs of a type, in symbol times; see
+        :class:`PCIeFlowControl`. Defaults to 30 us at 2.5 GT/s.
+
+    Attributes
+    ----------
+    rx : PCIeDLLRX
+        Receiver. Received TLPs are delivered through ``rx.tlp``, which carries two dwords per
+        cycle if the data path is more than 4 symbols wide.
+    tx : PCIeDLLTX
+        Transmitter.
+    replay : PCIeReplayBuffer
+        Replay buffer.
+    fc : PCIeFlowControl
+        Flow control.
+    dl_up : Signal
+        Output. Asserted once flow control is initialized.
+    tx_tlp : Record(tlp_layout)
+        Input. Dword of a TLP to transmit, if ``tx_tlp.valid`` is asserted. Must be held until
+        accepted.
+    tx_tlp_ready : Signal
+        Output. Strobe. Asserted if ``tx_tlp`` is accepted.
+    next_transmit_seq : Signal(12)
+        Output. Sequence number of the next TLP to transmit.
+    next_rcv_seq : Signal(12)
+        Output. Sequence number of the next TLP expected to be received.
+    rx_tlp_accept : Signal
+        Output. Strobe. Asserted once a TLP with a valid LCRC and the expected sequence number is
+        received by ``rx``; any other TLP must be discarded.
+    rx_tlp_credits : Record(fc_layout)
+        Output. Credits used by the accepted TLP. Valid while ``rx_tlp_accept`` is asserted.
+    rx_fc_release : Record(fc_layout)
+        Input. Credits of received TLPs released in this cycle.
+    """
+    def __init__(self, phy, state_encoding="binary", replay_depth=512, replay_tlps=32,
+                 replay_timeout=711, ack_latency=237, ack_coalesce=4, rx_credits=None,
+                 fc_update_threshold=None, fc_update_period=7500):
+        word_size = len(phy.rx_data) // 9
+        if word_size > 8:
+            raise ValueError("PCIe DLL requires a data path of at most 8 symbols, not {}"
+                             .format(word_size))
+        dwords = (word_size + 3) // 4
+        # Symbol times per cycle.
+        ratio = word_size // len(phy.rx_lanes)
+        replay_timeout_cyc   = -(-replay_timeout // ratio)
+        ack_latency_cyc      = -(-ack_latency // ratio)
+        fc_update_period_cyc = fc_update_period // ratio
+
+        if rx_credits is None:
+            rx_credits = {"ph": 16, "pd": 128, "nph": 16, "npd": 16, "cplh": 0, "cpld": 0}
+
+        self.submodules.rx = rx = PCIeDLLRX(word_size, state_encoding=state_encoding)
+        self.submodules.tx = tx = ResetInserter()(
+            PCIeDLLTX(word_size, state_encoding=state_encoding))
+        self.submodules.replay = replay = ResetInserter()(
+            PCIeReplayBuffer(replay_depth // dwords, replay_tlps, replay_timeout_cyc, dwords))
+        self.submodules.fc = fc = ResetInserter()(
+            PCIeFlowControl(rx_credits, fc_update_threshold, fc_update_period_cyc,
+                            state_encoding=state_encoding))
+
+        self.dl_up         = fc.dl_up
+        self.tx_tlp        = fc.tx_i
+        self.tx_tlp_ready  = fc.tx_i_ready
+        self.next_transmit_seq = replay.next_transmit_seq
+        self.next_rcv_seq  = Signal(12)
+        self.rx_tlp_accept = Signal()
+        self.rx_tlp_credits = fc.rx_tlp_credits
+        self.rx_fc_release = fc.rx_release
+
+        ###
+
+        self.comb += [
+            rx.i.eq(phy.rx_data),
+            rx.valid.eq(phy.rx_data_valid),
+            phy.tx_data.eq(tx.o),
+            phy.tx_data_hold.eq(tx.hold),
+            tx.ready.eq(phy.tx_data_ready),
+            tx.reset.eq(~phy.link_up),
+            replay.reset.eq(~phy.link_up),
+            fc.reset.eq(~phy.link_up),
+        ]
+
+        # Transmitting TLPs.
+        self.comb += [
+            replay.i.raw_bits().eq(fc.tx_o.raw_bits()),
+            fc.tx_o_ready.eq(replay.i_ready),
+            tx.tlp.raw_bits().eq(replay.o.raw_bits()),
+            tx.tlp_seq.eq(replay.o_seq),
+            replay.o_ready.eq(tx.tlp_ready),
+            replay.ack.eq(rx.dllp.valid & (rx.dllp.type == DLLP_ACK)),
+            replay.nak.eq(rx.dllp.valid & (rx.dllp.type == DLLP_NAK)),
+            replay.ack_seq.eq(rx.dllp.data[0:12]),
+            phy.retrain.eq(replay.retrain),
+        ]
+
+        # Receiving TLPs. A TLP with a sequence number up to 2048 before the expected one is
+        # a duplicate of a TLP that was already accepted.
+        rx_seq_offset = Signal(12)
+        rx_tlp_duplicate = Signal()
+        rx_tlp_bad = Signal()
+        # Flow control only uses the first dword of every TLP, so it is given the first valid
+        # dword of every cycle.
+        self.comb += [
+            If(rx.tlp.valid[n],
+                fc.rx_tlp.valid.eq(1),
+                fc.rx_tlp.data.eq(rx.tlp.data.part(32 * n, 32))
+            ) for n in reversed(range(dwords))
+        ]
+        self.comb += [
+            rx_seq_offset.eq(rx.tlp_seq - self.next_rcv_seq),
+            self.rx_tlp_accept.eq(rx.tlp_end & rx.tlp_good & (rx_seq_offset == 0)),
+            rx_tlp_duplicate.eq(rx.tlp_end & rx.tlp_good & rx_seq_offset[11]),
+            rx_tlp_bad.eq(rx.tlp_end & ~rx.tlp_nullified &
+                          ~self.rx_tlp_accept & ~rx_tlp_duplicate),
+            fc.rx_tlp_end.eq(rx.tlp_end | rx.error),
+            fc.rx_tlp_accept.eq(self.rx_tlp_accept),
+        ]
+
+        # Scheduling ACK and NAK DLLPs. Both acknowledge every TLP up to the last one accepted.
+        # Flow control DLLPs are transmitted whenever no ACK or NAK DLLP is due.
+        ack_valid     = Signal()
+        ack_ready     = Signal()
+        ack_pending   = Signal()
+        ack_count     = Signal(max=ack_coalesce + 1)
+        ack_timer     = Signal(max=ack_latency_cyc + 1)
+        nak_pending   = Signal()
+        nak_scheduled = Signal()
+        self.comb += [
+            ack_valid.eq(nak_pending |
+                         ack_pending & ((ack_count == ack_coalesce) |
+                                        (ack_timer == ack_latency_cyc))),
+            ack_ready.eq(ack_valid & tx.dllp_ready),
+            fc.dllp_rx.raw_bits().eq(rx.dllp.raw_bits()),
+            fc.dllp_tx_ready.eq(~ack_valid & tx.dllp_ready),
+            If(ack_valid,
+                tx.dllp.valid.eq(1),
+                tx.dllp.type.eq(Mux(nak_pending, DLLP_NAK, DLLP_ACK)),
+                tx.dllp.data.eq((self.next_rcv_seq - 1)[0:12])
+            ).Else(
+                tx.dllp.raw_bits().eq(fc.dllp_tx.raw_bits())
+            )
+        ]
+        self.sync += [
+            If(self.rx_tlp_accept,
+                self.next_rcv_seq.eq(self.next_rcv_seq + 1)
+            ),
+            If(ack_ready,
+                nak_pending.eq(0),
+                ack_pending.eq(0),
+                ack_count.eq(0),
+                ack_timer.eq(0)
+            ).Elif(ack_pending & (ack_timer != ack_latency_cyc),
+                ack_timer.eq(ack_timer + 1)
+            ),
+            If(self.rx_tlp_accept,
+                ack_pending.eq(1),
+                If(ack_ready,
+                    ack_count.eq(1)
+                ).Elif(ack_count != ack_coalesce,
+                    ack_count.eq(ack_count + 1)
+                )
+            ).Elif(rx_tlp_duplicate,
+                ack_pending.eq(1),
+                ack_count.eq(ack_coalesce)
+            ),
+            If(self.rx_tlp_accept,
+                nak_scheduled.eq(0)
+            ).Elif(rx_tlp_bad & ~nak_scheduled,
+                nak_scheduled.eq(1),
+                nak_pending.eq(1)
+            ),
+            If(~phy.link_up,
+                self.next_rcv_seq.eq(0),
+                ack_pending.eq(0),
+                ack_count.eq(0),
+                ack_timer.eq(0),
+                nak_pending.eq(0),
+                nak_scheduled.eq(0)
+            )
+        ]
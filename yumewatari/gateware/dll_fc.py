@@ -0,0 +1,374 @@
+from functools import reduce
+from operator import or_
+from migen import *
+
+from .fsm import EncodedFSM
+from .struct import *
+
+
+__all__ = ["PCIeFlowControl"]
+
+
+# Flow control credit types, in the order of the flow control DLLP types.
+_FC_TYPES = ("p", "np", "cpl")
+
+
+class _TLPCredits(Module):
+    """
+    Credit type and number of data credits of a TLP, decoded from its first dword.
+    """
+    def __init__(self, header):
+        self.type = Signal(max=len(_FC_TYPES))
+        self.data = Signal(9)
+
+        ###
+
+        fmt_type = header[0:5]
+        has_data = header[6]
+        length   = Signal(10)
+        self.comb += [
+            length.eq(Cat(header[24:32], header[16:18])),
+            # Memory writes and messages are posted; completions are completions; every other
+            # request is non-posted.
+            If((has_data & (fmt_type == 0b00000)) | (fmt_type[3:5] == 0b10),
+                self.type.eq(_FC_TYPES.index("p"))
+            ).Elif(fmt_type[1:5] == 0b0101,
+                self.type.eq(_FC_TYPES.index("cpl"))
+            ).Else(
+                self.type.eq(_FC_TYPES.index("np"))
+            ),
+            # A length of 0 stands for 1024 dwords.
+            If(has_data,
+                self.data.eq((Cat(length, length == 0) + 3) >> 2)
+            )
+        ]
+
+
+class PCIeFlowControl(Module):
+    """
+    PCIe flow control, for virtual channel 0. Initializes flow control with the link partner,
+    keeps track of the credits for transmitted and received TLPs, and advertises the credits
+    released by the consumer of received TLPs.
+
+    Flow control is initialized by transmitting InitFC1 DLLPs until InitFC1 or InitFC2 DLLPs of
+    every type are received, and then InitFC2 DLLPs until an InitFC2 or UpdateFC DLLP or a TLP
+    is received. Afterwards, the data link layer is up.
+
+    A TLP is only transmitted once the link partner has advertised enough credits for it;
+    until then, the following TLPs are held back as well. The number of cycles a TLP of every
+    type is held back is counted, so that starved credit types can be identified.
+
+    An UpdateFC DLLP is transmitted once the credits of a type released since the last
+    advertisement reach a threshold. A lower threshold keeps the link partner better informed,
+    at the cost of transmitting more DLLPs. Since DLLPs are not replayed, an UpdateFC DLLP is
+    also transmitted for every type without infinite credits if none was transmitted for
+    a period; otherwise, losing the UpdateFC DLLP that follows the link partner running out of
+    credits would stall it forever.
+
+    Parameters
+    ----------
+    rx_credits : dict of str to int
+        Credits advertised for received TLPs, with the keys of ``fc_layout``. Zero stands for
+        infinite credits. At most 127 header credits and 2047 data credits may be advertised.
+    update_threshold : dict of str to int
+        Number of credits of a type that must be released before an UpdateFC DLLP is
+        transmitted, with the keys of ``fc_layout``. Defaults to a quarter of ``rx_credits``.
+    update_period : int
+        Maximum number of cycles between UpdateFC DLLPs of a type without infinite credits.
+    state_encoding : str
+        Encoding of the initialization FSM state; see :class:`EncodedFSM`.
+
+    Attributes
+    ----------
+    dl_up : Signal
+        Output. Asserted once flow control is initialized.
+    tx_i : Record(tlp_layout)
+        Input. Dword of a TLP to transmit, if ``tx_i.valid`` is asserted. Must be held until
+        accepted.
+    tx_i_ready : Signal
+        Output. Strobe. Asserted if ``tx_i`` is accepted.
+    tx_o : Record(tlp_layout)
+        Output. Dword of a TLP to transmit, once the link partner has enough credits for it.
+    tx_o_ready : Signal
+        Input. Strobe. Asserted if ``tx_o`` is accepted.
+    tx_limit : Record(fc_layout)
+        Output. Credits advertised by the link partner (CREDIT_LIMIT).
+    tx_consumed : Record(fc_layout)
+        Output. Credits consumed by transmitted TLPs (CREDITS_CONSUMED).
+    tx_stall_p : Signal(32)
+    tx_stall_np : Signal(32)
+    tx_stall_cpl : Signal(32)
+        Output. Number of cycles a posted request, non-posted request or completion was held
+        back for lack of credits. Saturate.
+    rx_tlp : Record(tlp_layout)
+        Input. Dwords of received TLPs.
+    rx_tlp_end : Signal
+        Input. Strobe. Assert once a TLP is received completely or discarded.
+    rx_tlp_accept : Signal
+        Input. Strobe. Assert once a TLP is accepted.
+    rx_tlp_credits : Record(fc_layout)
+        Output. Credits used by the accepted TLP. Valid while ``rx_tlp_accept`` is asserted.
+    rx_release : Record(fc_layout)
+        Input. Credits released in this cycle by the consumer of received TLPs, e.g. once it
+        has processed a TLP whose credits were indicated by ``rx_tlp_credits``.
+    rx_allocated : Record(fc_layout)
+        Output. Credits allocated for received TLPs (CREDITS_ALLOCATED).
+    dllp_rx : Record(dllp_layout)
+        Input. Received DLLPs.
+    dllp_tx : Record(dllp_layout)
+        Output. Flow control DLLP to transmit, if ``dllp_tx.valid`` is asserted.
+    dllp_tx_ready : Signal
+        Input. Strobe. Asserted if ``dllp_tx`` is accepted.
+    """
+    def __init__(self, rx_credits, update_threshold=None, update_period=7500,
+                 state_encoding="binary"):
+        for name, width in fc_layout:
+            if not 0 <= rx_credits[name] < 2 ** (width - 1):
+                raise ValueError("Advertised {} credits must be between 0 and {}, not {}"
+                                 .format(name.upper(), 2 ** (width - 1) - 1, rx_credits[name]))
+        if update_threshold is None:
+            update_threshold = {name: max(1, credits // 4)
+                                for name, credits in rx_credits.items()}
+
+        self.dl_up        = Signal()
+
+        self.tx_i         = Record(tlp_layout)
+        self.tx_i_ready   = Signal()
+        self.tx_o         = Record(tlp_layout)
+        self.tx_o_ready   = Signal()
+        self.tx_limit     = Record(fc_layout)
+        self.tx_consumed  = Record(fc_layout)
+        self.tx_stall_p   = Signal(32)
+        self.tx_stall_np  = Signal(32)
+        self.tx_stall_cpl = Signal(32)
+
+        self.rx_tlp         = Record(tlp_layout)
+        self.rx_tlp_end     = Signal()
+        self.rx_tlp_accept  = Signal()
+        self.rx_tlp_credits = Record(fc_layout)
+        self.rx_release     = Record(fc_layout)
+        self.rx_allocated   = Record(fc_layout)
+
+        self.dllp_rx       = Record(dllp_layout)
+        self.dllp_tx       = Record(dllp_layout)
+        self.dllp_tx_ready = Signal()
+
+        ###
+
+        def fields(record, fc_type):
+            return getattr(record, fc_type + "h"), getattr(record, fc_type + "d")
+
+        def fc_data(hdr, data):
+            return Cat(data, C(0, 2), hdr)
+
+        # Received flow control DLLPs for virtual channel 0. Bits 4..5 of the type select
+        # the credit type, and bits 6..7 the kind of DLLP.
+        dllp_rx_fc     = Signal(2)
+        dllp_rx_init   = Signal()
+        dllp_rx_update = Signal()
+        dllp_rx_init2  = Signal()
+        self.comb += [
+            dllp_rx_fc.eq(self.dllp_rx.type[4:6]),
+            If(self.dllp_rx.valid & (self.dllp_rx.type[0:4] == 0) & (dllp_rx_fc != 3),
+                dllp_rx_init.eq(self.dllp_rx.type[6]),
+                dllp_rx_init2.eq(self.dllp_rx.type[6:8] == DLLP_INIT_FC2_P >> 6),
+                dllp_rx_update.eq(self.dllp_rx.type[6:8] == DLLP_UPDATE_FC_P >> 6)
+            )
+        ]
+
+        # Initialization. InitFC DLLPs of every type are transmitted in turn, advertising
+        # the same credits in both phases.
+        init_fc   = Signal(2)
+        init_fi1  = Signal(len(_FC_TYPES))
+        init_data = Signal(len(self.dllp_tx.data))
+        self.comb += init_data.eq(Array(
+            fc_data(C(rx_credits[fc_type + "h"], 8), C(rx_credits[fc_type + "d"], 12))
+            for fc_type in _FC_TYPES)[init_fc])
+
+        # Advertising credits; see below.
+        update_due  = Array(Signal(name="update_due_" + fc_type) for fc_type in _FC_TYPES)
+        update_fc   = Signal(2)
+        update_data = Array(Signal(len(self.dllp_tx.data), name="update_data_" + fc_type)
+                            for fc_type in _FC_TYPES)
+        update_sent = Signal()
+        self.comb += update_sent.eq(self.dl_up & self.dllp_tx.valid & self.dllp_tx_ready)
+
+        self.submodules.fsm = EncodedFSM(state_encoding=state_encoding)
+        self.fsm.act("FC_INIT1",
+            self.dllp_tx.valid.eq(1),
+            self.dllp_tx.type.eq(DLLP_INIT_FC1_P | (init_fc << 4)),
+            self.dllp_tx.data.eq(init_data),
+            If(self.dllp_tx_ready,
+                If(init_fc == len(_FC_TYPES) - 1,
+                    NextValue(init_fc, 0),
+                    # Credits of every type were received, and a complete sequence of InitFC1
+                    # DLLPs was transmitted since.
+                    If(init_fi1 == 2 ** len(_FC_TYPES) - 1,
+                        NextState("FC_INIT2")
+                    )
+                ).Else(
+                    NextValue(init_fc, init_fc + 1)
+                )
+            )
+        )
+        self.fsm.act("FC_INIT2",
+            self.dllp_tx.valid.eq(1),
+            self.dllp_tx.type.eq(DLLP_INIT_FC2_P | (init_fc << 4)),
+            self.dllp_tx.data.eq(init_data),
+            If(self.dllp_tx_ready,
+                If(init_fc == len(_FC_TYPES) - 1,
+                    NextValue(init_fc, 0)
+                ).Else(
+                    NextValue(init_fc, init_fc + 1)
+                )
+            ),
+            If(dllp_rx_init2 | dllp_rx_update | self.rx_tlp_accept,
+                NextState("DL_ACTIVE")
+            )
+        )
+        self.fsm.act("DL_ACTIVE",
+            self.dl_up.eq(1),
+            self.dllp_tx.valid.eq(update_due[update_fc]),
+            self.dllp_tx.type.eq(DLLP_UPDATE_FC_P | (update_fc << 4)),
+            self.dllp_tx.data.eq(update_data[update_fc])
+        )
+
+        # Transmitting TLPs. The first dword of a TLP is held back until the link partner has
+        # advertised enough credits for the TLP; the following dwords are passed through.
+        self.submodules.tx_decoder = tx_tlp_credits = _TLPCredits(self.tx_i.data)
+
+        tx_in_tlp    = Signal()
+        tx_credit_ok = Array(Signal(name="tx_credit_ok_" + fc_type) for fc_type in _FC_TYPES)
+        self.comb += [
+            self.tx_o.data.eq(self.tx_i.data),
+            self.tx_o.last.eq(self.tx_i.last),
+            self.tx_o.valid.eq(self.tx_i.valid &
+                               (tx_in_tlp | self.dl_up & tx_credit_ok[tx_tlp_credits.type])),
+            self.tx_i_ready.eq(self.tx_o.valid & self.tx_o_ready),
+        ]
+        self.sync += [
+            If(self.tx_i_ready,
+                tx_in_tlp.eq(~self.tx_i.last)
+            )
+        ]
+
+        tx_stalls = (self.tx_stall_p, self.tx_stall_np, self.tx_stall_cpl)
+        for n, (fc_type, tx_stall) in enumerate(zip(_FC_TYPES, tx_stalls)):
+            limit_hdr,    limit_data    = fields(self.tx_limit, fc_type)
+            consumed_hdr, consumed_data = fields(self.tx_consumed, fc_type)
+            # Credits advertised as zero during initialization are infinite.
+            infinite_hdr  = Signal(name="tx_infinite_{}h".format(fc_type))
+            infinite_data = Signal(name="tx_infinite_{}d".format(fc_type))
+            # Credits that would remain after transmitting the TLP, modulo the counter width.
+            margin_hdr    = Signal(len(limit_hdr),  name="tx_margin_{}h".format(fc_type))
+            margin_data   = Signal(len(limit_data), name="tx_margin_{}d".format(fc_type))
+            tx_start      = Signal(name="tx_start_" + fc_type)
+            self.comb += [
+                tx_start.eq(self.tx_i.valid & ~tx_in_tlp & (tx_tlp_credits.type == n)),
+                margin_hdr.eq(limit_hdr - consumed_hdr - 1),
+                margin_data.eq(limit_data - consumed_data - tx_tlp_credits.data),
+                tx_credit_ok[n].eq(
+                    (infinite_hdr  | (margin_hdr  <= 2 ** (len(margin_hdr)  - 1))) &
+                    (infinite_data | (margin_data <= 2 ** (len(margin_data) - 1)))),
+            ]
+            self.sync += [
+                If(tx_start & self.tx_i_ready,
+                    consumed_hdr.eq(consumed_hdr + 1),
+                    consumed_data.eq(consumed_data + tx_tlp_credits.data)
+                ),
+                If(tx_start & self.dl_up & ~tx_credit_ok[n] &
+                        (tx_stall != 2 ** len(tx_stall) - 1),
+                    tx_stall.eq(tx_stall + 1)
+                ),
+                If(self.dl_up,
+                    If(dllp_rx_update & (dllp_rx_fc == n),
+                        If(~infinite_hdr,
+                            limit_hdr.eq(self.dllp_rx.data[14:22])
+                        ),
+                        If(~infinite_data,
+                            limit_data.eq(self.dllp_rx.data[0:12])
+                        )
+                    )
+                ).Elif(dllp_rx_init & (dllp_rx_fc == n) & ~init_fi1[n],
+                    init_fi1[n].eq(1),
+                    limit_hdr.eq(self.dllp_rx.data[14:22]),
+                    limit_data.eq(self.dllp_rx.data[0:12]),
+                    infinite_hdr.eq(self.dllp_rx.data[14:22] == 0),
+                    infinite_data.eq(self.dllp_rx.data[0:12] == 0)
+                )
+            ]
+
+        # Receiving TLPs. The first dword of every TLP is kept to determine the credits it uses.
+        rx_header = Signal(32)
+        rx_in_tlp = Signal()
+        self.sync += [
+            If(self.rx_tlp_end,
+                rx_in_tlp.eq(0)
+            ).Elif(self.rx_tlp.valid,
+                rx_in_tlp.eq(1),
+                If(~rx_in_tlp,
+                    rx_header.eq(self.rx_tlp.data)
+                )
+            )
+        ]
+        self.submodules.rx_decoder = rx_tlp_credits = _TLPCredits(rx_header)
+
+        # Advertising credits. Credits released by the consumer are allocated at once, but only
+        # advertised by an UpdateFC DLLP once enough of them are released, or once the update
+        # period elapses; if several types are due, posted requests come first, then non-posted
+        # requests, then completions. Infinite credits are never updated.
+        for n, fc_type in reversed(list(enumerate(_FC_TYPES))):
+            release_hdr,   release_data   = fields(self.rx_release, fc_type)
+            allocated_hdr, allocated_data = fields(self.rx_allocated, fc_type)
+            credits_hdr,   credits_data   = fields(self.rx_tlp_credits, fc_type)
+            init_hdr  = rx_credits[fc_type + "h"]
+            init_data = rx_credits[fc_type + "d"]
+            allocated_hdr.reset  = C(init_hdr,  len(allocated_hdr))
+            allocated_data.reset = C(init_data, len(allocated_data))
+
+            self.comb += [
+                If(self.rx_tlp_accept & (rx_tlp_credits.type == n),
+                    credits_hdr.eq(1),
+                    credits_data.eq(rx_tlp_credits.data)
+                ),
+                update_data[n].eq(fc_data(allocated_hdr  if init_hdr  else 0,
+                                          allocated_data if init_data else 0)),
+            ]
+
+            due = []
+            for name, allocated, release in ((fc_type + "h", allocated_hdr,  release_hdr),
+                                             (fc_type + "d", allocated_data, release_data)):
+                if not rx_credits[name]:
+                    continue
+                # Credits advertised last, and released since.
+                advertised = Signal(len(allocated), reset=rx_credits[name],
+                                    name="advertised_" + name)
+                released   = Signal(len(allocated), name="released_" + name)
+                self.comb += released.eq(allocated - advertised)
+                self.sync += [
+                    allocated.eq(allocated + release),
+                    If(update_sent & (update_fc == n),
+                        advertised.eq(allocated)
+                    )
+                ]
+                due.append(released >= update_threshold[name])
+
+            if due:
+                # Cycles until the credits are advertised again regardless of the threshold.
+                period = Signal(max=update_period + 1, reset=update_period,
+                                name="update_period_" + fc_type)
+                self.sync += [
+                    If(update_sent & (update_fc == n),
+                        period.eq(update_period)
+                    ).Elif(self.dl_up & (period != 0),
+                        period.eq(period - 1)
+                    )
+                ]
+                due.append(period == 0)
+
+                self.comb += [
+                    update_due[n].eq(reduce(or_, due)),
+                    If(update_due[n],
+                        update_fc.eq(n)
+                    )
+                ]
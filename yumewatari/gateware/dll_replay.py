@@ -0,0 +1,259 @@
+from migen import *
+
+from .struct import *
+
+
+__all__ = ["PCIeReplayBuffer"]
+
+
+class PCIeReplayBuffer(Module):
+    """
+    PCIe replay buffer. Assigns sequence numbers to TLPs, and stores them until they are
+    acknowledged by the link partner. On a NAK, or if no acknowledgement arrives before
+    REPLAY_TIMER expires, every unacknowledged TLP is transmitted again.
+
+    TLPs are stored in a :class:`Memory`, one beat of ``dwords`` dwords per entry, and
+    the address of the first beat of every TLP is stored in a smaller one, indexed by
+    the sequence number. Dwords are stored one at a time, and are packed into beats so that
+    a wide data path can transmit several of them per cycle. A TLP is only transmitted once it
+    is stored completely, so it is never interrupted by a lack of data.
+    ACK and NAK DLLPs acknowledge every TLP up to their sequence number at once, and the space
+    of these TLPs is freed in a single cycle.
+
+    The buffer must hold at least as many TLPs as can be transmitted in the round trip time of
+    an ACK DLLP, including the time the link partner takes to schedule it; otherwise,
+    the transmitter stalls.
+
+    Parameters
+    ----------
+    depth : int
+        Size of the buffer, in beats. Must be a power of 2.
+    max_tlps : int
+        Maximum number of stored TLPs. Must be a power of 2, and at most 2048.
+    replay_timeout : int
+        REPLAY_TIMER limit, in cycles.
+    dwords : int
+        Number of dwords in a beat.
+
+    Attributes
+    ----------
+    i : Record(tlp_layout)
+        Input. Dword of a TLP to store, if ``i.valid`` is asserted. Must be held until accepted.
+    i_ready : Signal
+        Output. Strobe. Asserted if ``i`` is accepted.
+    o : Record(tlp_dwords_layout(dwords))
+        Output. Beat of a TLP to transmit, if ``o.valid`` is not zero. The valid dwords of a beat
+        start from the first one, and only the last beat of a TLP may have fewer than ``dwords``
+        of them. Once the first beat of a TLP is valid, every following beat up to the last one
+        is valid as well.
+    o_ready : Signal
+        Input. Asserted if ``o`` is accepted.
+    o_seq : Signal(12)
+        Output. Sequence number of the TLP in ``o``.
+    ack : Signal
+        Input. Strobe. Assert if an ACK DLLP is received.
+    nak : Signal
+        Input. Strobe. Assert if a NAK DLLP is received. NAKs that do not refer to a stored TLP
+        or to the last acknowledged one are ignored.
+    ack_seq : Signal(12)
+        Input. Sequence number of the ACK or NAK DLLP.
+    retrain : Signal
+        Output. Strobe. Asserted if REPLAY_NUM rolls over, i.e. if the same TLPs are replayed
+        for the fourth time, in which case the link should be retrained.
+    next_transmit_seq : Signal(12)
+        Output. Sequence number of the next TLP to store.
+    ackd_seq : Signal(12)
+        Output. Sequence number of the last acknowledged TLP.
+    occupancy : Signal(max=depth + 1)
+        Output. Number of stored beats.
+    replay_count : Signal(16)
+        Output. Number of replays, due to NAKs or REPLAY_TIMER expiring. Saturates.
+    """
+    def __init__(self, depth, max_tlps, replay_timeout, dwords=1):
+        if depth & (depth - 1):
+            raise ValueError("Replay buffer depth must be a power of 2, not {}".format(depth))
+        if max_tlps & (max_tlps - 1) or max_tlps > 2048:
+            raise ValueError("Replay buffer TLP count must be a power of 2 no greater than "
+                             "2048, not {}".format(max_tlps))
+
+        self.i       = Record(tlp_layout)
+        self.i_ready = Signal()
+        self.o       = Record(tlp_dwords_layout(dwords))
+        self.o_ready = Signal()
+        self.o_seq   = Signal(12)
+
+        self.ack     = Signal()
+        self.nak     = Signal()
+        self.ack_seq = Signal(12)
+        self.retrain = Signal()
+
+        self.next_transmit_seq = Signal(12)
+        self.ackd_seq          = Signal(12, reset=0xfff)
+        self.occupancy         = Signal(max=depth + 1)
+        self.replay_count      = Signal(16)
+
+        ###
+
+        # Pointers have one more bit than addresses, so that a full buffer can be told apart
+        # from an empty one.
+        ptr_width = log2_int(depth) + 1
+        # First beat of the oldest stored TLP, next beat to store, next beat to transmit.
+        head_ptr  = Signal(ptr_width)
+        write_ptr = Signal(ptr_width)
+        tx_ptr    = Signal(ptr_width)
+        tx_seq    = Signal(12)
+        self.comb += [
+            self.occupancy.eq(write_ptr - head_ptr),
+            self.o_seq.eq(tx_seq),
+        ]
+
+        storage = Memory(width=len(self.o.raw_bits()), depth=depth)
+        self.specials += storage
+
+        starts = Memory(width=ptr_width, depth=max_tlps)
+        self.specials += starts
+
+        # Storing TLPs.
+        wrport = storage.get_port(write_capable=True)
+        self.specials += wrport
+        starts_wrport = starts.get_port(write_capable=True)
+        self.specials += starts_wrport
+
+        # Set while the dwords after the first one of a TLP are being stored.
+        write_in_tlp = Signal()
+        stored_tlps  = Signal(12)
+        # Dwords of the beat being stored, which is written once it is full or the TLP ends.
+        write_beat   = Record(tlp_dwords_layout(dwords))
+        write_data   = Signal(len(write_beat.data))
+        write_index  = Signal(max=max(dwords, 2))
+        self.comb += [
+            stored_tlps.eq(self.next_transmit_seq - self.ackd_seq - 1),
+            self.i_ready.eq(self.i.valid & (self.occupancy != depth) &
+                            (write_in_tlp | (stored_tlps < max_tlps))),
+            write_beat.data.eq(write_data),
+            Case(write_index, {
+                n: [
+                    write_beat.valid.eq((1 << (n + 1)) - 1),
+                    write_beat.data.part(32 * n, 32).eq(self.i.data),
+                ] for n in range(dwords)
+            }),
+            write_beat.last.eq(self.i.last),
+            wrport.adr.eq(write_ptr),
+            wrport.dat_w.eq(write_beat.raw_bits()),
+            wrport.we.eq(self.i_ready & (self.i.last | (write_index == dwords - 1))),
+            starts_wrport.adr.eq(self.next_transmit_seq),
+            starts_wrport.dat_w.eq(write_ptr),
+            starts_wrport.we.eq(self.i_ready & ~write_in_tlp),
+        ]
+        self.sync += [
+            If(self.i_ready,
+                If(wrport.we,
+                    write_ptr.eq(write_ptr + 1),
+                    write_index.eq(0)
+                ).Else(
+                    write_data.eq(write_beat.data),
+                    write_index.eq(write_index + 1)
+                ),
+                write_in_tlp.eq(~self.i.last),
+                If(self.i.last,
+                    self.next_transmit_seq.eq(self.next_transmit_seq + 1)
+                )
+            )
+        ]
+
+        # Purging acknowledged TLPs. The acknowledged sequence number is valid if it is one of
+        # the stored TLPs, or the last acknowledged TLP.
+        starts_rdport = starts.get_port(async_read=True)
+        self.specials += starts_rdport
+
+        ack_offset   = Signal(12)
+        ack_next_seq = Signal(12)
+        ack_progress = Signal()
+        # A NAK with any other sequence number is a Data Link Protocol Error, and is discarded.
+        nak_valid    = Signal()
+        self.comb += [
+            ack_offset.eq(self.ack_seq - self.ackd_seq - 1),
+            ack_next_seq.eq(self.ack_seq + 1),
+            starts_rdport.adr.eq(ack_next_seq),
+            ack_progress.eq((self.ack | self.nak) & (ack_offset < stored_tlps)),
+            nak_valid.eq(self.nak & (ack_progress | (self.ack_seq == self.ackd_seq))),
+        ]
+        self.sync += [
+            If(ack_progress,
+                self.ackd_seq.eq(self.ack_seq),
+                If((ack_next_seq == self.next_transmit_seq) & ~write_in_tlp,
+                    head_ptr.eq(write_ptr)
+                ).Else(
+                    head_ptr.eq(starts_rdport.dat_r)
+                )
+            )
+        ]
+
+        # Transmitting TLPs. The read port always reads the beat at the next value of
+        # ``tx_ptr``, so that its output is the beat at ``tx_ptr``.
+        rdport = storage.get_port()
+        self.specials += rdport
+
+        tx_in_tlp      = Signal()
+        replay_pending = Signal()
+        replay_start   = Signal()
+        replay_num     = Signal(2)
+        replay_timer   = Signal(max=replay_timeout + 1)
+
+        tx_ptr_next = Signal(ptr_width)
+        # Sequence number of the oldest unacknowledged TLP.
+        head_seq    = Signal(12)
+        tx_valid    = Signal()
+        self.comb += [
+            head_seq.eq(self.ackd_seq + 1),
+            tx_valid.eq((tx_in_tlp | ~replay_pending) & (tx_seq != self.next_transmit_seq)),
+            self.o.raw_bits().eq(rdport.dat_r),
+            If(~tx_valid,
+                self.o.valid.eq(0)
+            ),
+            replay_start.eq(replay_pending & ~tx_in_tlp & ~ack_progress),
+            If(replay_start,
+                tx_ptr_next.eq(head_ptr)
+            ).Elif(tx_valid & self.o_ready,
+                tx_ptr_next.eq(tx_ptr + 1)
+            ).Else(
+                tx_ptr_next.eq(tx_ptr)
+            ),
+            rdport.adr.eq(tx_ptr_next),
+        ]
+        self.sync += [
+            tx_ptr.eq(tx_ptr_next),
+            If(replay_start,
+                tx_seq.eq(head_seq)
+            ).Elif(tx_valid & self.o_ready,
+                tx_in_tlp.eq(~self.o.last),
+                If(self.o.last,
+                    tx_seq.eq(tx_seq + 1)
+                )
+            )
+        ]
+
+        # Replaying TLPs. REPLAY_TIMER runs while any transmitted TLP is unacknowledged, and
+        # restarts whenever the link partner acknowledges a TLP or a replay starts.
+        self.comb += self.retrain.eq(replay_start & (replay_num == 3))
+        self.sync += [
+            If(ack_progress | replay_start | ((tx_seq == head_seq) & ~tx_in_tlp),
+                replay_timer.eq(0)
+            ).Elif(replay_timer != replay_timeout,
+                replay_timer.eq(replay_timer + 1)
+            ),
+            # A replay that starts includes the TLPs a NAK received at the same time refers to.
+            If(replay_start,
+                replay_pending.eq(0)
+            ).Elif(nak_valid | (replay_timer == replay_timeout),
+                replay_pending.eq(1)
+            ),
+            If(ack_progress,
+                replay_num.eq(0)
+            ).Elif(replay_start,
+                replay_num.eq(replay_num + 1),
+                If(self.replay_count != 2 ** len(self.replay_count) - 1,
+                    self.replay_count.eq(self.replay_count + 1)
+                )
+            )
+        ]
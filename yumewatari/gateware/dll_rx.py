@@ -0,0 +1,227 @@
+from migen import *
+
+from .serdes import K, D
+from .protocol import *
+from .crc import PCIeCRC, PCIeCRCWord
+from .struct import *
+
+
+__all__ = ["PCIeDLLRX"]
+
+
+class PCIeDLLRX(Module):
+    """
+    PCIe data link layer receiver. Parses DLLPs framed by SDP and END symbols, and checks
+    their CRC. Parses TLPs framed by STP and END or EDB symbols, and checks their sequence
+    number and LCRC. Logical idle and ordered sets between packets are ignored.
+
+    Packets may start in any slot of a word. The LCRC is computed by a chain of byte-wide
+    stages, one per slot, so a whole word of TLP data is processed every cycle. Since it is not
+    known whether a dword of a TLP is the LCRC until the end of the TLP is received, each dword
+    is delivered once the next one is received. A dword received in slots 4n to 4n+3 of a word
+    is delivered as dword n of ``tlp``, so words of more than 4 symbols deliver up to two dwords
+    per cycle.
+
+    At most one packet may end in any word, so the word size is limited to 8 symbols,
+    the length of a DLLP.
+
+    Parameters
+    ----------
+    word_size : int
+        Word size, in symbols.
+    state_encoding : str
+        Encoding of the parser FSM state; see :class:`EncodedFSM`.
+
+    Attributes
+    ----------
+    i : Signal(9 * word_size)
+        Input. Received symbols, with the 9th bit indicating a control symbol.
+    valid : Signal
+        Input. Asserted if ``i`` is valid. The parser is reset while deasserted.
+    error : Signal
+        Output. Asserted if ``i`` violates the framing rules. The TLP being received, if any,
+        is discarded.
+    dllp : Record(dllp_layout)
+        Output. ``dllp.valid`` is a strobe asserted once a DLLP with a valid CRC is received.
+    bad_dllp : Signal
+        Output. Strobe. Asserted once a DLLP with an invalid CRC is received.
+    tlp : Record(tlp_dwords_layout((word_size + 3) // 4))
+        Output. A bit of ``tlp.valid`` is a strobe asserted once the corresponding dword of
+        a TLP is received; the dwords of a TLP are delivered in the order of their index, and
+        any combination of them may be valid. ``tlp.last`` is never asserted; the end of a TLP
+        is indicated by ``tlp_end``.
+    tlp_end : Signal
+        Output. Strobe. Asserted once a TLP is received completely.
+    tlp_seq : Signal(12)
+        Output. Sequence number of the TLP. Valid while ``tlp_end`` is asserted.
+    tlp_good : Signal
+        Output. Asserted if the TLP has a valid LCRC. Valid while ``tlp_end`` is asserted.
+    tlp_nullified : Signal
+        Output. Asserted if the TLP was nullified by the transmitter, i.e. it is terminated
+        by EDB and has an inverted LCRC. Valid while ``tlp_end`` is asserted.
+    """
+    def __init__(self, word_size, state_encoding="binary"):
+        if not 1 <= word_size <= 8:
+            raise ValueError("Word size must be between 1 and 8 symbols, not {}"
+                             .format(word_size))
+
+        self.i        = Signal(9 * word_size)
+        self.valid    = Signal()
+        self.error    = Signal()
+        self.dllp     = Record(dllp_layout)
+        self.bad_dllp = Signal()
+        self.tlp      = Record(tlp_dwords_layout((word_size + 3) // 4))
+        self.tlp_end  = Signal()
+        self.tlp_seq  = Signal(12)
+        self.tlp_good = Signal()
+        self.tlp_nullified = Signal()
+
+        ###
+
+        crc = PCIeCRC(16, 0x100b)
+
+        # Bytes 0..3 of the DLLP, followed by the CRC.
+        dllp_bytes = [Signal(8, name="dllp_byte{}".format(n)) for n in range(6)]
+        dllp_body  = Signal(32)
+        dllp_crc   = Signal(16)
+        body_crc   = Signal(16)
+        self.comb += [body_crc[n].eq(bit)
+                      for n, bit in enumerate(crc.advance_bits(crc.init, dllp_body))]
+
+        self.submodules.parser = Parser(
+            symbol_size=9,
+            word_size=word_size,
+            reset_rule="IDLE",
+            state_encoding=state_encoding,
+            layout=[
+                ("data", 8),
+                ("ctrl", 1),
+            ])
+        self.comb += [
+            self.parser.reset.eq(~self.valid),
+            self.parser.i.eq(self.i),
+            self.error.eq(self.parser.error)
+        ]
+
+        def slot(symbol):
+            return next(n for n, s in enumerate(self.parser._i) if s is symbol)
+
+        lcrc = PCIeCRC(32, 0x04c11db7)
+        self.submodules.lcrc = lcrc_word = PCIeCRCWord(lcrc, word_size)
+        self.comb += lcrc_word.i.eq(Cat(symbol.data for symbol in self.parser._i))
+
+        # Bytes 0..2 of the dword being received, and the last dword received, which is
+        # the LCRC if the TLP ends after it.
+        tlp_seq_hi  = Signal(4)
+        tlp_seq_lo  = Signal(8)
+        tlp_bytes   = [Signal(8, name="tlp_byte{}".format(n)) for n in range(3)]
+        tlp_dword   = Signal(32)
+        tlp_pending = Signal()
+        self.parser.rule(
+            name="IDLE",
+            # Logical idle
+            cond=lambda symbol: symbol.raw_bits() == D(0,0),
+            succ="IDLE"
+        )
+        self.parser.rule(
+            name="IDLE",
+            # COM, SKP, FTS or IDL
+            cond=lambda symbol: (symbol.raw_bits() == K(28,5)) | (symbol.raw_bits() == K(28,0)) |
+                                (symbol.raw_bits() == K(28,1)) | (symbol.raw_bits() == K(28,3)),
+            succ="IDLE"
+        )
+        self.parser.rule(
+            name="IDLE",
+            cond=lambda symbol: symbol.raw_bits() == K(28,2),
+            succ="DLLP-0"
+        )
+        self.parser.rule(
+            name="IDLE",
+            cond=lambda symbol: symbol.raw_bits() == K(27,7),
+            succ="TLP-SEQ-0",
+            action=lambda symbol: [
+                NextMemory(tlp_pending, 0)
+            ]
+        )
+        for n in range(6):
+            self.parser.rule(
+                name="DLLP-%d" % n,
+                cond=lambda symbol: ~symbol.ctrl,
+                succ="DLLP-%d" % (n + 1),
+                action=lambda symbol, n=n: [
+                    NextMemory(dllp_bytes[n], symbol.data)
+                ]
+            )
+        self.parser.rule(
+            name="DLLP-6",
+            cond=lambda symbol: symbol.raw_bits() == K(29,7),
+            succ="IDLE",
+            action=lambda symbol: [
+                dllp_body.eq(Cat(Memory(dllp_bytes[n]) for n in range(4))),
+                dllp_crc.eq(Cat(Memory(dllp_bytes[n]) for n in range(4, 6))),
+                If(dllp_crc == crc.transmit(body_crc),
+                    self.dllp.valid.eq(1),
+                    self.dllp.type.eq(dllp_body[0:8]),
+                    self.dllp.data.eq(Cat(dllp_body[24:32], dllp_body[16:24], dllp_body[8:16]))
+                ).Else(
+                    self.bad_dllp.eq(1)
+                )
+            ]
+        )
+        self.parser.rule(
+            name="TLP-SEQ-0",
+            cond=lambda symbol: ~symbol.ctrl,
+            succ="TLP-SEQ-1",
+            action=lambda symbol: [
+                lcrc_word.start[slot(symbol)].eq(1),
+                lcrc_word.enable[slot(symbol)].eq(1),
+                NextMemory(tlp_seq_hi, symbol.data[0:4])
+            ]
+        )
+        self.parser.rule(
+            name="TLP-SEQ-1",
+            cond=lambda symbol: ~symbol.ctrl,
+            succ="TLP-0",
+            action=lambda symbol: [
+                lcrc_word.enable[slot(symbol)].eq(1),
+                NextMemory(tlp_seq_lo, symbol.data)
+            ]
+        )
+        for n in range(3):
+            self.parser.rule(
+                name="TLP-%d" % n,
+                cond=lambda symbol: ~symbol.ctrl,
+                succ="TLP-%d" % (n + 1),
+                action=lambda symbol, n=n: [
+                    lcrc_word.enable[slot(symbol)].eq(1),
+                    NextMemory(tlp_bytes[n], symbol.data)
+                ]
+            )
+        self.parser.rule(
+            name="TLP-3",
+            cond=lambda symbol: ~symbol.ctrl,
+            succ="TLP-0",
+            action=lambda symbol: [
+                lcrc_word.enable[slot(symbol)].eq(1),
+                If(Memory(tlp_pending),
+                    self.tlp.valid[slot(symbol) // 4].eq(1),
+                    self.tlp.data.part(32 * (slot(symbol) // 4), 32).eq(Memory(tlp_dword))
+                ),
+                NextMemory(tlp_pending, 1),
+                NextMemory(tlp_dword, Cat(*(Memory(tlp_bytes[n]) for n in range(3)),
+                                          symbol.data))
+            ]
+        )
+        for end, nullified in ((K(29,7), 0), (K(30,7), 1)):
+            self.parser.rule(
+                name="TLP-0",
+                cond=lambda symbol, end=end: symbol.raw_bits() == end,
+                succ="IDLE",
+                action=lambda symbol, nullified=nullified: [
+                    self.tlp_end.eq(1),
+                    self.tlp_seq.eq(Cat(Memory(tlp_seq_lo), Memory(tlp_seq_hi))),
+                    If(lcrc_word.values[slot(symbol)] == lcrc.residue(inverted=nullified),
+                        (self.tlp_nullified if nullified else self.tlp_good).eq(1)
+                    )
+                ]
+            )
@@ -0,0 +1,270 @@
+from migen import *
+
+from .serdes import K, D
+from .protocol import *
+from .crc import PCIeCRC, PCIeCRCWord
+from .struct import *
+
+
+__all__ = ["PCIeDLLTX"]
+
+
+class PCIeDLLTX(Module):
+    """
+    PCIe data link layer transmitter. Emits DLLPs framed by SDP and END symbols, with their CRC,
+    TLPs framed by STP and END symbols, with their sequence number and LCRC, or logical idle.
+    DLLPs take priority over TLPs that have not started yet.
+
+    The CRC of a DLLP is computed over all of its bytes in the cycle it is accepted. The LCRC of
+    a TLP is computed by a chain of byte-wide stages, one per slot, so a whole word of TLP data
+    is processed every cycle. The data of a TLP is accepted in beats of as many dwords as fit
+    in a word, rounded up, so that words of more than 4 symbols are filled as well.
+
+    At most one packet may start in any word, so the word size is limited to 8 symbols,
+    the length of a DLLP.
+
+    Parameters
+    ----------
+    word_size : int
+        Word size, in symbols.
+    state_encoding : str
+        Encoding of the emitter FSM state; see :class:`EncodedFSM`.
+
+    Attributes
+    ----------
+    o : Signal(9 * word_size)
+        Output. Symbols to transmit, with the 9th bit indicating a control symbol.
+    ready : Signal
+        Input. Asserted if ``o`` is transmitted in this cycle. The emitter is stopped while
+        deasserted.
+    hold : Signal
+        Output. Asserted if a packet continues in ``o``, and so no ordered set may be inserted
+        before it.
+    dllp : Record(dllp_layout)
+        Input. DLLP to transmit, if ``dllp.valid`` is asserted. Must be held until accepted.
+    dllp_ready : Signal
+        Output. Strobe. Asserted if ``dllp`` is accepted.
+    tlp : Record(tlp_dwords_layout((word_size + 3) // 4))
+        Input. Beat of a TLP to transmit, if ``tlp.valid`` is not zero. Must be held until
+        accepted. The valid dwords of a beat start from the first one, and every dword of
+        a beat but the last one of the TLP, indicated by ``tlp.last``, must be valid. Once
+        the first beat of a TLP is accepted, ``tlp.valid`` must remain not zero until its last
+        beat is accepted.
+    tlp_seq : Signal(12)
+        Input. Sequence number of the TLP. Sampled when its first beat is accepted.
+    tlp_ready : Signal
+        Output. Strobe. Asserted if ``tlp`` is accepted.
+    """
+    def __init__(self, word_size, state_encoding="binary"):
+        if not 1 <= word_size <= 8:
+            raise ValueError("Word size must be between 1 and 8 symbols, not {}"
+                             .format(word_size))
+        dwords = (word_size + 3) // 4
+
+        self.o          = Signal(9 * word_size)
+        self.ready      = Signal()
+        self.hold       = Signal()
+        self.dllp       = Record(dllp_layout)
+        self.dllp_ready = Signal()
+        self.tlp        = Record(tlp_dwords_layout(dwords))
+        self.tlp_seq    = Signal(12)
+        self.tlp_ready  = Signal()
+
+        ###
+
+        crc = PCIeCRC(16, 0x100b)
+
+        # Bytes 0..3 of the DLLP, followed by the CRC.
+        dllp_bytes = [Signal(8, name="dllp_byte{}".format(n)) for n in range(6)]
+        dllp_data  = Cat(self.dllp.data[16:24], self.dllp.data[8:16], self.dllp.data[0:8])
+        dllp_body  = Signal(32)
+        dllp_crc   = Signal(16)
+        self.comb += [
+            dllp_body.eq(Cat(self.dllp.type, dllp_data)),
+            [dllp_crc[n].eq(bit) for n, bit in enumerate(crc.advance_bits(crc.init, dllp_body))]
+        ]
+
+        dllp_start = Signal()
+        self.comb += self.dllp_ready.eq(dllp_start & self.ready)
+
+        self.submodules.emitter = CEInserter()(Emitter(
+            symbol_size=9,
+            word_size=word_size,
+            reset_rule="IDLE",
+            state_encoding=state_encoding,
+            layout=[
+                ("data", 8),
+                ("ctrl", 1),
+            ]))
+        self.comb += [
+            self.emitter.ce.eq(self.ready),
+            self.o.eq(self.emitter.o),
+        ]
+
+        def slot(symbol):
+            return next(n for n, s in enumerate(self.emitter._o) if s is symbol)
+
+        lcrc = PCIeCRC(32, 0x04c11db7)
+        self.submodules.lcrc = lcrc_word = CEInserter()(PCIeCRCWord(lcrc, word_size))
+        self.comb += [
+            lcrc_word.ce.eq(self.ready),
+            lcrc_word.i.eq(Cat(symbol.data for symbol in self.emitter._o)),
+        ]
+
+        # Sequence number and current beat of the TLP, starting with the dword being transmitted,
+        # followed by the LCRC.
+        tlp_seq   = Signal(12)
+        tlp_beat  = Signal(32 * dwords)
+        tlp_valid = Signal(dwords)
+        tlp_last  = Signal()
+        tlp_lcrc  = Signal(32)
+        lcrc_tx   = [Signal(32, name="lcrc_tx{}".format(n)) for n in range(word_size)]
+        self.comb += [lcrc_tx[n].eq(lcrc.transmit(lcrc_word.values[n]))
+                      for n in range(word_size)]
+
+        # Asserted if the dword being transmitted is the last one of the current beat.
+        if dwords == 1:
+            beat_end = lambda: 1
+        else:
+            beat_end = lambda: ~Memory(tlp_valid)[1]
+
+        tlp_next = Signal()
+        self.comb += self.tlp_ready.eq(tlp_next & self.ready)
+        self.emitter.rule(
+            name="IDLE",
+            cond=lambda: self.dllp.valid,
+            succ="DLLP-0",
+            action=lambda symbol: [
+                dllp_start.eq(1),
+                NextValue(self.hold, 1),
+                symbol.raw_bits().eq(K(28,2)),
+                NextMemory(dllp_bytes[0], self.dllp.type),
+                [NextMemory(dllp_bytes[1 + n], dllp_data.part(8 * n, 8)) for n in range(3)],
+                [NextMemory(dllp_bytes[4 + n], crc.transmit(dllp_crc)[8 * n:8 * (n + 1)])
+                 for n in range(2)],
+            ]
+        )
+        self.emitter.rule(
+            name="IDLE",
+            cond=lambda: self.tlp.valid[0] & ~self.dllp.valid,
+            succ="TLP-SEQ-0",
+            action=lambda symbol: [
+                tlp_next.eq(1),
+                NextValue(self.hold, 1),
+                symbol.raw_bits().eq(K(27,7)),
+                NextMemory(tlp_seq, self.tlp_seq),
+                NextMemory(tlp_beat, self.tlp.data),
+                NextMemory(tlp_valid, self.tlp.valid),
+                NextMemory(tlp_last, self.tlp.last),
+            ]
+        )
+        # Logical idle. With words of more than 4 symbols, a packet can end in the middle of
+        # a word, and the rest of the word is idle.
+        self.emitter.rule(
+            name="IDLE",
+            cond=lambda: ~self.tlp.valid[0] & ~self.dllp.valid,
+            succ="IDLE",
+            action=lambda symbol: [
+                symbol.raw_bits().eq(0)
+            ]
+        )
+        for n in range(6):
+            self.emitter.rule(
+                name="DLLP-%d" % n,
+                succ="DLLP-%d" % (n + 1),
+                action=lambda symbol, n=n: [
+                    symbol.data.eq(Memory(dllp_bytes[n]))
+                ]
+            )
+        self.emitter.rule(
+            name="DLLP-6",
+            succ="IDLE",
+            action=lambda symbol: [
+                NextValue(self.hold, 0),
+                symbol.raw_bits().eq(K(29,7))
+            ]
+        )
+        self.emitter.rule(
+            name="TLP-SEQ-0",
+            succ="TLP-SEQ-1",
+            action=lambda symbol: [
+                lcrc_word.start[slot(symbol)].eq(1),
+                lcrc_word.enable[slot(symbol)].eq(1),
+                symbol.data.eq(Memory(tlp_seq)[8:12])
+            ]
+        )
+        self.emitter.rule(
+            name="TLP-SEQ-1",
+            succ="TLP-0",
+            action=lambda symbol: [
+                lcrc_word.enable[slot(symbol)].eq(1),
+                symbol.data.eq(Memory(tlp_seq)[0:8])
+            ]
+        )
+        for n in range(3):
+            self.emitter.rule(
+                name="TLP-%d" % n,
+                succ="TLP-%d" % (n + 1),
+                action=lambda symbol, n=n: [
+                    lcrc_word.enable[slot(symbol)].eq(1),
+                    symbol.data.eq(Memory(tlp_beat)[8 * n:8 * (n + 1)])
+                ]
+            )
+        if dwords > 1:
+            self.emitter.rule(
+                name="TLP-3",
+                cond=lambda: ~beat_end(),
+                succ="TLP-0",
+                action=lambda symbol: [
+                    lcrc_word.enable[slot(symbol)].eq(1),
+                    symbol.data.eq(Memory(tlp_beat)[24:32]),
+                    NextMemory(tlp_beat, Memory(tlp_beat)[32:]),
+                    NextMemory(tlp_valid, Memory(tlp_valid)[1:]),
+                ]
+            )
+        self.emitter.rule(
+            name="TLP-3",
+            cond=lambda: beat_end() & ~Memory(tlp_last),
+            succ="TLP-0",
+            action=lambda symbol: [
+                lcrc_word.enable[slot(symbol)].eq(1),
+                symbol.data.eq(Memory(tlp_beat)[24:32]),
+                tlp_next.eq(1),
+                NextMemory(tlp_beat, self.tlp.data),
+                NextMemory(tlp_valid, self.tlp.valid),
+                NextMemory(tlp_last, self.tlp.last),
+            ]
+        )
+        self.emitter.rule(
+            name="TLP-3",
+            cond=lambda: beat_end() & Memory(tlp_last),
+            succ="LCRC-0",
+            action=lambda symbol: [
+                lcrc_word.enable[slot(symbol)].eq(1),
+                symbol.data.eq(Memory(tlp_beat)[24:32])
+            ]
+        )
+        self.emitter.rule(
+            name="LCRC-0",
+            succ="LCRC-1",
+            action=lambda symbol: [
+                symbol.data.eq(lcrc_tx[slot(symbol)][0:8]),
+                NextMemory(tlp_lcrc, lcrc_tx[slot(symbol)])
+            ]
+        )
+        for n in range(1, 4):
+            self.emitter.rule(
+                name="LCRC-%d" % n,
+                succ="LCRC-%d" % (n + 1),
+                action=lambda symbol, n=n: [
+                    symbol.data.eq(Memory(tlp_lcrc)[8 * n:8 * (n + 1)])
+                ]
+            )
+        self.emitter.rule(
+            name="LCRC-4",
+            succ="IDLE",
+            action=lambda symbol: [
+                NextValue(self.hold, 0),
+                symbol.raw_bits().eq(K(29,7))
+            ]
+        )
@@ -0,0 +1,552 @@
+from functools import reduce
+from operator import or_
+from migen import *
+from migen.genlib.fifo import SyncFIFO
+
+from .struct import *
+from .tlp import *
+
+
+__all__ = ["PCIeDMAEngine"]
+
+
+class PCIeDMAEngine(Module):
+    """
+    PCIe bus master DMA engine. Copies data between host memory and a Wishbone bus, as
+    described by a ring of descriptors in host memory.
+
+    A descriptor is 16 bytes long, and consists of four dwords:
+
+      * host address, bits 0..31; must be dword aligned;
+      * host address, bits 32..63;
+      * word address on the bus;
+      * control: length in dwords in bits 0..15, direction in bit 30 (deasserted to copy from
+        host memory to the bus, asserted to copy from the bus to host memory). Bit 31 must be
+        deasserted by the host; once the descriptor is processed, the engine writes the control
+        dword back with bit 31 asserted, and bit 29 asserted if a read from host memory was not
+        completed successfully, or not completed within ``cpl_timeout`` cycles.
+
+    The host adds descriptors to the ring by advancing ``head``, and the engine processes them
+    one at a time and advances ``tail``; the ring is empty if ``head`` is equal to ``tail``.
+    Descriptors are only fetched while ``enable`` and the Bus Master Enable bit of
+    the configuration space are asserted.
+
+    Reads from host memory are split into MRd requests of at most Max_Read_Request_Size, and
+    writes into MWr requests of at most Max_Payload_Size; no request crosses a 4 KiB boundary.
+    Up to ``max_tags`` MRd requests are outstanding at once, each with its own tag and its own
+    slot in the completion buffer, so that completions are accepted in any order; the data of
+    each request is written to the bus once every completion for it is received, in the order
+    the requests were made. Descriptors are fetched with the same MRd requests.
+
+    The requests must be merged into the transmitted TLPs by the transaction layer, and
+    the completions for them routed to the engine.
+
+    Parameters
+    ----------
+    cfg : PCIeConfigSpace
+        Configuration space that provides the requester ID and the negotiated limits.
+    max_tags : int
+        Maximum number of outstanding MRd requests.
+    max_payload : int
+        Maximum size of MWr requests, in bytes, regardless of Max_Payload_Size.
+    max_read_request : int
+        Maximum size of MRd requests, in bytes, regardless of Max_Read_Request_Size.
+        Also the size of a slot in the completion buffer.
+    cpl_timeout : int
+        Number of cycles after which an MRd request that is not completed fails. The PCIe
+        specification requires between 50 us and 50 ms.
+
+    Attributes
+    ----------
+    o : Record(tlp_layout)
+        Output. Dword of a memory request, if ``o.valid`` is asserted.
+    o_ready : Signal
+        Input. Strobe. Assert if ``o`` is accepted.
+    i : Record(tlp_layout)
+        Input. Dword of a completion, if ``i.valid`` is asserted. Must be held until accepted.
+    i_ready : Signal
+        Output. Strobe. Asserted if ``i`` is accepted.
+    bus : Record(wishbone_layout)
+        Wishbone bus master.
+    enable : Signal
+        Input. Assert to process descriptors.
+    ring_base : Signal(64)
+        Input. Address of the descriptor ring. Must be 16 byte aligned.
+    ring_size : Signal(16)
+        Input. Number of descriptors in the ring.
+    head : Signal(16)
+        Input. Index of the descriptor after the last one added by the host.
+    tail : Signal(16)
+        Output. Index of the descriptor after the last one processed by the engine.
+    busy : Signal
+        Output. Asserted while a descriptor is processed.
+    done : Signal
+        Output. Strobe. Asserted once a descriptor is processed, e.g. to request an interrupt.
+    desc_count : Signal(32)
+        Output. Number of processed descriptors. Wraps around.
+    read_dwords : Signal(32)
+        Output. Number of dwords copied from host memory. Wraps around.
+    write_dwords : Signal(32)
+        Output. Number of dwords copied to host memory. Wraps around.
+    cpl_error_count : Signal(32)
+        Output. Number of completions with an unsuccessful status, or that do not match
+        an outstanding request, and of MRd requests that timed out. Wraps around.
+    """
+    def __init__(self, cfg, max_tags=4, max_payload=128, max_read_request=512,
+                 cpl_timeout=65536):
+        sizes = [128 << n for n in range(6)]
+        if max_payload not in sizes:
+            raise ValueError("Max payload size must be a power of 2 between 128 and 4096, "
+                             "not {}".format(max_payload))
+        if max_read_request not in sizes:
+            raise ValueError("Max read request size must be a power of 2 between 128 and 4096, "
+                             "not {}".format(max_read_request))
+        if not 1 <= max_tags <= 256:
+            raise ValueError("Number of tags must be between 1 and 256, not {}"
+                             .format(max_tags))
+
+        self.o       = Record(tlp_layout)
+        self.o_ready = Signal()
+        self.i       = Record(tlp_layout)
+        self.i_ready = Signal()
+        self.bus     = Record(wishbone_layout)
+
+        self.enable    = Signal()
+        self.ring_base = Signal(64)
+        self.ring_size = Signal(16)
+        self.head      = Signal(16)
+        self.tail      = Signal(16)
+        self.busy      = Signal()
+        self.done      = Signal()
+
+        self.desc_count      = Signal(32)
+        self.read_dwords     = Signal(32)
+        self.write_dwords    = Signal(32)
+        self.cpl_error_count = Signal(32)
+
+        ###
+
+        slot_dwords    = max_read_request // 4
+        payload_dwords = max_payload // 4
+
+        def succ(value, limit):
+            return Mux(value == limit - 1, 0, value + 1)
+
+        # Current descriptor, and progress through it.
+        desc_host    = Signal(64)
+        desc_local   = Signal(30)
+        desc_control = Signal(32)
+        desc_error   = Signal()
+        host_adr     = Signal(64)
+        local_adr    = Signal(30)
+        remaining    = Signal(16)
+        to_host      = Signal()
+        self.comb += to_host.eq(desc_control[30])
+
+        # Current request. Descriptors are fetched with MRd requests, and written back with
+        # MWr requests carrying the status.
+        tx_adr    = Signal(64)
+        tx_len    = Signal(11)
+        tx_write  = Signal()
+        tx_desc   = Signal()
+        tx_status = Signal()
+
+        # Requests are at most as long as the negotiated limits, and end at a 4 KiB boundary.
+        mps_dwords  = Signal(11)
+        mrrs_dwords = Signal(11)
+        boundary    = Signal(11)
+        limit       = Signal(11)
+        limit_len   = Signal(11)
+        chunk_len   = Signal(11)
+        self.comb += [
+            Case(cfg.max_payload_size, {
+                n: mps_dwords.eq(min(32 << min(n, 5), payload_dwords)) for n in range(8)
+            }),
+            Case(cfg.max_read_request_size, {
+                n: mrrs_dwords.eq(min(32 << min(n, 5), slot_dwords)) for n in range(8)
+            }),
+            boundary.eq(1024 - host_adr[2:12]),
+            limit.eq(Mux(to_host, mps_dwords, mrrs_dwords)),
+            limit_len.eq(Mux(remaining < limit, remaining, limit)),
+            chunk_len.eq(Mux(boundary < limit_len, boundary, limit_len)),
+        ]
+
+        # Tags. Tags are allocated and freed in order; a tag is complete once every dword of
+        # data for it is received, or an unsuccessful completion is received, or it times out.
+        tag_bits      = max(bits_for(max_tags - 1), 1)
+        tag_length    = Array(Signal(max=slot_dwords + 1, name="tag{}_length".format(n))
+                              for n in range(max_tags))
+        tag_remaining = Array(Signal(max=slot_dwords + 1, name="tag{}_remaining".format(n))
+                              for n in range(max_tags))
+        tag_local     = Array(Signal(30, name="tag{}_local".format(n))
+                              for n in range(max_tags))
+        tag_desc      = Array(Signal(name="tag{}_desc".format(n))
+                              for n in range(max_tags))
+        tag_error     = Array(Signal(name="tag{}_error".format(n))
+                              for n in range(max_tags))
+        tag_timer     = [Signal(max=cpl_timeout + 1, name="tag{}_timer".format(n))
+                         for n in range(max_tags)]
+        alloc_tag     = Signal(tag_bits)
+        drain_tag     = Signal(tag_bits)
+        inflight      = Signal(max=max_tags + 1)
+        tag_alloc     = Signal()
+        tag_free      = Signal()
+        self.sync += [
+            If(tag_alloc & ~tag_free,
+                inflight.eq(inflight + 1)
+            ).Elif(~tag_alloc & tag_free,
+                inflight.eq(inflight - 1)
+            ),
+            If(tag_free,
+                drain_tag.eq(succ(drain_tag, max_tags))
+            )
+        ]
+
+        self.specials.buffer = Memory(width=32, depth=max_tags * slot_dwords)
+        buf_w = self.buffer.get_port(write_capable=True)
+        buf_r = self.buffer.get_port(async_read=True)
+        self.specials += buf_w, buf_r
+
+        # Receiving completions. Completions are never stalled, since every outstanding request
+        # has room for all of its data.
+        rx_dword      = Signal(2)
+        rx_data       = Signal()
+        rx_write      = Signal()
+        rx_cpl        = Signal()
+        rx_sc         = Signal()
+        rx_byte_count = Signal(12)
+        rx_tag        = Signal(tag_bits)
+        rx_offset     = Signal(max=slot_dwords)
+        cpl_header    = Signal()
+        cpl_tag       = Signal(8)
+        cpl_hit       = Signal()
+        cpl_error     = Signal()
+        cpl_expired   = Signal()
+        self.comb += [
+            self.i_ready.eq(self.i.valid),
+            cpl_header.eq(self.i.valid & ~rx_data & (rx_dword == 2)),
+            cpl_error.eq(cpl_header & (~cpl_hit | ~rx_sc)),
+            cpl_tag.eq(self.i.data[16:24]),
+            cpl_hit.eq(rx_cpl & (cpl_tag < max_tags) & (tag_remaining[cpl_tag] != 0)),
+            buf_w.adr.eq(Cat(rx_offset, rx_tag)),
+            buf_w.dat_w.eq(self.i.data),
+            buf_w.we.eq(self.i.valid & rx_data & rx_write),
+        ]
+        self.sync += [
+            If(self.i.valid & rx_data,
+                rx_offset.eq(rx_offset + 1),
+                If(rx_write,
+                    tag_remaining[rx_tag].eq(tag_remaining[rx_tag] - 1)
+                ),
+                If(self.i.last,
+                    rx_data.eq(0)
+                )
+            ).Elif(self.i.valid,
+                rx_dword.eq(rx_dword + 1),
+                Case(rx_dword, {
+                    0: rx_cpl.eq((self.i.data[0:8] == TLP_CPL) | (self.i.data[0:8] == TLP_CPLD)),
+                    1: [
+                        rx_sc.eq(self.i.data[21:24] == CPL_SC),
+                        rx_byte_count.eq(Cat(self.i.data[24:32], self.i.data[16:20])),
+                    ],
+                    2: [
+                        rx_dword.eq(0),
+                        rx_data.eq(~self.i.last),
+                        rx_write.eq(cpl_hit & rx_sc),
+                        rx_tag.eq(cpl_tag),
+                        # The byte count is the number of bytes remaining, up to 4096.
+                        rx_offset.eq(tag_length[cpl_tag] -
+                                     Cat(rx_byte_count[2:12], rx_byte_count == 0)),
+                        If(cpl_hit & ~rx_sc,
+                            tag_remaining[cpl_tag].eq(0),
+                            tag_error[cpl_tag].eq(1)
+                        )
+                    ]
+                })
+            ),
+            If(tag_alloc,
+                alloc_tag.eq(succ(alloc_tag, max_tags)),
+                tag_length[alloc_tag].eq(tx_len),
+                tag_remaining[alloc_tag].eq(tx_len),
+                tag_local[alloc_tag].eq(local_adr),
+                tag_desc[alloc_tag].eq(tx_desc),
+                tag_error[alloc_tag].eq(0)
+            )
+        ]
+
+        # Timing out requests. A request that is not complete once its timer expires fails as
+        # if an unsuccessful completion was received, and the rest of a completion for it that is
+        # being received is discarded.
+        tag_expired = [Signal(name="tag{}_expired".format(n)) for n in range(max_tags)]
+        for n in range(max_tags):
+            self.comb += tag_expired[n].eq((tag_timer[n] == 0) & (tag_remaining[n] != 0))
+            self.sync += [
+                If(tag_alloc & (alloc_tag == n),
+                    tag_timer[n].eq(cpl_timeout)
+                ).Elif(tag_timer[n] != 0,
+                    tag_timer[n].eq(tag_timer[n] - 1)
+                ),
+                If(tag_expired[n],
+                    tag_remaining[n].eq(0),
+                    tag_error[n].eq(1),
+                    If(Mux(cpl_header, cpl_tag, rx_tag) == n,
+                        rx_write.eq(0)
+                    )
+                )
+            ]
+        # Requests are allocated one per cycle, so at most one of them expires in every cycle.
+        self.comb += cpl_expired.eq(reduce(or_, tag_expired))
+        self.sync += [
+            If(cpl_error | cpl_expired,
+                self.cpl_error_count.eq(self.cpl_error_count + cpl_error + cpl_expired)
+            )
+        ]
+
+        # Writing the data of complete tags to the bus, or into the descriptor registers.
+        drain_stb   = Signal()
+        drain_n     = Signal(max=slot_dwords)
+        drain_error = Signal()
+        desc_load   = Signal()
+        desc_start  = Signal()
+        bus_issue   = Signal()
+        self.comb += buf_r.adr.eq(Cat(drain_n, drain_tag))
+
+        self.submodules.drain = FSM()
+        self.drain.act("IDLE",
+            If((inflight != 0) & (tag_remaining[drain_tag] == 0),
+                NextValue(drain_n, 0),
+                If(tag_error[drain_tag],
+                    drain_error.eq(1),
+                    tag_free.eq(1)
+                ).Elif(tag_desc[drain_tag],
+                    NextState("DESCRIPTOR")
+                ).Else(
+                    NextState("WRITE")
+                )
+            )
+        )
+        self.drain.act("WRITE",
+            drain_stb.eq(1),
+            If(bus_issue,
+                NextValue(drain_n, drain_n + 1),
+                NextValue(self.read_dwords, self.read_dwords + 1),
+                If(drain_n == tag_length[drain_tag] - 1,
+                    tag_free.eq(1),
+                    NextState("IDLE")
+                )
+            )
+        )
+        self.drain.act("DESCRIPTOR",
+            desc_load.eq(1),
+            NextValue(drain_n, drain_n + 1),
+            If(drain_n == 3,
+                tag_free.eq(1),
+                NextState("IDLE")
+            )
+        )
+        self.sync += [
+            If(desc_start,
+                desc_control.eq(0),
+                desc_error.eq(0)
+            ).Elif(desc_load,
+                Case(drain_n, {
+                    0: desc_host[0:32].eq(buf_r.dat_r),
+                    1: desc_host[32:64].eq(buf_r.dat_r),
+                    2: desc_local.eq(buf_r.dat_r),
+                    3: desc_control.eq(buf_r.dat_r),
+                })
+            ).Elif(drain_error,
+                desc_error.eq(1)
+            )
+        ]
+
+        # Reading the data of MWr requests from the bus. Every dword of a request is read
+        # before it is transmitted.
+        self.submodules.payload = payload = SyncFIFO(32, payload_dwords)
+        fetch_stb   = Signal()
+        fetch_count = Signal(11)
+        fetching    = Signal()
+        bus_pending = Signal(16)
+        self.comb += [
+            self.bus.stb.eq(drain_stb | fetch_stb),
+            bus_issue.eq(self.bus.stb & ~self.bus.stall),
+            self.bus.cyc.eq(self.bus.stb | (bus_pending != 0)),
+            self.bus.sel.eq(0b1111),
+            If(drain_stb,
+                self.bus.we.eq(1),
+                self.bus.adr.eq(tag_local[drain_tag] + drain_n),
+                self.bus.dat_w.eq(buf_r.dat_r)
+            ).Else(
+                self.bus.adr.eq(local_adr + fetch_count)
+            ),
+            payload.din.eq(self.bus.dat_r),
+            payload.we.eq(self.bus.ack & fetching),
+        ]
+        self.sync += [
+            If(bus_issue & ~self.bus.ack,
+                bus_pending.eq(bus_pending + 1)
+            ).Elif(~bus_issue & self.bus.ack,
+                bus_pending.eq(bus_pending - 1)
+            ),
+            If(fetch_stb & bus_issue,
+                fetch_count.eq(fetch_count + 1)
+            )
+        ]
+
+        # Transmitting requests.
+        tx_count  = Signal(11)
+        tx_64     = Signal()
+        desc_adr  = Signal(64)
+        tail_succ = Signal(16)
+        self.comb += [
+            tx_64.eq(tx_adr[32:64] != 0),
+            desc_adr.eq(self.ring_base + Cat(C(0, 4), self.tail)),
+            tail_succ.eq(self.tail + 1),
+        ]
+
+        def advance():
+            return [
+                NextValue(host_adr, host_adr + (tx_len << 2)),
+                NextValue(local_adr, local_adr + tx_len),
+                NextValue(remaining, remaining - tx_len),
+            ]
+
+        self.submodules.fsm = FSM()
+        self.comb += self.busy.eq(~self.fsm.ongoing("IDLE"))
+        self.fsm.act("IDLE",
+            If(self.enable & cfg.bus_master_enable & (self.head != self.tail),
+                desc_start.eq(1),
+                NextValue(tx_adr, desc_adr),
+                NextValue(tx_len, 4),
+                NextValue(tx_write, 0),
+                NextValue(tx_desc, 1),
+                NextState("HEADER-0")
+            )
+        )
+        self.fsm.act("DESCRIPTOR-WAIT",
+            If(inflight == 0,
+                NextValue(host_adr, desc_host),
+                NextValue(local_adr, desc_local),
+                NextValue(remaining, desc_control[0:16]),
+                NextValue(tx_desc, 0),
+                If(desc_error,
+                    NextState("FLUSH")
+                ).Elif(desc_control[30],
+                    NextState("WRITE")
+                ).Else(
+                    NextState("READ")
+                )
+            )
+        )
+        self.fsm.act("READ",
+            If(remaining == 0,
+                NextState("FLUSH")
+            ).Elif(inflight != max_tags,
+                NextValue(tx_adr, host_adr),
+                NextValue(tx_len, chunk_len),
+                NextState("HEADER-0")
+            )
+        )
+        self.fsm.act("WRITE",
+            If(remaining == 0,
+                NextState("FLUSH")
+            ).Else(
+                NextValue(tx_adr, host_adr),
+                NextValue(tx_len, chunk_len),
+                NextValue(tx_write, 1),
+                NextValue(fetch_count, 0),
+                NextState("FETCH")
+            )
+        )
+        self.fsm.act("FETCH",
+            fetching.eq(1),
+            fetch_stb.eq(fetch_count != tx_len),
+            If(payload.level == tx_len,
+                NextState("HEADER-0")
+            )
+        )
+        self.fsm.act("HEADER-0",
+            self.o.valid.eq(1),
+            self.o.data.eq(tlp_dw0(Mux(tx_write, Mux(tx_64, TLP_MWR64, TLP_MWR32),
+                                                 Mux(tx_64, TLP_MRD64, TLP_MRD32)),
+                                   tx_len)),
+            If(self.o_ready,
+                NextValue(tx_count, tx_len),
+                NextState("HEADER-1")
+            )
+        )
+        self.fsm.act("HEADER-1",
+            self.o.valid.eq(1),
+            self.o.data.eq(tlp_req_dw1(cfg.id, Mux(tx_write, 0, alloc_tag),
+                                       0b1111, Mux(tx_len == 1, 0, 0b1111))),
+            If(self.o_ready,
+                If(tx_64,
+                    NextState("HEADER-2")
+                ).Else(
+                    NextState("HEADER-3")
+                )
+            )
+        )
+        self.fsm.act("HEADER-2",
+            self.o.valid.eq(1),
+            self.o.data.eq(tlp_address_dw(tx_adr[32:64])),
+            If(self.o_ready,
+                NextState("HEADER-3")
+            )
+        )
+        self.fsm.act("HEADER-3",
+            self.o.valid.eq(1),
+            self.o.data.eq(tlp_address_dw(tx_adr[0:32])),
+            self.o.last.eq(~tx_write),
+            If(self.o_ready,
+                If(tx_write,
+                    NextState("DATA")
+                ).Else(
+                    tag_alloc.eq(1),
+                    If(tx_desc,
+                        NextState("DESCRIPTOR-WAIT")
+                    ).Else(
+                        advance(),
+                        NextState("READ")
+                    )
+                )
+            )
+        )
+        self.fsm.act("DATA",
+            self.o.valid.eq(tx_status | payload.readable),
+            self.o.data.eq(Mux(tx_status,
+                               Cat(desc_control[0:29], desc_error, desc_control[30], C(1, 1)),
+                               payload.dout)),
+            self.o.last.eq(tx_count == 1),
+            payload.re.eq(self.o_ready & ~tx_status),
+            If(self.o_ready & self.o.valid,
+                NextValue(tx_count, tx_count - 1),
+                If(~tx_status,
+                    NextValue(self.write_dwords, self.write_dwords + 1)
+                ),
+                If(tx_count == 1,
+                    If(tx_status,
+                        NextState("NEXT")
+                    ).Else(
+                        advance(),
+                        NextState("WRITE")
+                    )
+                )
+            )
+        )
+        self.fsm.act("FLUSH",
+            If((inflight == 0) & (bus_pending == 0) & self.drain.ongoing("IDLE"),
+                NextValue(tx_adr, desc_adr + 12),
+                NextValue(tx_len, 1),
+                NextValue(tx_write, 1),
+                NextValue(tx_status, 1),
+                NextState("HEADER-0")
+            )
+        )
+        self.fsm.act("NEXT",
+            self.done.eq(1),
+            NextValue(tx_status, 0),
+            NextValue(self.tail, Mux(tail_succ == self.ring_size, 0, tail_succ)),
+            NextValue(self.desc_count, self.desc_count + 1),
+            NextState("IDLE")
+        )
@@ -0,0 +1,103 @@
+from migen import *
+from migen.genlib.fsm import FSM
+
+
+__all__ = ["EncodedFSM"]
+
+
+class EncodedFSM(FSM):
+    """
+    Finite state machine with a selectable state encoding.
+
+    The ``encoding`` and ``decoding`` attributes map states to values of the ``state`` signal
+    and back regardless of the chosen encoding, so e.g. a log of ``state`` values can always be
+    decoded using ``decoding``.
+
+    Parameters
+    ----------
+    reset_state
+        Reset state. Defaults to the first added state.
+    state_encoding : str
+        ``"binary"`` (default) numbers the states sequentially. ``"gray"`` numbers the states
+        using a Gray code. ``"one-hot"`` assigns a separate bit of ``state`` to each state, which
+        uses more flip-flops but makes state decoding a single bit test.
+    """
+    def __init__(self, reset_state=None, state_encoding="binary"):
+        if state_encoding not in ("binary", "gray", "one-hot"):
+            raise ValueError("State encoding must be one of 'binary', 'gray' or 'one-hot', "
+                             "not {!r}".format(state_encoding))
+
+        super().__init__(reset_state)
+        self.state_encoding = state_encoding
+
+    def _get_encoding(self):
+        encoding = {}
+        for n, state in enumerate(self.actions.keys()):
+            if self.state_encoding == "binary":
+                encoding[state] = n
+            elif self.state_encoding == "gray":
+                encoding[state] = n ^ (n >> 1)
+            elif self.state_encoding == "one-hot":
+                encoding[state] = 1 << n
+        return encoding
+
+    def state_width(self):
+        """
+        Width of the ``state`` signal. May only be called once all states have been added.
+        """
+        if self.state_encoding == "one-hot":
+            return len(self.actions)
+        else:
+            return bits_for(max(len(self.actions) - 1, 0))
+
+    def _is_state(self, value, state):
+        encoded = self.encoding[state]
+        if self.state_encoding == "one-hot":
+            return value[log2_int(encoded)]
+        else:
+            return value == encoded
+
+    def do_finalize(self):
+        self.encoding = self._get_encoding()
+        self.decoding = {n: s for s, n in self.encoding.items()}
+
+        self.state = Signal(self.state_width(), reset=self.encoding[self.reset_state])
+        self.state._enumeration = self.decoding
+        self.next_state = Signal(self.state_width(), reset=self.encoding[self.reset_state])
+        self.next_state._enumeration = {n: "{}:{}".format(n, s) for n, s in self.decoding.items()}
+
+        # drive entering/leaving signals
+        for state, signal in self.before_leaving_signals.items():
+            self.comb += signal.eq(self._is_state(self.state, state) &
+                                   ~self._is_state(self.next_state, state))
+        if self.reset_state in self.after_entering_signals:
+            self.after_entering_signals[self.reset_state].reset = 1
+        for state, signal in self.before_entering_signals.items():
+            self.comb += signal.eq(~self._is_state(self.state, state) &
+                                   self._is_state(self.next_state, state))
+
+        # Allow overriding and extending control functionality (Next*) in subclasses.
+        self._finalize_sync(self._lower_controls())
+
+    def _get_state_cases(self, ls):
+        if self.state_encoding == "one-hot":
+            # Exactly one bit of the state register is set, so the actions of every state can
+            # be selected by that bit alone.
+            return [
+                If(self._is_state(self.state, state), ls.visit(actions))
+                for state, actions in self.actions.items() if actions
+            ]
+        else:
+            cases = dict((self.encoding[k], ls.visit(v)) for k, v in self.actions.items() if v)
+            return [
+                Case(self.state, cases).makedefault(self.encoding[self.reset_state])
+            ]
+
+    def _finalize_sync(self, ls):
+        self.comb += [
+            self.next_state.eq(self.state),
+            *self._get_state_cases(ls)
+        ]
+        self.sync += self.state.eq(self.next_state)
+        for register, next_value_ce, next_value in ls.registers:
+            self.sync += If(next_value_ce, register.eq(next_value))
@@ -0,0 +1,371 @@
+from migen import *
+from migen.genlib.fifo import SyncFIFO
+
+from .struct import *
+from .tlp import *
+
+
+__all__ = ["PCIeMMIOBridge"]
+
+
+_read_layout = [
+    ("adr",        30),
+    ("length",     11), # in dwords
+    ("byte_count", 12),
+    ("lower_adr",   7),
+    ("requester",  16),
+    ("tag",         8),
+    ("tc",          3),
+    ("attr",        2),
+    ("ur",          1),
+    ("timestamp",  16),
+]
+
+
+class PCIeMMIOBridge(Module):
+    """
+    PCIe memory mapped completer. Performs the MRd and MWr requests that hit a BAR of
+    the configuration space on a Wishbone bus, and answers MRd requests with completions.
+
+    The bus is a pipelined Wishbone bus; the bridge keeps issuing reads while earlier ones are
+    in flight, up to ``max_inflight`` bus cycles, and accepts further MRd requests while
+    the completions of earlier ones are pending, up to ``max_reads`` requests. Completions are
+    split at every Read Completion Boundary, as selected by the configuration space. MRd
+    requests that do not hit a BAR, or that are not plain memory reads, are answered with
+    Unsupported Request completions; MWr requests that do not hit a BAR are dropped.
+
+    The word address on the bus consists of the offset within the BAR in bits 0..26 and
+    the number of the BAR in bits 27..29; so BARs larger than 512 MiB are not fully accessible.
+
+    The requests must be routed to the bridge by the transaction layer, and its completions
+    merged into the transmitted TLPs. The latency of a read request is counted from the cycle
+    its header is received to the cycle the last dword of its last completion is transmitted.
+
+    Parameters
+    ----------
+    cfg : PCIeConfigSpace
+        Configuration space that provides the BARs and the completer ID.
+    max_reads : int
+        Maximum number of MRd requests being processed.
+    max_inflight : int
+        Maximum number of bus cycles in flight.
+    read_buffer : int
+        Size of the buffer for data read from the bus, in dwords. Must be at least
+        ``max_inflight``.
+
+    Attributes
+    ----------
+    i : Record(tlp_layout)
+        Input. Dword of a memory request, if ``i.valid`` is asserted. Must be held until
+        accepted.
+    i_ready : Signal
+        Output. Strobe. Asserted if ``i`` is accepted.
+    o : Record(tlp_layout)
+        Output. Dword of a completion, if ``o.valid`` is asserted.
+    o_ready : Signal
+        Input. Strobe. Assert if ``o`` is accepted.
+    bus : Record(wishbone_layout)
+        Wishbone bus master.
+    read_count : Signal(32)
+        Output. Number of completed MRd requests. Wraps around.
+    write_count : Signal(32)
+        Output. Number of MWr requests. Wraps around.
+    cpl_count : Signal(32)
+        Output. Number of transmitted completions. Wraps around.
+    cpl_dwords : Signal(32)
+        Output. Number of dwords of data in transmitted completions. Wraps around.
+    read_latency : Signal(16)
+        Output. Latency of the last completed MRd request, in cycles, modulo 2 ** 16.
+    read_latency_max : Signal(16)
+        Output. Highest value of ``read_latency``.
+    read_latency_total : Signal(32)
+        Output. Sum of the latencies of every MRd request, in cycles. Together with
+        ``read_count``, gives the average latency. Wraps around.
+    """
+    def __init__(self, cfg, max_reads=4, max_inflight=4, read_buffer=32):
+        if read_buffer < max_inflight:
+            raise ValueError("Read buffer must be at least as large as the number of bus cycles "
+                             "in flight ({}), not {}".format(max_inflight, read_buffer))
+
+        self.i       = Record(tlp_layout)
+        self.i_ready = Signal()
+        self.o       = Record(tlp_layout)
+        self.o_ready = Signal()
+        self.bus     = Record(wishbone_layout)
+
+        self.read_count         = Signal(32)
+        self.write_count        = Signal(32)
+        self.cpl_count          = Signal(32)
+        self.cpl_dwords         = Signal(32)
+        self.read_latency       = Signal(16)
+        self.read_latency_max   = Signal(16)
+        self.read_latency_total = Signal(32)
+
+        ###
+
+        timestamp = Signal(16)
+        self.sync += timestamp.eq(timestamp + 1)
+
+        # Every MRd request is queued both for its bus cycles to be issued and for its completions
+        # to be transmitted, so that a read larger than the read buffer is completed while
+        # it is still being issued.
+        self.submodules.reads = reads = SyncFIFO(layout_len(_read_layout), max_reads)
+        self.submodules.cpls  = cpls  = SyncFIFO(layout_len(_read_layout), max_reads)
+        # Data read from the bus.
+        self.submodules.data  = data  = SyncFIFO(32, read_buffer)
+        # Whether each bus cycle in flight is a read.
+        self.submodules.kinds = kinds = SyncFIFO(1, max_inflight)
+
+        # Receiving requests. The header is 3 dwords long, or 4 with a 64-bit address, and is
+        # followed by the data of MWr requests.
+        req_dword    = Signal(2)
+        req_4dw      = Signal()
+        req_has_data = Signal()
+        req_mem      = Signal()
+        req_upper    = Signal()
+        req_length   = Signal(11)
+        req_first_be = Signal(4)
+        req_last_be  = Signal(4)
+        req_data     = Signal()
+        req_first    = Signal()
+        req_hit      = Signal()
+        req_adr      = Signal(30)
+        header_last  = Signal()
+        read         = Record(_read_layout)
+
+        length = Signal(10)
+        hit    = Signal()
+        self.comb += [
+            length.eq(Cat(self.i.data[24:32], self.i.data[16:18])),
+            header_last.eq(req_dword == Mux(req_4dw, 3, 2)),
+            cfg.bar_adr.eq(tlp_address(self.i.data)),
+            hit.eq(cfg.bar_hit & req_mem & (~req_4dw | req_upper)),
+        ]
+
+        # Byte count and lower address of reads, from the byte enables. The first enabled byte
+        # is in the first dword, and the last enabled byte is in the last dword; a read with
+        # no enabled bytes reads one byte.
+        first_offset = Signal(2)
+        last_missing = Signal(2)
+        last_be      = Signal(4)
+        self.comb += [
+            first_offset.eq(Mux(req_first_be[0], 0,
+                            Mux(req_first_be[1], 1,
+                            Mux(req_first_be[2], 2,
+                            Mux(req_first_be[3], 3, 0))))),
+            last_be.eq(Mux(req_length == 1, req_first_be, req_last_be)),
+            last_missing.eq(Mux(last_be[3], 0,
+                            Mux(last_be[2], 1,
+                            Mux(last_be[1], 2, 3)))),
+            read.adr.eq(Cat(cfg.bar_offset[2:29], cfg.bar_index)),
+            read.length.eq(req_length),
+            read.byte_count.eq((req_length << 2) - first_offset - last_missing),
+            read.lower_adr.eq(Cat(first_offset, self.i.data[26:31])),
+            read.ur.eq(~hit),
+            read.timestamp.eq(timestamp),
+            reads.din.eq(read.raw_bits()),
+            cpls.din.eq(read.raw_bits()),
+        ]
+        self.sync += [
+            If(self.i_ready & ~req_data,
+                req_dword.eq(req_dword + 1),
+                Case(req_dword, {
+                    0: [
+                        req_4dw.eq(self.i.data[5]),
+                        req_has_data.eq(self.i.data[6]),
+                        req_mem.eq(self.i.data[0:5] == 0),
+                        req_length.eq(Cat(length, length == 0)),
+                        read.tc.eq(self.i.data[12:15]),
+                        read.attr.eq(self.i.data[20:22]),
+                    ],
+                    1: [
+                        read.requester.eq(tlp_requester_id(self.i.data)),
+                        read.tag.eq(self.i.data[16:24]),
+                        req_first_be.eq(self.i.data[24:28]),
+                        req_last_be.eq(self.i.data[28:32]),
+                    ],
+                    # Upper 32 bits of a 64-bit address. The BARs are 32-bit.
+                    2: req_upper.eq(self.i.data == 0),
+                }),
+                If(header_last,
+                    req_dword.eq(0),
+                    req_data.eq(req_has_data & ~self.i.last),
+                    req_first.eq(1),
+                    req_hit.eq(hit),
+                    req_adr.eq(read.adr)
+                )
+            )
+        ]
+
+        # Writes are performed as the data is received. MWr requests may pass MRd requests,
+        # so writes take priority over reads.
+        write_stb  = Signal()
+        write_sel  = Signal(4)
+        bus_issue  = Signal()
+        self.comb += [
+            write_stb.eq(self.i.valid & req_data & req_hit),
+            If(req_first,
+                write_sel.eq(req_first_be)
+            ).Elif(req_length == 1,
+                write_sel.eq(req_last_be)
+            ).Else(
+                write_sel.eq(0b1111)
+            ),
+            If(req_data,
+                self.i_ready.eq(self.i.valid & (~write_stb | bus_issue))
+            ).Elif(header_last & ~req_has_data,
+                self.i_ready.eq(self.i.valid & reads.writable & cpls.writable),
+                reads.we.eq(self.i_ready),
+                cpls.we.eq(self.i_ready)
+            ).Else(
+                self.i_ready.eq(self.i.valid)
+            )
+        ]
+        self.sync += [
+            If(self.i_ready & req_data,
+                req_first.eq(0),
+                req_adr.eq(req_adr + 1),
+                req_length.eq(req_length - 1),
+                If(self.i.last,
+                    req_data.eq(0),
+                    self.write_count.eq(self.write_count + 1)
+                )
+            )
+        ]
+
+        # Issuing bus cycles. The data of every read in flight must fit into the read buffer.
+        read_head     = Record(_read_layout)
+        read_issued   = Signal(11)
+        read_inflight = Signal(max=max_inflight + 1)
+        read_stb      = Signal()
+        read_issue    = Signal()
+        self.comb += [
+            read_head.raw_bits().eq(reads.dout),
+            read_stb.eq(reads.readable & ~read_head.ur & (read_issued != read_head.length) &
+                        (data.level + read_inflight < read_buffer)),
+            self.bus.stb.eq(kinds.writable & (write_stb | read_stb)),
+            bus_issue.eq(self.bus.stb & ~self.bus.stall),
+            If(write_stb,
+                self.bus.we.eq(1),
+                self.bus.adr.eq(req_adr),
+                self.bus.sel.eq(write_sel),
+                self.bus.dat_w.eq(self.i.data)
+            ).Else(
+                self.bus.adr.eq(read_head.adr + read_issued),
+                self.bus.sel.eq(0b1111),
+                read_issue.eq(bus_issue)
+            ),
+            self.bus.cyc.eq(self.bus.stb | kinds.readable),
+            kinds.din.eq(~write_stb),
+            kinds.we.eq(bus_issue),
+            kinds.re.eq(self.bus.ack),
+            data.din.eq(self.bus.dat_r),
+            data.we.eq(self.bus.ack & kinds.dout),
+            reads.re.eq(read_head.ur | (read_issued == read_head.length)),
+        ]
+        self.sync += [
+            If(reads.readable & reads.re,
+                read_issued.eq(0)
+            ).Elif(read_issue,
+                read_issued.eq(read_issued + 1)
+            ),
+            If(read_issue & ~data.we,
+                read_inflight.eq(read_inflight + 1)
+            ).Elif(~read_issue & data.we,
+                read_inflight.eq(read_inflight - 1)
+            )
+        ]
+
+        # Transmitting completions. Every completion but the last one ends at a Read Completion
+        # Boundary; since the boundary is at most 128 bytes, no completion exceeds
+        # Max_Payload_Size.
+        cpl_head       = Record(_read_layout)
+        cpl_remaining  = Signal(11)
+        cpl_byte_count = Signal(12)
+        cpl_lower_adr  = Signal(7)
+        cpl_boundary   = Signal(6)
+        cpl_length     = Signal(11)
+        cpl_dword      = Signal(11)
+        cpl_latency    = Signal(16)
+        self.comb += [
+            cpl_head.raw_bits().eq(cpls.dout),
+            If(cfg.rcb,
+                cpl_boundary.eq(32 - cpl_lower_adr[2:7])
+            ).Else(
+                cpl_boundary.eq(16 - cpl_lower_adr[2:6])
+            ),
+            cpl_length.eq(Mux(cpl_remaining < cpl_boundary, cpl_remaining, cpl_boundary)),
+            cpl_latency.eq(timestamp - cpl_head.timestamp),
+        ]
+
+        self.submodules.fsm = FSM()
+        self.fsm.act("IDLE",
+            If(cpls.readable,
+                NextValue(cpl_remaining, cpl_head.length),
+                NextValue(cpl_byte_count, cpl_head.byte_count),
+                NextValue(cpl_lower_adr, cpl_head.lower_adr),
+                NextState("HEADER-0")
+            )
+        )
+        self.fsm.act("HEADER-0",
+            self.o.valid.eq(1),
+            If(cpl_head.ur,
+                self.o.data.eq(tlp_dw0(TLP_CPL, 0, cpl_head.tc, cpl_head.attr))
+            ).Else(
+                self.o.data.eq(tlp_dw0(TLP_CPLD, cpl_length, cpl_head.tc, cpl_head.attr))
+            ),
+            If(self.o_ready,
+                NextValue(cpl_dword, cpl_length),
+                NextState("HEADER-1")
+            )
+        )
+        self.fsm.act("HEADER-1",
+            self.o.valid.eq(1),
+            self.o.data.eq(tlp_cpl_dw1(cfg.id, Mux(cpl_head.ur, CPL_UR, CPL_SC),
+                                       cpl_byte_count)),
+            If(self.o_ready,
+                NextState("HEADER-2")
+            )
+        )
+        self.fsm.act("HEADER-2",
+            self.o.valid.eq(1),
+            self.o.data.eq(tlp_cpl_dw2(cpl_head.requester, cpl_head.tag, cpl_lower_adr)),
+            self.o.last.eq(cpl_head.ur),
+            If(self.o_ready,
+                NextValue(self.cpl_count, self.cpl_count + 1),
+                If(cpl_head.ur,
+                    NextState("DONE")
+                ).Else(
+                    NextState("DATA")
+                )
+            )
+        )
+        self.fsm.act("DATA",
+            self.o.valid.eq(data.readable),
+            self.o.data.eq(data.dout),
+            self.o.last.eq(cpl_dword == 1),
+            data.re.eq(self.o_ready),
+            If(self.o_ready & data.readable,
+                NextValue(self.cpl_dwords, self.cpl_dwords + 1),
+                NextValue(cpl_dword, cpl_dword - 1),
+                NextValue(cpl_remaining, cpl_remaining - 1),
+                # Only the first dword may have bytes that are not read.
+                NextValue(cpl_byte_count, cpl_byte_count - 4 + cpl_lower_adr[0:2]),
+                NextValue(cpl_lower_adr, Cat(C(0, 2), cpl_lower_adr[2:7] + 1)),
+                If(cpl_remaining == 1,
+                    NextState("DONE")
+                ).Elif(cpl_dword == 1,
+                    NextState("HEADER-0")
+                )
+            )
+        )
+        self.fsm.act("DONE",
+            cpls.re.eq(1),
+            NextValue(self.read_count, self.read_count + 1),
+            NextValue(self.read_latency, cpl_latency),
+            If(cpl_latency > self.read_latency_max,
+                NextValue(self.read_latency_max, cpl_latency)
+            ),
+            NextValue(self.read_latency_total, self.read_latency_total + cpl_latency),
+            NextState("IDLE")
+        )
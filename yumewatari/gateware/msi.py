@@ -0,0 +1,175 @@
+from migen import *
+
+from .struct import *
+from .tlp import *
+
+
+__all__ = ["PCIeMSIGenerator"]
+
+
+class PCIeMSIGenerator(Module):
+    """
+    PCIe MSI generator. Transmits MSI writes, as configured in the MSI capability of
+    the configuration space, for a set of interrupt sources.
+
+    Source ``n`` uses vector ``n``, modulo the number of vectors allocated by the host; so
+    the sources share vectors if fewer vectors are allocated than there are sources.
+
+    Interrupt requests of every source are coalesced: once a source has a pending request,
+    its MSI is transmitted when ``coalesce_count`` requests are pending, or ``coalesce_timer``
+    cycles after the first of them, whichever comes first. With both set to zero, every request
+    is transmitted as soon as possible; requests that arrive while the MSI of the source is
+    waiting to be transmitted are coalesced regardless. Requests stay pending while MSI or bus
+    mastering is disabled. If several sources are ready, the lowest numbered one is transmitted
+    first.
+
+    The MSI writes must be merged into the transmitted TLPs by the transaction layer.
+
+    Parameters
+    ----------
+    cfg : PCIeConfigSpace
+        Configuration space that provides the MSI capability and the requester ID.
+    sources : int
+        Number of interrupt sources. Must be at most 32.
+
+    Attributes
+    ----------
+    irq : Signal(sources)
+        Input. Strobe. Assert bit ``n`` to request an interrupt of source ``n``.
+    o : Record(tlp_layout)
+        Output. Dword of an MSI write, if ``o.valid`` is asserted.
+    o_ready : Signal
+        Input. Strobe. Assert if ``o`` is accepted.
+    coalesce_count : Signal(16)
+        Input. Number of pending requests of a source that causes its MSI to be transmitted.
+        Zero acts as one.
+    coalesce_timer : Signal(16)
+        Input. Number of cycles after the first pending request of a source that causes its
+        MSI to be transmitted. Zero disables the timer.
+    request_count : Signal(32)
+        Output. Number of interrupt requests. Wraps around.
+    msi_count : Signal(32)
+        Output. Number of transmitted MSI writes. Wraps around.
+    coalesced_count : Signal(32)
+        Output. Number of interrupt requests that did not cause an MSI write of their own,
+        i.e. ``request_count`` less ``msi_count``, not counting pending requests. Wraps around.
+    """
+    def __init__(self, cfg, sources=1):
+        if not 1 <= sources <= 32:
+            raise ValueError("Number of interrupt sources must be between 1 and 32, not {}"
+                             .format(sources))
+
+        self.irq     = Signal(sources)
+        self.o       = Record(tlp_layout)
+        self.o_ready = Signal()
+
+        self.coalesce_count = Signal(16)
+        self.coalesce_timer = Signal(16)
+
+        self.request_count   = Signal(32)
+        self.msi_count       = Signal(32)
+        self.coalesced_count = Signal(32)
+
+        ###
+
+        enable = Signal()
+        self.comb += enable.eq(cfg.msi_enable & cfg.bus_master_enable)
+
+        # Pending requests, and cycles until the timer of each source expires.
+        pending = Array(Signal(16, name="src{}_pending".format(n)) for n in range(sources))
+        timer   = Array(Signal(16, name="src{}_timer".format(n)) for n in range(sources))
+        ready   = Signal(sources)
+
+        source  = Signal(max=max(sources, 2))
+        sent    = Signal()
+        for n in range(sources):
+            self.comb += ready[n].eq((pending[n] != 0) &
+                                     ((pending[n] >= self.coalesce_count) |
+                                      (self.coalesce_timer != 0) & (timer[n] == 0)))
+            clear = sent & (source == n)
+            self.sync += [
+                If(clear,
+                    pending[n].eq(self.irq[n])
+                ).Elif(self.irq[n] & (pending[n] != 0xffff),
+                    pending[n].eq(pending[n] + 1)
+                ),
+                If(clear | (pending[n] == 0),
+                    timer[n].eq(self.coalesce_timer)
+                ).Elif(timer[n] != 0,
+                    timer[n].eq(timer[n] - 1)
+                )
+            ]
+
+        # Number of the source that is transmitted next.
+        next_source = Signal(max=max(sources, 2))
+        for n in reversed(range(sources)):
+            self.comb += If(ready[n], next_source.eq(n))
+
+        # Message data, with as many of its low bits replaced with the vector as allocated.
+        vector_mask = Signal(5)
+        msg_data    = Signal(16)
+        self.comb += [
+            Case(cfg.msi_vectors, {
+                n: vector_mask.eq((1 << n) - 1) for n in range(6)
+            }),
+            msg_data.eq(Cat((cfg.msi_data[0:5] & ~vector_mask) | (source & vector_mask),
+                            cfg.msi_data[5:16])),
+        ]
+
+        request_count = Signal(max=sources + 1)
+        self.comb += request_count.eq(sum(self.irq[n] for n in range(sources)))
+        self.sync += self.request_count.eq(self.request_count + request_count)
+
+        address_64 = Signal()
+        self.comb += address_64.eq(cfg.msi_address[32:64] != 0)
+
+        self.submodules.fsm = FSM()
+        self.fsm.act("IDLE",
+            If(enable & (ready != 0),
+                NextValue(source, next_source),
+                NextState("HEADER-0")
+            )
+        )
+        self.fsm.act("HEADER-0",
+            self.o.valid.eq(1),
+            self.o.data.eq(tlp_dw0(Mux(address_64, TLP_MWR64, TLP_MWR32), 1)),
+            If(self.o_ready,
+                NextState("HEADER-1")
+            )
+        )
+        self.fsm.act("HEADER-1",
+            self.o.valid.eq(1),
+            self.o.data.eq(tlp_req_dw1(cfg.id, 0, 0b1111, 0)),
+            If(self.o_ready,
+                If(address_64,
+                    NextState("HEADER-2")
+                ).Else(
+                    NextState("HEADER-3")
+                )
+            )
+        )
+        self.fsm.act("HEADER-2",
+            self.o.valid.eq(1),
+            self.o.data.eq(tlp_address_dw(cfg.msi_address[32:64])),
+            If(self.o_ready,
+                NextState("HEADER-3")
+            )
+        )
+        self.fsm.act("HEADER-3",
+            self.o.valid.eq(1),
+            self.o.data.eq(tlp_address_dw(cfg.msi_address[0:32])),
+            If(self.o_ready,
+                NextState("DATA")
+            )
+        )
+        self.fsm.act("DATA",
+            self.o.valid.eq(1),
+            self.o.data.eq(msg_data),
+            self.o.last.eq(1),
+            If(self.o_ready,
+                sent.eq(1),
+                NextValue(self.msi_count, self.msi_count + 1),
+                NextValue(self.coalesced_count, self.coalesced_count + pending[source] - 1),
+                NextState("IDLE")
+            )
+        )
@@ -1,56 +1,432 @@
+from functools import reduce
+from operator import and_, or_
 from migen import *
 from migen.genlib.fsm import *
 
 from .protocol import *
+from .serdes import PCIeSERDESInterface, PCIeSERDESDeskew
 from .phy_rx import *
 from .phy_tx import *
-from .debug import RingLog
+from .scrambler import PCIeSERDESScrambler
+from .fsm import EncodedFSM
+from .debug import RingLog, StateStatistics
+from .struct import *
 
 
 __all__ = ["PCIePHY"]
 
 
 class PCIePHY(Module):
-    def __init__(self, lane, ms_cyc):
-        self.submodules.rx = rx = PCIePHYRX(lane)
-        self.submodules.tx = tx = PCIePHYTX(lane)
+    """
+    PCIe PHY. Implements the Link Training and Status State Machine (LTSSM).
 
-        self.link_up = Signal()
+    Transmitted and received symbols are scrambled, unless the link partner sets the Disable
+    Scrambling bit in the TS2 ordered sets during Configuration.
 
-        self.submodules.ltssm_log = RingLog(timestamp_width=32, data_width=8, depth=16)
+    If ``gen2`` is true, 5 GT/s is advertised, and once the link is up at 2.5 GT/s and the link
+    partner advertises 5 GT/s as well, the link rate is changed through Recovery. If the link
+    cannot be established at 5 GT/s, it falls back to 2.5 GT/s.
+
+    The link may use 1, 2 or 4 lanes. Received lanes are deskewed on COM symbols. The link
+    width is the widest of x1, x2 and x4 for which the link partner proposes a link number on
+    all of lanes ``0..width-1``, and the lane numbers it proposes may be either in order or
+    reversed. Lane 0 must be a part of the link. Lanes outside of the link are kept in
+    Electrical Idle.
+
+    In L0, the transmitter and the receiver may independently enter L0s. The transmitter sends
+    an EIOS and enters Electrical Idle while ``tx_l0s`` is asserted, and exits L0s by sending
+    as many FTS ordered sets as the link partner requested, followed by a SKP ordered set.
+    The receiver enters L0s once it receives an EIOS, and exits L0s once it receives a SKP
+    ordered set; if that does not happen in time, the link is retrained through Recovery.
+
+    In L0, outside of L0s, data symbols are transmitted and received through ``tx_data`` and
+    ``rx_data``. The data path is striped across the lanes: symbol ``n`` of a word belongs to
+    logical lane ``n % len(lanes)``, so it is only available if the link is trained at its full
+    width.
+
+    Parameters
+    ----------
+    lanes : PCIeSERDESInterface or list of PCIeSERDESInterface
+        Lane or lanes to use for the link.
+    ms_cyc : int
+        Number of clock cycles in one millisecond at 2.5 GT/s. The clock frequency of the link
+        must double at 5 GT/s, as it does with :class:`LatticeECP5PCIeSERDES`; the timeouts are
+        then counted in twice as many cycles.
+    state_encoding : str
+        Encoding of the LTSSM, receiver parser and transmitter emitter FSM states;
+        see :class:`EncodedFSM`.
+    gen2 : bool
+        Advertise and use 5 GT/s.
+    n_fts : int
+        Number of FTS ordered sets the receiver requires to exit L0s, advertised to the link
+        partner. Can be tuned using ``l0s_exit_cycles``.
+    log_depth : int
+        Number of entries in ``ltssm_log``. Must be a power of 2.
+
+    Attributes
+    ----------
+    rx : PCIePHYRX
+        Receiver of lane 0.
+    tx : PCIePHYTX
+        Transmitter of lane 0.
+    rx_lanes : list of PCIePHYRX
+        Receivers of every lane.
+    tx_lanes : list of PCIePHYTX
+        Transmitters of every lane.
+    link_up : Signal
+        Asserted if the link is up.
+    rate : Signal
+        Negotiated link rate. Deasserted for 2.5 GT/s, asserted for 5 GT/s.
+    width : Signal(max=len(lanes) + 1)
+        Negotiated link width, in lanes. Valid while ``link_up`` is asserted.
+    reversed : Signal
+        Asserted if the lanes of the link are reversed, i.e. physical lane ``n`` is logical lane
+        ``width-1-n``. Valid while ``link_up`` is asserted.
+    retrain : Signal
+        Input. Strobe. Retrain the link through Recovery if it is in L0, e.g. if the data link
+        layer replays the same TLPs too many times.
+    tx_l0s : Signal
+        Input. Place the transmitter in L0s while asserted and the link is in L0.
+    rx_l0s : Signal
+        Asserted while the receiver is in L0s.
+    l0s_exit_cycles : Signal(16)
+        Number of cycles between the first ordered set and the SKP ordered set received during
+        the last exit of the receiver from L0s. Saturates. The FTS ordered sets received before
+        the receiver achieves symbol lock are not counted, so the more this exceeds the time
+        it takes to receive a SKP ordered set, the more ``n_fts`` can be reduced.
+    rx_snapshot : Signal
+        Input. Strobe. Snapshot the error and ordered set counters of every receiver;
+        see :class:`PCIePHYRX`.
+    rx_clear : Signal
+        Input. Strobe. Clear the error and ordered set counters of every receiver.
+    tx_data : Signal(9 * ratio * len(lanes))
+        Input. Data symbols to transmit, with the 9th bit indicating a control symbol.
+    tx_data_ready : Signal
+        Output. Strobe. Asserted if ``tx_data`` is transmitted in this cycle.
+    tx_data_hold : Signal
+        Input. Postpone SKP ordered sets while asserted, e.g. while a packet is being transmitted.
+    rx_data : Signal(9 * ratio * len(lanes))
+        Output. Received data symbols, with the 9th bit indicating a control symbol.
+    rx_data_valid : Signal
+        Output. Asserted if ``rx_data`` is valid.
+    ltssm_log : RingLog
+        Log of LTSSM state transitions. Entries are values of ``ltssm.state``, and can be
+        decoded using ``ltssm.decoding``. The trigger inputs are not driven.
+    ltssm_stats : StateStatistics
+        Cycles spent in every LTSSM state, and number of times every LTSSM state was left.
+        States are numbered in the order of ``ltssm.actions``, regardless of the state encoding.
+    ltssm_retries : Signal(16)
+        Number of times the LTSSM went from Detect to Polling, not counting the first time,
+        i.e. the number of times training was retried from Detect. Saturates.
+    ltssm_link_up_cycles : Signal(32)
+        Number of cycles from the first time the LTSSM entered Detect.Active to the first time
+        the link was up. Saturates.
+    """
+    def __init__(self, lanes, ms_cyc, state_encoding="binary", gen2=False, n_fts=0xff,
+                 log_depth=1024):
+        if isinstance(lanes, PCIeSERDESInterface):
+            lanes = [lanes]
+        if len(lanes) not in (1, 2, 4):
+            raise ValueError("PCIe PHY must have 1, 2 or 4 lanes, not {}".format(len(lanes)))
+        if not 0 <= n_fts <= 255:
+            raise ValueError("N_FTS must be between 0 and 255, not {}".format(n_fts))
+
+        self.submodules.scramblers = scramblers = [PCIeSERDESScrambler(lane) for lane in lanes]
+        # The skew must be shorter than a TS1/TS2 ordered set, i.e. 16 symbol times.
+        self.submodules.deskew = deskew = \
+            PCIeSERDESDeskew(scramblers, max_skew=min(4, 15 // lanes[0].ratio))
+        self.submodules.rx_lanes = self.rx_lanes = \
+            [PCIePHYRX(lane, state_encoding=state_encoding) for lane in deskew.lanes]
+        self.submodules.tx_lanes = self.tx_lanes = \
+            [PCIePHYTX(lane, state_encoding=state_encoding) for lane in deskew.lanes]
+        self.rx = rx = self.rx_lanes[0]
+        self.tx = tx = self.tx_lanes[0]
+
+        self.link_up  = Signal()
+        self.rate     = Signal()
+        self.width    = Signal(max=len(lanes) + 1)
+        self.reversed = Signal()
+
+        self.retrain  = Signal()
+        self.tx_l0s   = Signal()
+        self.rx_l0s   = Signal()
+        self.l0s_exit_cycles = Signal(16)
+
+        self.rx_snapshot = Signal()
+        self.rx_clear    = Signal()
+
+        ratio = lanes[0].ratio
+        self.tx_data       = Signal(9 * ratio * len(lanes))
+        self.tx_data_ready = Signal()
+        self.tx_data_hold  = Signal()
+        self.rx_data       = Signal(9 * ratio * len(lanes))
+        self.rx_data_valid = Signal()
 
         ###
 
+        for rx_lane in self.rx_lanes:
+            self.comb += [
+                rx_lane.snapshot.eq(self.rx_snapshot),
+                rx_lane.clear.eq(self.rx_clear),
+            ]
+
+        # Lanes that are a part of the link, or, before Configuration, lanes that detected
+        # a receiver.
+        link_lanes = Signal(len(lanes))
+        self.comb += deskew.enable.eq(link_lanes)
+
+        # Every lane transmits the same ordered sets, except for the lane number.
+        tx_ts        = Record(ts_layout)
+        tx_e_idle    = Signal()
+        tx_eios      = Signal()
+        tx_lane_nums = [Signal(5, name="tx_lane_num{}".format(n)) for n in range(len(lanes))]
+        # Driven by the Tx_L0s substate machine.
+        l0s_e_idle   = Signal()
+        l0s_eios     = Signal()
+        l0s_fts      = Signal()
+        l0s_skp      = Signal()
+        for n, tx_lane in enumerate(self.tx_lanes):
+            self.comb += [
+                tx_lane.ts.raw_bits().eq(tx_ts.raw_bits()),
+                tx_lane.ts.lane.number.eq(tx_lane_nums[n]),
+                tx_lane.e_idle.eq(tx_e_idle | l0s_e_idle | ~link_lanes[n]),
+                tx_lane.eios.eq(tx_eios | l0s_eios),
+                tx_lane.fts.eq(l0s_fts),
+                tx_lane.skp.eq(l0s_skp),
+            ]
+
+        def rx_all(cond):
+            # Condition holds on every lane of the link.
+            return reduce(and_, [~link_lanes[n] | cond(n, rx_lane)
+                                 for n, rx_lane in enumerate(self.rx_lanes)])
+        def rx_any(cond):
+            # Condition holds on any lane of the link.
+            return reduce(or_, [link_lanes[n] & cond(n, rx_lane)
+                                for n, rx_lane in enumerate(self.rx_lanes)])
+        def rx_ts_matches(n, rx_lane):
+            return (rx_lane.ts.valid & rx_lane.ts.link.valid & rx_lane.ts.lane.valid &
+                    (rx_lane.ts.link.number == tx_ts.link.number) &
+                    (rx_lane.ts.lane.number == tx_lane_nums[n]))
+
+        # Link widths that can be negotiated, and whether lanes 0..width-1 are numbered
+        # in order or reversed.
+        widths = [width for width in (1, 2, 4) if width <= len(lanes)]
+        lanes_in_order = {
+            width: reduce(and_, [self.rx_lanes[n].ts.lane.number == n
+                                 for n in range(width)])
+            for width in widths
+        }
+        lanes_reversed = {
+            width: reduce(and_, [self.rx_lanes[n].ts.lane.number == width - 1 - n
+                                 for n in range(width)])
+            for width in widths
+        }
+
+        # Choose the widest link for which every lane receives the same link number as lane 0.
+        select_width = None
+        for width in reversed(widths):
+            same_link = reduce(and_, [
+                link_lanes[n] & self.rx_lanes[n].ts.valid & self.rx_lanes[n].ts.link.valid &
+                (self.rx_lanes[n].ts.link.number == rx.ts.link.number)
+                for n in range(width)
+            ])
+            statements = [
+                NextValue(self.width, width),
+                NextValue(link_lanes, (1 << width) - 1),
+            ]
+            if select_width is None:
+                select_width = If(same_link, *statements)
+            else:
+                select_width = select_width.Elif(same_link, *statements)
+
         self.comb += [
-            tx.ts.rate.gen1.eq(1),
+            tx_ts.n_fts.eq(n_fts),
+            tx_ts.rate.gen1.eq(1),
+            tx_ts.rate.gen2.eq(gen2),
+            [lane.rate.eq(self.rate) for lane in lanes],
         ]
 
-        rx_timer    = Signal(max=64 * ms_cyc + 1)
+        # Set if the link partner advertises 5 GT/s.
+        partner_gen2   = Signal()
+        # Set while a change to 5 GT/s is being negotiated; tx_ts.rate.speed_change mirrors it.
+        directed_speed = Signal()
+        # Set once a change to 5 GT/s was attempted, so that it is not retried if it fails.
+        speed_tried    = Signal()
+        # Rate to change to in Recovery.Speed.
+        speed_rate     = Signal()
+        # Number of FTS ordered sets the link partner requires to exit L0s.
+        partner_n_fts  = Signal(8)
+
+        # Number of cycles in ``count`` milliseconds at ``rate``.
+        def ms(count, rate=self.rate):
+            return Mux(rate, 2 * count * ms_cyc, count * ms_cyc)
+
+        rx_timer    = Signal(max=2 * 48 * ms_cyc + 1)
         rx_ts_count = Signal(max=16 + 1)
         tx_ts_count = Signal(max=1024 + 1)
 
+        # Idle data symbols received consecutively, and transmitted since the first one was
+        # received, in Configuration.Idle and Recovery.Idle.
+        rx_idle = rx_all(lambda n, rx: (deskew.lanes[n].rx_symbol == 0) &
+                                       (deskew.lanes[n].rx_valid == (1 << ratio) - 1))
+        rx_idle_count = Signal(max=8 + ratio)
+        tx_idle_count = Signal(max=16 + ratio)
+        count_idle = [
+            If(rx_idle,
+                If(rx_idle_count < 8,
+                    NextValue(rx_idle_count, rx_idle_count + ratio)
+                )
+            ).Else(
+                NextValue(rx_idle_count, 0)
+            ),
+            If(rx_idle | (tx_idle_count != 0),
+                If(tx_idle_count < 16,
+                    NextValue(tx_idle_count, tx_idle_count + ratio)
+                )
+            ),
+        ]
+        idle_done = (rx_idle_count >= 8) & (tx_idle_count >= 16)
+
+        # Receiver errors in L0 (8b10b or framing errors) other than while the receiver is in L0s.
+        rx_errors = ~self.rx_l0s & \
+            rx_any(lambda n, rx: rx.error |
+                                 (deskew.lanes[n].rx_valid != (1 << ratio) - 1))
+
+        # The transmitter and the receiver enter and exit L0s independently of each other, so
+        # their L0s substates are implemented as separate state machines that are only active
+        # while the LTSSM is in L0.
+        in_l0 = Signal()
+
+        # Minimum time in Electrical Idle (T_TX-IDLE-MIN, 20 ns). The timer then counts
+        # the transmitted FTS ordered sets.
+        tx_idle_min  = Mux(self.rate, -(-2 * ms_cyc // 50000), -(-ms_cyc // 50000))
+        tx_l0s_timer = Signal(max=max(-(-2 * ms_cyc // 50000), 256) + 1)
+        self.submodules.tx_l0s_fsm = ResetInserter()(EncodedFSM(state_encoding=state_encoding))
+        self.comb += self.tx_l0s_fsm.reset.eq(~in_l0)
+        self.tx_l0s_fsm.act("L0",
+            If(self.tx_l0s,
+                NextState("Tx_L0s.Entry")
+            )
+        )
+        self.tx_l0s_fsm.act("Tx_L0s.Entry",
+            l0s_eios.eq(1),
+            If(tx.comma,
+                NextValue(tx_l0s_timer, tx_idle_min),
+                NextState("Tx_L0s.Idle")
+            )
+        )
+        self.tx_l0s_fsm.act("Tx_L0s.Idle",
+            l0s_e_idle.eq(1),
+            If(tx_l0s_timer != 0,
+                NextValue(tx_l0s_timer, tx_l0s_timer - 1)
+            ).Elif(~self.tx_l0s,
+                NextValue(tx_l0s_timer, 0),
+                NextState("Tx_L0s.FTS")
+            )
+        )
+        self.tx_l0s_fsm.act("Tx_L0s.FTS",
+            # Transmit N_FTS FTS ordered sets, then a SKP ordered set.
+            If(tx_l0s_timer == partner_n_fts,
+                l0s_skp.eq(1),
+                NextState("L0")
+            ).Else(
+                l0s_fts.eq(1),
+                If(tx.comma,
+                    NextValue(tx_l0s_timer, tx_l0s_timer + 1)
+                )
+            )
+        )
+
+        # The partner transmits N_FTS FTS ordered sets and a SKP ordered set; allow for twice
+        # as many symbol times.
+        rx_l0s_timeout = Signal()
+        rx_l0s_timer   = Signal(max=2 * (4 * n_fts + 4) // lanes[0].ratio + 1)
+        self.submodules.rx_l0s_fsm = ResetInserter()(EncodedFSM(state_encoding=state_encoding))
+        self.comb += self.rx_l0s_fsm.reset.eq(~in_l0)
+        self.rx_l0s_fsm.act("L0",
+            If(rx.eios,
+                NextState("Rx_L0s.Idle")
+            )
+        )
+        self.rx_l0s_fsm.act("Rx_L0s.Idle",
+            self.rx_l0s.eq(1),
+            If(rx.comma,
+                NextValue(rx_l0s_timer, 2 * (4 * n_fts + 4) // lanes[0].ratio),
+                NextValue(self.l0s_exit_cycles, 0),
+                NextState("Rx_L0s.FTS")
+            )
+        )
+        self.rx_l0s_fsm.act("Rx_L0s.FTS",
+            self.rx_l0s.eq(1),
+            If(self.l0s_exit_cycles != 2 ** len(self.l0s_exit_cycles) - 1,
+                NextValue(self.l0s_exit_cycles, self.l0s_exit_cycles + 1)
+            ),
+            NextValue(rx_l0s_timer, rx_l0s_timer - 1),
+            If(rx.skp,
+                NextState("L0")
+            ).Elif(rx_l0s_timer == 0,
+                rx_l0s_timeout.eq(1),
+                NextState("L0")
+            )
+        )
+
+        # Data path. Physical lane n is logical lane n, or width-1-n if the lanes are reversed.
+        def data_symbol(data, lane, slot):
+            return data.part(9 * (slot * len(lanes) + lane), 9)
+        full_width = self.width == len(lanes)
+        for n, (rx_lane, tx_lane) in enumerate(zip(deskew.lanes, self.tx_lanes)):
+            self.comb += [
+                If(self.reversed,
+                    tx_lane.data.eq(Cat(data_symbol(self.tx_data, len(lanes) - 1 - n, k)
+                                        for k in range(ratio))),
+                    [data_symbol(self.rx_data, len(lanes) - 1 - n, k)
+                        .eq(rx_lane.rx_symbol.part(9 * k, 9)) for k in range(ratio)]
+                ).Else(
+                    tx_lane.data.eq(Cat(data_symbol(self.tx_data, n, k)
+                                        for k in range(ratio))),
+                    [data_symbol(self.rx_data, n, k)
+                        .eq(rx_lane.rx_symbol.part(9 * k, 9)) for k in range(ratio)]
+                ),
+                tx_lane.data_valid.eq(in_l0 & full_width & self.tx_l0s_fsm.ongoing("L0")),
+                tx_lane.data_hold.eq(self.tx_data_hold),
+            ]
+        self.comb += [
+            self.tx_data_ready.eq(tx.data_ready),
+            self.rx_data_valid.eq(in_l0 & full_width & ~self.rx_l0s),
+        ]
+
         # LTSSM implemented according to PCIe Base Specification Revision 2.1.
         # The Specification must be read side to side with this code in order to understand it.
         # Unfortunately, the Specification is copyrighted and probably cannot be quoted here
         # directly at length.
-        self.submodules.ltssm = ltssm = ResetInserter()(FSM())
+        self.submodules.ltssm = ltssm = ResetInserter()(EncodedFSM(state_encoding=state_encoding))
         self.ltssm.act("Detect.Quiet",
-            NextValue(tx.e_idle, 1),
+            NextValue(tx_e_idle, 1),
             NextValue(self.link_up, 0),
+            NextValue(self.rate, 0),
+            NextValue(partner_gen2, 0),
+            NextValue(directed_speed, 0),
+            NextValue(speed_tried, 0),
+            NextValue(tx_ts.rate.speed_change, 0),
+            [NextValue(scrambler.disable, 0) for scrambler in scramblers],
+            NextValue(link_lanes, 0),
+            # The rate is 2.5 GT/s from here on.
             NextValue(rx_timer, 12 * ms_cyc),
             NextState("Detect.Quiet:Timeout")
         )
         self.ltssm.act("Detect.Quiet:Timeout",
             NextValue(rx_timer, rx_timer - 1),
-            If(lane.rx_present | (rx_timer == 0),
-                NextValue(lane.det_enable, 1),
+            If(reduce(or_, [lane.rx_present for lane in lanes]) | (rx_timer == 0),
+                [NextValue(lane.det_enable, 1) for lane in lanes],
                 NextState("Detect.Active")
             )
         )
         self.ltssm.act("Detect.Active",
-            If(lane.det_valid,
-                NextValue(lane.det_enable, 0),
-                If(lane.det_status,
+            If(reduce(and_, [lane.det_valid for lane in lanes]),
+                [NextValue(lane.det_enable, 0) for lane in lanes],
+                NextValue(link_lanes, Cat(lane.det_status for lane in lanes)),
+                # Lane 0 must be a part of the link.
+                If(lanes[0].det_status,
                     NextState("Polling.Active")
                 ).Else(
                     NextState("Detect.Quiet")
@@ -58,13 +434,13 @@ class PCIePHY(Module):
             )
         )
         self.ltssm.act("Polling.Active",
-            NextValue(tx.e_idle, 0),
+            NextValue(tx_e_idle, 0),
             # Transmit TS1 Link=PAD Lane=PAD
-            NextValue(tx.ts.valid, 1),
-            NextValue(tx.ts.ts_id, 0),
-            NextValue(tx.ts.link.valid, 0),
-            NextValue(tx.ts.lane.valid, 0),
-            NextValue(rx_timer, 24 * ms_cyc),
+            NextValue(tx_ts.valid, 1),
+            NextValue(tx_ts.ts_id, 0),
+            NextValue(tx_ts.link.valid, 0),
+            NextValue(tx_ts.lane.valid, 0),
+            NextValue(rx_timer, ms(24)),
             NextValue(rx_ts_count, 0),
             NextValue(tx_ts_count, 0),
             NextState("Polling.Active:TS")
@@ -100,13 +476,13 @@ class PCIePHY(Module):
         )
         self.ltssm.act("Polling.Configuration",
             # Transmit TS2 Link=PAD Lane=PAD
-            NextValue(tx.ts.valid, 1),
-            NextValue(tx.ts.ts_id, 1),
-            NextValue(tx.ts.link.valid, 0),
-            NextValue(tx.ts.lane.valid, 0),
+            NextValue(tx_ts.valid, 1),
+            NextValue(tx_ts.ts_id, 1),
+            NextValue(tx_ts.link.valid, 0),
+            NextValue(tx_ts.lane.valid, 0),
             NextValue(rx_ts_count, 0),
             NextValue(tx_ts_count, 0),
-            NextValue(rx_timer, 48 * ms_cyc),
+            NextValue(rx_timer, ms(48)),
             NextState("Polling.Configuration:TS")
         )
         self.ltssm.act("Polling.Configuration:TS",
@@ -122,7 +498,7 @@ class PCIePHY(Module):
                 If(rx.ts.valid & (rx.ts.ts_id == 1) & ~rx.ts.link.valid & ~rx.ts.lane.valid,
                     If(rx_ts_count == 8,
                         If(tx_ts_count == 16,
-                            NextValue(rx_timer, 24 * ms_cyc),
+                            NextValue(rx_timer, ms(24)),
                             NextState("Configuration.Linkwidth.Start")
                         )
                     ).Else(
@@ -139,16 +515,17 @@ class PCIePHY(Module):
         )
         self.ltssm.act("Configuration.Linkwidth.Start",
             # Transmit TS1 Link=PAD Lane=PAD
-            NextValue(tx.ts.valid, 1),
-            NextValue(tx.ts.ts_id, 0),
-            NextValue(tx.ts.link.valid, 0),
-            NextValue(tx.ts.lane.valid, 0),
+            NextValue(tx_ts.valid, 1),
+            NextValue(tx_ts.ts_id, 0),
+            NextValue(tx_ts.link.valid, 0),
+            NextValue(tx_ts.lane.valid, 0),
             # Accept TS1 Link=Upstream-Link Lane=PAD
             If(rx.ts.valid & (rx.ts.ts_id == 0) & rx.ts.link.valid & ~rx.ts.lane.valid,
                 # Transmit TS1 Link=Upstream-Link Lane=PAD
-                NextValue(tx.ts.link.valid, 1),
-                NextValue(tx.ts.link.number, rx.ts.link.number),
-                NextValue(rx_timer, 2 * ms_cyc),
+                NextValue(tx_ts.link.valid, 1),
+                NextValue(tx_ts.link.number, rx.ts.link.number),
+                select_width,
+                NextValue(rx_timer, ms(2)),
                 NextState("Configuration.Linkwidth.Accept")
             ),
             NextValue(rx_timer, rx_timer - 1),
@@ -158,13 +535,20 @@ class PCIePHY(Module):
         )
         self.ltssm.act("Configuration.Linkwidth.Accept",
             # Accept TS1 Link=Upstream-Link Lane=Upstream-Lane
-            If(rx.ts.valid & (rx.ts.ts_id == 0) & rx.ts.link.valid & rx.ts.lane.valid,
-                # Accept Upstream-Lane=0
-                If(rx.ts.lane.number == 0,
+            If(rx_all(lambda n, rx: rx.ts.valid & (rx.ts.ts_id == 0) &
+                                    rx.ts.link.valid & rx.ts.lane.valid),
+                # Accept Upstream-Lane=0..width-1, either in order or reversed
+                If(reduce(or_, [(self.width == width) &
+                                (lanes_in_order[width] | lanes_reversed[width])
+                                for width in widths]),
                     # Transmit TS1 Link=Upstream-Link Lane=Upstream-Lane
-                    NextValue(tx.ts.lane.valid, 1),
-                    NextValue(tx.ts.lane.number, rx.ts.lane.number),
-                    NextValue(rx_timer, 2 * ms_cyc),
+                    NextValue(tx_ts.lane.valid, 1),
+                    [NextValue(tx_lane_nums[n], rx_lane.ts.lane.number)
+                     for n, rx_lane in enumerate(self.rx_lanes)],
+                    NextValue(self.reversed, ~reduce(or_, [(self.width == width) &
+                                                           lanes_in_order[width]
+                                                           for width in widths])),
+                    NextValue(rx_timer, ms(2)),
                     NextState("Configuration.Lanenum.Wait")
                 )
             ),
@@ -179,10 +563,10 @@ class PCIePHY(Module):
         )
         self.ltssm.act("Configuration.Lanenum.Wait",
             # Accept TS1 Link=Upstream-Link Lane=Upstream-Lane
-            If(rx.ts.valid & (rx.ts.ts_id == 0) & rx.ts.link.valid & rx.ts.lane.valid,
-                If(rx.ts.lane.number != tx.ts.lane.number,
-                    NextState("Configuration.Lanenum.Accept")
-                )
+            If(rx_any(lambda n, rx: rx.ts.valid & (rx.ts.ts_id == 0) &
+                                    rx.ts.link.valid & rx.ts.lane.valid &
+                                    (rx.ts.lane.number != tx_lane_nums[n])),
+                NextState("Configuration.Lanenum.Accept")
             ),
             # Accept TS2
             If(rx.ts.valid & (rx.ts.ts_id == 1),
@@ -200,8 +584,7 @@ class PCIePHY(Module):
         self.ltssm.act("Configuration.Lanenum.Accept",
             # Accept TS2 Link=Upstream-Link Lane=Upstream-Lane
             If(rx.ts.valid & (rx.ts.ts_id == 1) & rx.ts.link.valid & rx.ts.lane.valid,
-                If((rx.ts.link.number == tx.ts.link.number) &
-                   (rx.ts.lane.number == tx.ts.lane.number),
+                If(rx_all(rx_ts_matches),
                     NextState("Configuration.Complete")
                 ).Else(
                     NextState("Detect.Quiet")
@@ -214,11 +597,10 @@ class PCIePHY(Module):
         )
         self.ltssm.act("Configuration.Complete",
             # Transmit TS2 Link=Upstream-Link Lane=Upstream-Lane
-            NextValue(tx.ts.ts_id, 1),
-            NextValue(tx.ts.n_fts, 0xff),
+            NextValue(tx_ts.ts_id, 1),
             NextValue(rx_ts_count, 0),
             NextValue(tx_ts_count, 0),
-            NextValue(rx_timer, 2 * ms_cyc),
+            NextValue(rx_timer, ms(2)),
             NextState("Configuration.Complete:TS")
         )
         self.ltssm.act("Configuration.Complete:TS",
@@ -231,11 +613,13 @@ class PCIePHY(Module):
             ),
             If(rx.comma,
                 # Accept TS2 Link=Upstream-Link Lane=Upstream-Lane
-                If(rx.ts.valid & (rx.ts.ts_id == 1) & rx.ts.link.valid & rx.ts.lane.valid &
-                        (rx.ts.link.number == tx.ts.link.number) &
-                        (rx.ts.lane.number == tx.ts.lane.number),
+                If(rx_all(lambda n, rx: rx_ts_matches(n, rx) & (rx.ts.ts_id == 1)),
                     If(rx_ts_count == 8,
                         If(tx_ts_count == 16,
+                            [NextValue(scrambler.disable, rx.ts.ctrl.disable_scrambling)
+                             for scrambler in scramblers],
+                            NextValue(partner_gen2, rx.ts.rate.gen2),
+                            NextValue(partner_n_fts, rx.ts.n_fts),
                             NextState("Configuration.Idle")
                         )
                     ).Else(
@@ -251,8 +635,203 @@ class PCIePHY(Module):
             )
         )
         self.ltssm.act("Configuration.Idle",
-            NextValue(self.link_up, 1)
+            # Transmit Idle data
+            NextValue(tx_ts.valid, 0),
+            NextValue(rx_idle_count, 0),
+            NextValue(tx_idle_count, 0),
+            NextValue(rx_timer, ms(2)),
+            NextState("Configuration.Idle:Idle")
+        )
+        self.ltssm.act("Configuration.Idle:Idle",
+            # Accept 8 Idle data symbols, after transmitting 16 Idle data symbols
+            count_idle,
+            If(idle_done,
+                NextValue(self.link_up, 1),
+                NextState("L0")
+            ),
+            NextValue(rx_timer, rx_timer - 1),
+            If(rx_timer == 0,
+                NextState("Detect.Quiet")
+            )
         )
+        self.ltssm.act("L0",
+            in_l0.eq(1),
+            # Accept TS1/TS2, a receiver error, or a request to retrain
+            If(rx_l0s_timeout | rx_errors | self.retrain | rx_any(lambda n, rx: rx.ts.valid),
+                NextState("Recovery.RcvrLock")
+            ).Elif(~self.rate & partner_gen2 & ~speed_tried,
+                # Change to 5 GT/s.
+                NextValue(directed_speed, 1),
+                NextValue(speed_tried, 1),
+                NextState("Recovery.RcvrLock")
+            )
+        )
+        self.ltssm.act("Recovery.RcvrLock",
+            # Transmit TS1 Link=Upstream-Link Lane=Upstream-Lane
+            NextValue(tx_e_idle, 0),
+            NextValue(tx_ts.valid, 1),
+            NextValue(tx_ts.ts_id, 0),
+            NextValue(tx_ts.rate.speed_change, directed_speed),
+            NextValue(rx_ts_count, 0),
+            NextValue(rx_timer, ms(24)),
+            NextState("Recovery.RcvrLock:TS")
+        )
+        self.ltssm.act("Recovery.RcvrLock:TS",
+            If(rx.comma,
+                # Accept TS1/TS2 Link=Upstream-Link Lane=Upstream-Lane
+                If(rx_all(rx_ts_matches),
+                    If(gen2 & ~self.rate & rx.ts.rate.gen2 & rx.ts.rate.speed_change,
+                        # The link partner requests a change to 5 GT/s.
+                        NextValue(directed_speed, 1),
+                        NextValue(tx_ts.rate.speed_change, 1),
+                    ),
+                    If(rx_ts_count == 8,
+                        NextValue(rx_timer, ms(48)),
+                        NextState("Recovery.RcvrCfg")
+                    ).Else(
+                        NextValue(rx_ts_count, rx_ts_count + 1)
+                    )
+                ).Else(
+                    NextValue(rx_ts_count, 0)
+                )
+            ),
+            NextValue(rx_timer, rx_timer - 1),
+            If(rx_timer == 0,
+                If(self.rate,
+                    # The link could not be established at 5 GT/s; fall back to 2.5 GT/s.
+                    NextValue(speed_rate, 0),
+                    NextValue(directed_speed, 0),
+                    NextState("Recovery.Speed")
+                ).Else(
+                    NextState("Detect.Quiet")
+                )
+            )
+        )
+        self.ltssm.act("Recovery.RcvrCfg",
+            # Transmit TS2 Link=Upstream-Link Lane=Upstream-Lane
+            NextValue(tx_ts.ts_id, 1),
+            NextValue(rx_ts_count, 0),
+            NextValue(tx_ts_count, 0),
+            NextState("Recovery.RcvrCfg:TS")
+        )
+        self.ltssm.act("Recovery.RcvrCfg:TS",
+            If(tx.comma,
+                If(rx_ts_count == 0,
+                    NextValue(tx_ts_count, 0)
+                ).Else(
+                    NextValue(tx_ts_count, tx_ts_count + 1)
+                )
+            ),
+            If(rx.comma,
+                # Accept TS2 Link=Upstream-Link Lane=Upstream-Lane
+                If(rx_all(lambda n, rx: rx_ts_matches(n, rx) & (rx.ts.ts_id == 1)),
+                    If(rx_ts_count == 8,
+                        If(directed_speed & rx.ts.rate.speed_change & rx.ts.rate.gen2,
+                            NextValue(speed_rate, 1),
+                            NextValue(directed_speed, 0),
+                            NextState("Recovery.Speed")
+                        ).Elif(tx_ts_count == 16,
+                            NextValue(directed_speed, 0),
+                            NextValue(tx_ts.rate.speed_change, 0),
+                            NextState("Recovery.Idle")
+                        )
+                    ).Else(
+                        NextValue(rx_ts_count, rx_ts_count + 1)
+                    )
+                ).Else(
+                    NextValue(rx_ts_count, 0)
+                )
+            ),
+            NextValue(rx_timer, rx_timer - 1),
+            If(rx_timer == 0,
+                NextState("Detect.Quiet")
+            )
+        )
+        self.ltssm.act("Recovery.Idle",
+            # Transmit Idle data
+            NextValue(tx_ts.valid, 0),
+            NextValue(rx_idle_count, 0),
+            NextValue(tx_idle_count, 0),
+            NextValue(rx_timer, ms(2)),
+            NextState("Recovery.Idle:Idle")
+        )
+        self.ltssm.act("Recovery.Idle:Idle",
+            # Accept 8 Idle data symbols, after transmitting 16 Idle data symbols
+            count_idle,
+            If(idle_done,
+                NextState("L0")
+            ),
+            NextValue(rx_timer, rx_timer - 1),
+            If(rx_timer == 0,
+                NextState("Detect.Quiet")
+            )
+        )
+        self.ltssm.act("Recovery.Speed",
+            # Transmit EIOS, then enter Electrical Idle while the SERDES changes the rate.
+            NextValue(tx_eios, 1),
+            NextValue(tx_ts.rate.speed_change, 0),
+            NextState("Recovery.Speed:EIOS")
+        )
+        self.ltssm.act("Recovery.Speed:EIOS",
+            If(tx.comma,
+                NextValue(tx_eios, 0),
+                NextValue(tx_e_idle, 1),
+                NextValue(rx_timer, ms(1, speed_rate) + 4),
+                NextState("Recovery.Speed:Idle")
+            )
+        )
+        self.ltssm.act("Recovery.Speed:Idle",
+            NextValue(rx_timer, rx_timer - 1),
+            # The rest of the EIOS is transmitted in at most 3 more cycles.
+            If(rx_timer == ms(1, speed_rate),
+                NextValue(self.rate, speed_rate)
+            ),
+            If(rx_timer == 0,
+                NextState("Recovery.RcvrLock")
+            )
+        )
+
+        # Round the log entries up to whole bytes, so that they are easy to read out.
+        self.submodules.ltssm_log = RingLog(timestamp_width=32,
+                                            data_width=(ltssm.state_width() + 7) // 8 * 8,
+                                            depth=log_depth)
+
+        self.submodules.ltssm_stats = StateStatistics(states=len(ltssm.actions))
+
+        self.ltssm_retries        = Signal(16)
+        self.ltssm_link_up_cycles = Signal(32)
+
+        in_detect    = reduce(or_, [ltssm.ongoing(state) for state in ltssm.actions
+                                    if state.startswith("Detect.")])
+        in_polling   = reduce(or_, [ltssm.ongoing(state) for state in ltssm.actions
+                                    if state.startswith("Polling.")])
+        was_detect   = Signal()
+        polled       = Signal()
+        link_timing  = Signal()
+        link_timed   = Signal()
+        self.sync += [
+            was_detect.eq(in_detect),
+            If(was_detect & in_polling,
+                polled.eq(1),
+                If(polled & (self.ltssm_retries != 0xffff),
+                    self.ltssm_retries.eq(self.ltssm_retries + 1)
+                )
+            ),
+            If(self.link_up,
+                link_timed.eq(1)
+            ).Elif(~link_timed & (link_timing | ltssm.ongoing("Detect.Active")),
+                link_timing.eq(1),
+                If(self.ltssm_link_up_cycles != 0xffffffff,
+                    self.ltssm_link_up_cycles.eq(self.ltssm_link_up_cycles + 1)
+                )
+            )
+        ]
 
     def do_finalize(self):
-        self.comb += self.ltssm_log.data_i.eq(self.ltssm.state)
+        self.comb += [
+            self.ltssm_log.data_i.eq(self.ltssm.state),
+            Case(self.ltssm.state, {
+                self.ltssm.encoding[state]: self.ltssm_stats.state_i.eq(n)
+                for n, state in enumerate(self.ltssm.actions)
+            }),
+        ]
@@ -9,13 +9,97 @@ __all__ = ["PCIePHYRX"]
 
 
 class PCIePHYRX(Module):
-    def __init__(self, lane):
+    """
+    PCIe PHY receiver. Parses TS1/TS2, SKP, FTS and EIOS ordered sets. Data symbols and framing
+    symbols outside of ordered sets, e.g. logical idle or packets, are accepted.
+
+    Parameters
+    ----------
+    lane : PCIeSERDESInterface
+        Lane to receive from.
+    pipeline : bool
+        If true, the parser is pipelined (see :class:`Parser`), and ``error``, ``comma``
+        and ``ts`` are delayed by one additional cycle.
+    state_encoding : str
+        Encoding of the parser FSM state; see :class:`EncodedFSM`.
+
+    Attributes
+    ----------
+    skp : Signal
+        Strobe. Asserted once a complete SKP ordered set is received, i.e. for the symbol
+        following it.
+    fts : Signal
+        Strobe. Asserted once a complete FTS ordered set is received.
+    eios : Signal
+        Strobe. Asserted once a complete EIOS ordered set is received.
+
+    snapshot : Signal
+        Input. Strobe. Assert to copy the current values of the error and ordered set counters
+        to the ``*_count`` outputs.
+    clear : Signal
+        Input. Strobe. Assert to reset the error and ordered set counters. If asserted together
+        with ``snapshot``, the values before reset are copied, so no events are lost between
+        consecutive readouts.
+    code_error_count : list of Signal(16)
+        Output. Number of symbols in slot ``n`` received with a coding error (i.e. with
+        ``lane.rx_valid[n]`` deasserted) while ``lane.rx_aligned`` is asserted. Saturates.
+    error_count : Signal(16)
+        Output. Number of cycles ``error`` was asserted. Saturates.
+    align_loss_count : Signal(16)
+        Output. Number of times ``lane.rx_aligned`` was deasserted. Saturates.
+    invert_count : Signal(16)
+        Output. Number of times the receiver polarity was inverted. Saturates.
+    ts_count : Signal(16)
+        Output. Number of complete TS1/TS2 ordered sets received. Saturates.
+    skp_count : Signal(16)
+        Output. Number of complete SKP ordered sets received. Saturates.
+    """
+    def __init__(self, lane, pipeline=False, state_encoding="binary"):
         self.error  = Signal()
         self.comma  = Signal()
         self.ts     = Record(ts_layout)
+        self.skp    = Signal()
+        self.fts    = Signal()
+        self.eios   = Signal()
+
+        self.snapshot         = Signal()
+        self.clear            = Signal()
+        self.code_error_count = [Signal(16, name="code_error_count{}".format(n))
+                                 for n in range(lane.ratio)]
+        self.error_count      = Signal(16)
+        self.align_loss_count = Signal(16)
+        self.invert_count     = Signal(16)
+        self.ts_count         = Signal(16)
+        self.skp_count        = Signal(16)
 
         ###
 
+        ts_received = Signal()
+        ts_inverted = Signal()
+        aligned_l   = Signal()
+        self.sync += aligned_l.eq(lane.rx_aligned)
+
+        def counter(event, output):
+            value = Signal.like(output)
+            self.sync += [
+                If(self.snapshot,
+                    output.eq(value)
+                ),
+                If(self.clear,
+                    value.eq(event)
+                ).Elif(event & (value != (1 << len(value)) - 1),
+                    value.eq(value + 1)
+                )
+            ]
+
+        for n in range(lane.ratio):
+            counter(lane.rx_aligned & ~lane.rx_valid[n], self.code_error_count[n])
+        counter(self.error,                   self.error_count)
+        counter(aligned_l & ~lane.rx_aligned, self.align_loss_count)
+        counter(ts_inverted,                  self.invert_count)
+        counter(ts_received,                  self.ts_count)
+        counter(self.skp,                     self.skp_count)
+
         self.comb += lane.rx_align.eq(1)
 
         self._tsY  = Record(ts_layout) # previous TS received
@@ -29,6 +113,8 @@ class PCIePHYRX(Module):
             symbol_size=9,
             word_size=lane.ratio,
             reset_rule="COMMA",
+            pipeline=pipeline,
+            state_encoding=state_encoding,
             layout=[
                 ("data", 8),
                 ("ctrl", 1),
@@ -38,20 +124,45 @@ class PCIePHYRX(Module):
             self.parser.i.eq(lane.rx_symbol),
             self.error.eq(self.parser.error)
         ]
-        self.parser.rule(
-            name="COMMA",
-            cond=lambda symbol: symbol.raw_bits() == K(28,5),
-            succ="TSn-LINK/SKP-0",
-            action=lambda symbol: [
+        def comma_action(symbol):
+            return [
                 self.comma.eq(1),
                 NextValue(self._tsZ.valid, 1),
                 NextValue(self._tsY.raw_bits(), self._tsZ.raw_bits()),
             ]
+        def data_action(symbol):
+            # TS1/TS2 ordered sets separated by data are not consecutive.
+            return [
+                NextValue(self._tsZ.valid, 0),
+                NextValue(self.ts.valid, 0),
+            ]
+        self.parser.rule(
+            name="COMMA",
+            cond=lambda symbol: symbol.raw_bits() == K(28,5),
+            succ="TSn-LINK/SKP-0",
+            action=comma_action
+        )
+        self.parser.rule(
+            name="COMMA",
+            cond=lambda symbol: ~symbol.ctrl,
+            succ="COMMA",
+            action=data_action
+        )
+        def is_framing(symbol):
+            # STP, SDP, END, EDB or PAD
+            return ((symbol.raw_bits() == K(27,7)) | (symbol.raw_bits() == K(28,2)) |
+                    (symbol.raw_bits() == K(29,7)) | (symbol.raw_bits() == K(30,7)) |
+                    (symbol.raw_bits() == K(23,7)))
+        self.parser.rule(
+            name="COMMA",
+            cond=is_framing,
+            succ="COMMA",
+            action=data_action
         )
         self.parser.rule(
             name="TSn-LINK/SKP-0",
             cond=lambda symbol: symbol.raw_bits() == K(28,0),
-            succ="SKP-1"
+            succ="SKP-N"
         )
         self.parser.rule(
             name="TSn-LINK/SKP-0",
@@ -70,12 +181,76 @@ class PCIePHYRX(Module):
                 NextValue(self._tsZ.link.valid,  1)
             ]
         )
-        for n in range(1, 3):
-            self.parser.rule(
-                name="SKP-%d" % n,
-                cond=lambda symbol: symbol.raw_bits() == K(28,0),
-                succ="COMMA" if n == 2 else "SKP-%d" % (n + 1),
-            )
+        # Elastic buffers add or remove SKP symbols, so any number of them is accepted.
+        self.parser.rule(
+            name="SKP-N",
+            cond=lambda symbol: symbol.raw_bits() == K(28,0),
+            succ="SKP-N"
+        )
+        self.parser.rule(
+            name="SKP-N",
+            cond=lambda symbol: symbol.raw_bits() == K(28,5),
+            succ="TSn-LINK/SKP-0",
+            action=lambda symbol: [
+                self.skp.eq(1),
+                *comma_action(symbol)
+            ]
+        )
+        self.parser.rule(
+            name="SKP-N",
+            cond=lambda symbol: ~symbol.ctrl,
+            succ="COMMA",
+            action=lambda symbol: [
+                self.skp.eq(1),
+                *data_action(symbol)
+            ]
+        )
+        # Packets may start right after a SKP ordered set.
+        self.parser.rule(
+            name="SKP-N",
+            cond=is_framing,
+            succ="COMMA",
+            action=lambda symbol: [
+                self.skp.eq(1),
+                *data_action(symbol)
+            ]
+        )
+        self.parser.rule(
+            name="TSn-LINK/SKP-0",
+            cond=lambda symbol: symbol.raw_bits() == K(28,1),
+            succ="FTS-1"
+        )
+        self.parser.rule(
+            name="FTS-1",
+            cond=lambda symbol: symbol.raw_bits() == K(28,1),
+            succ="FTS-2"
+        )
+        self.parser.rule(
+            name="FTS-2",
+            cond=lambda symbol: symbol.raw_bits() == K(28,1),
+            succ="COMMA",
+            action=lambda symbol: [
+                self.fts.eq(1)
+            ]
+        )
+        self.parser.rule(
+            name="TSn-LINK/SKP-0",
+            cond=lambda symbol: symbol.raw_bits() == K(28,3),
+            succ="IDL-1"
+        )
+        self.parser.rule(
+            name="IDL-1",
+            cond=lambda symbol: symbol.raw_bits() == K(28,3),
+            succ="IDL-2"
+        )
+        self.parser.rule(
+            name="IDL-2",
+            cond=lambda symbol: symbol.raw_bits() == K(28,3),
+            succ="COMMA",
+            action=lambda symbol: [
+                self.eios.eq(1)
+            ]
+        )
         self.parser.rule(
             name="TSn-LANE",
             cond=lambda symbol: symbol.raw_bits() == K(23,7),
@@ -168,9 +343,13 @@ class PCIePHYRX(Module):
             action=lambda symbol: [
                 NextValue(self.ts.valid, 0),
                 If(ts_inv,
+                    ts_inverted.eq(1),
                     NextValue(lane.rx_invert, ~lane.rx_invert)
-                ).Elif(self._tsZ.raw_bits() == self._tsY.raw_bits(),
-                    NextValue(self.ts.raw_bits(), self._tsY.raw_bits())
+                ).Else(
+                    ts_received.eq(1),
+                    If(self._tsZ.raw_bits() == self._tsY.raw_bits(),
+                        NextValue(self.ts.raw_bits(), self._tsY.raw_bits())
+                    )
                 ),
                 NextState("COMMA")
             ]
@@ -9,17 +9,107 @@ __all__ = ["PCIePHYTX"]
 
 
 class PCIePHYTX(Module):
-    def __init__(self, lane):
-        self.e_idle = Signal()
-        self.comma  = Signal()
-        self.ts     = Record(ts_layout)
+    """
+    PCIe PHY transmitter. Emits TS1/TS2, FTS or EIOS ordered sets, data, or Electrical Idle.
+
+    Unless in Electrical Idle, a SKP ordered set is inserted for clock compensation once
+    every ``skp_interval`` symbol times, or when requested through ``skp``. SKP ordered sets
+    never interrupt another ordered set; a SKP ordered set that becomes due while one is being
+    transmitted is emitted right after it. FTS and EIOS ordered sets take priority over SKP
+    ordered sets, which in turn take priority over TS1/TS2 ordered sets and data. While
+    ``data_valid`` and ``data_hold`` are asserted, SKP ordered sets are postponed, so that they are
+    only inserted between packets.
+
+    Ordered sets are a multiple of 4 symbols long, and so start and end on word boundaries; data
+    is transmitted a whole word at a time.
+
+    An ordered set that has started is always completed, so ``e_idle`` may be asserted as soon
+    as ``comma`` indicates that an EIOS is being transmitted.
+
+    Parameters
+    ----------
+    lane : PCIeSERDESInterface
+        Lane to transmit to.
+    state_encoding : str
+        Encoding of the emitter FSM state; see :class:`EncodedFSM`.
+    skp_interval : int
+        Interval between SKP ordered sets, in symbol times. Must be between 1180 and 1538.
+
+    Attributes
+    ----------
+    e_idle : Signal
+        Input. Enter Electrical Idle once the current ordered set is completed.
+    eios : Signal
+        Input. Transmit EIOS ordered sets while asserted.
+    fts : Signal
+        Input. Transmit FTS ordered sets while asserted and ``eios`` is deasserted.
+    skp : Signal
+        Input. Strobe. Transmit a SKP ordered set as soon as possible.
+    comma : Signal
+        Output. Strobe. Asserted for the COM symbol of every TS1/TS2, FTS or EIOS ordered set.
+    skp_count : Signal(16)
+        Number of inserted SKP ordered sets. Wraps around.
+    data : Signal(9 * lane.ratio)
+        Input. Data symbols, with the 9th bit indicating a control symbol, e.g. a framing symbol.
+    data_valid : Signal
+        Input. Transmit ``data`` if no ordered set is due, instead of logical idle.
+    data_ready : Signal
+        Output. Strobe. Asserted if ``data`` is transmitted in this cycle.
+    data_hold : Signal
+        Input. Postpone SKP ordered sets while asserted, e.g. while a packet is being transmitted.
+    """
+    def __init__(self, lane, state_encoding="binary", skp_interval=1180):
+        if not 1180 <= skp_interval <= 1538:
+            raise ValueError("SKP interval must be between 1180 and 1538 symbol times, not {}"
+                             .format(skp_interval))
+
+        self.e_idle    = Signal()
+        self.eios      = Signal()
+        self.fts       = Signal()
+        self.skp       = Signal()
+        self.comma     = Signal()
+        self.ts        = Record(ts_layout)
+        self.skp_count = Signal(16)
+
+        self.data       = Signal(9 * lane.ratio)
+        self.data_valid = Signal()
+        self.data_ready = Signal()
+        self.data_hold  = Signal()
 
         ###
 
+        # The timer stops once a SKP ordered set is due; it is then delayed by at most one
+        # TS1/TS2 ordered set (16 symbols), which keeps the interval within 1538 symbol times.
+        skp_timer = Signal(max=skp_interval + lane.ratio)
+        skp_req   = Signal()
+        skp_due   = Signal()
+        skp_sent  = Signal()
+        skp_go    = Signal()
+        self.comb += [
+            skp_due.eq((skp_timer >= skp_interval) | skp_req | self.skp),
+            skp_go.eq(skp_due & ~(self.data_valid & self.data_hold)),
+        ]
+        self.sync += [
+            If(skp_sent,
+                skp_req.eq(0)
+            ).Elif(self.skp,
+                skp_req.eq(1)
+            ),
+            If(self.e_idle | skp_sent,
+                skp_timer.eq(0)
+            ).Elif(~skp_due,
+                skp_timer.eq(skp_timer + lane.ratio)
+            ),
+            If(skp_sent,
+                self.skp_count.eq(self.skp_count + 1)
+            )
+        ]
+
         self.submodules.emitter = Emitter(
             symbol_size=12,
             word_size=lane.ratio,
             reset_rule="IDLE",
+            state_encoding=state_encoding,
             layout=[
                 ("data",     8),
                 ("ctrl",     1),
@@ -46,7 +136,64 @@ class PCIePHYTX(Module):
         )
         self.emitter.rule(
             name="IDLE",
-            cond=lambda: self.ts.valid,
+            cond=lambda: ~self.e_idle & self.eios,
+            succ="IDL-1",
+            action=lambda symbol: [
+                self.comma.eq(1),
+                symbol.raw_bits().eq(K(28,5)),
+                symbol.set_disp.eq(1),
+                symbol.disp.eq(0)
+            ]
+        )
+        for n in range(1, 4):
+            self.emitter.rule(
+                name="IDL-%d" % n,
+                succ="IDLE" if n == 3 else "IDL-%d" % (n + 1),
+                action=lambda symbol: [
+                    symbol.raw_bits().eq(K(28,3))
+                ]
+            )
+        self.emitter.rule(
+            name="IDLE",
+            cond=lambda: ~self.e_idle & ~self.eios & self.fts,
+            succ="FTS-1",
+            action=lambda symbol: [
+                self.comma.eq(1),
+                symbol.raw_bits().eq(K(28,5)),
+                symbol.set_disp.eq(1),
+                symbol.disp.eq(0)
+            ]
+        )
+        for n in range(1, 4):
+            self.emitter.rule(
+                name="FTS-%d" % n,
+                succ="IDLE" if n == 3 else "FTS-%d" % (n + 1),
+                action=lambda symbol: [
+                    symbol.raw_bits().eq(K(28,1))
+                ]
+            )
+        self.emitter.rule(
+            name="IDLE",
+            cond=lambda: ~self.e_idle & ~self.eios & ~self.fts & skp_go,
+            succ="SKP-1",
+            action=lambda symbol: [
+                skp_sent.eq(1),
+                symbol.raw_bits().eq(K(28,5)),
+                symbol.set_disp.eq(1),
+                symbol.disp.eq(0)
+            ]
+        )
+        for n in range(1, 4):
+            self.emitter.rule(
+                name="SKP-%d" % n,
+                succ="IDLE" if n == 3 else "SKP-%d" % (n + 1),
+                action=lambda symbol: [
+                    symbol.raw_bits().eq(K(28,0))
+                ]
+            )
+        self.emitter.rule(
+            name="IDLE",
+            cond=lambda: ~self.e_idle & ~self.eios & ~self.fts & ~skp_go & self.ts.valid,
             succ="TSn-LINK",
             action=lambda symbol: [
                 self.comma.eq(1),
@@ -110,3 +257,21 @@ class PCIePHYTX(Module):
                     )
                 ]
             )
+        self.emitter.rule(
+            name="IDLE",
+            cond=lambda: ~self.e_idle & ~self.eios & ~self.fts & ~skp_go & ~self.ts.valid &
+                         self.data_valid,
+            succ="IDLE" if lane.ratio == 1 else "DATA-1",
+            action=lambda symbol: [
+                self.data_ready.eq(1),
+                Cat(symbol.data, symbol.ctrl).eq(self.data.part(0, 9))
+            ]
+        )
+        for n in range(1, lane.ratio):
+            self.emitter.rule(
+                name="DATA-%d" % n,
+                succ="IDLE" if n == lane.ratio - 1 else "DATA-%d" % (n + 1),
+                action=lambda symbol, n=n: [
+                    Cat(symbol.data, symbol.ctrl).eq(self.data.part(9 * n, 9))
+                ]
+            )
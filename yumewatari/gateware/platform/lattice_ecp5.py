@@ -1,5 +1,6 @@
 from migen import *
 from migen.genlib.cdc import *
+from migen.genlib.resetsync import AsyncResetSynchronizer
 
 from ..serdes import *
 
@@ -10,26 +11,41 @@ __all__ = ["LatticeECP5PCIeSERDES"]
 class LatticeECP5PCIeSERDES(Module):
     """
     Lattice ECP5 DCU configured in PCIe mode. Assumes 100 MHz reference clock on SERDES clock
-    input pair. Uses 1:2 gearing. Receiver Detection runs in TX clock domain. Only provides
-    a single lane.
+    input pair. Receiver Detection runs in TX clock domain. Only provides a single lane.
+
+    The DCU is configured for 5 GT/s, and runs at half rate (2.5 GT/s) unless ``lane.rate``
+    is asserted. The clocks below are twice as fast at 5 GT/s.
+
+    The DCU FIFOs are at most 2 symbols wide. With 1:4 gearing, the FIFOs are clocked by
+    the full rate DCU clocks, and a fabric gearbox converts between 2 and 4 symbols per cycle;
+    ``rx_clk_o`` and ``tx_clk_o`` are divided by 2 by a ``CLKDIVF``, and ``rx_clk_i`` and
+    ``tx_clk_i`` must be driven from them, since the gearbox requires phase aligned clocks.
 
     Parameters
     ----------
+    gearing : int
+        Symbols per cycle, 2 (default) or 4.
+
+    Attributes
+    ----------
     ref_clk : Signal
         100 MHz SERDES reference clock.
 
     rx_clk_o : Signal
-        125 MHz clock recovered from received data.
+        125 MHz (62.5 MHz with 1:4 gearing) clock recovered from received data.
     rx_clk_i : Signal
-        125 MHz clock for the receive FIFO.
+        125 MHz (62.5 MHz with 1:4 gearing) clock for the receive FIFO.
 
     tx_clk_o : Signal
-        125 MHz clock generated by transmit PLL.
+        125 MHz (62.5 MHz with 1:4 gearing) clock generated by transmit PLL.
     tx_clk_i : Signal
-        125 MHz clock for the transmit FIFO.
+        125 MHz (62.5 MHz with 1:4 gearing) clock for the transmit FIFO.
     """
 
-    def __init__(self, pins):
+    def __init__(self, pins, gearing=2):
+        if gearing not in (2, 4):
+            raise ValueError("Gearing must be 2 or 4, not {!r}".format(gearing))
+
         self.ref_clk = Signal() # reference clock
 
         self.specials.extref0 = Instance("EXTREFB",
@@ -45,7 +61,7 @@ class LatticeECP5PCIeSERDES(Module):
         self.rx_clk_i   = Signal()
         self.rx_bus     = Signal(24)
 
-        self.clock_domains.cd_rx = ClockDomain(reset_less=True)
+        self.clock_domains.cd_rx = ClockDomain("rx", reset_less=True)
         self.comb += self.cd_rx.clk.eq(self.rx_clk_i)
 
         rx_los   = Signal()
@@ -56,6 +72,7 @@ class LatticeECP5PCIeSERDES(Module):
         rx_lsm_s = Signal()
         rx_inv   = Signal()
         rx_det   = Signal()
+        rx_half  = Signal()
         self.specials += [
             MultiReg(rx_los, rx_los_s, odomain="rx"),
             MultiReg(rx_lol, rx_lol_s, odomain="rx"),
@@ -66,36 +83,83 @@ class LatticeECP5PCIeSERDES(Module):
         self.tx_clk_i   = Signal()
         self.tx_bus     = Signal(24)
 
-        self.clock_domains.cd_tx = ClockDomain(reset_less=True)
+        self.clock_domains.cd_tx = ClockDomain("tx", reset_less=True)
         self.comb += self.cd_tx.clk.eq(self.tx_clk_i)
 
         tx_lol   = Signal()
         tx_lol_s = Signal()
+        tx_half  = Signal()
         self.specials += [
             MultiReg(tx_lol, tx_lol_s, odomain="tx")
         ]
 
-        self.lane = lane = PCIeSERDESInterface(ratio=2)
+        self.lane = lane = PCIeSERDESInterface(ratio=gearing)
         self.comb += [
             rx_inv.eq(lane.rx_invert),
             rx_det.eq(lane.rx_align),
+            rx_half.eq(~lane.rate),
+            tx_half.eq(~lane.rate),
             lane.rx_present.eq(~rx_los_s),
             lane.rx_locked .eq(~rx_lol_s),
             lane.rx_aligned.eq(rx_lsm_s),
-            lane.rx_symbol.eq(Cat(self.rx_bus[ 0: 9],
-                                  self.rx_bus[12:21])),
-            # In theory, ``rx_bus[9:11]`` has disparity error and coding violation status
-            # signals, but in practice, they appear to be stuck at 1 and 0 respectively.
-            # However, the 8b10b decoder replaces errors with a "K14.7", which is not a legal
-            # point in 8b10b coding space, so we can use that as an indication.
-            lane.rx_valid.eq(Cat(self.rx_bus[ 0: 9] != 0x1EE,
-                                 self.rx_bus[12:21] != 0x1EE)),
         ]
+
+        # In theory, ``rx_bus[9:11]`` has disparity error and coding violation status
+        # signals, but in practice, they appear to be stuck at 1 and 0 respectively.
+        # However, the 8b10b decoder replaces errors with a "K14.7", which is not a legal
+        # point in 8b10b coding space, so we can use that as an indication.
+        rx_word = Cat(self.rx_bus[ 0: 9], self.rx_bus[ 0: 9] != 0x1EE,
+                      self.rx_bus[12:21], self.rx_bus[12:21] != 0x1EE)
+        tx_word = Cat(*[Cat(lane.tx_symbol[9 * n:9 * (n + 1)],
+                            lane.tx_set_disp[n], lane.tx_disp[n], lane.tx_e_idle[n])
+                        for n in range(gearing)])
+
+        if gearing == 2:
+            rx_fifo_clk = self.rx_clk_i
+            tx_fifo_clk = self.tx_clk_i
+        else:
+            rx_fifo_clk = Signal()
+            tx_fifo_clk = Signal()
+            self.specials += [
+                Instance("CLKDIVF",
+                    i_CLKI=rx_fifo_clk, i_RST=0, i_ALIGNWD=0, o_CDIVX=self.rx_clk_o,
+                    p_DIV="2.0"),
+                Instance("CLKDIVF",
+                    i_CLKI=tx_fifo_clk, i_RST=0, i_ALIGNWD=0, o_CDIVX=self.tx_clk_o,
+                    p_DIV="2.0"),
+            ]
+
+            # The gearbox needs its domains to be reset until the clocks are stable.
+            self.clock_domains.cd_rx_full = ClockDomain("rx_full")
+            self.clock_domains.cd_rx_gear = ClockDomain("rx_gear")
+            self.clock_domains.cd_tx_full = ClockDomain("tx_full")
+            self.clock_domains.cd_tx_gear = ClockDomain("tx_gear")
+            self.comb += [
+                self.cd_rx_full.clk.eq(rx_fifo_clk),
+                self.cd_rx_gear.clk.eq(self.rx_clk_i),
+                self.cd_tx_full.clk.eq(tx_fifo_clk),
+                self.cd_tx_gear.clk.eq(self.tx_clk_i),
+            ]
+            self.specials += [
+                AsyncResetSynchronizer(self.cd_rx_full, rx_lol),
+                AsyncResetSynchronizer(self.cd_rx_gear, rx_lol),
+                AsyncResetSynchronizer(self.cd_tx_full, tx_lol),
+                AsyncResetSynchronizer(self.cd_tx_gear, tx_lol),
+            ]
+
+            self.submodules.rx_gearbox = rx_gearbox = Gearbox(20, "rx_full", 40, "rx_gear")
+            self.submodules.tx_gearbox = tx_gearbox = Gearbox(48, "tx_gear", 24, "tx_full")
+            self.comb += [
+                rx_gearbox.i.eq(rx_word),
+                tx_gearbox.i.eq(tx_word),
+            ]
+            rx_word = rx_gearbox.o
+            tx_word = tx_gearbox.o
+
         self.comb += [
-            self.tx_bus.eq(Cat(lane.tx_symbol[0: 9],
-                               lane.tx_set_disp[0], lane.tx_disp[0], lane.tx_e_idle[0],
-                               lane.tx_symbol[9:18],
-                               lane.tx_set_disp[1], lane.tx_disp[1], lane.tx_e_idle[1])),
+            lane.rx_symbol.eq(Cat(*[rx_word[10 * n:10 * n + 9] for n in range(gearing)])),
+            lane.rx_valid .eq(Cat(*[rx_word[10 * n + 9]        for n in range(gearing)])),
+            self.tx_bus.eq(tx_word),
         ]
 
         pcie_det_en = Signal()
@@ -196,7 +260,7 @@ class LatticeECP5PCIeSERDES(Module):
             i_D_REFCLKI             = self.ref_clk,
             o_D_FFS_PLOL            = tx_lol,
             p_D_REFCK_MODE          = "0b100",  # 25x REFCLK
-            p_D_TX_MAX_RATE         = "2.5",    # 2.5 Gbps
+            p_D_TX_MAX_RATE         = "5.0",    # 5 Gbps
             p_D_TX_VCO_CK_DIV       = "0b000",  # DIV/1
             p_D_BITCLK_LOCAL_EN     = "0b1",    # undocumented (PCIe sample code used)
 
@@ -249,11 +313,12 @@ class LatticeECP5PCIeSERDES(Module):
 
             # CH0 RX ­— clocking
             i_CH0_RX_REFCLK         = self.ref_clk,
-            o_CH0_FF_RX_PCLK        = self.rx_clk_o,
-            i_CH0_FF_RXI_CLK        = self.rx_clk_i,
+            o_CH0_FF_RX_PCLK        = self.rx_clk_o if gearing == 2 else rx_fifo_clk,
+            i_CH0_FF_RXI_CLK        = rx_fifo_clk,
 
-            p_CH0_CDR_MAX_RATE      = "2.5",    # 2.5 Gbps
+            p_CH0_CDR_MAX_RATE      = "5.0",    # 5 Gbps
             p_CH0_RX_DCO_CK_DIV     = "0b000",  # DIV/1
+            i_CH0_FFC_RATE_MODE_RX  = rx_half,  # DIV/2 if 2.5 Gbps
             p_CH0_RX_GEAR_MODE      = "0b1",    # 1:2 gearbox
             p_CH0_FF_RX_H_CLK_EN    = "0b1",    # enable  DIV/2 output clock
             p_CH0_FF_RX_F_CLK_DIS   = "0b1",    # disable DIV/1 output clock
@@ -338,9 +403,10 @@ class LatticeECP5PCIeSERDES(Module):
             p_CH0_TDRV_SLICE5_SEL   = "0b00",   # power down
 
             # CH0 TX ­— clocking
-            o_CH0_FF_TX_PCLK        = self.tx_clk_o,
-            i_CH0_FF_TXI_CLK        = self.tx_clk_i,
+            o_CH0_FF_TX_PCLK        = self.tx_clk_o if gearing == 2 else tx_fifo_clk,
+            i_CH0_FF_TXI_CLK        = tx_fifo_clk,
 
+            i_CH0_FFC_RATE_MODE_TX  = tx_half,  # DIV/2 if 2.5 Gbps
             p_CH0_TX_GEAR_MODE      = "0b1",    # 1:2 gearbox
             p_CH0_FF_TX_H_CLK_EN    = "0b1",    # enable  DIV/2 output clock
             p_CH0_FF_TX_F_CLK_DIS   = "0b1",    # disable DIV/1 output clock
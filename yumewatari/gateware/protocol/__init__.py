@@ -1,3 +1,4 @@
 from .engine import Memory, NextMemory
 from .parser import Parser
 from .emitter import Emitter
+from .executor import Executor
@@ -1,13 +1,20 @@
 from collections import namedtuple, defaultdict
 from migen import *
-from migen.fhdl.structure import _Value, _Statement
-from migen.genlib.fsm import _LowerNext, FSM
+from migen.fhdl.structure import _Value, _Statement, _Operator, _Slice, _Part
+from migen.fhdl.module import FinalizeError
+from migen.fhdl.visit import NodeTransformer
+from migen.genlib.fsm import NextValue
+
+from ..fsm import EncodedFSM
 
 
 class Memory(_Value):
     def __init__(self, target):
         self.target = target
 
+    def __len__(self):
+        return len(self.target)
+
 
 class NextMemory(_Statement):
     def __init__(self, target, value):
@@ -15,61 +22,255 @@ class NextMemory(_Statement):
         self.value  = value
 
 
-class _LowerMemory(_LowerNext):
-    def __init__(self, *args):
-        super().__init__(*args)
-        # (target, next_value_ce, next_value)
-        self.memories = []
+def _value_key(value):
+    """
+    Return a hashable key that is equal for structurally identical values, such that e.g.
+    two separately constructed ``symbol.raw_bits() == K(28,5)`` expressions compare equal.
+    """
+    value = wrap(value)
+    if isinstance(value, Constant):
+        return (Constant, value.value, value.nbits, value.signed)
+    elif isinstance(value, Signal):
+        return (Signal, value.duid)
+    elif isinstance(value, Memory):
+        return (Memory, value.target.duid)
+    elif isinstance(value, _Operator):
+        return (_Operator, value.op, *(_value_key(o) for o in value.operands))
+    elif isinstance(value, _Slice):
+        return (_Slice, _value_key(value.value), value.start, value.stop)
+    elif isinstance(value, _Part):
+        return (_Part, _value_key(value.value), _value_key(value.offset), value.width)
+    elif isinstance(value, Cat):
+        return (Cat, *(_value_key(v) for v in value.l))
+    elif isinstance(value, Replicate):
+        return (Replicate, _value_key(value.v), value.n)
+    else:
+        return (_Value, value.duid)
 
-    def _get_memory_control(self, memory):
-        for target, next_value_ce, next_value in self.memories:
-            if target is memory:
-                break
-        else:
-            next_value_ce = Signal(related=memory)
-            next_value    = Signal(memory.nbits, related=memory)
-            self.memories.append((memory, next_value_ce, next_value))
-        return next_value_ce, next_value
+
+def _key_uses_memory(key):
+    return key[0] is Memory or any(isinstance(k, tuple) and _key_uses_memory(k) for k in key)
+
+
+class _MemoryViews:
+    """
+    Values of every :class:`Memory` target at the beginning of each slot of a word. The value at
+    the beginning of a slot reflects the ``NextMemory`` statements of the preceding slots only,
+    regardless of the order in which the statements of different slots are evaluated.
+    """
+    def __init__(self, word_size):
+        self.word_size = word_size
+        # target -> ([value at the beginning of each slot and after the last one],
+        #            [(write enable, write value) of each slot])
+        self.targets = {}
+
+    def _get(self, target):
+        if target not in self.targets:
+            views  = [target] + [Signal.like(target, related=target)
+                                 for _ in range(self.word_size)]
+            writes = [(Signal(related=target), Signal.like(target, related=target))
+                      for _ in range(self.word_size)]
+            self.targets[target] = (views, writes)
+        return self.targets[target]
+
+    def view(self, target, slot):
+        views, _ = self._get(target)
+        return views[slot]
+
+    def write(self, target, slot):
+        _, writes = self._get(target)
+        return writes[slot]
+
+    def get_statements(self):
+        comb, sync = [], []
+        for target, (views, writes) in self.targets.items():
+            for slot, (write_enable, write_value) in enumerate(writes):
+                comb.append(views[slot + 1].eq(Mux(write_enable, write_value, views[slot])))
+            sync.append(target.eq(views[-1]))
+        return comb, sync
+
+
+class _LowerMemory(NodeTransformer):
+    def __init__(self, views, slot):
+        self.views = views
+        self.slot  = slot
 
     def visit_unknown(self, node):
         if isinstance(node, Memory):
-            next_value_ce, next_value = self._get_memory_control(node.target)
-            return Mux(next_value_ce, next_value, node.target)
+            return self.views.view(node.target, self.slot)
         elif isinstance(node, NextMemory):
-            next_value_ce, next_value = self._get_memory_control(node.target)
-            return next_value_ce.eq(1), next_value.eq(node.value)
+            write_enable, write_value = self.views.write(node.target, self.slot)
+            return write_enable.eq(1), write_value.eq(self.visit(node.value))
+        elif isinstance(node, NextValue):
+            return NextValue(node.target, self.visit(node.value))
         else:
-            return super().visit_unknown(node)
+            return node
 
 
-class _ProtocolFSM(FSM):
-    def _lower_controls(self):
-        return _LowerMemory(self.next_state, self.encoding, self.state_aliases)
+class _ProtocolFSM(EncodedFSM):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prologue = []
+        self.epilogue = []
+
+    def act_prologue(self, *statements):
+        """
+        Schedules ``statements`` to be executed in every state, before the statements specific
+        to the current state.
+        """
+        if self.finalized:
+            raise FinalizeError
+        self.prologue += statements
+
+    def act_epilogue(self, *statements):
+        """
+        Schedules ``statements`` to be executed in every state, after the statements specific
+        to the current state.
+        """
+        if self.finalized:
+            raise FinalizeError
+        self.epilogue += statements
 
     def _finalize_sync(self, ls):
-        super()._finalize_sync(ls)
-        for memory, next_value_ce, next_value in ls.memories:
-            self.sync += If(next_value_ce, memory.eq(next_value))
+        self.comb += [
+            self.next_state.eq(self.state),
+            *ls.visit(self.prologue),
+            *self._get_state_cases(ls),
+            *ls.visit(self.epilogue)
+        ]
+        self.sync += self.state.eq(self.next_state)
+        for register, next_value_ce, next_value in ls.registers:
+            self.sync += If(next_value_ce, register.eq(next_value))
 
 
 _Rule = namedtuple("_Rule", ("name", "cond", "succ", "action"))
 
 
+_ProtocolStats = namedtuple("_ProtocolStats", ("states", "nodes", "rules", "tuples"))
+
+
 class _ProtocolEngine(Module):
-    def __init__(self, symbol_size, word_size, reset_rule):
+    """
+    Attributes
+    ----------
+    stats : _ProtocolStats
+        Elaboration statistics, available after finalization: the number of FSM states,
+        of (state, slot) nodes, of rules instantiated across all nodes, and of rule tuples
+        (paths of ``word_size`` rules starting at a state) matched by the FSM.
+    """
+    def __init__(self, symbol_size, word_size, reset_rule, state_encoding="binary"):
         self._symbol_size = symbol_size
         self._word_size   = word_size
         self._reset_rule  = reset_rule
+        self._state_encoding = state_encoding
         # name -> [(cond, succ, action)]
         self._grammar = defaultdict(lambda: [])
 
+        self.stats = None
+
     def rule(self, name, succ, cond=lambda *_: True, action=lambda symbol: []):
         self._grammar[name].append(_Rule(name, cond, succ, action))
 
-    def _get_rule_tuples(self, rule_name, rule_tuples, rule_path=()):
-        if len(rule_path) == self._word_size:
-            rule_tuples.add(rule_path)
-            return
+    def _rule_cond_value(self, rule, symbol):
+        raise NotImplementedError
+
+    def _rule_cond(self, rule, slot, symbol):
+        return self._rule_cond_value(rule, symbol)
+
+    def _word_prologue(self):
+        return []
+
+    def _slot_prologue(self, slot):
+        return []
+
+    def _rule_leaf(self, rule_name):
+        return [NextState(rule_name)]
+
+    def _get_rule_nodes(self):
+        # Each word is matched by a path of ``word_size`` rules, which begins at the current
+        # state at slot 0 and ends at the next state after the last slot. Instead of
+        # enumerating every such path (which is exponential in ``word_size``), compute the set
+        # of rules reachable at each slot; every (rule, slot) node is then instantiated once
+        # and shared between all paths that pass through it.
+        states = []
+        slots  = [set() for _ in range(self._word_size)]
+        worklist = [self._reset_rule]
+        while worklist:
+            rule_name = worklist.pop(0)
+            if rule_name in states:
+                continue
+            states.append(rule_name)
+
+            nodes = {rule_name}
+            for slot in range(self._word_size):
+                slots[slot] |= nodes
+                nodes = {rule.succ for node in nodes for rule in self._grammar[node]}
+            worklist += sorted(nodes)
+        return states, [states] + [sorted(nodes) for nodes in slots[1:]]
+
+    def _get_tuple_count(self, states):
+        counts = defaultdict(lambda: 1)
+        for slot in range(self._word_size):
+            counts = defaultdict(lambda: 0, {
+                rule_name: sum(counts[rule.succ] for rule in rules)
+                for rule_name, rules in self._grammar.items()
+            })
+        return sum(counts[rule_name] for rule_name in states)
+
+    def _elaborate(self, fsm, symbols, debug=False):
+        states, slots = self._get_rule_nodes()
+
+        # Signals that are asserted if a path matched up to the beginning of a given slot
+        # reaches a given rule. There is no such signal for slot 0, since the FSM state
+        # serves that purpose.
+        reached = [{rule_name: Signal() for rule_name in nodes} if slot > 0 else None
+                   for slot, nodes in enumerate(slots)]
+
+        memory_views = _MemoryViews(self._word_size)
+
+        n_rules = 0
+        for slot, nodes in enumerate(slots):
+            symbol = symbols[slot]
+            node_actions = []
+            for rule_name in nodes:
+                if debug:
+                    print("  Slot %d State %s" % (slot, rule_name))
+
+                actions = []
+                for rule in self._grammar[rule_name]:
+                    if debug:
+                        print("    %s -> %s" % (rule_name, rule.succ))
+
+                    if slot == self._word_size - 1:
+                        succ_action = self._rule_leaf(rule.succ)
+                    else:
+                        succ_action = [reached[slot + 1][rule.succ].eq(1)]
+                    actions.append(
+                        If(self._rule_cond(rule, slot, symbol),
+                            rule.action(symbol),
+                            *succ_action
+                        )
+                    )
+                    n_rules += 1
+                node_actions.append((rule_name, actions))
+
+            lower = _LowerMemory(memory_views, slot)
+            if slot == 0:
+                fsm.act_prologue(*lower.visit(self._slot_prologue(slot)))
+                for rule_name, actions in node_actions:
+                    fsm.act(rule_name, lower.visit(actions))
+            else:
+                fsm.act_epilogue(*lower.visit(self._slot_prologue(slot)))
+                for rule_name, actions in node_actions:
+                    fsm.act_epilogue(If(reached[slot][rule_name], *lower.visit(actions)))
+
+        # The memory registers are a part of the FSM, so that they are reset together with it.
+        memory_comb, memory_sync = memory_views.get_statements()
+        fsm.comb += memory_comb
+        fsm.sync += memory_sync
 
-        for rule in self._grammar[rule_name]:
-            self._get_rule_tuples(rule.succ, rule_tuples, rule_path + (rule,))
+        self.stats = _ProtocolStats(
+            states=len(states),
+            nodes=sum(len(nodes) for nodes in slots),
+            rules=n_rules,
+            tuples=self._get_tuple_count(states))
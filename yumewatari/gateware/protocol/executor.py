@@ -0,0 +1,274 @@
+from migen import *
+from migen.fhdl.tools import list_signals, list_targets
+from migen.fhdl.visit import NodeTransformer
+from migen.genlib.fsm import NextState, NextValue
+from migen.sim.core import Evaluator
+
+from .engine import Memory, NextMemory
+from .parser import Parser
+from .emitter import Emitter
+
+
+__all__ = ["Executor"]
+
+
+class _LowerExecutor(NodeTransformer):
+    def __init__(self):
+        # target -> signal holding the value of Memory(target) at this point in the cycle
+        self.memories = {}
+
+    def _get_memory_view(self, target):
+        if target not in self.memories:
+            self.memories[target] = Signal.like(target)
+        return self.memories[target]
+
+    def visit_unknown(self, node):
+        if isinstance(node, Memory):
+            return self._get_memory_view(node.target)
+        elif isinstance(node, NextMemory):
+            return NextMemory(node.target, self.visit(node.value))
+        elif isinstance(node, NextValue):
+            return NextValue(node.target, self.visit(node.value))
+        else:
+            return node
+
+
+class _Evaluator(Evaluator):
+    def __init__(self, executor):
+        super().__init__(clock_domains={}, replaced_memories={})
+        self.executor = executor
+
+    def assign(self, node, value):
+        if isinstance(node, Signal):
+            # Combinatorial assignments made by actions are visible immediately.
+            self.signal_values[node] = value & ((1 << node.nbits) - 1)
+        else:
+            super().assign(node, value)
+
+    def execute(self, statements):
+        for s in statements:
+            if isinstance(s, NextState):
+                self.executor._next_state = s.state
+            elif isinstance(s, NextValue):
+                self.executor._next_values.append((s.target, self.eval(wrap(s.value))))
+            elif isinstance(s, NextMemory):
+                value = self.eval(wrap(s.value))
+                self.executor._next_values.append((s.target, value))
+                self.assign(self.executor._lower._get_memory_view(s.target), value)
+            else:
+                super().execute([s])
+
+
+class Executor:
+    """
+    Reference executor for :class:`Parser` and :class:`Emitter` grammars.
+
+    Interprets the rules registered on a protocol engine directly in Python, one word at a time,
+    with the same semantics as the gateware produced by the engine: the rules of every state
+    reachable at a given slot are tried in order of registration, ``NextValue`` and
+    ``NextMemory`` take effect at the end of the word, and for a parser, an unmatched word
+    asserts ``error`` and resets the state and every register written by the rules.
+
+    This is significantly faster than simulating the gateware and is useful for testing
+    the grammar against large amounts of input. Timing is not modelled; e.g. the additional
+    latency of a pipelined :class:`Parser` is not reproduced.
+
+    Signals that the grammar refers to but that are not driven by it (e.g. inputs of
+    the emitter) can be set by assigning to ``executor[signal]``; any value or record
+    the grammar refers to can be read as ``executor[value]``. Reading a record returns
+    a dictionary of its fields.
+
+    Parameters
+    ----------
+    engine : Parser or Emitter
+        Protocol engine to execute. The engine does not need to be finalized.
+
+    Attributes
+    ----------
+    state : str
+        Current state.
+    error : bool
+        Parser only. Asserted if the last word could not be matched.
+    """
+    def __init__(self, engine):
+        if not isinstance(engine, (Parser, Emitter)):
+            raise TypeError("Cannot execute {!r}; expected a Parser or Emitter"
+                            .format(engine))
+
+        self._engine = engine
+        self._lower  = _LowerExecutor()
+        self._eval   = _Evaluator(self)
+
+        if isinstance(engine, Parser):
+            self._symbols = engine._i
+        else:
+            self._symbols = engine._o
+
+        states, slots = engine._get_rule_nodes()
+        # slot -> [(rule_name, [(cond, statements, succ)])]
+        self._slots = []
+        comb_targets = set()
+        sync_targets = set()
+        for slot, nodes in enumerate(slots):
+            symbol = self._symbols[slot]
+            slot_rules = []
+            for rule_name in nodes:
+                node_rules = []
+                for rule in engine._grammar[rule_name]:
+                    cond = self._lower.visit(wrap(engine._rule_cond_value(rule, symbol)))
+                    statements = self._lower.visit(rule.action(symbol))
+                    node_rules.append((cond, statements, rule.succ))
+                    comb_targets |= list_targets(statements)
+                    sync_targets |= self._list_sync_targets(statements)
+                slot_rules.append((rule_name, node_rules))
+            self._slots.append(slot_rules)
+        if isinstance(engine, Parser):
+            comb_targets.add(engine.error)
+        self._comb_targets = comb_targets
+        self._sync_targets = sync_targets
+
+        self.reset()
+
+    @staticmethod
+    def _list_sync_targets(statements):
+        targets = set()
+        def visit(statements):
+            for s in statements:
+                if isinstance(s, (NextValue, NextMemory)):
+                    targets.update(list_signals(s.target))
+                elif isinstance(s, If):
+                    visit(s.t)
+                    visit(s.f)
+                elif isinstance(s, Case):
+                    for case in s.cases.values():
+                        visit(case)
+                elif isinstance(s, (list, tuple)):
+                    visit(s)
+        visit(statements)
+        return targets
+
+    def reset(self):
+        """Return to the reset state and reset every register written by the rules."""
+        self.state = self._engine._reset_rule
+        self.error = False
+        for signal in self._sync_targets:
+            self._eval.signal_values[signal] = signal.reset.value
+
+    def __getitem__(self, value):
+        if isinstance(value, Record):
+            fields = {}
+            for name, *_ in value.layout:
+                fields[name] = self[getattr(value, name)]
+            return fields
+        return self._eval.eval(wrap(value))
+
+    def __setitem__(self, signal, value):
+        self._eval.assign(signal, int(value))
+
+    def _is_true(self, value):
+        return self._eval.eval(value) & ((1 << len(value)) - 1)
+
+    def step(self, word=None, reset=False):
+        """
+        Process a single word.
+
+        Parameters
+        ----------
+        word : int or sequence of int
+            Parser only. Input word, either as a single integer, or as a sequence of
+            ``word_size`` symbols.
+        reset : bool
+            Parser only. Value of the ``reset`` input during this word.
+
+        Returns the state after this word.
+        """
+        engine = self._engine
+        if isinstance(engine, Parser):
+            if isinstance(word, int):
+                word = [(word >> (n * engine._symbol_size)) & ((1 << engine._symbol_size) - 1)
+                        for n in range(engine._word_size)]
+            for symbol, value in zip(self._symbols, word):
+                if isinstance(symbol, Record):
+                    symbol = symbol.raw_bits()
+                self._eval.assign(symbol, int(value))
+
+        for signal in self._comb_targets:
+            self._eval.signal_values[signal] = signal.reset.value
+        for target, view in self._lower.memories.items():
+            self._eval.signal_values[view] = self[target]
+        if isinstance(engine, Parser):
+            self._eval.execute(engine._word_prologue())
+
+        self._next_state  = self.state
+        self._next_values = []
+        reached = {self.state}
+        for slot, slot_rules in enumerate(self._slots):
+            # Conditions are evaluated before the actions of the slot, like the parser
+            # condition bank.
+            matches = [
+                (rule_name, [(self._is_true(cond), statements, succ)
+                             for cond, statements, succ in node_rules])
+                for rule_name, node_rules in slot_rules if rule_name in reached
+            ]
+
+            reached = set()
+            for rule_name, node_rules in matches:
+                for matched, statements, succ in node_rules:
+                    if not matched:
+                        continue
+                    self._eval.execute(statements)
+                    if slot == engine._word_size - 1:
+                        self._eval.execute(engine._rule_leaf(succ))
+                    else:
+                        reached.add(succ)
+
+        error = isinstance(engine, Parser) and bool(self[engine.error])
+        if error or reset:
+            # The parser FSM, including every register written by the rules, is reset
+            # on error.
+            self.reset()
+        else:
+            for target, value in self._next_values:
+                self._eval.assign(target, value)
+            self.state = self._next_state
+        self.error = error
+        return self.state
+
+    def run(self, symbols):
+        """
+        Parse a stream of symbols.
+
+        Parameters
+        ----------
+        symbols : sequence of int
+            Input symbols, e.g. a list or a NumPy array. Its length must be a multiple of
+            ``word_size``.
+
+        Returns a list of ``(state, error)`` tuples, one per word, where ``state`` is the state
+        after the word.
+        """
+        word_size = self._engine._word_size
+        if len(symbols) % word_size != 0:
+            raise ValueError("Symbol count {} is not a multiple of word size {}"
+                             .format(len(symbols), word_size))
+
+        trace = []
+        for offset in range(0, len(symbols), word_size):
+            state = self.step(symbols[offset:offset + word_size])
+            trace.append((state, self.error))
+        return trace
+
+    def emit(self, count):
+        """
+        Emit ``count`` words.
+
+        Returns a list of words, each a tuple of ``word_size`` symbols.
+        """
+        words = []
+        for _ in range(count):
+            self.step()
+            words.append(tuple(
+                self[symbol.raw_bits() if isinstance(symbol, Record) else symbol]
+                for symbol in self._symbols
+            ))
+        return words
@@ -1,72 +1,138 @@
 import os
 from migen import *
 
-from .engine import _ProtocolFSM, _ProtocolEngine
+from .engine import _ProtocolFSM, _ProtocolEngine, _value_key, _key_uses_memory
 
 
 _DEBUG = os.getenv("DEBUG_PARSER")
 
 
 class Parser(_ProtocolEngine):
-    def __init__(self, symbol_size, word_size, reset_rule, layout=None):
-        super().__init__(symbol_size, word_size, reset_rule)
+    """
+    Protocol parser. Accepts a word of ``word_size`` symbols per cycle and matches it against
+    the grammar defined using :meth:`rule`, one rule per symbol.
+
+    Parameters
+    ----------
+    symbol_size : int
+        Symbol width, in bits.
+    word_size : int
+        Word size, in symbols.
+    reset_rule : str
+        Name of the rule matched after reset or error.
+    layout : list or None
+        If specified, symbols are passed to rule conditions and actions as a record with
+        this layout.
+    pipeline : bool
+        If true, classification of the input symbols (i.e. evaluation of all rule conditions
+        that depend only on the symbol) is registered, and the state transition is performed
+        in the next cycle. Conditions that use :class:`Memory` are evaluated together with
+        the state transition. The ``error`` output and all rule actions are delayed by
+        ``latency`` cycles relative to ``i`` and ``reset``.
+    state_encoding : str
+        Encoding of the FSM state; see :class:`EncodedFSM`.
+
+    Attributes
+    ----------
+    i : Signal(symbol_size * word_size)
+        Input word.
+    reset : Signal
+        Reset input. Assert to return to ``reset_rule``.
+    error : Signal
+        Asserted if the input word could not be matched.
+    latency : int
+        Latency of ``error`` and rule actions, in cycles, relative to inputs; 1 if
+        ``pipeline`` is true, 0 otherwise.
+    """
+    def __init__(self, symbol_size, word_size, reset_rule, layout=None, pipeline=False,
+                 state_encoding="binary"):
+        super().__init__(symbol_size, word_size, reset_rule, state_encoding)
 
         self.reset = Signal()
         self.error = Signal()
         self.i     = Signal(symbol_size * word_size)
 
+        self.latency = 1 if pipeline else 0
+
         ###
 
-        self._i = [self.i.part(n * symbol_size, symbol_size) for n in range(word_size)]
+        self._pipeline = pipeline
+        self._reset = Signal()
+        self._i_early = self._get_symbols(self.i, layout)
+        if pipeline:
+            i = Signal.like(self.i)
+            self.sync += [
+                i.eq(self.i),
+                self._reset.eq(self.reset),
+            ]
+            self._i = self._get_symbols(i, layout)
+        else:
+            self.comb += self._reset.eq(self.reset)
+            self._i = self._i_early
+
+        # Per-slot condition vector; each distinct condition that appears in any rule is
+        # evaluated exactly once per slot, and every rule then refers to the same signal.
+        # slot -> {key: (value, signal)}
+        self._conds = [{} for n in range(word_size)]
+
+    def _get_symbols(self, word, layout):
+        symbols = [word.part(n * self._symbol_size, self._symbol_size)
+                   for n in range(self._word_size)]
         if layout is not None:
-            for n in range(word_size):
+            for n in range(self._word_size):
                 irec = Record(layout)
-                self.comb += irec.raw_bits().eq(self._i[n])
-                self._i[n] = irec
+                self.comb += irec.raw_bits().eq(symbols[n])
+                symbols[n] = irec
+        return symbols
+
+    def _rule_cond_value(self, rule, symbol):
+        return rule.cond(symbol)
+
+    def _rule_cond(self, rule, slot, symbol):
+        value = wrap(self._rule_cond_value(rule, symbol))
+        if isinstance(value, Constant):
+            return value
+
+        key = _value_key(value)
+        if key in self._conds[slot]:
+            _, cond = self._conds[slot][key]
+            return cond
+
+        cond = Signal(name="cond%d_%d" % (slot, len(self._conds[slot])))
+        self._conds[slot][key] = (value, cond)
+        if not _key_uses_memory(key):
+            if self._pipeline:
+                self.sync += cond.eq(self._rule_cond_value(rule, self._i_early[slot]))
+            else:
+                self.comb += cond.eq(value)
+        return cond
+
+    def _slot_prologue(self, slot):
+        # Conditions that refer to a Memory depend on the values written by NextMemory in
+        # the preceding slots, so they have to be evaluated in order with the FSM actions.
+        return [
+            cond.eq(value)
+            for key, (value, cond) in self._conds[slot].items() if _key_uses_memory(key)
+        ]
+
+    def _word_prologue(self):
+        return [self.error.eq(1)]
+
+    def _rule_leaf(self, rule_name):
+        return [
+            self.error.eq(0),
+            NextState(rule_name)
+        ]
 
     def do_finalize(self):
-        self.submodules.fsm = ResetInserter()(_ProtocolFSM())
-        self.comb += self.fsm.reset.eq(self.reset | self.error)
+        self.submodules.fsm = ResetInserter()(_ProtocolFSM(state_encoding=self._state_encoding))
+        self.comb += self.fsm.reset.eq(self._reset | self.error)
+        self.fsm.act_prologue(*self._word_prologue())
 
         if _DEBUG:
             print("Parser layout:")
-        worklist  = {self._reset_rule}
-        processed = set()
-        while worklist:
-            rule_name = worklist.pop()
-            processed.add(rule_name)
-
-            if _DEBUG:
-                print("  State %s" % rule_name)
-
-            rule_tuples = set()
-            self._get_rule_tuples(rule_name, rule_tuples)
-
-            actions = []
-            for i, rule_tuple in enumerate(rule_tuples):
-                if _DEBUG:
-                    print("    Input #%d %s -> %s" %
-                          (i, rule_name, " -> ".join(rule.succ for rule in rule_tuple)))
-
-                succ = rule_tuple[-1].succ
-                action = [
-                    self.error.eq(0),
-                    NextState(succ)
-                ]
-                for j, rule in enumerate(reversed(rule_tuple)):
-                    symbol = self._i[self._word_size - j - 1]
-                    action = [
-                        If(rule.cond(symbol),
-                            rule.action(symbol),
-                            *action
-                        ),
-                    ]
-
-                actions.append(action)
-                if succ not in processed:
-                    worklist.add(succ)
-
-            self.fsm.act(rule_name, [
-                self.error.eq(1),
-                *actions
-            ])
+        self._elaborate(self.fsm, self._i, debug=_DEBUG)
+
+        if _DEBUG:
+            for slot, conds in enumerate(self._conds):
+                print("  Slot %d: %d conditions" % (slot, len(conds)))
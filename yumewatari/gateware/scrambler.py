@@ -0,0 +1,183 @@
+from functools import reduce
+from operator import xor
+from migen import *
+
+from .serdes import K, PCIeSERDESInterface
+
+
+__all__ = ["PCIeScrambler", "PCIeSERDESScrambler"]
+
+
+def _lfsr_advance(state, count):
+    """
+    Advance the PCIe LFSR (G(X) = X^16 + X^5 + X^4 + X^3 + 1) by ``count`` bits symbolically.
+    ``state`` is a list of 16 bit masks, each bit of which stands for a bit of the initial state.
+    Returns the list of bit masks of the output bits and the list of bit masks of the new state.
+    """
+    output = []
+    for _ in range(count):
+        output.append(state[15])
+        state = [
+            state[15],
+            state[0],
+            state[1],
+            state[2] ^ state[15],
+            state[3] ^ state[15],
+            state[4] ^ state[15],
+            *state[5:15]
+        ]
+    return output, state
+
+
+def _lfsr_apply(masks, state):
+    return Cat(reduce(xor, [state[n] for n in range(len(state)) if mask & (1 << n)])
+               for mask in masks)
+
+
+class PCIeScrambler(Module):
+    """
+    PCIe scrambler. Since scrambling is an XOR with the output of an LFSR, the same module
+    is used as a descrambler.
+
+    Every clock cycle, the LFSR is advanced by all symbols of the word at once, i.e. by up to
+    ``8 * ratio`` bits; the equations for every symbol are unrolled at elaboration time.
+    The LFSR is reset by a COM symbol, and is not advanced by SKP symbols. Control symbols and
+    the symbols of TS1/TS2 ordered sets (which are recognized by the COM symbol followed by
+    a PAD or a data symbol) are not scrambled.
+
+    The output is registered.
+
+    Parameters
+    ----------
+    ratio : int
+        Word size, in symbols.
+
+    Attributes
+    ----------
+    i : Signal(9 * ratio)
+        Input word.
+    o : Signal(9 * ratio)
+        Output word.
+    bypass : Signal
+        If asserted, symbols are passed through unchanged. The LFSR is advanced regardless.
+    """
+    def __init__(self, ratio):
+        self.i      = Signal(9 * ratio)
+        self.o      = Signal(9 * ratio)
+        self.bypass = Signal()
+
+        ###
+
+        key_masks, lfsr_masks = _lfsr_advance([1 << n for n in range(16)], 8)
+
+        lfsr_r     = Signal(16, reset=0xffff)
+        ts_left_r  = Signal(max=15) # symbols of a TS1/TS2 ordered set remaining after a word
+        prev_com_r = Signal()       # last symbol of the previous word was COM
+        o          = Signal.like(self.o)
+
+        lfsr, ts_left, prev_com = lfsr_r, ts_left_r, prev_com_r
+        for n in range(ratio):
+            symbol     = self.i.part(9 * n, 9)
+            is_com     = Signal(name="is_com{}".format(n))
+            is_skp     = Signal(name="is_skp{}".format(n))
+            ts_start   = Signal(name="ts_start{}".format(n))
+            lfsr_n     = Signal.like(lfsr_r, name="lfsr{}".format(n))
+            ts_left_n  = Signal.like(ts_left_r, name="ts_left{}".format(n))
+            prev_com_n = Signal(name="prev_com{}".format(n))
+            self.comb += [
+                is_com.eq(symbol == K(28,5)),
+                is_skp.eq(symbol == K(28,0)),
+                ts_start.eq(prev_com & (~symbol[8] | (symbol == K(23,7)))),
+                If(self.bypass | symbol[8] | ts_start | (ts_left != 0),
+                    o.part(9 * n, 9).eq(symbol)
+                ).Else(
+                    o.part(9 * n, 9).eq(symbol ^ _lfsr_apply(key_masks, lfsr))
+                ),
+                If(is_com,
+                    lfsr_n.eq(lfsr_r.reset)
+                ).Elif(is_skp,
+                    lfsr_n.eq(lfsr)
+                ).Else(
+                    lfsr_n.eq(_lfsr_apply(lfsr_masks, lfsr))
+                ),
+                If(is_com,
+                    ts_left_n.eq(0)
+                ).Elif(ts_start,
+                    ts_left_n.eq(14)
+                ).Elif(ts_left != 0,
+                    ts_left_n.eq(ts_left - 1)
+                ),
+                prev_com_n.eq(is_com),
+            ]
+            lfsr, ts_left, prev_com = lfsr_n, ts_left_n, prev_com_n
+
+        self.sync += [
+            lfsr_r.eq(lfsr),
+            ts_left_r.eq(ts_left),
+            prev_com_r.eq(prev_com),
+            self.o.eq(o),
+        ]
+
+
+class PCIeSERDESScrambler(PCIeSERDESInterface):
+    """
+    A lane adapter that scrambles transmitted symbols and descrambles received symbols.
+    Adds one cycle of latency in each direction.
+
+    Parameters
+    ----------
+    lane : PCIeSERDESInterface
+        Lane to scramble.
+
+    Attributes
+    ----------
+    disable : Signal
+        Assert to disable scrambling and descrambling, e.g. if the link partner requests it
+        with the Disable Scrambling bit of a TS1/TS2 ordered set.
+    """
+    def __init__(self, lane):
+        self.ratio        = lane.ratio
+
+        self.rx_invert    = lane.rx_invert
+        self.rx_align     = lane.rx_align
+        self.rx_present   = lane.rx_present
+        self.rx_locked    = lane.rx_locked
+        self.rx_aligned   = lane.rx_aligned
+
+        self.rx_symbol    = Signal(lane.ratio * 9)
+        self.rx_valid     = Signal(lane.ratio)
+
+        self.tx_symbol    = Signal(lane.ratio * 9)
+        self.tx_set_disp  = Signal(lane.ratio)
+        self.tx_disp      = Signal(lane.ratio)
+        self.tx_e_idle    = Signal(lane.ratio)
+
+        self.rate         = lane.rate
+
+        self.det_enable   = lane.det_enable
+        self.det_valid    = lane.det_valid
+        self.det_status   = lane.det_status
+
+        self.disable      = Signal()
+
+        ###
+
+        self.submodules.descrambler = PCIeScrambler(lane.ratio)
+        self.comb += [
+            self.descrambler.bypass.eq(self.disable),
+            self.descrambler.i.eq(lane.rx_symbol),
+            self.rx_symbol.eq(self.descrambler.o),
+        ]
+        self.sync += self.rx_valid.eq(lane.rx_valid)
+
+        self.submodules.scrambler = PCIeScrambler(lane.ratio)
+        self.comb += [
+            self.scrambler.bypass.eq(self.disable),
+            self.scrambler.i.eq(self.tx_symbol),
+            lane.tx_symbol.eq(self.scrambler.o),
+        ]
+        self.sync += [
+            lane.tx_set_disp.eq(self.tx_set_disp),
+            lane.tx_disp    .eq(self.tx_disp),
+            lane.tx_e_idle  .eq(self.tx_e_idle),
+        ]
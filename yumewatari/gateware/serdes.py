@@ -1,9 +1,13 @@
+from functools import reduce
+from operator import and_
 from migen import *
+from migen.genlib.cdc import MultiReg, GrayCounter, GrayDecoder
 
 from .align import SymbolSlip
 
 
-__all__ = ["PCIeSERDESInterface", "PCIeSERDESAligner"]
+__all__ = ["PCIeSERDESInterface", "PCIeSERDESAligner", "PCIeSERDESElasticBuffer",
+           "PCIeSERDESDeskew"]
 
 
 def K(x, y): return (1 << 8) | (y << 5) | x
@@ -41,6 +45,10 @@ class PCIeSERDESInterface(Module):
     tx_locked : Signal
         Asserted if the transmitter is generating a valid clock.
 
+    rate : Signal
+        Assert to operate at 5 GT/s, deassert to operate at 2.5 GT/s. The transmitter must be
+        in Electrical Idle while ``rate`` changes, and the receiver may lose lock.
+
     tx_symbol : Signal(9 * ratio)
         Symbol to 8b10b-encode and transmit, with 9th bit indicating a control symbol.
     tx_set_disp : Signal(ratio)
@@ -79,6 +87,8 @@ class PCIeSERDESInterface(Module):
         self.tx_disp      = Signal(ratio)
         self.tx_e_idle    = Signal(ratio)
 
+        self.rate         = Signal()
+
         self.det_enable   = Signal()
         self.det_valid    = Signal()
         self.det_status   = Signal()
@@ -106,6 +116,8 @@ class PCIeSERDESAligner(PCIeSERDESInterface):
         self.tx_disp      = lane.tx_disp
         self.tx_e_idle    = lane.tx_e_idle
 
+        self.rate         = lane.rate
+
         self.det_enable   = lane.det_enable
         self.det_valid    = lane.det_valid
         self.det_status   = lane.det_status
@@ -129,3 +141,378 @@ class PCIeSERDESAligner(PCIeSERDESInterface):
                 for n in range(lane.ratio)
             )),
         ]
+
+
+class PCIeSERDESElasticBuffer(PCIeSERDESInterface):
+    """
+    An elastic buffer that transfers received symbols from the recovered clock of the lane to
+    the local clock, compensating for the difference in their frequencies by adding or removing
+    SKP symbols.
+
+    The receive side of the lane is in the ``write`` clock domain, and every signal of
+    the buffer is in the ``read`` clock domain. Use :class:`ClockDomainsRenamer` to rename
+    them to other names. The transmit and Receiver Detection signals are passed through.
+
+    Words that consist entirely of SKP symbols are removed while the buffer is more than
+    half full, and repeated once while it is less than half full; a few words of hysteresis
+    account for the latency of synchronizing the fill level between the clock domains. The lane
+    must be comma-aligned, e.g. by :class:`PCIeSERDESAligner`; then every SKP ordered set
+    includes such a word if ``ratio`` is 1 or 2.
+
+    For wider words, an aligned SKP ordered set is a single COM SKP SKP SKP word, so single
+    SKP symbols are removed before the received symbols are packed into words again and
+    buffered, or repeated as the buffered words are unpacked. A SKP symbol is only removed if it
+    is followed by another one, so that every SKP ordered set retains at least one. Once
+    a symbol has been removed or repeated, the following words are no longer comma-aligned;
+    :class:`PCIePHYRX` accepts ordered sets in any slot, but :class:`PCIeSERDESDeskew` does not.
+
+    If the buffer is full, received words are discarded. If it is empty, words with
+    ``rx_valid`` deasserted are produced until it is half full again.
+
+    Parameters
+    ----------
+    lane : PCIeSERDESInterface
+        Comma-aligned lane to buffer.
+    depth : int
+        Buffer depth, in words. Must be a power of 2, at least 16.
+
+    Attributes
+    ----------
+    level : Signal(max=depth + 1)
+        Fill level, in words. Lags behind the write side by a few cycles.
+    overflow_count : Signal(16)
+        Number of discarded received words. Wraps around.
+    underflow_count : Signal(16)
+        Number of times the buffer ran empty. Wraps around.
+    """
+    def __init__(self, lane, depth=16):
+        if depth < 16 or depth & (depth - 1):
+            raise ValueError("Elastic buffer depth must be a power of 2 and at least 16, not {}"
+                             .format(depth))
+
+        self.ratio        = lane.ratio
+
+        self.rx_invert    = Signal()
+        self.rx_align     = Signal()
+        self.rx_present   = Signal()
+        self.rx_locked    = Signal()
+        self.rx_aligned   = Signal()
+
+        self.rx_symbol    = Signal(lane.ratio * 9)
+        self.rx_valid     = Signal(lane.ratio)
+
+        self.tx_symbol    = lane.tx_symbol
+        self.tx_set_disp  = lane.tx_set_disp
+        self.tx_disp      = lane.tx_disp
+        self.tx_e_idle    = lane.tx_e_idle
+
+        self.rate         = lane.rate
+
+        self.det_enable   = lane.det_enable
+        self.det_valid    = lane.det_valid
+        self.det_status   = lane.det_status
+
+        self.level           = Signal(max=depth + 1)
+        self.overflow_count  = Signal(16)
+        self.underflow_count = Signal(16)
+
+        ###
+
+        self.specials += [
+            MultiReg(self.rx_invert, lane.rx_invert, odomain="write"),
+            MultiReg(self.rx_align,  lane.rx_align,  odomain="write"),
+            MultiReg(lane.rx_present, self.rx_present, odomain="read"),
+            MultiReg(lane.rx_locked,  self.rx_locked,  odomain="read"),
+            MultiReg(lane.rx_aligned, self.rx_aligned, odomain="read"),
+        ]
+
+        def is_skp_symbol(word, n):
+            return word.part(10 * n, 10) == ((1 << 9) | K(28,0))
+
+        def is_skp(word):
+            return reduce(and_, [is_skp_symbol(word, n) for n in range(lane.ratio)])
+
+        ratio      = lane.ratio
+        depth_bits = log2_int(depth)
+        half_depth = depth // 2
+        # Each side sees the pointer of the other one delayed by up to this many cycles.
+        sync_lag   = 4
+
+        produce   = ClockDomainsRenamer("write")(GrayCounter(depth_bits + 1))
+        consume   = ClockDomainsRenamer("read") (GrayCounter(depth_bits + 1))
+        overflow  = ClockDomainsRenamer("write")(GrayCounter(len(self.overflow_count)))
+        underflow = ClockDomainsRenamer("read") (GrayCounter(len(self.underflow_count)))
+        self.submodules += produce, consume, overflow, underflow
+
+        produce_r  = ClockDomainsRenamer("read") (GrayDecoder(len(produce.q)))
+        consume_w  = ClockDomainsRenamer("write")(GrayDecoder(len(consume.q)))
+        overflow_r = ClockDomainsRenamer("read") (GrayDecoder(len(overflow.q)))
+        self.submodules += produce_r, consume_w, overflow_r
+        self.specials += [
+            MultiReg(produce.q,  produce_r.i,  odomain="read"),
+            MultiReg(consume.q,  consume_w.i,  odomain="write"),
+            MultiReg(overflow.q, overflow_r.i, odomain="read"),
+        ]
+
+        storage = Memory(width=lane.ratio * 10, depth=depth)
+        self.specials += storage
+
+        level_w = Signal(depth_bits + 1)
+        word_w  = Signal(lane.ratio * 10)
+        wrport  = storage.get_port(write_capable=True, clock_domain="write")
+        self.specials += wrport
+        self.comb += [
+            level_w.eq(produce.q_binary - consume_w.o),
+            word_w.eq(Cat(
+                (lane.rx_symbol.part(9 * n, 9), lane.rx_valid[n])
+                for n in range(lane.ratio)
+            )),
+            wrport.adr.eq(produce.q_binary[:-1]),
+            wrport.we.eq(produce.ce),
+        ]
+        if lane.ratio <= 2:
+            self.comb += [
+                If(is_skp(word_w) & (level_w > half_depth + sync_lag),
+                    # Remove SKP word.
+                ).Elif(level_w == depth,
+                    overflow.ce.eq(1)
+                ).Else(
+                    produce.ce.eq(1)
+                ),
+                wrport.dat_w.eq(word_w),
+            ]
+        else:
+            # Symbols of the received word, after removing a SKP symbol, preceded by the symbols
+            # left over from the previous words. A word is written once enough symbols are
+            # packed, so at most ``ratio - 1`` symbols are left over.
+            symbols_w = Signal(10 * ratio)
+            count_w   = Signal(max=ratio + 1)
+            carry_w   = Signal(10 * (ratio - 1))
+            carried_w = Signal(max=ratio)
+            packed_w  = Signal(10 * (2 * ratio - 1))
+            total_w   = Signal(max=2 * ratio)
+            self.comb += [
+                symbols_w.eq(word_w),
+                count_w.eq(ratio),
+                # The first SKP symbol in the word that is followed by another one is removed.
+                [If((level_w > half_depth + sync_lag) &
+                        is_skp_symbol(word_w, n) & is_skp_symbol(word_w, n + 1),
+                    symbols_w.eq(Cat(word_w[:10 * n], word_w[10 * (n + 1):])),
+                    count_w.eq(ratio - 1)
+                 ) for n in reversed(range(ratio - 1))],
+                Case(carried_w, {
+                    n: packed_w.eq(Cat(carry_w[:10 * n], symbols_w) if n else symbols_w)
+                    for n in range(ratio)
+                }),
+                total_w.eq(carried_w + count_w),
+                If(total_w >= ratio,
+                    If(level_w == depth,
+                        overflow.ce.eq(1)
+                    ).Else(
+                        produce.ce.eq(1)
+                    )
+                ),
+                wrport.dat_w.eq(packed_w[:10 * ratio]),
+            ]
+            self.sync.write += [
+                If(total_w >= ratio,
+                    carry_w.eq(packed_w[10 * ratio:]),
+                    carried_w.eq(total_w - ratio)
+                ).Else(
+                    carry_w.eq(packed_w),
+                    carried_w.eq(total_w)
+                )
+            ]
+
+        level_r  = Signal(depth_bits + 1)
+        word_r   = Signal(lane.ratio * 10)
+        primed   = Signal()
+        repeat   = Signal()
+        repeated = Signal()
+        rdport   = storage.get_port(clock_domain="read")
+        self.specials += rdport
+        if lane.ratio <= 2:
+            self.comb += repeat.eq(is_skp(word_r) & (level_r < half_depth - sync_lag) &
+                                   ~repeated)
+            read_word = rdport.dat_r
+        else:
+            # Symbols of the buffered word, after repeating a SKP symbol, preceded by the symbols
+            # left over from the previous words. Once a whole word is left over, it is produced
+            # instead of the buffered word.
+            symbols_r = Signal(10 * (ratio + 1))
+            count_r   = Signal(max=ratio + 2)
+            carry_r   = Signal(10 * ratio)
+            carried_r = Signal(max=ratio + 1)
+            packed_r  = Signal(10 * 2 * ratio)
+            total_r   = Signal(max=2 * ratio + 2)
+            self.comb += [
+                symbols_r.eq(rdport.dat_r),
+                count_r.eq(ratio),
+                # The first SKP symbol in the word is repeated.
+                [If((level_r < half_depth - sync_lag) & is_skp_symbol(rdport.dat_r, n),
+                    symbols_r.eq(Cat(rdport.dat_r[:10 * (n + 1)], rdport.dat_r[10 * n:])),
+                    count_r.eq(ratio + 1)
+                 ) for n in reversed(range(ratio))],
+                Case(carried_r, {
+                    n: packed_r.eq(Cat(carry_r[:10 * n], symbols_r) if n else symbols_r)
+                    for n in range(ratio + 1)
+                }),
+                total_r.eq(carried_r + count_r),
+                repeat.eq(carried_r == ratio),
+            ]
+            self.sync.read += [
+                If(primed & (level_r != 0),
+                    If(repeat,
+                        carried_r.eq(0)
+                    ).Else(
+                        carry_r.eq(packed_r[10 * ratio:]),
+                        carried_r.eq(total_r - ratio)
+                    )
+                )
+            ]
+            read_word = packed_r[:10 * ratio]
+        self.comb += [
+            level_r.eq(produce_r.o - consume.q_binary),
+            self.level.eq(level_r),
+            rdport.adr.eq(consume.q_next_binary[:-1]),
+            If(primed & (level_r != 0),
+                word_r.eq(read_word),
+                If(repeat,
+                    # Repeat SKP word, or produce the left over symbols.
+                ).Else(
+                    consume.ce.eq(1)
+                )
+            ).Elif(primed,
+                underflow.ce.eq(1)
+            ),
+            self.rx_symbol.eq(Cat(word_r.part(10 * n, 9) for n in range(lane.ratio))),
+            self.rx_valid.eq(Cat(word_r[10 * n + 9] for n in range(lane.ratio))),
+            self.overflow_count.eq(overflow_r.o),
+            self.underflow_count.eq(underflow.q_binary),
+        ]
+        self.sync.read += [
+            If(level_r == 0,
+                primed.eq(0)
+            ).Elif(level_r >= half_depth,
+                primed.eq(1)
+            ),
+            repeated.eq(primed & (level_r != 0) & ~consume.ce),
+        ]
+
+
+class _PCIeSERDESDeskewLane(PCIeSERDESInterface):
+    def __init__(self, lane):
+        self.ratio        = lane.ratio
+
+        self.rx_invert    = lane.rx_invert
+        self.rx_align     = lane.rx_align
+        self.rx_present   = lane.rx_present
+        self.rx_locked    = lane.rx_locked
+        self.rx_aligned   = lane.rx_aligned
+
+        self.rx_symbol    = Signal(lane.ratio * 9)
+        self.rx_valid     = Signal(lane.ratio)
+
+        self.tx_symbol    = lane.tx_symbol
+        self.tx_set_disp  = lane.tx_set_disp
+        self.tx_disp      = lane.tx_disp
+        self.tx_e_idle    = lane.tx_e_idle
+
+        self.rate         = lane.rate
+
+        self.det_enable   = lane.det_enable
+        self.det_valid    = lane.det_valid
+        self.det_status   = lane.det_status
+
+
+class PCIeSERDESDeskew(Module):
+    """
+    Lane-to-lane deskew for a multi-lane link. Delays the received words of every lane such that
+    COM symbols that arrive on all enabled lanes within ``max_skew`` cycles of each other are
+    output in the same cycle. The delays are updated on every ordered set, which makes SKP
+    ordered sets maintain the deskew in L0.
+
+    The lanes must be comma-aligned, e.g. by :class:`PCIeSERDESAligner`. Adds one cycle of
+    latency.
+
+    Parameters
+    ----------
+    lanes : list of PCIeSERDESInterface
+        Lanes to deskew.
+    max_skew : int
+        Maximum lane-to-lane skew, in words. Must be less than the length of a TS1/TS2 ordered
+        set, in words.
+
+    Attributes
+    ----------
+    lanes : list of PCIeSERDESInterface
+        Deskewed lanes.
+    enable : Signal(len(lanes))
+        Lanes that are taken into account for deskew. Defaults to all lanes.
+    error : Signal
+        Asserted for a cycle if a COM symbol did not arrive on all enabled lanes within
+        ``max_skew`` cycles.
+    """
+    def __init__(self, lanes, max_skew=4):
+        ratio = lanes[0].ratio
+        if max_skew * ratio >= 16:
+            raise ValueError("Maximum skew of {} words at ratio {} is not shorter than "
+                             "a TS1/TS2 ordered set".format(max_skew, ratio))
+
+        self.lanes  = [_PCIeSERDESDeskewLane(lane) for lane in lanes]
+        self.enable = Signal(len(lanes), reset=(1 << len(lanes)) - 1)
+        self.error  = Signal()
+
+        ###
+
+        arrived = Signal(len(lanes))
+        self.comb += arrived.eq(self.enable & Cat(
+            lane.rx_valid[0] & (lane.rx_symbol[0:9] == K(28,5)) for lane in lanes
+        ))
+
+        window  = Signal()
+        timer   = Signal(max=max_skew + 1)
+        seen    = Signal(len(lanes))
+        arrival = [Signal(max=max_skew + 1, name="arrival{}".format(n))
+                   for n in range(len(lanes))]
+        delay   = [Signal(max=max_skew + 1, name="delay{}".format(n))
+                   for n in range(len(lanes))]
+
+        self.sync += [
+            self.error.eq(0),
+            If(~window,
+                If(arrived == self.enable,
+                    [delay[n].eq(0) for n in range(len(lanes))]
+                ).Elif(arrived != 0,
+                    window.eq(1),
+                    timer.eq(1),
+                    seen.eq(arrived),
+                    [arrival[n].eq(0) for n in range(len(lanes))]
+                )
+            ).Else(
+                [If(arrived[n] & ~seen[n],
+                    arrival[n].eq(timer)
+                ) for n in range(len(lanes))],
+                seen.eq(seen | arrived),
+                If((seen | arrived) == self.enable,
+                    window.eq(0),
+                    [If(seen[n],
+                        delay[n].eq(timer - arrival[n])
+                    ).Else(
+                        delay[n].eq(0)
+                    ) for n in range(len(lanes))]
+                ).Elif(timer == max_skew,
+                    window.eq(0),
+                    self.error.eq(1)
+                ).Else(
+                    timer.eq(timer + 1)
+                )
+            )
+        ]
+
+        for n, (lane, deskewed) in enumerate(zip(lanes, self.lanes)):
+            words = [Signal(lane.ratio * 10, name="word{}_{}".format(n, m))
+                     for m in range(max_skew + 1)]
+            self.sync += words[0].eq(Cat(lane.rx_symbol, lane.rx_valid))
+            self.sync += [words[m + 1].eq(words[m]) for m in range(max_skew)]
+            self.comb += Cat(deskewed.rx_symbol, deskewed.rx_valid).eq(Array(words)[delay[n]])
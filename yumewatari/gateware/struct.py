@@ -1,4 +1,14 @@
-__all__ = ["ts_layout"]
+__all__ = ["ts_layout", "dllp_layout", "tlp_layout", "tlp_dwords_layout", "tlp_stream_layout",
+           "fc_layout", "wishbone_layout",
+           "DLLP_ACK", "DLLP_NAK",
+           "DLLP_PM_ENTER_L1", "DLLP_PM_ENTER_L23", "DLLP_PM_ACTIVE_STATE_REQUEST_L1",
+           "DLLP_PM_REQUEST_ACK", "DLLP_VENDOR",
+           "DLLP_INIT_FC1_P", "DLLP_INIT_FC1_NP", "DLLP_INIT_FC1_CPL",
+           "DLLP_INIT_FC2_P", "DLLP_INIT_FC2_NP", "DLLP_INIT_FC2_CPL",
+           "DLLP_UPDATE_FC_P", "DLLP_UPDATE_FC_NP", "DLLP_UPDATE_FC_CPL",
+           "TLP_MRD32", "TLP_MRD64", "TLP_MWR32", "TLP_MWR64", "TLP_CFG_RD0", "TLP_CFG_WR0",
+           "TLP_CPL", "TLP_CPLD",
+           "CPL_SC", "CPL_UR", "CPL_CA"]
 
 
 ts_layout = [
@@ -29,3 +39,94 @@ ts_layout = [
     ]),
     ("ts_id",       1), # 0: TS1, 1: TS2
 ]
+
+
+dllp_layout = [
+    ("valid",       1),
+    ("type",        8), # byte 0; includes the VC ID for flow control DLLPs
+    ("data",       24), # bytes 1..3, byte 3 in the least significant bits
+]
+
+tlp_layout = [
+    ("valid",       1),
+    ("last",        1), # last dword of the TLP
+    ("data",       32), # first byte in the least significant bits
+]
+
+def tlp_dwords_layout(dwords):
+    return [
+        ("valid", dwords), # dwords of the beat that are valid, first dword in bit 0
+        ("last",        1), # last beat of the TLP
+        ("data", 32 * dwords), # first dword in the least significant bits
+    ]
+
+def tlp_stream_layout(data_width):
+    return [
+        ("valid",       1),
+        ("start",       1), # first beat of the TLP
+        ("end",         1), # last beat of the TLP
+        ("be", data_width // 8), # byte enables; whole dwords, starting from the first one
+        ("data", data_width), # first byte in the least significant bits
+    ]
+
+
+# Flow control credits of every type: header credits (one per TLP) and data credits (one per
+# 4 dwords of payload), for posted requests, non-posted requests and completions.
+fc_layout = [
+    ("ph",          8),
+    ("pd",         12),
+    ("nph",         8),
+    ("npd",        12),
+    ("cplh",        8),
+    ("cpld",       12),
+]
+
+
+# Wishbone B4 pipelined bus, from the point of view of the master.
+wishbone_layout = [
+    ("cyc",         1),
+    ("stb",         1),
+    ("we",          1),
+    ("adr",        30), # in words
+    ("sel",         4),
+    ("dat_w",      32),
+    ("dat_r",      32),
+    ("ack",         1),
+    ("stall",       1),
+]
+
+
+# DLLP types. In ``data``, ACK and NAK DLLPs carry the sequence number in bits 0..11; flow control
+# DLLPs carry DataFC in bits 0..11 and HdrFC in bits 14..21.
+DLLP_ACK                        = 0x00
+DLLP_NAK                        = 0x10
+DLLP_PM_ENTER_L1                = 0x20
+DLLP_PM_ENTER_L23               = 0x21
+DLLP_PM_ACTIVE_STATE_REQUEST_L1 = 0x23
+DLLP_PM_REQUEST_ACK             = 0x24
+DLLP_VENDOR                     = 0x30
+DLLP_INIT_FC1_P                 = 0x40
+DLLP_INIT_FC1_NP                = 0x50
+DLLP_INIT_FC1_CPL               = 0x60
+DLLP_INIT_FC2_P                 = 0xc0
+DLLP_INIT_FC2_NP                = 0xd0
+DLLP_INIT_FC2_CPL               = 0xe0
+DLLP_UPDATE_FC_P                = 0x80
+DLLP_UPDATE_FC_NP               = 0x90
+DLLP_UPDATE_FC_CPL              = 0xa0
+
+
+# TLP formats and types, i.e. byte 0 of the header.
+TLP_MRD32                       = 0x00
+TLP_MRD64                       = 0x20
+TLP_MWR32                       = 0x40
+TLP_MWR64                       = 0x60
+TLP_CFG_RD0                     = 0x04
+TLP_CFG_WR0                     = 0x44
+TLP_CPL                         = 0x0a
+TLP_CPLD                        = 0x4a
+
+# Completion status.
+CPL_SC                          = 0b000
+CPL_UR                          = 0b001
+CPL_CA                          = 0b100
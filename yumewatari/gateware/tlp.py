@@ -0,0 +1,77 @@
+from migen import *
+
+
+__all__ = ["tlp_dw0", "tlp_requester_id", "tlp_address", "tlp_req_dw1", "tlp_address_dw",
+           "tlp_cpl_dw1", "tlp_cpl_dw2"]
+
+
+# Dwords are in the format of ``tlp_layout``, i.e. byte 0 of the dword is in the least
+# significant bits. IDs are 16-bit values with the bus number in bits 8..15 and the device and
+# function numbers in bits 0..7, the way they are written in the specification.
+
+
+def _const(value, width):
+    if isinstance(value, int):
+        return C(value, width)
+    return Cat(value, C(0, width))[:width]
+
+
+def _swap_id(id):
+    return Cat(id[8:16], id[0:8])
+
+
+def tlp_dw0(fmt_type, length, tc=0, attr=0):
+    """
+    First dword of a TLP header. ``length`` is in dwords; 0 stands for 1024.
+    """
+    length = _const(length, 10)
+    return Cat(_const(fmt_type, 8), C(0, 4), _const(tc, 3), C(0, 1),
+               length[8:10], C(0, 2), _const(attr, 2), C(0, 2), length[0:8])
+
+
+def tlp_requester_id(dw1):
+    """
+    Requester ID of a request, from the second dword of its header.
+    """
+    return _swap_id(dw1[0:16])
+
+
+def tlp_address(dw):
+    """
+    Address bits 0..31 of a memory request, from the last dword of its header. Bits 0..1 are
+    always zero.
+    """
+    return Cat(C(0, 2), dw[26:32], dw[16:24], dw[8:16], dw[0:8])
+
+
+def tlp_req_dw1(requester_id, tag, first_be=0b1111, last_be=0b1111):
+    """
+    Second dword of a memory request header. ``last_be`` must be zero if the request is one
+    dword long.
+    """
+    return Cat(_swap_id(requester_id), _const(tag, 8), _const(first_be, 4), _const(last_be, 4))
+
+
+def tlp_address_dw(address):
+    """
+    Address dword of a memory request header, from 32 bits of the address. If these are
+    the bits 0..31, bits 0..1 must be zero.
+    """
+    return Cat(address[24:32], address[16:24], address[8:16], address[0:8])
+
+
+def tlp_cpl_dw1(completer_id, status, byte_count):
+    """
+    Second dword of a completion header. ``byte_count`` is the number of bytes remaining,
+    including the ones in this completion; 0 stands for 4096.
+    """
+    byte_count = _const(byte_count, 12)
+    return Cat(_swap_id(completer_id), byte_count[8:12], C(0, 1), _const(status, 3),
+               byte_count[0:8])
+
+
+def tlp_cpl_dw2(requester_id, tag, lower_address=0):
+    """
+    Third dword of a completion header.
+    """
+    return Cat(_swap_id(requester_id), _const(tag, 8), _const(lower_address, 7), C(0, 1))
@@ -0,0 +1,299 @@
+from migen import *
+from migen.genlib.fifo import SyncFIFO, AsyncFIFO
+
+from .struct import *
+
+
+__all__ = ["PCIeTLPStreamTX", "PCIeTLPStreamRX"]
+
+
+def _check_data_width(data_width):
+    if data_width not in (32, 64, 128):
+        raise ValueError("TLP stream data width must be 32, 64 or 128 bits, not {}"
+                         .format(data_width))
+
+
+class PCIeTLPStreamTX(Module):
+    """
+    Transmit side of a TLP stream. Splits beats of TLPs into the dwords accepted by
+    :class:`PCIeDLL`, and transfers them between clock domains.
+
+    The user side is in the ``write`` clock domain, and the data link layer side is in
+    the ``read`` clock domain. Use :class:`ClockDomainsRenamer` to rename them to other names.
+
+    The dwords of a beat are enabled by ``i.be`` starting from the first one; only the last beat
+    of a TLP may have dwords that are not enabled. ``i.start`` is not used, since TLPs follow each
+    other without gaps.
+
+    Parameters
+    ----------
+    data_width : int
+        Width of a beat, in bits. Must be 32, 64 or 128.
+    depth : int
+        Depth of the clock domain crossing FIFO, in dwords. Must be a power of 2.
+
+    Attributes
+    ----------
+    i : Record(tlp_stream_layout(data_width))
+        Input. Beat of a TLP to transmit, if ``i.valid`` is asserted. Must be held until
+        accepted.
+    i_ready : Signal
+        Output. Strobe. Asserted if ``i`` is accepted.
+    o : Record(tlp_layout)
+        Output. Dword of a TLP to transmit, if ``o.valid`` is asserted.
+    o_ready : Signal
+        Input. Strobe. Assert if ``o`` is accepted.
+    """
+    def __init__(self, data_width, depth=16):
+        _check_data_width(data_width)
+
+        self.i       = Record(tlp_stream_layout(data_width))
+        self.i_ready = Signal()
+        self.o       = Record(tlp_layout)
+        self.o_ready = Signal()
+
+        ###
+
+        self.submodules.cdc = cdc = AsyncFIFO(len(self.o.data) + 1, depth)
+
+        # Splitting beats. ``dword`` is the dword of the beat being written to the FIFO.
+        dwords    = data_width // 32
+        dword     = Signal(max=max(dwords, 2))
+        beat_last = Signal()
+        self.comb += [
+            beat_last.eq(~Array([self.i.be[4 * (n + 1)] for n in range(dwords - 1)] +
+                                [C(0)])[dword]),
+            cdc.din.eq(Cat(Array(self.i.data[32 * n:32 * (n + 1)] for n in range(dwords))[dword],
+                           self.i.end & beat_last)),
+            cdc.we.eq(self.i.valid),
+            self.i_ready.eq(self.i.valid & cdc.writable & beat_last),
+        ]
+        self.sync.write += [
+            If(self.i.valid & cdc.writable,
+                If(beat_last,
+                    dword.eq(0)
+                ).Else(
+                    dword.eq(dword + 1)
+                )
+            )
+        ]
+
+        self.comb += [
+            self.o.valid.eq(cdc.readable),
+            Cat(self.o.data, self.o.last).eq(cdc.dout),
+            cdc.re.eq(self.o_ready),
+        ]
+
+
+class PCIeTLPStreamRX(Module):
+    """
+    Receive side of a TLP stream. Buffers the dwords of TLPs received by :class:`PCIeDLL`
+    until they are accepted, transfers them between clock domains, and packs them into beats.
+
+    The data link layer side is in the ``write`` clock domain, and the user side is in
+    the ``read`` clock domain. Use :class:`ClockDomainsRenamer` to rename them to other names.
+
+    The data link layer only accepts a TLP once it is received completely, and cannot hold
+    back received dwords; so every TLP is stored in a :class:`Memory` until it is accepted or
+    discarded, and the credits it uses are released once it is moved out of the memory. Since
+    a TLP that is lost after it is accepted cannot be recovered, the memory must be able to
+    hold every TLP the advertised credits allow for, counting 4 dwords per header credit and
+    per data credit. Infinite credits cannot be accounted for; the user must bound the TLPs
+    received using them, e.g. completions, by the requests it transmits.
+
+    Parameters
+    ----------
+    data_width : int
+        Width of a beat, in bits. Must be 32, 64 or 128.
+    depth : int
+        Size of the buffer, in dwords. Must be a power of 2.
+    max_tlps : int
+        Maximum number of buffered TLPs.
+    rx_credits : dict of str to int
+        Credits advertised by the data link layer; see :class:`PCIeDLL`. Defaults to
+        the defaults of :class:`PCIeDLL`.
+    cdc_depth : int
+        Depth of the clock domain crossing FIFO, in dwords. Must be a power of 2.
+
+    Attributes
+    ----------
+    i : Record(tlp_layout)
+        Input. Dword of a received TLP, if ``i.valid`` is asserted. ``i.last`` is ignored.
+    i_end : Signal
+        Input. Strobe. Assert once a TLP is received completely, or discarded.
+    i_accept : Signal
+        Input. Strobe. Assert together with ``i_end`` if the TLP is accepted.
+    i_credits : Record(fc_layout)
+        Input. Credits used by the TLP. Sampled while ``i_accept`` is asserted.
+    release : Record(fc_layout)
+        Output. Credits released in this cycle.
+    overflow_count : Signal(16)
+        Output. Number of accepted TLPs lost because the buffer was full, i.e. the link
+        partner transmitted TLPs in excess of ``rx_credits``. Saturates.
+    o : Record(tlp_stream_layout(data_width))
+        Output. Beat of a received TLP, if ``o.valid`` is asserted.
+    o_ready : Signal
+        Input. Assert if ``o`` is accepted.
+    """
+    def __init__(self, data_width, depth=1024, max_tlps=32, cdc_depth=16, rx_credits=None):
+        _check_data_width(data_width)
+        if depth & (depth - 1):
+            raise ValueError("TLP stream buffer depth must be a power of 2, not {}"
+                             .format(depth))
+        if rx_credits is None:
+            rx_credits = {"ph": 16, "pd": 128, "nph": 16, "npd": 16, "cplh": 0, "cpld": 0}
+        credit_tlps   = sum(rx_credits[name] for name in ("ph", "nph", "cplh"))
+        credit_dwords = 4 * sum(rx_credits.values())
+        if credit_dwords > depth:
+            raise ValueError("TLP stream buffer depth must be at least {} dwords to hold "
+                             "the advertised credits, not {}"
+                             .format(credit_dwords, depth))
+        if credit_tlps > max_tlps:
+            raise ValueError("TLP stream buffer must hold at least {} TLPs to hold "
+                             "the advertised credits, not {}"
+                             .format(credit_tlps, max_tlps))
+
+        self.i         = Record(tlp_layout)
+        self.i_end     = Signal()
+        self.i_accept  = Signal()
+        self.i_credits = Record(fc_layout)
+        self.release   = Record(fc_layout)
+        self.overflow_count = Signal(16)
+        self.o         = Record(tlp_stream_layout(data_width))
+        self.o_ready   = Signal()
+
+        ###
+
+        # Pointers have one more bit than addresses, so that a full buffer can be told apart
+        # from an empty one.
+        ptr_width = log2_int(depth) + 1
+        # First dword of the TLP being received, next dword to store, next dword to read.
+        start_ptr = Signal(ptr_width)
+        write_ptr = Signal(ptr_width)
+        read_ptr  = Signal(ptr_width)
+
+        storage = Memory(width=len(self.i.data), depth=depth)
+        self.specials += storage
+
+        # The end of every accepted TLP, and the credits it uses.
+        self.submodules.ends = ends = ClockDomainsRenamer("write")(
+            SyncFIFO(ptr_width + len(self.i_credits), max_tlps))
+
+        # Storing TLPs. A TLP that does not fit is discarded, and a TLP that is not accepted
+        # is removed by rewinding ``write_ptr``. Accepted TLPs are committed a cycle later, so that
+        # the last dword is stored by the time it is read.
+        wrport = storage.get_port(write_capable=True, clock_domain="write")
+        self.specials += wrport
+
+        level        = Signal(ptr_width)
+        write_full   = Signal()
+        write_drop   = Signal()
+        write_ptr_next = Signal(ptr_width)
+        commit       = Signal()
+        commit_ptr   = Signal(ptr_width)
+        commit_credits = Signal(len(self.i_credits))
+        self.comb += [
+            level.eq(write_ptr - read_ptr),
+            write_full.eq(level == depth),
+            wrport.adr.eq(write_ptr),
+            wrport.dat_w.eq(self.i.data),
+            wrport.we.eq(self.i.valid & ~write_full),
+            If(wrport.we,
+                write_ptr_next.eq(write_ptr + 1)
+            ).Else(
+                write_ptr_next.eq(write_ptr)
+            ),
+            ends.din.eq(Cat(commit_ptr, commit_credits)),
+            ends.we.eq(commit),
+        ]
+        self.sync.write += [
+            write_ptr.eq(write_ptr_next),
+            If(self.i.valid & write_full,
+                write_drop.eq(1)
+            ),
+            commit.eq(0),
+            If(self.i_end,
+                write_drop.eq(0),
+                If(self.i_accept & ~write_drop & ~(self.i.valid & write_full) &
+                        (ends.level + commit != max_tlps),
+                    start_ptr.eq(write_ptr_next),
+                    commit.eq(1),
+                    commit_ptr.eq(write_ptr_next),
+                    commit_credits.eq(self.i_credits.raw_bits())
+                ).Else(
+                    write_ptr.eq(start_ptr),
+                    If(self.i_accept &
+                            (self.overflow_count != 2 ** len(self.overflow_count) - 1),
+                        self.overflow_count.eq(self.overflow_count + 1)
+                    )
+                )
+            )
+        ]
+
+        # Reading TLPs. The read port always reads the dword at the next value of ``read_ptr``,
+        # so that its output is the dword at ``read_ptr``.
+        rdport = storage.get_port(clock_domain="write")
+        self.specials += rdport
+
+        self.submodules.cdc = cdc = AsyncFIFO(len(self.i.data) + 1, cdc_depth)
+
+        read_last     = Signal()
+        read_ptr_succ = Signal(ptr_width)
+        read_ptr_next = Signal(ptr_width)
+        read_end_ptr  = Signal(ptr_width)
+        read_credits  = Record(fc_layout)
+        self.comb += [
+            Cat(read_end_ptr, read_credits.raw_bits()).eq(ends.dout),
+            read_ptr_succ.eq(read_ptr + 1),
+            read_last.eq(read_ptr_succ == read_end_ptr),
+            cdc.din.eq(Cat(rdport.dat_r, read_last)),
+            cdc.we.eq(ends.readable),
+            ends.re.eq(ends.readable & cdc.writable & read_last),
+            If(ends.re,
+                self.release.raw_bits().eq(read_credits.raw_bits())
+            ),
+            If(ends.readable & cdc.writable,
+                read_ptr_next.eq(read_ptr_succ)
+            ).Else(
+                read_ptr_next.eq(read_ptr)
+            ),
+            rdport.adr.eq(read_ptr_next),
+        ]
+        self.sync.write += read_ptr.eq(read_ptr_next)
+
+        # Packing beats. A beat is filled while it is not valid, and is made valid once every
+        # dword is filled or the TLP ends.
+        dwords   = data_width // 32
+        dword    = Signal(max=max(dwords, 2))
+        in_tlp   = Signal()
+        fill     = Signal()
+        cdc_data = Signal(len(self.i.data))
+        cdc_last = Signal()
+        self.comb += [
+            Cat(cdc_data, cdc_last).eq(cdc.dout),
+            fill.eq(cdc.readable & (~self.o.valid | self.o_ready)),
+            cdc.re.eq(fill),
+        ]
+        self.sync.read += [
+            If(self.o.valid & self.o_ready,
+                self.o.valid.eq(0)
+            ),
+            If(fill,
+                If(dword == 0,
+                    self.o.start.eq(~in_tlp),
+                    self.o.be.eq(0)
+                ),
+                [If(dword == n,
+                    self.o.data[32 * n:32 * (n + 1)].eq(cdc_data),
+                    self.o.be[4 * n:4 * (n + 1)].eq(0b1111)
+                 ) for n in range(dwords)],
+                in_tlp.eq(~cdc_last),
+                If(cdc_last | (dword == dwords - 1),
+                    self.o.valid.eq(1),
+                    self.o.end.eq(cdc_last),
+                    dword.eq(0)
+                ).Else(
+                    dword.eq(dword + 1)
+                )
+            )
+        ]
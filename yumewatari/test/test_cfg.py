@@ -0,0 +1,185 @@
+import unittest
+from migen import *
+
+from ..gateware.struct import *
+from ..gateware.cfg import *
+from . import simulation_test
+
+
+def cfg_request(fmt_type, offset, data=None, be=0b1111, id=0x0100, tag=0x12):
+    dwords = [
+        fmt_type | (1 << 24),
+        (0x01 << 0) | (tag << 16) | (be << 24),
+        (id >> 8) | ((id & 0xff) << 8) | ((offset >> 8) << 16) | (((offset >> 2) & 0x3f) << 26),
+    ]
+    if data is not None:
+        dwords.append(data)
+    return dwords
+
+
+class PCIeConfigSpaceTestbench(Module):
+    def __init__(self, n_fts=0xff):
+        self.submodules.dut = PCIeConfigSpace(vendor_id=0x1234, device_id=0x5678,
+                                              class_code=0x058000, revision_id=0x01,
+                                              bars=[4096, None, 1 << 20], msi_vectors=4,
+                                              max_link_width=4, n_fts=n_fts)
+
+    def request(self, dwords):
+        for n, dword in enumerate(dwords):
+            yield self.dut.i.valid.eq(1)
+            yield self.dut.i.data.eq(dword)
+            yield self.dut.i.last.eq(n == len(dwords) - 1)
+            yield
+            while not (yield self.dut.i_ready):
+                yield
+        yield self.dut.i.valid.eq(0)
+        completion = []
+        while True:
+            yield
+            if (yield self.dut.o.valid):
+                completion.append((yield self.dut.o.data))
+                last = yield self.dut.o.last
+                yield self.dut.o_ready.eq(1)
+                yield
+                yield self.dut.o_ready.eq(0)
+                if last:
+                    break
+        return completion
+
+    def read(self, offset):
+        completion = yield from self.request(cfg_request(TLP_CFG_RD0, offset))
+        self.check_completion(completion, TLP_CPLD)
+        return completion[3]
+
+    def write(self, offset, data, be=0b1111, id=0x0100):
+        completion = yield from self.request(cfg_request(TLP_CFG_WR0, offset, data, be, id))
+        self.check_completion(completion, TLP_CPL)
+
+    def check_completion(self, completion, fmt_type):
+        assert len(completion) == (4 if fmt_type == TLP_CPLD else 3)
+        assert completion[0] & 0xff == fmt_type
+        # Successful Completion, byte count of 4.
+        assert (completion[1] >> 16) == 0x0400
+        # Requester ID and tag.
+        assert completion[2] == 0x00120001
+
+
+class PCIeConfigSpaceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tb = PCIeConfigSpaceTestbench()
+
+    @simulation_test
+    def test_header(self, tb):
+        self.assertEqual((yield from tb.read(0x00)), 0x56781234)
+        self.assertEqual((yield from tb.read(0x04)), 0x00100000)
+        self.assertEqual((yield from tb.read(0x08)), 0x05800001)
+        self.assertEqual((yield from tb.read(0x34)), 0x40)
+        # Unimplemented registers.
+        self.assertEqual((yield from tb.read(0x14)), 0)
+        self.assertEqual((yield from tb.read(0x100)), 0)
+
+    @simulation_test
+    def test_command(self, tb):
+        yield from tb.write(0x04, 0xffffffff)
+        self.assertEqual((yield from tb.read(0x04)), 0x00100546)
+        self.assertEqual((yield tb.dut.memory_enable), 1)
+        self.assertEqual((yield tb.dut.bus_master_enable), 1)
+        # Only the enabled bytes are written.
+        yield from tb.write(0x04, 0x00000000, be=0b0010)
+        self.assertEqual((yield from tb.read(0x04)), 0x00100046)
+
+    @simulation_test
+    def test_id(self, tb):
+        yield from tb.write(0x3c, 0x0b, id=0x0308)
+        self.assertEqual((yield tb.dut.id), 0x0308)
+        completion = yield from tb.request(cfg_request(TLP_CFG_RD0, 0x3c))
+        self.assertEqual(completion[1] & 0xffff, 0x0803)
+        self.assertEqual(completion[3], 0x0b)
+
+    @simulation_test
+    def test_bar_sizing(self, tb):
+        yield from tb.write(0x10, 0xffffffff)
+        yield from tb.write(0x14, 0xffffffff)
+        yield from tb.write(0x18, 0xffffffff)
+        self.assertEqual((yield from tb.read(0x10)), 0xfffff000)
+        self.assertEqual((yield from tb.read(0x14)), 0)
+        self.assertEqual((yield from tb.read(0x18)), 0xfff00000)
+
+    @simulation_test
+    def test_bar_decode(self, tb):
+        yield from tb.write(0x10, 0x80001000)
+        yield from tb.write(0x18, 0x80100000)
+        for adr, hit, index, offset in [
+            (0x80001abc, 1, 0, 0xabc),
+            (0x80123456, 1, 2, 0x23456),
+            (0x80000abc, 0, None, None),
+            (0x80200000, 0, None, None),
+        ]:
+            yield tb.dut.bar_adr.eq(adr)
+            yield
+            # Memory space is not enabled yet.
+            self.assertEqual((yield tb.dut.bar_hit), 0)
+        yield from tb.write(0x04, 0x00000002)
+        for adr, hit, index, offset in [
+            (0x80001abc, 1, 0, 0xabc),
+            (0x80123456, 1, 2, 0x23456),
+            (0x80000abc, 0, None, None),
+            (0x80200000, 0, None, None),
+        ]:
+            yield tb.dut.bar_adr.eq(adr)
+            yield
+            self.assertEqual((yield tb.dut.bar_hit), hit)
+            if hit:
+                self.assertEqual((yield tb.dut.bar_index), index)
+                self.assertEqual((yield tb.dut.bar_offset), offset)
+
+    @simulation_test
+    def test_msi(self, tb):
+        # 64-bit capable, 4 vectors requested; next capability at 0x50.
+        self.assertEqual((yield from tb.read(0x40)), 0x00845005)
+        yield from tb.write(0x44, 0xfee00003)
+        yield from tb.write(0x48, 0x00000001)
+        yield from tb.write(0x4c, 0xffff4321)
+        yield from tb.write(0x40, 0x00210000)
+        self.assertEqual((yield from tb.read(0x40)), 0x00a55005)
+        self.assertEqual((yield tb.dut.msi_enable), 1)
+        self.assertEqual((yield tb.dut.msi_vectors), 2)
+        self.assertEqual((yield tb.dut.msi_address), 0x1fee00000)
+        self.assertEqual((yield tb.dut.msi_data), 0x4321)
+        self.assertEqual((yield from tb.read(0x4c)), 0x4321)
+
+    @simulation_test
+    def test_pcie_capability(self, tb):
+        self.assertEqual((yield from tb.read(0x50)), 0x00020010)
+        # 2.5 GT/s, x4, L0s with an exit latency of more than 4 us.
+        self.assertEqual((yield from tb.read(0x5c)), 0x00007441)
+        yield tb.dut.link_width.eq(2)
+        self.assertEqual((yield from tb.read(0x60)), 0x00210000)
+        yield tb.dut.link_rate.eq(1)
+        yield tb.dut.link_width.eq(4)
+        self.assertEqual((yield from tb.read(0x60)), 0x00420000)
+        yield from tb.write(0x60, 0x00000008)
+        self.assertEqual((yield tb.dut.rcb), 1)
+        yield from tb.write(0x58, 0x00003020)
+        self.assertEqual((yield tb.dut.max_payload_size), 1)
+        self.assertEqual((yield tb.dut.max_read_request_size), 3)
+
+    def test_bars(self):
+        with self.assertRaisesRegex(ValueError,
+                r"BAR size must be a power of 2 and at least 16, not 24"):
+            PCIeConfigSpace(vendor_id=0, device_id=0, class_code=0, bars=[24])
+
+    def test_n_fts(self):
+        with self.assertRaisesRegex(ValueError,
+                r"N_FTS must be between 0 and 255, not 256"):
+            PCIeConfigSpace(vendor_id=0, device_id=0, class_code=0, n_fts=256)
+
+
+class PCIeConfigSpaceNFTSTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tb = PCIeConfigSpaceTestbench(n_fts=15)
+
+    @simulation_test
+    def test_l0s_exit_latency(self, tb):
+        # 16 ordered sets take 256 ns at 2.5 GT/s.
+        self.assertEqual((yield from tb.read(0x5c)) >> 12 & 0b111, 0b011)
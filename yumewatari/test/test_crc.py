@@ -0,0 +1,102 @@
+import unittest
+import zlib
+from migen import *
+
+from ..gateware.crc import *
+from . import simulation_test
+
+
+def crc(width, poly, data):
+    value = (1 << width) - 1
+    for byte in data:
+        for n in range(8):
+            feedback = ((value >> (width - 1)) ^ (byte >> n)) & 1
+            value = (value << 1) & ((1 << width) - 1)
+            if feedback:
+                value ^= poly
+    return value
+
+
+def crc_bytes(width, poly, data):
+    value = ~crc(width, poly, data)
+    return [int("{:08b}".format((value >> (8 * n)) & 0xff)[::-1], 2)
+            for n in reversed(range(width // 8))]
+
+
+class CRCTestCase(unittest.TestCase):
+    def test_lcrc_reference(self):
+        # The LCRC is the same as the Ethernet CRC.
+        data = bytes(range(1, 21))
+        self.assertEqual(bytes(crc_bytes(32, 0x04c11db7, data)),
+                         zlib.crc32(data).to_bytes(4, "little"))
+
+    def test_compute(self):
+        data = bytes(range(1, 21))
+        self.assertEqual(PCIeCRC(32, 0x04c11db7).compute(data), crc(32, 0x04c11db7, data))
+        self.assertEqual(PCIeCRC(16, 0x100b).compute(data[10:], crc(16, 0x100b, data[:10])),
+                         crc(16, 0x100b, data))
+
+    def test_residue(self):
+        for width, poly in ((16, 0x100b), (32, 0x04c11db7)):
+            lcrc = PCIeCRC(width, poly)
+            for data in (b"", bytes(range(1, 21))):
+                fcs = crc_bytes(width, poly, data)
+                self.assertEqual(lcrc.compute(data + bytes(fcs)), lcrc.residue())
+                self.assertEqual(lcrc.compute(data + bytes(b ^ 0xff for b in fcs)),
+                                 lcrc.residue(inverted=True))
+
+
+class PCIeCRCTestbench(Module):
+    def __init__(self, width, poly, word_size):
+        self.crc = PCIeCRC(width, poly)
+        self.i   = Signal(8 * word_size)
+        self.o   = Signal(width)
+        self.en  = Signal()
+        self.state = Signal(width, reset=self.crc.init)
+        self.sync += If(self.en, self.state.eq(self.crc.advance(self.state, self.i)))
+        self.comb += self.o.eq(self.crc.transmit(self.state))
+
+    def compute(self, data):
+        word_size = len(self.i) // 8
+        for offset in range(0, len(data), word_size):
+            yield self.i.eq(int.from_bytes(data[offset:offset + word_size], "little"))
+            yield self.en.eq(1)
+            yield
+        yield self.en.eq(0)
+        yield
+        yield
+        value = yield self.o
+        return list(value.to_bytes(self.crc.width // 8, "little"))
+
+
+class PCIeCRC16TestCase(unittest.TestCase):
+    width, poly = 16, 0x100b
+    word_size = 1
+
+    def setUp(self):
+        self.tb = PCIeCRCTestbench(self.width, self.poly, self.word_size)
+
+    data = bytes([0x00, 0x01, 0x55, 0xaa, 0xff, 0x80, 0x12, 0x34])
+
+    @simulation_test
+    def test_crc(self, tb):
+        self.assertEqual((yield from tb.compute(self.data)),
+                         crc_bytes(self.width, self.poly, self.data))
+
+    def test_width(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Data width must be a multiple of 8, not 12"):
+            PCIeCRC(self.width, self.poly).advance(Signal(self.width), Signal(12))
+
+
+class PCIeCRC16Word4xTestCase(PCIeCRC16TestCase):
+    word_size = 4
+
+
+class PCIeCRC32TestCase(PCIeCRC16TestCase):
+    width, poly = 32, 0x04c11db7
+    word_size = 2
+
+
+class PCIeCRC32Word8xTestCase(PCIeCRC32TestCase):
+    word_size = 8
@@ -47,3 +47,110 @@ class RingLogTestCase(unittest.TestCase):
             (4, 0x55),
             (9, 0xaa),
         ])
+
+
+class RingLogTriggerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tb = RingLogTestbench()
+
+    def run_log(self, tb, values, mode, post_trigger, match_value=0, match_mask=0xff,
+                trigger_at=None):
+        yield tb.dut.trigger_mode.eq(mode)
+        yield tb.dut.match_value.eq(match_value)
+        yield tb.dut.match_mask.eq(match_mask)
+        yield tb.dut.post_trigger.eq(post_trigger)
+        yield tb.dut.arm.eq(1)
+        yield
+        yield tb.dut.arm.eq(0)
+        yield
+        self.assertEqual((yield tb.dut.armed), 1)
+        for n, value in enumerate(values):
+            yield tb.dut.data_i.eq(value)
+            yield tb.dut.trigger_i.eq(n == trigger_at)
+            yield
+            yield tb.dut.trigger_i.eq(0)
+            yield
+        self.assertEqual((yield tb.dut.armed), 0)
+        self.assertEqual((yield tb.dut.triggered), 1)
+        self.assertEqual((yield tb.dut.done), 1)
+        return [data for time, data in (yield from tb.read_out())]
+
+    @simulation_test
+    def test_match(self, tb):
+        data = yield from self.run_log(tb, [1, 2, 3, 4, 5, 6, 7], TRIGGER_MATCH,
+                                       post_trigger=1, match_value=3)
+        self.assertEqual(data, [1, 2, 3, 4])
+
+    @simulation_test
+    def test_post_trigger(self, tb):
+        data = yield from self.run_log(tb, [1, 2, 3, 4, 5, 6, 7], TRIGGER_MATCH,
+                                       post_trigger=3, match_value=2)
+        self.assertEqual(data, [2, 3, 4, 5])
+
+    @simulation_test
+    def test_edge(self, tb):
+        yield tb.dut.data_i.eq(1)
+        yield
+        data = yield from self.run_log(tb, [3, 2, 5, 6, 7], TRIGGER_EDGE,
+                                       post_trigger=0, match_value=1, match_mask=0x01)
+        self.assertEqual(data, [1, 3, 2, 5])
+
+    @simulation_test
+    def test_external(self, tb):
+        data = yield from self.run_log(tb, [1, 2, 3, 4, 5, 6, 7], TRIGGER_EXTERNAL,
+                                       post_trigger=2, trigger_at=3)
+        self.assertEqual(data, [3, 4, 5, 6])
+
+    @simulation_test
+    def test_rearm(self, tb):
+        yield from self.run_log(tb, [1, 2], TRIGGER_MATCH, post_trigger=0, match_value=1)
+        data = yield from self.run_log(tb, [3, 4, 5, 6, 7], TRIGGER_MATCH,
+                                       post_trigger=1, match_value=5)
+        self.assertEqual(data, [3, 4, 5, 6])
+
+    def test_depth(self):
+        with self.assertRaisesRegex(ValueError, r"Depth must be a power of 2, not 5"):
+            RingLog(timestamp_width=8, data_width=8, depth=5)
+
+
+class StateStatisticsTestbench(Module):
+    def __init__(self):
+        self.submodules.dut = StateStatistics(states=3, cycles_width=4, transitions_width=2)
+
+    def read_out(self):
+        result = []
+        for index in range(self.dut.states):
+            yield self.dut.index.eq(index)
+            yield
+            result.append(((yield self.dut.cycles_o), (yield self.dut.transitions_o)))
+        return result
+
+    def run(self, states):
+        for state in states:
+            yield self.dut.state_i.eq(state)
+            yield
+
+
+class StateStatisticsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tb = StateStatisticsTestbench()
+
+    @simulation_test
+    def test_basic(self, tb):
+        yield from tb.run([0, 0, 1, 1, 1, 0, 2])
+        # The state is 0 in the first cycle. The state does not change during the read out,
+        # so it keeps counting cycles.
+        self.assertEqual((yield from tb.read_out()), [
+            (4, 2),
+            (3, 1),
+            (3, 0),
+        ])
+
+    @simulation_test
+    def test_saturate(self, tb):
+        yield from tb.run([1] * 20 + [0, 1, 0, 1, 0, 1, 0, 2])
+        self.assertEqual((yield from tb.read_out()), [
+            (5, 3),
+            (15, 3),
+            (3, 0),
+        ])
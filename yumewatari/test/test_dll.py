@@ -0,0 +1,125 @@
+import unittest
+from migen import *
+
+from ..gateware.serdes import K, D
+from ..gateware.dll import *
+from . import simulation_test
+
+
+class _DataPath(Module):
+    # The data path of a PCIePHY that is trained and stays in L0.
+    def __init__(self, word_size):
+        self.rx_lanes      = [None]
+        self.link_up       = Signal(reset=1)
+        self.retrain       = Signal()
+        self.tx_data       = Signal(9 * word_size)
+        self.tx_data_ready = Signal(reset=1)
+        self.tx_data_hold  = Signal()
+        self.rx_data       = Signal(9 * word_size)
+        self.rx_data_valid = Signal(reset=1)
+
+
+class PCIeDLLTestbench(Module):
+    def __init__(self, word_size=1):
+        self.submodules.phy_a = _DataPath(word_size)
+        self.submodules.phy_b = _DataPath(word_size)
+        self.submodules.dll_a = PCIeDLL(self.phy_a, replay_timeout=128, ack_latency=16,
+                                        ack_coalesce=2)
+        self.submodules.dll_b = PCIeDLL(self.phy_b, replay_timeout=128, ack_latency=16,
+                                        ack_coalesce=2)
+
+        # If armed, the symbol following the next STP transmitted by A is corrupted.
+        self.corrupt = Signal()
+        stp       = Signal(word_size)
+        stp_last  = Signal()
+        after_stp = Signal(word_size)
+        self.comb += [
+            [stp[n].eq(self.phy_a.tx_data[9 * n:9 * (n + 1)] == K(27,7))
+             for n in range(word_size)],
+            after_stp.eq(Cat(stp_last, stp[:-1])),
+        ]
+        self.sync += [
+            stp_last.eq(stp[-1]),
+            If(after_stp != 0,
+                self.corrupt.eq(0)
+            )
+        ]
+        self.comb += [
+            self.phy_b.rx_data.eq(self.phy_a.tx_data ^
+                                  Cat(Cat(self.corrupt & after_stp[n], C(0, 8))
+                                      for n in range(word_size))),
+            self.phy_a.rx_data.eq(self.phy_b.tx_data),
+        ]
+
+    def transfer(self, tlps, count):
+        received = []
+        data = []
+        def receive():
+            nonlocal data
+            tlp_valid = yield self.dll_b.rx.tlp.valid
+            tlp_data  = yield self.dll_b.rx.tlp.data
+            for n in range(len(self.dll_b.rx.tlp.valid)):
+                if tlp_valid & (1 << n):
+                    data.append((tlp_data >> (32 * n)) & 0xffffffff)
+            if (yield self.dll_b.rx.tlp_end):
+                if (yield self.dll_b.rx_tlp_accept):
+                    received.append(((yield self.dll_b.rx.tlp_seq), data))
+                data = []
+        # With wider words, the first TLPs can be received before the last one is transmitted.
+        for tlp in tlps:
+            for n, dword in enumerate(tlp):
+                yield self.dll_a.tx_tlp.valid.eq(1)
+                yield self.dll_a.tx_tlp.data.eq(dword)
+                yield self.dll_a.tx_tlp.last.eq(n == len(tlp) - 1)
+                yield
+                yield from receive()
+                while not (yield self.dll_a.tx_tlp_ready):
+                    yield
+                    yield from receive()
+        yield self.dll_a.tx_tlp.valid.eq(0)
+        for _ in range(count):
+            yield
+            yield from receive()
+        return received
+
+
+class PCIeDLLTestCase(unittest.TestCase):
+    word_size = 1
+
+    def setUp(self):
+        self.tb = PCIeDLLTestbench(self.word_size)
+
+    tlps = [
+        [0x00000001, 0x00000002, 0x00000003],
+        [0x40000001, 0x00000002, 0x00000003, 0xdeadbeef],
+    ]
+
+    @simulation_test
+    def test_transfer(self, tb):
+        self.assertEqual((yield from tb.transfer(self.tlps, 80)), [
+            (0, self.tlps[0]),
+            (1, self.tlps[1]),
+        ])
+        self.assertEqual((yield tb.dll_a.dl_up), 1)
+        self.assertEqual((yield tb.dll_b.dl_up), 1)
+        self.assertEqual((yield tb.dll_a.fc.tx_consumed.nph), 2)
+        self.assertEqual((yield tb.dll_b.next_rcv_seq), 2)
+        # Both TLPs are acknowledged by a single ACK DLLP.
+        self.assertEqual((yield tb.dll_a.replay.ackd_seq), 1)
+        self.assertEqual((yield tb.dll_a.replay.occupancy), 0)
+        self.assertEqual((yield tb.dll_a.replay.replay_count), 0)
+
+    @simulation_test
+    def test_nak(self, tb):
+        yield tb.corrupt.eq(1)
+        self.assertEqual((yield from tb.transfer(self.tlps, 120)), [
+            (0, self.tlps[0]),
+            (1, self.tlps[1]),
+        ])
+        self.assertEqual((yield tb.dll_a.replay.ackd_seq), 1)
+        self.assertEqual((yield tb.dll_a.replay.occupancy), 0)
+        self.assertEqual((yield tb.dll_a.replay.replay_count), 1)
+
+
+class PCIeDLLWord8xTestCase(PCIeDLLTestCase):
+    word_size = 8
@@ -0,0 +1,215 @@
+import unittest
+from migen import *
+
+from ..gateware.struct import *
+from ..gateware.dll_fc import *
+from . import simulation_test
+
+
+def fc_data(hdr, data):
+    return (hdr << 14) | data
+
+
+class PCIeFlowControlTestbench(Module):
+    def __init__(self, update_period=7500):
+        self.submodules.dut = PCIeFlowControl(rx_credits={
+            "ph": 2, "pd": 8, "nph": 1, "npd": 1, "cplh": 0, "cpld": 0
+        }, update_period=update_period)
+
+    def exchange(self, count, dllps=[]):
+        transmitted = []
+        dllps = list(dllps)
+        yield self.dut.dllp_tx_ready.eq(1)
+        for _ in range(count):
+            if dllps:
+                type, data = dllps.pop(0)
+                yield self.dut.dllp_rx.valid.eq(1)
+                yield self.dut.dllp_rx.type.eq(type)
+                yield self.dut.dllp_rx.data.eq(data)
+            else:
+                yield self.dut.dllp_rx.valid.eq(0)
+            yield
+            if (yield self.dut.dllp_tx.valid):
+                transmitted.append(((yield self.dut.dllp_tx.type),
+                                    (yield self.dut.dllp_tx.data)))
+        yield self.dut.dllp_rx.valid.eq(0)
+        yield self.dut.dllp_tx_ready.eq(0)
+        yield
+        return transmitted
+
+    def initialize(self, p=(0, 0), np=(0, 0), cpl=(0, 0)):
+        return (yield from self.exchange(12, [
+            (DLLP_INIT_FC1_P,   fc_data(*p)),
+            (DLLP_INIT_FC1_NP,  fc_data(*np)),
+            (DLLP_INIT_FC1_CPL, fc_data(*cpl)),
+        ] * 2 + [
+            (DLLP_INIT_FC2_P,   fc_data(*p)),
+            (DLLP_INIT_FC2_NP,  fc_data(*np)),
+            (DLLP_INIT_FC2_CPL, fc_data(*cpl)),
+        ]))
+
+    def send(self, tlp, count=8):
+        accepted = True
+        yield self.dut.tx_o_ready.eq(1)
+        for n, dword in enumerate(tlp):
+            yield self.dut.tx_i.valid.eq(1)
+            yield self.dut.tx_i.data.eq(dword)
+            yield self.dut.tx_i.last.eq(n == len(tlp) - 1)
+            for _ in range(count):
+                yield
+                if (yield self.dut.tx_i_ready):
+                    break
+            else:
+                accepted = False
+                break
+        yield self.dut.tx_i.valid.eq(0)
+        yield self.dut.tx_o_ready.eq(0)
+        yield
+        return accepted
+
+    def receive(self, tlp):
+        for dword in tlp:
+            yield self.dut.rx_tlp.valid.eq(1)
+            yield self.dut.rx_tlp.data.eq(dword)
+            yield
+        yield self.dut.rx_tlp.valid.eq(0)
+        yield self.dut.rx_tlp_end.eq(1)
+        yield self.dut.rx_tlp_accept.eq(1)
+        yield
+        credits = {}
+        for name, _ in fc_layout:
+            credits[name] = yield getattr(self.dut.rx_tlp_credits, name)
+        yield self.dut.rx_tlp_end.eq(0)
+        yield self.dut.rx_tlp_accept.eq(0)
+        yield
+        return credits
+
+
+class PCIeFlowControlTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tb = PCIeFlowControlTestbench()
+
+    # Memory write with 5 dwords of payload, memory read, completion with 1 dword of payload.
+    mwr = [0x05000040, 0x000000ff, 0x00001000, 1, 2, 3, 4, 5]
+    mrd = [0x01000000, 0x000000ff, 0x00001000]
+    cpl = [0x0100004a, 0x00000004, 0x00000000, 1]
+
+    @simulation_test
+    def test_initialize(self, tb):
+        self.assertEqual((yield from tb.initialize(p=(4, 16), np=(2, 2))), [
+            (DLLP_INIT_FC1_P,   fc_data(2, 8)),
+            (DLLP_INIT_FC1_NP,  fc_data(1, 1)),
+            (DLLP_INIT_FC1_CPL, fc_data(0, 0)),
+            (DLLP_INIT_FC1_P,   fc_data(2, 8)),
+            (DLLP_INIT_FC1_NP,  fc_data(1, 1)),
+            (DLLP_INIT_FC1_CPL, fc_data(0, 0)),
+            (DLLP_INIT_FC2_P,   fc_data(2, 8)),
+        ])
+        self.assertEqual((yield tb.dut.dl_up), 1)
+        self.assertEqual((yield tb.dut.tx_limit.ph), 4)
+        self.assertEqual((yield tb.dut.tx_limit.pd), 16)
+        self.assertEqual((yield tb.dut.tx_limit.nph), 2)
+        self.assertEqual((yield tb.dut.tx_limit.npd), 2)
+
+    @simulation_test
+    def test_initialize_incomplete(self, tb):
+        transmitted = yield from tb.exchange(12, [
+            (DLLP_INIT_FC1_P,   fc_data(4, 16)),
+            (DLLP_INIT_FC1_NP,  fc_data(2, 2)),
+        ])
+        self.assertEqual({type for type, data in transmitted},
+                         {DLLP_INIT_FC1_P, DLLP_INIT_FC1_NP, DLLP_INIT_FC1_CPL})
+        self.assertEqual((yield tb.dut.dl_up), 0)
+        self.assertFalse((yield from tb.send(self.mrd)))
+
+    @simulation_test
+    def test_tx_credits(self, tb):
+        yield from tb.initialize(p=(4, 2), np=(2, 2))
+        # 5 dwords of payload take 2 data credits.
+        self.assertTrue((yield from tb.send(self.mwr)))
+        self.assertEqual((yield tb.dut.tx_consumed.ph), 1)
+        self.assertEqual((yield tb.dut.tx_consumed.pd), 2)
+        # Completion credits are infinite.
+        self.assertTrue((yield from tb.send(self.cpl)))
+        self.assertEqual((yield tb.dut.tx_stall_cpl), 0)
+        # Non-posted requests are not held back by posted requests.
+        self.assertTrue((yield from tb.send(self.mrd)))
+        self.assertEqual((yield tb.dut.tx_consumed.nph), 1)
+        self.assertEqual((yield tb.dut.tx_consumed.npd), 0)
+
+        self.assertFalse((yield from tb.send(self.mwr)))
+        self.assertEqual((yield tb.dut.tx_stall_p), 8)
+        yield from tb.exchange(1, [(DLLP_UPDATE_FC_P, fc_data(4, 4))])
+        self.assertTrue((yield from tb.send(self.mwr)))
+        self.assertEqual((yield tb.dut.tx_stall_p), 8)
+        self.assertEqual((yield tb.dut.tx_consumed.ph), 2)
+        self.assertEqual((yield tb.dut.tx_consumed.pd), 4)
+
+    @simulation_test
+    def test_tx_credits_infinite(self, tb):
+        yield from tb.initialize(p=(0, 0), np=(1, 0))
+        for _ in range(4):
+            self.assertTrue((yield from tb.send(self.mwr)))
+        self.assertTrue((yield from tb.send(self.mrd)))
+        self.assertFalse((yield from tb.send(self.mrd)))
+        self.assertEqual((yield tb.dut.tx_stall_p), 0)
+        self.assertEqual((yield tb.dut.tx_stall_np), 8)
+
+    @simulation_test
+    def test_rx_credits(self, tb):
+        yield from tb.initialize()
+        self.assertEqual((yield from tb.receive(self.mwr)),
+                         {"ph": 1, "pd": 2, "nph": 0, "npd": 0, "cplh": 0, "cpld": 0})
+        self.assertEqual((yield from tb.receive(self.mrd)),
+                         {"ph": 0, "pd": 0, "nph": 1, "npd": 0, "cplh": 0, "cpld": 0})
+        self.assertEqual((yield from tb.receive(self.cpl)),
+                         {"ph": 0, "pd": 0, "nph": 0, "npd": 0, "cplh": 1, "cpld": 1})
+
+    @simulation_test
+    def test_update_fc(self, tb):
+        yield from tb.initialize()
+        # Below the threshold of 2 posted data credits.
+        yield tb.dut.rx_release.pd.eq(1)
+        yield
+        yield tb.dut.rx_release.pd.eq(0)
+        self.assertEqual((yield from tb.exchange(4)), [])
+        self.assertEqual((yield tb.dut.rx_allocated.pd), 9)
+        # Above the threshold of 1 header credit, and of 1 non-posted data credit.
+        yield tb.dut.rx_release.ph.eq(1)
+        yield tb.dut.rx_release.nph.eq(1)
+        yield
+        yield tb.dut.rx_release.ph.eq(0)
+        yield tb.dut.rx_release.nph.eq(0)
+        self.assertEqual((yield from tb.exchange(4)), [
+            (DLLP_UPDATE_FC_P,  fc_data(3, 9)),
+            (DLLP_UPDATE_FC_NP, fc_data(2, 1)),
+        ])
+
+    def test_credits(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Advertised PH credits must be between 0 and 127, not 128"):
+            PCIeFlowControl(rx_credits={
+                "ph": 128, "pd": 8, "nph": 1, "npd": 1, "cplh": 0, "cpld": 0
+            })
+
+
+class PCIeFlowControlUpdatePeriodTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tb = PCIeFlowControlTestbench(update_period=32)
+
+    @simulation_test
+    def test_update_fc_period(self, tb):
+        yield from tb.initialize()
+        yield tb.dut.rx_release.ph.eq(1)
+        yield
+        yield tb.dut.rx_release.ph.eq(0)
+        self.assertEqual((yield from tb.exchange(4)), [
+            (DLLP_UPDATE_FC_P,  fc_data(3, 8)),
+        ])
+        # If the UpdateFC DLLP is lost, the credits are advertised again; completion credits
+        # are infinite.
+        self.assertEqual((yield from tb.exchange(60)), [
+            (DLLP_UPDATE_FC_NP, fc_data(1, 1)),
+            (DLLP_UPDATE_FC_P,  fc_data(3, 8)),
+            (DLLP_UPDATE_FC_NP, fc_data(1, 1)),
+        ])
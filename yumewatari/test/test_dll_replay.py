@@ -0,0 +1,193 @@
+import unittest
+from migen import *
+
+from ..gateware.dll_replay import *
+from . import simulation_test
+
+
+class PCIeReplayBufferTestbench(Module):
+    def __init__(self, dwords=1):
+        self.submodules.dut = PCIeReplayBuffer(depth=16, max_tlps=4, replay_timeout=32,
+                                               dwords=dwords)
+
+    def store(self, tlp):
+        for n, dword in enumerate(tlp):
+            yield self.dut.i.valid.eq(1)
+            yield self.dut.i.data.eq(dword)
+            yield self.dut.i.last.eq(n == len(tlp) - 1)
+            yield
+            while not (yield self.dut.i_ready):
+                yield
+        yield self.dut.i.valid.eq(0)
+        yield
+
+    def transmit(self, count):
+        tlps = []
+        data = []
+        yield self.dut.o_ready.eq(1)
+        for _ in range(count):
+            yield
+            valid = yield self.dut.o.valid
+            if valid:
+                beat = yield self.dut.o.data
+                data += [(beat >> (32 * n)) & 0xffffffff
+                         for n in range(len(self.dut.o.valid)) if valid & (1 << n)]
+                if (yield self.dut.o.last):
+                    tlps.append(((yield self.dut.o_seq), data))
+                    data = []
+        yield self.dut.o_ready.eq(0)
+        yield
+        return tlps
+
+    def acknowledge(self, seq, nak=False):
+        strobe = self.dut.nak if nak else self.dut.ack
+        yield strobe.eq(1)
+        yield self.dut.ack_seq.eq(seq)
+        yield
+        yield strobe.eq(0)
+        yield
+
+
+class PCIeReplayBufferTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tb = PCIeReplayBufferTestbench()
+
+    tlps = [
+        [0x00000001, 0x00000002, 0x00000003],
+        [0x40000001, 0x00000002, 0x00000003, 0xdeadbeef],
+        [0x04000001, 0x00000002, 0x00000003],
+    ]
+
+    @simulation_test
+    def test_transmit(self, tb):
+        yield from tb.store(self.tlps[0])
+        yield from tb.store(self.tlps[1])
+        self.assertEqual((yield tb.dut.next_transmit_seq), 2)
+        self.assertEqual((yield tb.dut.occupancy), 7)
+        self.assertEqual((yield from tb.transmit(10)), [
+            (0, self.tlps[0]),
+            (1, self.tlps[1]),
+        ])
+        self.assertEqual((yield tb.dut.occupancy), 7)
+
+    @simulation_test
+    def test_ack(self, tb):
+        yield from tb.store(self.tlps[0])
+        yield from tb.store(self.tlps[1])
+        yield from tb.transmit(10)
+        yield from tb.acknowledge(0)
+        self.assertEqual((yield tb.dut.ackd_seq), 0)
+        self.assertEqual((yield tb.dut.occupancy), 4)
+        # Sequence numbers of TLPs that were not transmitted are ignored.
+        yield from tb.acknowledge(5)
+        self.assertEqual((yield tb.dut.ackd_seq), 0)
+        yield from tb.acknowledge(1)
+        self.assertEqual((yield tb.dut.ackd_seq), 1)
+        self.assertEqual((yield tb.dut.occupancy), 0)
+        self.assertEqual((yield from tb.transmit(10)), [])
+        self.assertEqual((yield tb.dut.replay_count), 0)
+
+    @simulation_test
+    def test_nak(self, tb):
+        for tlp in self.tlps:
+            yield from tb.store(tlp)
+        yield from tb.transmit(12)
+        yield from tb.acknowledge(0, nak=True)
+        self.assertEqual((yield tb.dut.occupancy), 7)
+        self.assertEqual((yield from tb.transmit(10)), [
+            (1, self.tlps[1]),
+            (2, self.tlps[2]),
+        ])
+        self.assertEqual((yield tb.dut.replay_count), 1)
+
+    @simulation_test
+    def test_nak_invalid(self, tb):
+        for tlp in self.tlps:
+            yield from tb.store(tlp)
+        yield from tb.transmit(12)
+        yield from tb.acknowledge(0)
+        # Sequence numbers of TLPs that were not transmitted are ignored.
+        yield from tb.acknowledge(5, nak=True)
+        self.assertEqual((yield tb.dut.ackd_seq), 0)
+        self.assertEqual((yield from tb.transmit(10)), [])
+        self.assertEqual((yield tb.dut.replay_count), 0)
+        # A NAK of the last acknowledged TLP replays every stored one.
+        yield from tb.acknowledge(0, nak=True)
+        self.assertEqual((yield from tb.transmit(10)), [
+            (1, self.tlps[1]),
+            (2, self.tlps[2]),
+        ])
+        self.assertEqual((yield tb.dut.replay_count), 1)
+
+    @simulation_test
+    def test_replay_timer(self, tb):
+        yield from tb.store(self.tlps[0])
+        self.assertEqual((yield from tb.transmit(40)), [
+            (0, self.tlps[0]),
+            (0, self.tlps[0]),
+        ])
+        self.assertEqual((yield tb.dut.replay_count), 1)
+        yield from tb.acknowledge(0)
+        self.assertEqual((yield from tb.transmit(40)), [])
+        self.assertEqual((yield tb.dut.replay_count), 1)
+
+    @simulation_test
+    def test_retrain(self, tb):
+        yield from tb.store(self.tlps[0])
+        yield tb.dut.o_ready.eq(1)
+        retrains = 0
+        for _ in range(160):
+            yield
+            retrains += (yield tb.dut.retrain)
+        self.assertEqual((yield tb.dut.replay_count), 4)
+        self.assertEqual(retrains, 1)
+
+    @simulation_test
+    def test_max_tlps(self, tb):
+        for _ in range(4):
+            yield from tb.store(self.tlps[0])
+        yield tb.dut.i.valid.eq(1)
+        for _ in range(4):
+            yield
+            self.assertEqual((yield tb.dut.i_ready), 0)
+        yield tb.dut.i.valid.eq(0)
+        yield from tb.transmit(16)
+        yield from tb.acknowledge(0)
+        yield from tb.store(self.tlps[1])
+        self.assertEqual((yield tb.dut.next_transmit_seq), 5)
+        self.assertEqual((yield tb.dut.occupancy), 13)
+
+    def test_depth(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Replay buffer depth must be a power of 2, not 12"):
+            PCIeReplayBuffer(depth=12, max_tlps=4, replay_timeout=32)
+
+
+class PCIeReplayBufferBeatTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tb = PCIeReplayBufferTestbench(dwords=2)
+
+    tlps = PCIeReplayBufferTestCase.tlps
+
+    @simulation_test
+    def test_transmit(self, tb):
+        yield from tb.store(self.tlps[0])
+        yield from tb.store(self.tlps[1])
+        # A TLP with an odd number of dwords takes a partial beat.
+        self.assertEqual((yield tb.dut.occupancy), 4)
+        self.assertEqual((yield from tb.transmit(6)), [
+            (0, self.tlps[0]),
+            (1, self.tlps[1]),
+        ])
+
+    @simulation_test
+    def test_nak(self, tb):
+        for tlp in self.tlps:
+            yield from tb.store(tlp)
+        yield from tb.transmit(8)
+        yield from tb.acknowledge(0, nak=True)
+        self.assertEqual((yield tb.dut.occupancy), 4)
+        self.assertEqual((yield from tb.transmit(6)), [
+            (1, self.tlps[1]),
+            (2, self.tlps[2]),
+        ])
@@ -0,0 +1,221 @@
+import unittest
+from migen import *
+
+from ..gateware.serdes import K, D
+from ..gateware.struct import *
+from ..gateware.dll_rx import *
+from . import simulation_test
+from .test_crc import crc_bytes
+
+
+def dllp_symbols(type, data, crc=None):
+    body = [type, (data >> 16) & 0xff, (data >> 8) & 0xff, data & 0xff]
+    if crc is None:
+        crc = crc_bytes(16, 0x100b, body)
+    return [K(28,2), *body, *crc, K(29,7)]
+
+
+def tlp_symbols(seq, data, lcrc=None, nullified=False):
+    body = [(seq >> 8) & 0xf, seq & 0xff, *data]
+    if lcrc is None:
+        lcrc = crc_bytes(32, 0x04c11db7, body)
+    if nullified:
+        return [K(27,7), *body, *[byte ^ 0xff for byte in lcrc], K(30,7)]
+    return [K(27,7), *body, *lcrc, K(29,7)]
+
+
+class PCIeDLLRXTestbench(Module):
+    def __init__(self, word_size=1):
+        self.word_size = word_size
+        self.submodules.dll = PCIeDLLRX(word_size)
+
+    def transmit(self, symbols):
+        dllps  = []
+        errors = []
+        tlps   = []
+        data   = []
+        symbols = symbols + [D(0,0)] * (-len(symbols) % self.word_size)
+        for offset in range(0, len(symbols) + 2 * self.word_size, self.word_size):
+            word = symbols[offset:offset + self.word_size]
+            word = word + [D(0,0)] * (self.word_size - len(word))
+            yield self.dll.i.eq(Cat(C(symbol, 9) for symbol in word))
+            yield
+            if (yield self.dll.dllp.valid):
+                dllps.append(((yield self.dll.dllp.type), (yield self.dll.dllp.data)))
+            if (yield self.dll.bad_dllp):
+                errors.append("bad_dllp")
+            if (yield self.dll.error):
+                errors.append("error")
+                data = []
+            tlp_valid = yield self.dll.tlp.valid
+            tlp_data  = yield self.dll.tlp.data
+            for n in range(len(self.dll.tlp.valid)):
+                if tlp_valid & (1 << n):
+                    data += ((tlp_data >> (32 * n)) & 0xffffffff).to_bytes(4, "little")
+            if (yield self.dll.tlp_end):
+                if (yield self.dll.tlp_good):
+                    status = "good"
+                elif (yield self.dll.tlp_nullified):
+                    status = "nullified"
+                else:
+                    status = "bad"
+                tlps.append(((yield self.dll.tlp_seq), data, status))
+                data = []
+        return dllps, errors, tlps
+
+
+class PCIeDLLRXTestCase(unittest.TestCase):
+    word_size = 1
+
+    def setUp(self):
+        self.tb = PCIeDLLRXTestbench(self.word_size)
+
+    def simulationSetUp(self, tb):
+        yield tb.dll.valid.eq(1)
+
+    def assertReceive(self, tb, symbols, dllps, errors=[], tlps=[]):
+        self.assertEqual((yield from tb.transmit(symbols)), (dllps, errors, tlps))
+
+    @simulation_test
+    def test_rx_dllp(self, tb):
+        yield from self.assertReceive(tb, [
+            *dllp_symbols(DLLP_ACK, 0x000123),
+            *dllp_symbols(DLLP_UPDATE_FC_P | 1, 0x12345a),
+        ], [
+            (DLLP_ACK, 0x000123),
+            (DLLP_UPDATE_FC_P | 1, 0x12345a),
+        ])
+
+    @simulation_test
+    def test_rx_dllp_idle(self, tb):
+        yield from self.assertReceive(tb, [
+            D(0,0),
+            *dllp_symbols(DLLP_NAK, 0x000fff),
+            D(0,0), D(0,0), D(0,0),
+            K(28,5), K(28,0), K(28,0), K(28,0),
+            *dllp_symbols(DLLP_PM_ENTER_L1, 0x000000),
+        ], [
+            (DLLP_NAK, 0x000fff),
+            (DLLP_PM_ENTER_L1, 0x000000),
+        ])
+
+    @simulation_test
+    def test_rx_bad_dllp(self, tb):
+        yield from self.assertReceive(tb, [
+            *dllp_symbols(DLLP_ACK, 0x000123, crc=[0x12, 0x34]),
+            *dllp_symbols(DLLP_ACK, 0x000124),
+        ], [
+            (DLLP_ACK, 0x000124),
+        ], ["bad_dllp"])
+
+    @simulation_test
+    def test_rx_framing_error(self, tb):
+        yield from self.assertReceive(tb, [
+            *dllp_symbols(DLLP_ACK, 0x000123)[:5], K(29,7),
+            # The rest of the word is discarded with the error.
+            *[D(0,0)] * 8,
+            *dllp_symbols(DLLP_ACK, 0x000124),
+        ], [
+            (DLLP_ACK, 0x000124),
+        ], ["error"])
+
+    tlp_header = [0x00, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00, 0x0f, 0x12, 0x34, 0x56, 0x78]
+    tlp_data   = [0xde, 0xad, 0xbe, 0xef]
+
+    @simulation_test
+    def test_rx_tlp(self, tb):
+        yield from self.assertReceive(tb, [
+            *tlp_symbols(0x000, self.tlp_header),
+            *dllp_symbols(DLLP_ACK, 0x000123),
+            *tlp_symbols(0xabc, self.tlp_header + self.tlp_data),
+            D(0,0),
+        ], [
+            (DLLP_ACK, 0x000123),
+        ], [], [
+            (0x000, self.tlp_header, "good"),
+            (0xabc, self.tlp_header + self.tlp_data, "good"),
+        ])
+
+    @simulation_test
+    def test_rx_tlp_bad_lcrc(self, tb):
+        yield from self.assertReceive(tb, [
+            *tlp_symbols(0x001, self.tlp_header, lcrc=[0x12, 0x34, 0x56, 0x78]),
+            *tlp_symbols(0x001, self.tlp_header),
+        ], [], [], [
+            (0x001, self.tlp_header, "bad"),
+            (0x001, self.tlp_header, "good"),
+        ])
+
+    @simulation_test
+    def test_rx_tlp_nullified(self, tb):
+        yield from self.assertReceive(tb, [
+            *tlp_symbols(0x002, self.tlp_header, nullified=True),
+            *tlp_symbols(0x002, self.tlp_header[:8], lcrc=[0x12, 0x34, 0x56, 0x78],
+                         nullified=True),
+        ], [], [], [
+            (0x002, self.tlp_header, "nullified"),
+            (0x002, self.tlp_header[:8], "bad"),
+        ])
+
+    @simulation_test
+    def test_rx_tlp_framing_error(self, tb):
+        yield from self.assertReceive(tb, [
+            # END in the middle of a dword.
+            *tlp_symbols(0x003, self.tlp_header)[:-2], K(29,7),
+            *[D(0,0)] * 8,
+            *tlp_symbols(0x003, self.tlp_header),
+        ], [], ["error"], [
+            (0x003, self.tlp_header, "good"),
+        ])
+
+
+class PCIeDLLRXWord2xTestCase(PCIeDLLRXTestCase):
+    word_size = 2
+
+
+class PCIeDLLRXWord4xTestCase(PCIeDLLRXTestCase):
+    word_size = 4
+
+    @simulation_test
+    def test_rx_dllp_unaligned(self, tb):
+        yield from self.assertReceive(tb, [
+            D(0,0),
+            *dllp_symbols(DLLP_ACK, 0x000123),
+            *dllp_symbols(DLLP_ACK, 0x000124),
+            D(0,0), D(0,0),
+            *dllp_symbols(DLLP_ACK, 0x000125),
+        ], [
+            (DLLP_ACK, 0x000123),
+            (DLLP_ACK, 0x000124),
+            (DLLP_ACK, 0x000125),
+        ])
+
+    @simulation_test
+    def test_rx_tlp_unaligned(self, tb):
+        # Every packet starts in a different slot.
+        yield from self.assertReceive(tb, [
+            D(0,0),
+            *tlp_symbols(0x004, self.tlp_header),
+            D(0,0),
+            *tlp_symbols(0x005, self.tlp_header + self.tlp_data),
+            D(0,0),
+            *dllp_symbols(DLLP_ACK, 0x000123),
+            *tlp_symbols(0x006, self.tlp_header),
+        ], [
+            (DLLP_ACK, 0x000123),
+        ], [], [
+            (0x004, self.tlp_header, "good"),
+            (0x005, self.tlp_header + self.tlp_data, "good"),
+            (0x006, self.tlp_header, "good"),
+        ])
+
+
+class PCIeDLLRXWord8xTestCase(PCIeDLLRXWord4xTestCase):
+    word_size = 8
+
+
+class PCIeDLLRXWordSizeTestCase(unittest.TestCase):
+    def test_word_size(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Word size must be between 1 and 8 symbols, not 16"):
+            PCIeDLLRX(16)
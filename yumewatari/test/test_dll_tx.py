@@ -0,0 +1,185 @@
+import unittest
+from migen import *
+
+from ..gateware.serdes import K, D
+from ..gateware.struct import *
+from ..gateware.dll_rx import *
+from ..gateware.dll_tx import *
+from . import simulation_test
+from .test_dll_rx import dllp_symbols, tlp_symbols
+
+
+class PCIeDLLTXTestbench(Module):
+    def __init__(self, word_size=1):
+        self.word_size = word_size
+        self.submodules.dll = PCIeDLLTX(word_size)
+        # The receiver only sees the words that are transmitted.
+        self.submodules.rx  = CEInserter()(PCIeDLLRX(word_size))
+        self.comb += [
+            self.rx.ce.eq(self.dll.ready),
+            self.rx.i.eq(self.dll.o),
+            self.rx.valid.eq(1),
+        ]
+
+    def send(self, dllps):
+        for type, data in dllps:
+            yield self.dll.dllp.valid.eq(1)
+            yield self.dll.dllp.type.eq(type)
+            yield self.dll.dllp.data.eq(data)
+            yield
+            while not (yield self.dll.dllp_ready):
+                yield
+        yield self.dll.dllp.valid.eq(0)
+
+    def send_tlps(self, tlps):
+        beat_size = 4 * len(self.dll.tlp.valid)
+        for seq, data in tlps:
+            yield self.dll.tlp_seq.eq(seq)
+            for offset in range(0, len(data), beat_size):
+                beat = data[offset:offset + beat_size]
+                yield self.dll.tlp.valid.eq((1 << (len(beat) // 4)) - 1)
+                yield self.dll.tlp.data.eq(int.from_bytes(bytes(beat), "little"))
+                yield self.dll.tlp.last.eq(offset + beat_size >= len(data))
+                yield
+                while not (yield self.dll.tlp_ready):
+                    yield
+        yield self.dll.tlp.valid.eq(0)
+
+    def receive(self, count, ready):
+        symbols  = []
+        holds    = []
+        received = []
+        tlps     = []
+        data     = []
+        for n in range(count):
+            yield self.dll.ready.eq(ready(n))
+            yield
+            if ready(n):
+                word = yield self.dll.o
+                symbols += [(word >> (9 * n)) & 0x1ff for n in range(self.word_size)]
+                holds.append((yield self.dll.hold))
+                if (yield self.rx.dllp.valid):
+                    received.append(((yield self.rx.dllp.type), (yield self.rx.dllp.data)))
+                tlp_valid = yield self.rx.tlp.valid
+                tlp_data  = yield self.rx.tlp.data
+                for n in range(len(self.rx.tlp.valid)):
+                    if tlp_valid & (1 << n):
+                        data += ((tlp_data >> (32 * n)) & 0xffffffff).to_bytes(4, "little")
+                if (yield self.rx.tlp_end):
+                    if (yield self.rx.tlp_good):
+                        tlps.append(((yield self.rx.tlp_seq), data))
+                    data = []
+        return symbols, holds, received, tlps
+
+    def transfer(self, dllps, count, ready=lambda n: True, tlps=[]):
+        result = []
+        def receiver():
+            result.extend((yield from self.receive(count, ready)))
+        run_simulation(self, [self.send(dllps), self.send_tlps(tlps), receiver()],
+                       vcd_name="test.vcd")
+        return result
+
+
+class PCIeDLLTXTestCase(unittest.TestCase):
+    word_size = 1
+
+    def setUp(self):
+        self.tb = PCIeDLLTXTestbench(self.word_size)
+
+    dllps = [
+        (DLLP_ACK, 0x000123),
+        (DLLP_UPDATE_FC_NP, 0x04a001),
+        (DLLP_PM_REQUEST_ACK, 0x000000),
+    ]
+
+    def test_tx_dllp(self):
+        symbols, holds, _, _ = self.tb.transfer(self.dllps[:1], 16 // self.word_size + 1)
+        offset = symbols.index(K(28,2))
+        self.assertEqual(symbols[:offset], [D(0,0)] * offset)
+        self.assertEqual(symbols[offset:offset + 8], dllp_symbols(*self.dllps[0]))
+        self.assertEqual(symbols[offset + 8:], [D(0,0)] * (len(symbols) - offset - 8))
+
+    def test_tx_idle(self):
+        symbols, holds, _, _ = self.tb.transfer([], 4)
+        self.assertEqual(symbols, [D(0,0)] * 4 * self.word_size)
+        self.assertEqual(holds, [0] * 4)
+
+    def test_loopback(self):
+        _, _, received, _ = self.tb.transfer(self.dllps, 32)
+        self.assertEqual(received, self.dllps)
+
+    def test_loopback_stall(self):
+        _, _, received, _ = self.tb.transfer(self.dllps, 48, ready=lambda n: n % 3 != 1)
+        self.assertEqual(received, self.dllps)
+
+    tlps = [
+        (0x000, [0x00, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00, 0x0f, 0x12, 0x34, 0x56, 0x78]),
+        (0x001, [0x40, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00, 0x0f, 0x12, 0x34, 0x56, 0x78,
+                 0xde, 0xad, 0xbe, 0xef]),
+        (0xfff, [0x04, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00, 0x0f, 0x12, 0x34, 0x56, 0x78]),
+    ]
+
+    def test_tx_tlp(self):
+        symbols, holds, _, _ = self.tb.transfer([], 32 // self.word_size + 1,
+                                                tlps=self.tlps[1:2])
+        offset = symbols.index(K(27,7))
+        self.assertEqual(symbols[:offset], [D(0,0)] * offset)
+        self.assertEqual(symbols[offset:offset + 24], tlp_symbols(*self.tlps[1]))
+        self.assertEqual(symbols[offset + 24:], [D(0,0)] * (len(symbols) - offset - 24))
+
+    def test_tx_tlp_unaligned(self):
+        # A TLP of 20 symbols ends in the middle of a word of 8 symbols.
+        symbols, holds, _, _ = self.tb.transfer([], 32 // self.word_size + 1,
+                                                tlps=self.tlps[:1])
+        offset = symbols.index(K(27,7))
+        self.assertEqual(symbols[offset:offset + 20], tlp_symbols(*self.tlps[0]))
+        self.assertEqual(symbols[offset + 20:], [D(0,0)] * (len(symbols) - offset - 20))
+
+    def test_tx_tlp_line_rate(self):
+        # Back-to-back TLPs occupy every symbol of every word.
+        symbols, _, _, tlps = self.tb.transfer([], 72 // self.word_size + 2,
+                                                tlps=self.tlps)
+        offset = symbols.index(K(27,7))
+        self.assertEqual(symbols[offset:offset + 20 + 24 + 20],
+                         [symbol for tlp in self.tlps for symbol in tlp_symbols(*tlp)])
+        self.assertEqual(tlps, self.tlps)
+
+    def test_tlp_loopback(self):
+        _, _, received, tlps = self.tb.transfer(self.dllps, 96 // self.word_size + 4,
+                                                tlps=self.tlps)
+        self.assertEqual(received, self.dllps)
+        self.assertEqual(tlps, self.tlps)
+
+    def test_tlp_loopback_stall(self):
+        _, _, received, tlps = self.tb.transfer(self.dllps, 144 // self.word_size + 6,
+                                                ready=lambda n: n % 3 != 1, tlps=self.tlps)
+        self.assertEqual(received, self.dllps)
+        self.assertEqual(tlps, self.tlps)
+
+
+class PCIeDLLTXWord2xTestCase(PCIeDLLTXTestCase):
+    word_size = 2
+
+
+class PCIeDLLTXWord4xTestCase(PCIeDLLTXTestCase):
+    word_size = 4
+
+    def test_tx_hold(self):
+        symbols, holds, _, _ = self.tb.transfer(self.dllps[:2], 8)
+        offset = symbols.index(K(28,2))
+        self.assertEqual(offset % 4, 0)
+        self.assertEqual(symbols[offset:offset + 16], [*dllp_symbols(*self.dllps[0]),
+                                                       *dllp_symbols(*self.dllps[1])])
+        # No ordered set may be inserted in the middle of a DLLP.
+        self.assertEqual(holds[offset // 4:offset // 4 + 5], [0, 1, 0, 1, 0])
+
+
+class PCIeDLLTXWord8xTestCase(PCIeDLLTXTestCase):
+    word_size = 8
+
+
+class PCIeDLLTXWordSizeTestCase(unittest.TestCase):
+    def test_word_size(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Word size must be between 1 and 8 symbols, not 16"):
+            PCIeDLLTX(16)
@@ -0,0 +1,257 @@
+import unittest
+from migen import *
+
+from ..gateware.struct import *
+from ..gateware.cfg import *
+from ..gateware.dma import *
+from .test_cfg import cfg_request
+from .test_mmio import swap32
+
+
+def completions(adr, length, tag, data, status=CPL_SC):
+    if status != CPL_SC:
+        return [[TLP_CPL, (status << 21) | ((length * 4) & 0xff) << 24 |
+                 (((length * 4) >> 8) & 0xf) << 16, tag << 16]]
+    tlps = []
+    offset = 0
+    while offset < length:
+        # Split at every 64 byte Read Completion Boundary.
+        chunk = min(length - offset, 16 - ((adr // 4 + offset) % 16))
+        byte_count = (length - offset) * 4
+        tlps.append([
+            TLP_CPLD | ((chunk >> 8) << 16) | ((chunk & 0xff) << 24),
+            (status << 21) | ((byte_count & 0xff) << 24) | (((byte_count >> 8) & 0xf) << 16),
+            (tag << 16) | (((adr + offset * 4) & 0x7f) << 24),
+        ] + data[offset:offset + chunk])
+        offset += chunk
+    return tlps
+
+
+class PCIeDMAEngineTestbench(Module):
+    def __init__(self, **kwargs):
+        self.submodules.cfg = PCIeConfigSpace(vendor_id=0x1234, device_id=0x5678,
+                                              class_code=0x058000, bars=[4096])
+        self.submodules.dma = PCIeDMAEngine(self.cfg, **kwargs)
+        self.bus = self.dma.bus
+
+        self.host        = {}
+        self.local       = {}
+        self.latency     = 20
+        self.reorder     = False
+        self.status      = lambda adr: CPL_SC
+        self.drop        = lambda adr: False
+        self.requests    = []
+        self.pending     = []
+        self.max_pending = 0
+        self.cycle       = 0
+        self.done        = 0
+
+    def configure(self, offset, data):
+        for n, dword in enumerate(cfg_request(TLP_CFG_WR0, offset, data)):
+            yield self.cfg.i.valid.eq(1)
+            yield self.cfg.i.data.eq(dword)
+            yield self.cfg.i.last.eq(n == 3)
+            yield
+            while not (yield self.cfg.i_ready):
+                yield
+        yield self.cfg.i.valid.eq(0)
+        yield self.cfg.o_ready.eq(1)
+        while not (yield self.cfg.o.last):
+            yield
+        yield
+        yield self.cfg.o_ready.eq(0)
+
+    def handle(self, dwords):
+        fmt_type = dwords[0] & 0xff
+        length   = (dwords[0] >> 24) | (((dwords[0] >> 16) & 0b11) << 8)
+        tag      = (dwords[1] >> 16) & 0xff
+        if fmt_type & 0x20:
+            adr  = (swap32(dwords[2]) << 32) | swap32(dwords[3])
+            data = dwords[4:]
+        else:
+            adr  = swap32(dwords[2])
+            data = dwords[3:]
+        self.requests.append((fmt_type, adr, length))
+        if fmt_type in (TLP_MWR32, TLP_MWR64):
+            assert len(data) == length
+            for n, dword in enumerate(data):
+                self.host[adr // 4 + n] = dword
+        else:
+            assert not data
+            data = [self.host.get(adr // 4 + n, 0) for n in range(length)]
+            if self.drop(adr):
+                return
+            self.pending.append((self.cycle + self.latency,
+                                 completions(adr, length, tag, data, self.status(adr))))
+            self.max_pending = max(self.max_pending, len(self.pending))
+
+    @passive
+    def host_requests(self):
+        dwords = []
+        yield self.dma.o_ready.eq(1)
+        while True:
+            yield
+            self.cycle += 1
+            self.done  += yield self.dma.done
+            if (yield self.dma.o.valid):
+                dwords.append((yield self.dma.o.data))
+                if (yield self.dma.o.last):
+                    self.handle(dwords)
+                    dwords = []
+
+    @passive
+    def host_completions(self):
+        while True:
+            ready = [n for n, (cycle, tlps) in enumerate(self.pending) if cycle <= self.cycle]
+            if not ready:
+                yield
+                continue
+            # Completions for different requests may be reordered, but not the completions
+            # for the same request.
+            index = ready[-1] if self.reorder else ready[0]
+            cycle, tlps = self.pending[index]
+            tlp = tlps.pop(0)
+            if not tlps:
+                del self.pending[index]
+            for n, dword in enumerate(tlp):
+                yield self.dma.i.valid.eq(1)
+                yield self.dma.i.data.eq(dword)
+                yield self.dma.i.last.eq(n == len(tlp) - 1)
+                yield
+                while not (yield self.dma.i_ready):
+                    yield
+            yield self.dma.i.valid.eq(0)
+
+    @passive
+    def serve(self):
+        pending = []
+        n = 0
+        while True:
+            if (yield self.bus.stb) and not (yield self.bus.stall):
+                adr = yield self.bus.adr
+                if (yield self.bus.we):
+                    self.local[adr] = yield self.bus.dat_w
+                pending.append((n + 3, self.local.get(adr, 0)))
+            n += 1
+            if pending and pending[0][0] <= n:
+                _, data = pending.pop(0)
+                yield self.bus.ack.eq(1)
+                yield self.bus.dat_r.eq(data)
+            else:
+                yield self.bus.ack.eq(0)
+            yield self.bus.stall.eq(n % 7 == 0)
+            yield
+
+    def add(self, index, host_adr, local_adr, length, to_host=False, ring_base=0x2000):
+        adr = ring_base // 4 + index * 4
+        self.host[adr + 0] = host_adr & 0xffffffff
+        self.host[adr + 1] = host_adr >> 32
+        self.host[adr + 2] = local_adr
+        self.host[adr + 3] = length | (to_host << 30)
+
+    def run(self, batches, ring_base=0x2000, ring_size=16):
+        counters = {}
+        def main():
+            yield from self.configure(0x04, 0x00000006)
+            yield self.dma.ring_base.eq(ring_base)
+            yield self.dma.ring_size.eq(ring_size)
+            yield self.dma.enable.eq(1)
+            for descriptors, head in batches:
+                for descriptor in descriptors:
+                    self.add(*descriptor, ring_base=ring_base)
+                yield self.dma.head.eq(head)
+                for _ in range(5000):
+                    yield
+                    if (yield self.dma.tail) == head and not (yield self.dma.busy):
+                        break
+                else:
+                    raise AssertionError("DMA did not finish")
+            for name in ("desc_count", "read_dwords", "write_dwords", "cpl_error_count"):
+                counters[name] = yield getattr(self.dma, name)
+        run_simulation(self, [main(), self.host_requests(), self.host_completions(),
+                              self.serve()],
+                       vcd_name="test.vcd")
+        return counters
+
+    def control(self, index, ring_base=0x2000):
+        return self.host[ring_base // 4 + index * 4 + 3]
+
+
+class PCIeDMAEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tb = PCIeDMAEngineTestbench()
+
+    def test_from_host(self):
+        self.tb.reorder = True
+        for n in range(300):
+            self.tb.host[0x10000f00 // 4 + n] = 0x5a000000 | n
+        counters = self.tb.run([([(0, 0x10000f00, 0x100, 300)], 1)])
+        self.assertEqual([self.tb.local.get(0x100 + n) for n in range(300)],
+                         [0x5a000000 | n for n in range(300)])
+        reads = [(adr, length) for fmt_type, adr, length in self.tb.requests
+                 if fmt_type == TLP_MRD32 and adr >= 0x10000000]
+        # Max_Read_Request_Size is 512 bytes, and no request crosses a 4 KiB boundary.
+        self.assertEqual(reads, [(0x10000f00, 64), (0x10001000, 128), (0x10001200, 108)])
+        self.assertGreater(self.tb.max_pending, 1)
+        self.assertEqual(self.tb.control(0), 0x8000012c)
+        self.assertEqual(counters, {"desc_count": 1, "read_dwords": 300, "write_dwords": 0,
+                                    "cpl_error_count": 0})
+
+    def test_to_host(self):
+        for n in range(100):
+            self.tb.local[0x40 + n] = 0xa5000000 | n
+        counters = self.tb.run([([(0, 0x100000040, 0x40, 100, True)], 1)])
+        self.assertEqual([self.tb.host.get(0x100000040 // 4 + n) for n in range(100)],
+                         [0xa5000000 | n for n in range(100)])
+        writes = [(adr, length) for fmt_type, adr, length in self.tb.requests
+                  if fmt_type == TLP_MWR64]
+        # Max_Payload_Size is 128 bytes.
+        self.assertEqual(writes, [(0x100000040, 32), (0x1000000c0, 32), (0x100000140, 32),
+                                  (0x1000001c0, 4)])
+        self.assertEqual(self.tb.control(0), 0xc0000064)
+        self.assertEqual(counters["write_dwords"], 100)
+
+    def test_ring(self):
+        for n in range(8):
+            self.tb.host[0x8000 // 4 + n] = n
+        counters = self.tb.run([
+            ([(0, 0x8000, 0x00, 4), (1, 0x9000, 0x00, 4, True), (2, 0x8010, 0x10, 4)], 3),
+            ([(3, 0x9010, 0x10, 4, True), (0, 0xa000, 0x00, 8, True)], 1),
+        ], ring_size=4)
+        self.assertEqual([self.tb.host.get(0x9000 // 4 + n) for n in range(8)],
+                         [0, 1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual([self.tb.host.get(0xa000 // 4 + n) for n in range(8)],
+                         [0, 1, 2, 3, 0, 0, 0, 0])
+        self.assertEqual(counters["desc_count"], 5)
+        self.assertEqual(self.tb.done, 5)
+        self.assertEqual([self.tb.control(n) >> 29 for n in range(4)],
+                         [0b110, 0b110, 0b100, 0b110])
+
+    def test_error(self):
+        self.tb.status = lambda adr: CPL_UR if adr == 0x10000200 else CPL_SC
+        counters = self.tb.run([([(0, 0x10000000, 0x100, 256), (1, 0x10000000, 0x100, 4)], 2)])
+        self.assertEqual(self.tb.control(0), 0xa0000100)
+        self.assertEqual(self.tb.control(1), 0x80000004)
+        self.assertEqual(counters["cpl_error_count"], 1)
+        self.assertEqual(counters["desc_count"], 2)
+
+    def test_timeout(self):
+        self.tb = PCIeDMAEngineTestbench(cpl_timeout=200)
+        # The completions for a data read and for a descriptor fetch are lost.
+        self.tb.drop = lambda adr: adr in (0x10000200, 0x2010)
+        counters = self.tb.run([([(0, 0x10000000, 0x100, 256), (1, 0x10000000, 0x100, 4),
+                                  (2, 0x10000000, 0x100, 4)], 3)])
+        self.assertEqual(self.tb.control(0), 0xa0000100)
+        self.assertEqual(self.tb.control(1), 0xa0000000)
+        self.assertEqual(self.tb.control(2), 0x80000004)
+        self.assertEqual(counters["cpl_error_count"], 2)
+        self.assertEqual(counters["desc_count"], 3)
+
+    def test_parameters(self):
+        cfg = PCIeConfigSpace(vendor_id=0, device_id=0, class_code=0)
+        with self.assertRaisesRegex(ValueError,
+                r"Max payload size must be a power of 2 between 128 and 4096, not 64"):
+            PCIeDMAEngine(cfg, max_payload=64)
+        with self.assertRaisesRegex(ValueError,
+                r"Number of tags must be between 1 and 256, not 0"):
+            PCIeDMAEngine(cfg, max_tags=0)
@@ -0,0 +1,137 @@
+import random
+import unittest
+from migen import *
+
+from ..gateware.serdes import *
+from ..gateware.serdes import K, D
+from ..gateware.phy_rx import *
+from ..gateware.phy_tx import *
+from ..gateware.protocol import Executor
+from . import simulation_test
+
+
+def random_ordered_sets(rng, count, error_rate):
+    symbols = []
+    for _ in range(count):
+        kind = rng.choice(["TS1", "TS2", "TS1-INV", "TS2-INV", "SKP"])
+        if kind == "SKP":
+            symbols += [K(28,5), K(28,0), K(28,0), K(28,0)]
+        else:
+            ts_id = {"TS1": D(10,2), "TS2": D(5,2), "TS1-INV": D(21,5), "TS2-INV": D(26,5)}[kind]
+            symbols += [
+                K(28,5),
+                rng.choice([K(23,7), rng.randrange(256)]),
+                rng.choice([K(23,7), rng.randrange(32)]),
+                rng.randrange(256),
+                rng.choice([0b0010, 0b0110]),
+                rng.randrange(16),
+                *[ts_id for _ in range(10)]
+            ]
+    return [rng.randrange(512) if rng.random() < error_rate else symbol for symbol in symbols]
+
+
+class ExecutorPCIePHYRXTestbench(Module):
+    def __init__(self, ratio):
+        self.submodules.lane = PCIeSERDESInterface(ratio)
+        self.submodules.phy  = PCIePHYRX(self.lane)
+
+    def do_finalize(self):
+        self.states = {v: k for k, v in self.phy.parser.fsm.encoding.items()}
+
+
+class ExecutorPCIePHYRXTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tb = ExecutorPCIePHYRXTestbench(ratio=self.ratio)
+
+    ratio = 1
+
+    def simulationSetUp(self, tb):
+        yield tb.lane.rx_valid.eq(Replicate(1, tb.lane.ratio))
+
+    def execute(self, tb, symbols):
+        executor = Executor(tb.phy.parser)
+        trace = []
+        for offset in range(0, len(symbols), tb.lane.ratio):
+            executor.step(symbols[offset:offset + tb.lane.ratio])
+            trace.append((executor.state, executor.error, executor[tb.phy.comma],
+                          executor[tb.phy._tsZ.raw_bits()], executor[tb.phy.ts.raw_bits()],
+                          executor[tb.lane.rx_invert]))
+        return trace
+
+    @simulation_test
+    def test_cosimulation(self, tb):
+        symbols = random_ordered_sets(random.Random(0), 100, error_rate=0.01)
+        symbols = symbols[:len(symbols) // tb.lane.ratio * tb.lane.ratio]
+        trace = self.execute(tb, symbols)
+        for n, (state, error, comma, *_) in enumerate(trace):
+            word = symbols[n * tb.lane.ratio:(n + 1) * tb.lane.ratio]
+            for j, symbol in enumerate(word):
+                yield tb.lane.rx_symbol.part(j * 9, 9).eq(symbol)
+            yield
+            # Combinatorial outputs reflect the current word, and registers reflect
+            # the previous one.
+            self.assertEqual((yield tb.phy.error), error)
+            self.assertEqual((yield tb.phy.comma), comma)
+            if n > 0:
+                state, _, _, tsZ, ts, rx_invert = trace[n - 1]
+                self.assertEqual(tb.states[(yield tb.phy.parser.fsm.state)], state)
+                self.assertEqual((yield tb.phy._tsZ.raw_bits()), tsZ)
+                self.assertEqual((yield tb.phy.ts.raw_bits()), ts)
+                self.assertEqual((yield tb.lane.rx_invert), rx_invert)
+
+    def test_skp_packets(self):
+        symbols = [
+            K(28,5), K(28,0), K(28,0), K(28,0),
+            K(27,7), D(1,0), D(2,0), K(29,7),
+            K(28,5), K(28,0), K(28,0), K(28,0),
+            K(28,2), D(3,0), D(4,0), K(29,7),
+        ]
+        trace = self.execute(self.tb, symbols)
+        self.assertEqual([error for state, error, *_ in trace], [False] * len(trace))
+        self.assertEqual(trace[-1][0], "COMMA")
+
+
+class ExecutorPCIePHYRXGear2xTestCase(ExecutorPCIePHYRXTestCase):
+    ratio = 2
+
+
+class ExecutorPCIePHYRXGear4xTestCase(ExecutorPCIePHYRXTestCase):
+    ratio = 4
+
+
+class ExecutorTestCase(unittest.TestCase):
+    def test_run(self):
+        lane = PCIeSERDESInterface(ratio=2)
+        phy  = PCIePHYRX(lane)
+        executor = Executor(phy.parser)
+        self.assertEqual(executor.run([
+            K(28,5), 0xaa, 0x1a, 0xff, 0b0010, 0b0000, *[D(10,2) for _ in range(10)],
+            K(28,5), 0xaa, 0x1a, 0xff, 0b0010, 0b0000, *[D(10,2) for _ in range(10)],
+        ]), [
+            ("TSn-LANE", False), ("TSn-RATE", False), ("TSn-ID0", False),
+            *[("TSn-ID%d" % n, False) for n in range(2, 10, 2)], ("COMMA", False),
+            ("TSn-LANE", False), ("TSn-RATE", False), ("TSn-ID0", False),
+            *[("TSn-ID%d" % n, False) for n in range(2, 10, 2)], ("COMMA", False),
+        ])
+        self.assertEqual(executor[phy.ts]["valid"], 1)
+        self.assertEqual(executor[phy.ts]["link"], {"valid": 1, "number": 0xaa})
+        self.assertEqual(executor.run([K(28,5), 0x1ee]), [("COMMA", True)])
+        self.assertEqual(executor[phy.ts]["valid"], 0)
+
+    def test_emit(self):
+        lane = PCIeSERDESInterface(ratio=1)
+        phy  = PCIePHYTX(lane)
+        executor = Executor(phy.emitter)
+        executor[phy.ts.valid] = 1
+        executor[phy.ts.link.valid] = 1
+        executor[phy.ts.link.number] = 0xaa
+        executor[phy.ts.n_fts] = 0xff
+        executor[phy.ts.rate.gen1] = 1
+        self.assertEqual([word[0] & 0x1ff for word in executor.emit(17)], [
+            K(28,5), 0xaa, K(23,7), 0xff, 0b0010, 0b0000, *[D(10,2) for _ in range(10)],
+            K(28,5)
+        ])
+
+    def test_wrong_engine(self):
+        with self.assertRaises(TypeError):
+            Executor(Module())
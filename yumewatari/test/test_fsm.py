@@ -0,0 +1,82 @@
+import unittest
+from migen import *
+
+from ..gateware.fsm import *
+from . import simulation_test
+
+
+class EncodedFSMTestbench(Module):
+    def __init__(self, state_encoding):
+        self.i = Signal()
+        self.o = Signal(2)
+
+        self.submodules.dut = EncodedFSM(state_encoding=state_encoding)
+        for n, state in enumerate(["A", "B", "C", "D"]):
+            self.dut.act(state,
+                self.o.eq(n),
+                If(self.i,
+                    NextState(["A", "B", "C", "D"][(n + 1) % 4])
+                )
+            )
+
+    def do_finalize(self):
+        self.states = self.dut.decoding
+
+    def step(self):
+        yield self.i.eq(1)
+        yield
+        yield self.i.eq(0)
+        yield
+        return self.states[(yield self.dut.state)], (yield self.o)
+
+
+class _EncodedFSMTestCase(unittest.TestCase):
+    def assertSequence(self, tb):
+        self.assertEqual(tb.states[(yield tb.dut.state)], "A")
+        self.assertEqual((yield from tb.step()), ("B", 1))
+        self.assertEqual((yield from tb.step()), ("C", 2))
+        self.assertEqual((yield from tb.step()), ("D", 3))
+        self.assertEqual((yield from tb.step()), ("A", 0))
+
+
+class EncodedFSMBinaryTestCase(_EncodedFSMTestCase):
+    def setUp(self):
+        self.tb = EncodedFSMTestbench("binary")
+
+    @simulation_test
+    def test_sequence(self, tb):
+        yield from self.assertSequence(tb)
+
+    def test_encoding(self):
+        self.tb.finalize()
+        self.assertEqual(self.tb.dut.encoding, {"A": 0, "B": 1, "C": 2, "D": 3})
+        self.assertEqual(len(self.tb.dut.state), 2)
+
+
+class EncodedFSMGrayTestCase(_EncodedFSMTestCase):
+    def setUp(self):
+        self.tb = EncodedFSMTestbench("gray")
+
+    @simulation_test
+    def test_sequence(self, tb):
+        yield from self.assertSequence(tb)
+
+    def test_encoding(self):
+        self.tb.finalize()
+        self.assertEqual(self.tb.dut.encoding, {"A": 0b00, "B": 0b01, "C": 0b11, "D": 0b10})
+        self.assertEqual(len(self.tb.dut.state), 2)
+
+
+class EncodedFSMOneHotTestCase(_EncodedFSMTestCase):
+    def setUp(self):
+        self.tb = EncodedFSMTestbench("one-hot")
+
+    @simulation_test
+    def test_sequence(self, tb):
+        yield from self.assertSequence(tb)
+
+    def test_encoding(self):
+        self.tb.finalize()
+        self.assertEqual(self.tb.dut.encoding, {"A": 0b0001, "B": 0b0010, "C": 0b0100,
+                                                "D": 0b1000})
+        self.assertEqual(len(self.tb.dut.state), 4)
@@ -0,0 +1,50 @@
+import unittest
+from migen import *
+from migen.fhdl.verilog import convert
+
+from ..gateware.serdes import *
+from ..gateware.platform.lattice_ecp5 import *
+
+
+def _traces_names():
+    # Unnamed clock domains, such as those of migen's Gearbox, need the bytecode tracer.
+    try:
+        ClockDomain()
+    except ValueError:
+        return False
+    return True
+
+
+class LatticeECP5PCIeSERDESTestbench(Module):
+    def __init__(self, gearing):
+        self.pins = Record([
+            ("clk_p", 1), ("clk_n", 1),
+            ("rx_p",  1), ("rx_n",  1),
+            ("tx_p",  1), ("tx_n",  1),
+        ])
+        self.submodules.serdes  = LatticeECP5PCIeSERDES(self.pins, gearing=gearing)
+        self.submodules.aligner = ClockDomainsRenamer("rx")(
+            PCIeSERDESAligner(self.serdes.lane))
+        self.submodules.buffer  = ClockDomainsRenamer({"write": "rx", "read": "tx"})(
+            PCIeSERDESElasticBuffer(self.aligner))
+
+
+class LatticeECP5PCIeSERDESTestCase(unittest.TestCase):
+    def elaborate(self, gearing):
+        tb = LatticeECP5PCIeSERDESTestbench(gearing)
+        return str(convert(tb, ios={*tb.pins.flatten(), tb.buffer.rx_symbol, tb.buffer.rx_valid}))
+
+    def test_gearing_2x(self):
+        verilog = self.elaborate(gearing=2)
+        self.assertIn("DCUA", verilog)
+        self.assertNotIn("CLKDIVF", verilog)
+
+    @unittest.skipUnless(_traces_names(), "migen cannot trace names on this Python version")
+    def test_gearing_4x(self):
+        verilog = self.elaborate(gearing=4)
+        self.assertIn("DCUA", verilog)
+        self.assertIn("CLKDIVF", verilog)
+
+    def test_gearing_invalid(self):
+        with self.assertRaisesRegex(ValueError, r"Gearing must be 2 or 4, not 3"):
+            LatticeECP5PCIeSERDESTestbench(gearing=3)
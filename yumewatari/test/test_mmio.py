@@ -0,0 +1,220 @@
+import unittest
+from migen import *
+
+from ..gateware.struct import *
+from ..gateware.cfg import *
+from ..gateware.mmio import *
+from .test_cfg import cfg_request
+
+
+def swap32(value):
+    return int.from_bytes(value.to_bytes(4, "little"), "big")
+
+
+def mem_request(fmt_type, adr, length, data=None, first_be=0b1111, last_be=0b1111, tag=0):
+    dwords = [
+        fmt_type | ((length >> 8) << 16) | ((length & 0xff) << 24),
+        0x0001 | (tag << 16) | (first_be << 24) | ((last_be if length > 1 else 0) << 28),
+        swap32(adr),
+    ]
+    if data is not None:
+        dwords += data
+    return dwords
+
+
+def parse_completion(dwords):
+    return {
+        "fmt_type":   dwords[0] & 0xff,
+        "length":     (dwords[0] >> 24) | (((dwords[0] >> 16) & 0b11) << 8),
+        "status":     (dwords[1] >> 21) & 0b111,
+        "byte_count": (dwords[1] >> 24) | (((dwords[1] >> 16) & 0xf) << 8),
+        "tag":        (dwords[2] >> 16) & 0xff,
+        "lower_adr":  (dwords[2] >> 24) & 0x7f,
+        "data":       dwords[3:],
+    }
+
+
+class PCIeMMIOBridgeTestbench(Module):
+    def __init__(self):
+        self.submodules.cfg  = PCIeConfigSpace(vendor_id=0x1234, device_id=0x5678,
+                                               class_code=0x058000, bars=[4096, None, 1 << 16])
+        self.submodules.mmio = PCIeMMIOBridge(self.cfg)
+        self.bus = self.mmio.bus
+
+        self.memory      = {}
+        self.bus_latency = 1
+        self.bus_stall   = lambda n: False
+        self.bus_cycles  = []
+        self.max_pending = 0
+        self.counters    = {}
+
+    def configure(self, offset, data):
+        for n, dword in enumerate(cfg_request(TLP_CFG_WR0, offset, data)):
+            yield self.cfg.i.valid.eq(1)
+            yield self.cfg.i.data.eq(dword)
+            yield self.cfg.i.last.eq(n == 3)
+            yield
+            while not (yield self.cfg.i_ready):
+                yield
+        yield self.cfg.i.valid.eq(0)
+        yield self.cfg.o_ready.eq(1)
+        while not (yield self.cfg.o.last):
+            yield
+        yield
+        yield self.cfg.o_ready.eq(0)
+
+    def send(self, requests):
+        for request in requests:
+            for n, dword in enumerate(request):
+                yield self.mmio.i.valid.eq(1)
+                yield self.mmio.i.data.eq(dword)
+                yield self.mmio.i.last.eq(n == len(request) - 1)
+                yield
+                while not (yield self.mmio.i_ready):
+                    yield
+        yield self.mmio.i.valid.eq(0)
+
+    @passive
+    def serve(self):
+        pending = []
+        n = 0
+        while True:
+            if (yield self.bus.stb) and not (yield self.bus.stall):
+                adr = yield self.bus.adr
+                if (yield self.bus.we):
+                    sel  = yield self.bus.sel
+                    mask = sum(0xff << (8 * m) for m in range(4) if sel & (1 << m))
+                    data = yield self.bus.dat_w
+                    self.memory[adr] = (self.memory.get(adr, 0) & ~mask) | (data & mask)
+                    self.bus_cycles.append(("w", adr, sel))
+                else:
+                    self.bus_cycles.append(("r", adr))
+                pending.append((n + self.bus_latency, self.memory.get(adr, adr)))
+            self.max_pending = max(self.max_pending, len(pending))
+            n += 1
+            if pending and pending[0][0] <= n:
+                _, data = pending.pop(0)
+                yield self.bus.ack.eq(1)
+                yield self.bus.dat_r.eq(data)
+            else:
+                yield self.bus.ack.eq(0)
+            yield self.bus.stall.eq(self.bus_stall(n))
+            yield
+
+    def receive(self, count):
+        completions = []
+        dwords = []
+        yield self.mmio.o_ready.eq(1)
+        for _ in range(1000):
+            if len(completions) == count:
+                break
+            yield
+            if (yield self.mmio.o.valid):
+                dwords.append((yield self.mmio.o.data))
+                if (yield self.mmio.o.last):
+                    completions.append(parse_completion(dwords))
+                    dwords = []
+        return completions
+
+    def transfer(self, requests, count, config=[]):
+        completions = []
+        def requester():
+            yield from self.configure(0x10, 0x80000000)
+            yield from self.configure(0x18, 0x80010000)
+            yield from self.configure(0x04, 0x00000002)
+            for offset, data in config:
+                yield from self.configure(offset, data)
+            yield from self.send(requests)
+        def receiver():
+            completions.extend((yield from self.receive(count)))
+            for _ in range(10):
+                yield
+            for name in ("read_count", "write_count", "cpl_count", "cpl_dwords",
+                         "read_latency_max", "read_latency_total"):
+                self.counters[name] = yield getattr(self.mmio, name)
+        run_simulation(self, [requester(), receiver(), self.serve()], vcd_name="test.vcd")
+        return completions
+
+
+class PCIeMMIOBridgeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tb = PCIeMMIOBridgeTestbench()
+
+    def test_write_read(self):
+        completions = self.tb.transfer([
+            mem_request(TLP_MWR32, 0x80000010, 2, [0x11223344, 0x55667788], first_be=0b1110,
+                        last_be=0b0011),
+            mem_request(TLP_MWR32, 0x80010100, 1, [0xdeadbeef]),
+            mem_request(TLP_MRD32, 0x80000010, 2, tag=0x21),
+            mem_request(TLP_MRD32, 0x80010100, 1, tag=0x22),
+        ], count=2)
+        self.assertEqual(self.tb.memory, {
+            0x004: 0x11223300,
+            0x005: 0x00007788,
+            (2 << 27) | 0x040: 0xdeadbeef,
+        })
+        self.assertEqual(completions, [
+            {"fmt_type": TLP_CPLD, "length": 2, "status": CPL_SC, "byte_count": 8, "tag": 0x21,
+             "lower_adr": 0x10, "data": [0x11223300, 0x00007788]},
+            {"fmt_type": TLP_CPLD, "length": 1, "status": CPL_SC, "byte_count": 4, "tag": 0x22,
+             "lower_adr": 0x00, "data": [0xdeadbeef]},
+        ])
+        self.assertEqual(self.tb.bus_cycles[0], ("w", 0x004, 0b1110))
+        self.assertEqual(self.tb.bus_cycles[1], ("w", 0x005, 0b0011))
+
+    def test_outstanding(self):
+        self.tb.bus_latency = 8
+        self.tb.bus_stall   = lambda n: n % 5 == 0
+        completions = self.tb.transfer([
+            mem_request(TLP_MRD32, 0x80000000 + 4 * n, 1, tag=n) for n in range(6)
+        ], count=6)
+        self.assertEqual([(c["tag"], c["data"]) for c in completions],
+                         [(n, [n]) for n in range(6)])
+        self.assertGreater(self.tb.max_pending, 1)
+        counters = self.tb.counters
+        self.assertEqual(counters["read_count"], 6)
+        self.assertEqual(counters["cpl_count"], 6)
+        self.assertEqual(counters["cpl_dwords"], 6)
+        self.assertGreaterEqual(counters["read_latency_max"], 8)
+        self.assertGreaterEqual(counters["read_latency_total"], 6 * 8)
+
+    def check_split(self, rcb, lengths):
+        completions = self.tb.transfer([
+            mem_request(TLP_MRD32, 0x80000034, 40, first_be=0b1100, last_be=0b0011, tag=7),
+        ], count=len(lengths), config=[(0x60, rcb << 3)])
+        self.assertEqual([c["length"] for c in completions], lengths)
+        byte_count = 40 * 4 - 4
+        lower_adr  = 0x36
+        data       = []
+        for completion in completions:
+            self.assertEqual(completion["status"], CPL_SC)
+            self.assertEqual(completion["tag"], 7)
+            self.assertEqual(completion["byte_count"], byte_count)
+            self.assertEqual(completion["lower_adr"], lower_adr & 0x7f)
+            byte_count -= completion["length"] * 4 - (lower_adr & 3)
+            lower_adr   = (lower_adr & ~3) + completion["length"] * 4
+            data       += completion["data"]
+        self.assertEqual(byte_count, -2)
+        self.assertEqual(data, list(range(0x0d, 0x0d + 40)))
+        self.assertEqual(self.tb.counters["cpl_count"], len(lengths))
+        self.assertEqual(self.tb.counters["cpl_dwords"], 40)
+
+    def test_split_rcb64(self):
+        self.check_split(0, [3, 16, 16, 5])
+
+    def test_split_rcb128(self):
+        self.check_split(1, [19, 21])
+
+    def test_unsupported(self):
+        completions = self.tb.transfer([
+            mem_request(TLP_MWR32, 0x80002000, 1, [0x12345678]),
+            mem_request(TLP_MRD32, 0x80002000, 1, tag=1),
+            mem_request(TLP_MRD32, 0x80000000, 1, tag=2),
+        ], count=2)
+        self.assertEqual(self.tb.memory, {})
+        self.assertEqual(self.tb.bus_cycles, [("r", 0x000)])
+        self.assertEqual([(c["fmt_type"], c["status"], c["tag"], c["data"])
+                          for c in completions],
+                         [(TLP_CPL, CPL_UR, 1, []), (TLP_CPLD, CPL_SC, 2, [0])])
+        self.assertEqual(self.tb.counters["write_count"], 1)
+        self.assertEqual(self.tb.counters["read_count"], 2)
@@ -0,0 +1,122 @@
+import unittest
+from migen import *
+
+from ..gateware.struct import *
+from ..gateware.cfg import *
+from ..gateware.msi import *
+from .test_cfg import cfg_request
+from .test_mmio import swap32
+
+
+class PCIeMSIGeneratorTestbench(Module):
+    def __init__(self, sources=1):
+        self.submodules.cfg = PCIeConfigSpace(vendor_id=0x1234, device_id=0x5678,
+                                              class_code=0x058000, msi_vectors=4)
+        self.submodules.msi = PCIeMSIGenerator(self.cfg, sources)
+
+    def configure(self, offset, data):
+        for n, dword in enumerate(cfg_request(TLP_CFG_WR0, offset, data)):
+            yield self.cfg.i.valid.eq(1)
+            yield self.cfg.i.data.eq(dword)
+            yield self.cfg.i.last.eq(n == 3)
+            yield
+            while not (yield self.cfg.i_ready):
+                yield
+        yield self.cfg.i.valid.eq(0)
+        yield self.cfg.o_ready.eq(1)
+        while not (yield self.cfg.o.last):
+            yield
+        yield
+        yield self.cfg.o_ready.eq(0)
+
+    def enable(self, address=0xfee00000, data=0x4320, vectors=0):
+        yield from self.configure(0x44, address & 0xffffffff)
+        yield from self.configure(0x48, address >> 32)
+        yield from self.configure(0x4c, data)
+        yield from self.configure(0x40, 0x00010000 | (vectors << 20))
+
+    def run(self, irqs, cycles, enable=True, **kwargs):
+        writes = []
+        def main():
+            yield from self.configure(0x04, 0x00000004)
+            if enable:
+                yield from self.enable(**kwargs)
+            for n in range(cycles):
+                yield self.msi.irq.eq(irqs.get(n, 0))
+                yield
+        @passive
+        def receiver():
+            dwords = []
+            yield self.msi.o_ready.eq(1)
+            while True:
+                yield
+                if (yield self.msi.o.valid):
+                    dwords.append((yield self.msi.o.data))
+                    if (yield self.msi.o.last):
+                        writes.append(dwords)
+                        dwords = []
+        counters = {}
+        def counter():
+            for n in range(cycles + 100):
+                yield
+            for name in ("request_count", "msi_count", "coalesced_count"):
+                counters[name] = yield getattr(self.msi, name)
+        run_simulation(self, [main(), receiver(), counter()], vcd_name="test.vcd")
+        return writes, counters
+
+
+def msi_write(dwords):
+    if dwords[0] & 0xff == TLP_MWR64:
+        return (swap32(dwords[2]) << 32) | swap32(dwords[3]), dwords[4]
+    return swap32(dwords[2]), dwords[3]
+
+
+class PCIeMSIGeneratorTestCase(unittest.TestCase):
+    def test_single(self):
+        tb = PCIeMSIGeneratorTestbench()
+        writes, counters = tb.run({0: 1, 100: 1}, 200)
+        self.assertEqual(writes[0][:2], [TLP_MWR32 | (1 << 24), 0x0f000001])
+        self.assertEqual([msi_write(w) for w in writes],
+                         [(0xfee00000, 0x4320), (0xfee00000, 0x4320)])
+        self.assertEqual(counters, {"request_count": 2, "msi_count": 2, "coalesced_count": 0})
+
+    def test_address_64(self):
+        tb = PCIeMSIGeneratorTestbench()
+        writes, counters = tb.run({0: 1}, 100, address=0x1_2345_6780)
+        self.assertEqual(writes[0][0] & 0xff, TLP_MWR64)
+        self.assertEqual([msi_write(w) for w in writes], [(0x1_2345_6780, 0x4320)])
+
+    def test_vectors(self):
+        tb = PCIeMSIGeneratorTestbench(sources=4)
+        # Two vectors allocated.
+        writes, counters = tb.run({0: 0b0001, 50: 0b0010, 100: 0b0100, 150: 0b1000}, 200,
+                                  vectors=1)
+        self.assertEqual([msi_write(w)[1] for w in writes], [0x4320, 0x4321, 0x4320, 0x4321])
+
+    def test_disabled(self):
+        tb = PCIeMSIGeneratorTestbench()
+        writes, counters = tb.run({0: 1}, 100, enable=False)
+        self.assertEqual(writes, [])
+        self.assertEqual(counters["request_count"], 1)
+
+    def test_coalesce_count(self):
+        tb = PCIeMSIGeneratorTestbench()
+        tb.comb += tb.msi.coalesce_count.eq(4)
+        writes, counters = tb.run({n: 1 for n in range(0, 100, 10)}, 200)
+        self.assertEqual(len(writes), 2)
+        self.assertEqual(counters, {"request_count": 10, "msi_count": 2, "coalesced_count": 6})
+
+    def test_coalesce_timer(self):
+        tb = PCIeMSIGeneratorTestbench()
+        tb.comb += [
+            tb.msi.coalesce_count.eq(100),
+            tb.msi.coalesce_timer.eq(50),
+        ]
+        writes, counters = tb.run({0: 1, 10: 1, 20: 1, 200: 1}, 300)
+        self.assertEqual(len(writes), 2)
+        self.assertEqual(counters, {"request_count": 4, "msi_count": 2, "coalesced_count": 2})
+
+    def test_sources(self):
+        with self.assertRaisesRegex(ValueError,
+                r"Number of interrupt sources must be between 1 and 32, not 33"):
+            PCIeMSIGenerator(PCIeConfigSpace(vendor_id=0, device_id=0, class_code=0), 33)
@@ -0,0 +1,439 @@
+import unittest
+from migen import *
+
+from ..gateware.serdes import *
+from ..gateware.serdes import K, D
+from ..gateware.phy import *
+
+
+class PCIePHYPartner:
+    """
+    Scripted downstream port, following the received ordered sets just closely enough to bring
+    the link up, and to change its rate in Recovery. Only lane 0 is followed; the lane numbers
+    received on every lane are recorded.
+    """
+    def __init__(self, ratio, lanes=1):
+        self.ratio        = ratio
+        self.lanes        = lanes
+        # Propose a link number on lanes 0..width-1 only.
+        self.width        = lanes
+        # Propose lane numbers in reverse order.
+        self.reverse      = False
+        # Delay each lane by this many words.
+        self.skew         = [0] * lanes
+        # Advertise 5 GT/s.
+        self.gen2         = False
+        # Request a change to 5 GT/s from L0.
+        self.request      = False
+        # Set if the link cannot be established at 5 GT/s.
+        self.fail_gen2    = False
+
+        self.state        = "Polling"
+        self.speed_change = False
+        self.count        = 0
+        self.seen         = False
+        self.tx_queue     = None
+        self.rx_buffer    = [[] for _ in range(lanes)]
+        # Last lane number received on every lane.
+        self.rx_lane_numbers = [None] * lanes
+        # N_FTS, and EIOS, FTS and SKP ordered sets and Electrical Idle received on lane 0.
+        self.rx_n_fts     = None
+        self.rx_ordered_sets = []
+
+    def lane_number(self, lane):
+        if lane >= self.width:
+            return None
+        if self.reverse:
+            return self.width - 1 - lane
+        return lane
+
+    def ts(self, ts_id, link=None, lane=None):
+        return [
+            K(28,5),
+            K(23,7) if link is None else link,
+            K(23,7) if lane is None else lane,
+            0x10,
+            (1 << 1) | (self.gen2 << 2) | (self.speed_change << 7),
+            # Disable Scrambling, so that idle data symbols are zero.
+            1 << 3,
+            *[D(5,2) if ts_id else D(10,2)] * 10
+        ]
+
+    def emit(self, lane):
+        state = self.state
+        if state == "Polling":
+            return self.ts(0)
+        if state == "Polling.Configuration":
+            return self.ts(1)
+        if state == "Recovery.Speed":
+            # Electrical Idle.
+            return [None] * self.ratio
+        if lane >= self.width:
+            # Not a part of the link. Every lane emits as many symbols as lane 0.
+            if state == "Configuration.Linkwidth":
+                return self.ts(0)
+            return [None] * len(self.emit(0))
+        lane_number = self.lane_number(lane)
+        if state == "Configuration.Linkwidth":
+            return self.ts(0, link=0)
+        if state == "Configuration.Lanenum":
+            return self.ts(0, link=0, lane=lane_number)
+        if state == "Configuration.Complete":
+            return self.ts(1, link=0, lane=lane_number)
+        if state == "Recovery.RcvrLock":
+            return self.ts(0, link=0, lane=lane_number)
+        if state == "Recovery.RcvrCfg":
+            return self.ts(1, link=0, lane=lane_number)
+        return [0] * 4
+
+    def send(self, symbols):
+        for queue in self.tx_queue:
+            queue += symbols
+
+    def transmit(self):
+        if self.tx_queue is None:
+            self.tx_queue = [[None] * (self.ratio * skew) for skew in self.skew]
+        while any(len(queue) < self.ratio for queue in self.tx_queue):
+            for lane, queue in enumerate(self.tx_queue):
+                queue += self.emit(lane)
+        symbols = [queue[:self.ratio] for queue in self.tx_queue]
+        self.tx_queue = [queue[self.ratio:] for queue in self.tx_queue]
+        return symbols
+
+    def goto(self, state):
+        self.state = state
+        self.count = 0
+        self.seen  = False
+
+    def receive_ts(self, ts):
+        ts_id, link, lane, rate = ts
+        state = self.state
+        pad   = link is None and lane is None
+        own   = self.lane_number(0)
+        if state == "Polling":
+            if pad:
+                self.count += 1
+                if self.count == 8:
+                    self.goto("Polling.Configuration")
+        elif state == "Polling.Configuration":
+            if pad and ts_id == 1:
+                self.seen = True
+            elif pad and ts_id == 0 and self.seen:
+                self.goto("Configuration.Linkwidth")
+        elif state == "Configuration.Linkwidth":
+            if ts_id == 0 and link == 0 and lane is None:
+                self.goto("Configuration.Lanenum")
+        elif state == "Configuration.Lanenum":
+            if ts_id == 0 and link == 0 and lane == own:
+                self.goto("Configuration.Complete")
+        elif state in ("Configuration.Complete", "Recovery.RcvrCfg"):
+            if ts_id == 1 and link == 0 and lane == own:
+                self.count += 1
+        elif state in ("Idle", "L0", "Recovery.Speed"):
+            if ts_id == 0 and link == 0 and lane == own:
+                self.goto("Recovery.RcvrLock")
+                self.speed_change = self.gen2 and bool(rate & (1 << 7))
+        if self.state == "Recovery.RcvrLock":
+            if link == 0 and lane == own:
+                if self.gen2 and rate & (1 << 7):
+                    self.speed_change = True
+                self.count += 1
+                if self.count == 8:
+                    self.goto("Recovery.RcvrCfg")
+
+    def receive_eios(self):
+        if self.state == "Recovery.RcvrCfg" and self.count >= 8 and self.speed_change:
+            self.goto("Recovery.Speed")
+            self.send([K(28,5), K(28,3), K(28,3), K(28,3)])
+
+    def receive_idle(self):
+        state = self.state
+        if state in ("Configuration.Complete", "Recovery.RcvrCfg"):
+            if self.count >= 8:
+                self.goto("Idle")
+        elif state == "Idle":
+            self.count += 1
+            if self.count == 8:
+                self.speed_change = False
+                self.goto("L0")
+
+    def receive(self, symbols, lane=0):
+        rx_buffer = self.rx_buffer[lane]
+        for symbol in symbols:
+            if symbol is None:
+                rx_buffer.clear()
+                if lane == 0 and self.rx_ordered_sets[-1:] != ["EIdle"]:
+                    self.rx_ordered_sets.append("EIdle")
+            elif rx_buffer:
+                rx_buffer.append(symbol)
+                if rx_buffer[1] in (K(28,0), K(28,1), K(28,3)):
+                    # SKP, FTS or EIOS.
+                    if len(rx_buffer) == 4:
+                        if lane == 0:
+                            self.rx_ordered_sets.append({K(28,0): "SKP", K(28,1): "FTS",
+                                                         K(28,3): "EIOS"}[rx_buffer[1]])
+                            if rx_buffer[1] == K(28,3):
+                                self.receive_eios()
+                        rx_buffer.clear()
+                elif len(rx_buffer) == 16:
+                    link, lane_number, n_fts, rate, ctrl, ts_id, *_ = rx_buffer[1:]
+                    rx_buffer.clear()
+                    ts = (ts_id == D(5,2),
+                          None if link == K(23,7) else link,
+                          None if lane_number == K(23,7) else lane_number,
+                          rate)
+                    self.rx_lane_numbers[lane] = ts[2]
+                    if lane == 0:
+                        self.rx_n_fts = n_fts
+                        self.receive_ts(ts)
+            elif symbol == K(28,5):
+                rx_buffer.append(symbol)
+            elif symbol == 0 and lane == 0:
+                self.receive_idle()
+
+    def start_request(self):
+        self.speed_change = True
+        self.goto("Recovery.RcvrLock")
+
+
+class PCIePHYTestbench(Module):
+    def __init__(self, ratio=2, ms_cyc=400, gen2=True, lanes=1, n_fts=0xff):
+        self.submodules.lanes = self.lanes = [PCIeSERDESInterface(ratio) for _ in range(lanes)]
+        self.lane = self.lanes[0]
+        self.submodules.phy  = PCIePHY(self.lanes, ms_cyc=ms_cyc, gen2=gen2, n_fts=n_fts,
+                                       log_depth=16)
+        self.partner = PCIePHYPartner(ratio, lanes)
+        self.ms_cyc  = ms_cyc
+        # LTSSM states, and the cycles they were entered in.
+        self.states  = []
+        self.entered = []
+
+    @passive
+    def link(self):
+        ratio   = self.lane.ratio
+        partner = self.partner
+        for lane in self.lanes:
+            yield lane.rx_present.eq(1)
+            yield lane.rx_locked.eq(1)
+            yield lane.rx_aligned.eq(1)
+        cycle = 0
+        while True:
+            for lane in self.lanes:
+                yield lane.det_valid.eq((yield lane.det_enable))
+                yield lane.det_status.eq(1)
+
+            state = self.phy.ltssm.decoding[(yield self.phy.ltssm.state)]
+            if not self.states or self.states[-1] != state:
+                self.states.append(state)
+                self.entered.append(cycle)
+            cycle += 1
+
+            rate   = yield self.lane.rate
+            locked = not (rate and partner.fail_gen2)
+
+            if partner.request and partner.state == "L0" and not rate:
+                partner.request = False
+                partner.start_request()
+
+            for n, lane in enumerate(self.lanes):
+                tx_symbol = yield lane.tx_symbol
+                tx_e_idle = yield lane.tx_e_idle
+                partner.receive([
+                    (tx_symbol >> (9 * k)) & 0x1ff if locked and not tx_e_idle & (1 << k)
+                    else None
+                    for k in range(ratio)
+                ], lane=n)
+
+            for lane, rx_symbol in zip(self.lanes, partner.transmit()):
+                valid = locked and None not in rx_symbol
+                yield lane.rx_symbol.eq(sum((symbol or 0) << (9 * k)
+                                            for k, symbol in enumerate(rx_symbol)))
+                yield lane.rx_valid.eq((1 << ratio) - 1 if valid else 0)
+            yield
+
+    def wait_speed(self, cycles=2000):
+        start = len(self.states)
+        for _ in range(cycles):
+            yield
+            if "Recovery.Speed" in self.states[start:]:
+                return
+        raise AssertionError("Rate was not changed; LTSSM states: {}".format(self.states))
+
+    def wait_l0(self, rate, cycles=2000):
+        for _ in range(cycles):
+            yield
+            if self.states[-1] == "L0" and self.partner.state == "L0" and \
+                    (yield self.phy.rate) == rate and (yield self.phy.link_up):
+                return
+        raise AssertionError("Link is not in L0 at rate {}; LTSSM states: {}"
+                             .format(rate, self.states))
+
+    def hold_l0(self, rate, cycles=200):
+        start = len(self.states)
+        for _ in range(cycles):
+            yield
+        assert self.states[start - 1:] == ["L0"], self.states[start - 1:]
+        assert (yield self.phy.rate) == rate
+
+    def run(self, main):
+        run_simulation(self, [main(), self.link()], vcd_name="test.vcd")
+
+
+class PCIePHYSpeedChangeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tb = PCIePHYTestbench()
+
+    def test_directed(self):
+        tb = self.tb
+        tb.partner.gen2 = True
+        def main():
+            # The link is established at 2.5 GT/s, and the rate is changed right away.
+            yield from tb.wait_l0(rate=1, cycles=15000)
+            yield from tb.hold_l0(rate=1)
+        tb.run(main)
+        speed = tb.states.index("Recovery.Speed")
+        self.assertIn("L0", tb.states[:speed])
+        self.assertEqual(tb.states[speed - 2:speed], ["Recovery.RcvrCfg", "Recovery.RcvrCfg:TS"])
+
+    def test_fallback(self):
+        tb = self.tb
+        tb.partner.gen2      = True
+        tb.partner.fail_gen2 = True
+        def main():
+            # The change to 5 GT/s fails, and is not retried.
+            yield from tb.wait_speed(cycles=15000)
+            yield from tb.wait_speed(cycles=25000)
+            yield from tb.wait_l0(rate=0)
+            yield from tb.hold_l0(rate=0)
+        tb.run(main)
+        speeds = [n for n, state in enumerate(tb.states) if state == "Recovery.Speed"]
+        self.assertEqual(len(speeds), 2)
+        # The fallback happens once Recovery.RcvrLock times out at 5 GT/s, after 24 ms at
+        # the doubled clock frequency.
+        self.assertEqual(tb.states[speeds[1] - 2:speeds[1]],
+                         ["Recovery.RcvrLock", "Recovery.RcvrLock:TS"])
+        self.assertGreaterEqual(tb.entered[speeds[1]] - tb.entered[speeds[1] - 2],
+                                2 * 24 * tb.ms_cyc)
+
+    def test_partner_request(self):
+        tb = self.tb
+        def main():
+            # The link partner does not advertise 5 GT/s during training, so the rate is not
+            # changed until it requests a change.
+            yield from tb.wait_l0(rate=0, cycles=15000)
+            yield from tb.hold_l0(rate=0)
+            tb.partner.gen2    = True
+            tb.partner.request = True
+            yield from tb.wait_speed()
+            yield from tb.wait_l0(rate=1)
+            yield from tb.hold_l0(rate=1)
+        tb.run(main)
+        speed = tb.states.index("Recovery.Speed")
+        self.assertEqual(tb.states.count("Recovery.Speed"), 1)
+        self.assertEqual(tb.states[speed - 2:speed], ["Recovery.RcvrCfg", "Recovery.RcvrCfg:TS"])
+
+
+class PCIePHYLinkWidthTestCase(unittest.TestCase):
+    def assertLink(self, lanes, width, reversed=False, skew=None, partner_width=None,
+                   lane_numbers=None):
+        tb = PCIePHYTestbench(lanes=lanes, gen2=False)
+        if partner_width is not None:
+            tb.partner.width = partner_width
+        if skew is not None:
+            tb.partner.skew = skew
+        tb.partner.reverse = reversed
+        def main():
+            yield from tb.wait_l0(rate=0, cycles=15000)
+            yield from tb.hold_l0(rate=0)
+            self.assertEqual((yield tb.phy.width), width)
+            self.assertEqual((yield tb.phy.reversed), reversed)
+            self.assertEqual((yield tb.phy.rx_data_valid), width == lanes)
+            for n, lane in enumerate(tb.lanes):
+                self.assertEqual((yield lane.tx_e_idle),
+                                 0 if n < width else (1 << lane.ratio) - 1)
+        tb.run(main)
+        self.assertEqual(tb.partner.rx_lane_numbers, lane_numbers)
+
+    def test_x2(self):
+        self.assertLink(lanes=2, width=2, skew=[0, 1], lane_numbers=[0, 1])
+
+    def test_x2_reversed(self):
+        self.assertLink(lanes=2, width=2, reversed=True, lane_numbers=[1, 0])
+
+    def test_x2_fallback(self):
+        # The link partner only proposes a link number on lane 0, so the link is trained as x1,
+        # and lane 1 is kept in Electrical Idle.
+        self.assertLink(lanes=2, width=1, partner_width=1, lane_numbers=[0, None])
+
+    def test_x4(self):
+        self.assertLink(lanes=4, width=4, skew=[1, 0, 2, 0], lane_numbers=[0, 1, 2, 3])
+
+
+class PCIePHYL0sTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tb = PCIePHYTestbench(gen2=False, n_fts=16)
+
+    eios = [K(28,5), K(28,3), K(28,3), K(28,3)]
+    fts  = [K(28,5), K(28,1), K(28,1), K(28,1)]
+    skp  = [K(28,5), K(28,0), K(28,0), K(28,0)]
+
+    def test_tx_l0s(self):
+        tb = self.tb
+        def main():
+            yield from tb.wait_l0(rate=0, cycles=15000)
+            states = len(tb.states)
+            start  = len(tb.partner.rx_ordered_sets)
+            yield tb.phy.tx_l0s.eq(1)
+            for _ in range(50):
+                yield
+            self.assertEqual((yield tb.lane.tx_e_idle), 0b11)
+            yield tb.phy.tx_l0s.eq(0)
+            yield from tb.hold_l0(rate=0)
+            self.assertEqual(tb.states[states:], [])
+            # The link partner advertises N_FTS=16.
+            received = tb.partner.rx_ordered_sets[start:]
+            eios = received.index("EIOS")
+            self.assertEqual(received[eios:eios + 19],
+                             ["EIOS", "EIdle"] + ["FTS"] * 16 + ["SKP"])
+        tb.run(main)
+
+    def wait_rx_l0s(self, cycles=200):
+        tb = self.tb
+        entered = False
+        for _ in range(cycles):
+            yield
+            if (yield tb.phy.rx_l0s):
+                entered = True
+            elif entered:
+                return
+        raise AssertionError("Receiver did not enter and exit L0s")
+
+    def test_rx_l0s(self):
+        tb = self.tb
+        def main():
+            yield from tb.wait_l0(rate=0, cycles=15000)
+            states = len(tb.states)
+            self.assertEqual(tb.partner.rx_n_fts, 16)
+            tb.partner.send(self.eios + [None] * 40 + self.fts * 16 + self.skp)
+            yield from self.wait_rx_l0s()
+            yield from tb.hold_l0(rate=0)
+            self.assertEqual(tb.states[states:], [])
+            # 16 FTS ordered sets take 32 cycles, and a SKP ordered set takes 2 more.
+            l0s_exit_cycles = yield tb.phy.l0s_exit_cycles
+            self.assertGreaterEqual(l0s_exit_cycles, 32)
+            self.assertLessEqual(l0s_exit_cycles, 34)
+        tb.run(main)
+
+    def test_rx_l0s_timeout(self):
+        tb = self.tb
+        def main():
+            yield from tb.wait_l0(rate=0, cycles=15000)
+            states = len(tb.states)
+            # No SKP ordered set follows the FTS ordered sets, so the link is retrained.
+            tb.partner.send(self.eios + [None] * 40 + self.fts * 4)
+            yield from self.wait_rx_l0s()
+            yield from tb.wait_l0(rate=0)
+            yield from tb.hold_l0(rate=0)
+            self.assertEqual(tb.states[states:states + 2],
+                             ["Recovery.RcvrLock", "Recovery.RcvrLock:TS"])
+        tb.run(main)
@@ -8,9 +8,10 @@ from . import simulation_test
 
 
 class PCIePHYRXTestbench(Module):
-    def __init__(self, ratio=1):
+    def __init__(self, ratio=1, pipeline=False, state_encoding="binary"):
         self.submodules.lane = PCIeSERDESInterface(ratio)
-        self.submodules.phy  = PCIePHYRX(self.lane)
+        self.submodules.phy  = PCIePHYRX(self.lane, pipeline=pipeline,
+                                         state_encoding=state_encoding)
 
     def do_finalize(self):
         self.states = {v: k for k, v in self.phy.parser.fsm.encoding.items()}
@@ -20,7 +21,7 @@ class PCIePHYRXTestbench(Module):
 
     def transmit(self, symbols):
         for i, word in enumerate(symbols):
-            if i > 0:
+            if i > self.phy.parser.latency:
                 assert (yield self.phy.error) == 0
             if isinstance(word, tuple):
                 for j, symbol in enumerate(word):
@@ -29,6 +30,21 @@ class PCIePHYRXTestbench(Module):
                 yield self.lane.rx_symbol.eq(word)
             yield
 
+    def counters(self, clear=False):
+        yield self.phy.snapshot.eq(1)
+        yield self.phy.clear.eq(clear)
+        yield
+        yield self.phy.snapshot.eq(0)
+        yield self.phy.clear.eq(0)
+        yield
+        counters = {"code_error_count": []}
+        for signal in self.phy.code_error_count:
+            counters["code_error_count"].append((yield signal))
+        for name in ("error_count", "align_loss_count", "invert_count", "ts_count",
+                     "skp_count"):
+            counters[name] = yield getattr(self.phy, name)
+        return counters
+
 
 class _PCIePHYRXTestCase(unittest.TestCase):
     def assertState(self, tb, state):
@@ -301,6 +317,131 @@ class PCIePHYRXGear1xTestCase(_PCIePHYRXTestCase):
         ])
         yield from self.assertSignal(tb.phy.ts.valid, 1)
 
+    @simulation_test
+    def test_rx_fts(self, tb):
+        yield from self.tb.transmit([
+            K(28,5), K(28,1), K(28,1), K(28,1),
+        ])
+        yield from self.assertSignal(tb.phy.fts, 1)
+        yield from self.assertSignal(tb.phy.eios, 0)
+
+    @simulation_test
+    def test_rx_eios(self, tb):
+        yield from self.tb.transmit([
+            K(28,5), K(28,3), K(28,3), K(28,3),
+        ])
+        yield from self.assertSignal(tb.phy.eios, 1)
+        yield from self.assertSignal(tb.phy.fts, 0)
+
+    @simulation_test
+    def test_rx_skp(self, tb):
+        yield from self.tb.transmit([
+            K(28,5), K(28,0), K(28,0), K(28,0),
+            K(28,5),
+        ])
+        yield from self.assertSignal(tb.phy.skp, 1)
+        yield from self.assertSignal(tb.phy.comma, 1)
+
+    @simulation_test
+    def test_rx_skp_count(self, tb):
+        for count in (1, 2, 5):
+            yield from self.tb.transmit([
+                K(28,5), *[K(28,0) for _ in range(count)],
+                D(0,0),
+            ])
+            yield from self.assertSignal(tb.phy.skp, 1)
+            yield
+            yield from self.assertState(tb, "COMMA")
+
+    @simulation_test
+    def test_rx_idle(self, tb):
+        yield from self.tb.transmit([
+            K(28,5), 0xaa, 0x1a, 0xff, 0b0010, 0b0000, *[D(10,2) for _ in range(10)],
+            K(28,5), 0xaa, 0x1a, 0xff, 0b0010, 0b0000, *[D(10,2) for _ in range(10)],
+            K(28,5), K(28,0), K(28,0), K(28,0),
+        ])
+        yield from self.assertSignal(tb.phy.ts.valid, 1)
+        yield from self.tb.transmit([
+            D(0,0), D(0,0), D(0,0), D(0,0),
+        ])
+        yield from self.assertSignal(tb.phy.ts.valid, 0)
+        yield from self.assertState(tb, "COMMA")
+
+    @simulation_test
+    def test_rx_packets(self, tb):
+        yield from self.tb.transmit([
+            K(28,2), D(1,0), D(2,0), D(3,0), D(4,0), D(5,0), D(6,0), K(29,7),
+            K(27,7), D(1,0), D(2,0), D(3,0), K(30,7), K(23,7),
+            K(28,5), K(28,0), K(28,0), K(28,0),
+            D(0,0),
+        ])
+        yield
+        yield from self.assertState(tb, "COMMA")
+
+    @simulation_test
+    def test_rx_skp_packets(self, tb):
+        yield from self.tb.transmit([
+            K(28,5), K(28,0), K(28,0), K(28,0),
+            K(27,7), D(1,0), D(2,0), K(29,7),
+            K(28,5), K(28,0),
+            K(28,2), D(3,0), K(29,7),
+            K(28,5), K(28,0), K(28,0),
+            K(23,7),
+            D(0,0), D(0,0),
+        ])
+        yield from self.assertState(tb, "COMMA")
+
+    @simulation_test
+    def test_rx_fts_invalid(self, tb):
+        yield from self.tb.transmit([
+            K(28,5), K(28,1), K(28,3),
+        ])
+        yield from self.assertError(tb)
+
+    @simulation_test
+    def test_rx_counters(self, tb):
+        yield tb.lane.rx_aligned.eq(1)
+        yield from self.tb.transmit([
+            K(28,5), 0xaa, 0x1a, 0xff, 0b0010, 0b0000, *[D(10,2) for _ in range(10)],
+            K(28,5), 0xaa, 0x1a, 0xff, 0b0010, 0b0000, *[D(10,2) for _ in range(10)],
+            K(28,5), K(23,7), K(23,7), D(0,0), D(0,0), D(0,0), *[D(21,5) for _ in range(10)],
+            K(28,5), K(28,0), K(28,0), K(28,0),
+            K(28,5), K(28,1), K(28,3),
+        ])
+        yield tb.lane.rx_symbol.eq(D(0,0))
+        yield tb.lane.rx_valid.eq(0)
+        yield
+        yield
+        yield tb.lane.rx_valid.eq(1)
+        yield tb.lane.rx_aligned.eq(0)
+        yield
+        yield tb.lane.rx_valid.eq(0)
+        yield
+        yield tb.lane.rx_valid.eq(1)
+        yield tb.lane.rx_aligned.eq(1)
+        yield
+        self.assertEqual((yield from tb.counters(clear=True)), {
+            "code_error_count": [2],
+            "error_count":      1,
+            "align_loss_count": 1,
+            "invert_count":     1,
+            "ts_count":         2,
+            "skp_count":        1,
+        })
+        self.assertEqual((yield from tb.counters()), {
+            "code_error_count": [0],
+            "error_count":      0,
+            "align_loss_count": 0,
+            "invert_count":     0,
+            "ts_count":         0,
+            "skp_count":        0,
+        })
+
+
+class PCIePHYRXGear1xOneHotTestCase(PCIePHYRXGear1xTestCase):
+    def setUp(self):
+        self.tb = PCIePHYRXTestbench(state_encoding="one-hot")
+
 
 class PCIePHYRXGear2xTestCase(_PCIePHYRXTestCase):
     def setUp(self):
@@ -319,3 +460,141 @@ class PCIePHYRXGear2xTestCase(_PCIePHYRXTestCase):
             (K(28,5), K(28,0)),
         ])
         yield from self.assertSignal(tb.phy.ts.valid, 1)
+
+    @simulation_test
+    def test_rx_fts_eios(self, tb):
+        yield from self.tb.transmit([
+            (K(28,5), K(28,1)), (K(28,1), K(28,1)),
+        ])
+        yield from self.assertSignal(tb.phy.fts, 1)
+        yield from self.tb.transmit([
+            (K(28,5), K(28,3)), (K(28,3), K(28,3)),
+        ])
+        yield from self.assertSignal(tb.phy.eios, 1)
+
+    @simulation_test
+    def test_rx_code_errors(self, tb):
+        yield tb.lane.rx_aligned.eq(1)
+        for valid in (0b01, 0b10, 0b10, 0b00, 0b11):
+            yield tb.lane.rx_valid.eq(valid)
+            yield
+        counters = yield from tb.counters()
+        self.assertEqual(counters["code_error_count"], [3, 2])
+
+    @simulation_test
+    def test_rx_skp_packets(self, tb):
+        yield from self.tb.transmit([
+            (K(28,5), K(28,0)), (K(28,0), K(28,0)),
+            (K(27,7), D(1,0)), (D(2,0), K(29,7)),
+            (K(28,5), K(28,0)), (K(28,0), K(28,2)),
+            (D(3,0), K(29,7)),
+            (D(0,0), D(0,0)), (D(0,0), D(0,0)),
+        ])
+        yield from self.assertState(tb, "COMMA")
+
+
+class PCIePHYRXGear4xTestCase(_PCIePHYRXTestCase):
+    def setUp(self):
+        self.tb = PCIePHYRXTestbench(ratio=4)
+
+    def simulationSetUp(self, tb):
+        yield tb.lane.rx_valid.eq(0b1111)
+
+    @simulation_test
+    def test_rx_ts1_2x_same_valid(self, tb):
+        yield from self.tb.transmit([
+            (K(28,5), 0xaa, 0x1a, 0xff), (0b0010, 0b0000, D(10,2), D(10,2)),
+                *[(D(10,2), D(10,2), D(10,2), D(10,2)) for _ in range(2)],
+            (K(28,5), 0xaa, 0x1a, 0xff), (0b0010, 0b0000, D(10,2), D(10,2)),
+                *[(D(10,2), D(10,2), D(10,2), D(10,2)) for _ in range(2)],
+            (K(28,5), K(28,0), K(28,0), K(28,0)),
+        ])
+        yield from self.assertSignal(tb.phy.ts.valid, 1)
+
+    @simulation_test
+    def test_rx_ts2_inverted_valid(self, tb):
+        yield from self.tb.transmit([
+            (K(28,5), K(23,7), K(23,7), D(0,0)), (D(0,0), D(0,0), D(26,5), D(26,5)),
+                *[(D(26,5), D(26,5), D(26,5), D(26,5)) for _ in range(2)],
+            (K(28,5), K(28,0), K(28,0), K(28,0)),
+        ])
+        yield from self.assertSignal(tb.lane.rx_invert, 1)
+
+    @simulation_test
+    def test_rx_ts1_idN_invalid(self, tb):
+        yield from self.tb.transmit([
+            (K(28,5), 0xaa, 0x1a, 0xff), (0b0010, 0b0000, D(10,2), D(10,2)),
+        ])
+        yield tb.lane.rx_symbol.eq(Cat(C(D(10,2), 9), C(D(5,2), 9),
+                                       C(D(10,2), 9), C(D(10,2), 9)))
+        yield
+        yield from self.assertSignal(tb.phy.error, 1)
+
+    @simulation_test
+    def test_rx_fts_eios(self, tb):
+        yield from self.tb.transmit([
+            (K(28,5), K(28,1), K(28,1), K(28,1)),
+        ])
+        yield from self.assertSignal(tb.phy.fts, 1)
+        yield from self.tb.transmit([
+            (K(28,5), K(28,3), K(28,3), K(28,3)),
+        ])
+        yield from self.assertSignal(tb.phy.eios, 1)
+
+
+class PCIePHYRXPipelineTestbench(Module):
+    def __init__(self, ratio):
+        self.submodules.lane  = PCIeSERDESInterface(ratio)
+        self.submodules.phy   = PCIePHYRX(self.lane)
+        self.submodules.lane_p = PCIeSERDESInterface(ratio)
+        self.submodules.phy_p  = PCIePHYRX(self.lane_p, pipeline=True)
+        self.comb += [
+            self.lane_p.rx_symbol.eq(self.lane.rx_symbol),
+            self.lane_p.rx_valid.eq(self.lane.rx_valid),
+        ]
+
+
+class PCIePHYRXPipelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tb = PCIePHYRXPipelineTestbench(ratio=2)
+
+    def simulationSetUp(self, tb):
+        yield tb.lane.rx_valid.eq(1)
+
+    @simulation_test
+    def test_rx_latency(self, tb):
+        symbols = [
+            (K(28,5), 0xaa), (0x1a, 0xff), (0b0010, 0b0000),
+                *[(D(10,2), D(10,2)) for _ in range(5)],
+            (K(28,5), 0xaa), (0x1a, 0xff), (0b0010, 0b0000),
+                *[(D(10,2), D(10,2)) for _ in range(5)],
+            (K(28,5), K(28,0)), (K(28,0), K(28,0)),
+            (K(28,5), 0x1ee), (0, 0),
+            (K(28,5), K(23,7)), (K(23,7), 0xff), (0b0010, 0b0000),
+                *[(D(21,5), D(21,5)) for _ in range(5)],
+            (K(28,5), 0), (0, 0),
+        ]
+        outputs = []
+        for word in symbols:
+            yield tb.lane.rx_symbol.eq(word[0] | (word[1] << 9))
+            yield
+            outputs.append(((yield tb.phy.error), (yield tb.phy.comma),
+                            (yield tb.phy.ts.raw_bits()), (yield tb.lane.rx_invert)))
+            if len(outputs) > 1:
+                self.assertEqual(((yield tb.phy_p.error), (yield tb.phy_p.comma),
+                                  (yield tb.phy_p.ts.raw_bits()), (yield tb.lane_p.rx_invert)),
+                                 outputs[-2])
+
+    @simulation_test
+    def test_rx_skp_packets(self, tb):
+        symbols = [
+            (K(28,5), K(28,0)), (K(28,0), K(28,0)),
+            (K(27,7), D(1,0)), (D(2,0), K(29,7)),
+            (K(28,5), K(28,0)), (K(28,2), D(3,0)),
+            (K(29,7), D(0,0)), (0, 0), (0, 0),
+        ]
+        for word in symbols:
+            yield tb.lane.rx_symbol.eq(word[0] | (word[1] << 9))
+            yield
+            self.assertEqual((yield tb.phy.error), 0)
+            self.assertEqual((yield tb.phy_p.error), 0)
@@ -8,9 +8,9 @@ from . import simulation_test
 
 
 class PCIePHYTXTestbench(Module):
-    def __init__(self, ratio=1):
+    def __init__(self, ratio=1, state_encoding="binary"):
         self.submodules.lane = PCIeSERDESInterface(ratio)
-        self.submodules.phy  = PCIePHYTX(self.lane)
+        self.submodules.phy  = PCIePHYTX(self.lane, state_encoding=state_encoding)
 
     def do_finalize(self):
         self.states = {v: k for k, v in self.phy.emitter.fsm.encoding.items()}
@@ -106,6 +106,112 @@ class PCIePHYTXGear1xTestCase(_PCIePHYTXTestCase):
             K(28,5)
         ])
 
+    @simulation_test
+    def test_tx_skp(self, tb):
+        yield tb.phy.ts.valid.eq(1)
+        yield tb.phy.ts.n_fts.eq(0xff)
+        yield tb.phy.ts.rate.gen1.eq(1)
+        yield
+        symbols = yield from tb.receive(1180 + 16 + 4)
+        offset  = 1180 // 16 * 16 + 16
+        self.assertEqual(symbols[offset - 16], K(28,5))
+        self.assertEqual(symbols[offset:offset + 4], [K(28,5), K(28,0), K(28,0), K(28,0)])
+        self.assertEqual(symbols.count(K(28,0)), 3)
+        self.assertEqual((yield tb.phy.skp_count), 1)
+
+    @simulation_test
+    def test_tx_skp_e_idle(self, tb):
+        yield tb.phy.e_idle.eq(1)
+        yield
+        for _ in range(1200):
+            self.assertEqual((yield tb.lane.tx_e_idle), 1)
+            yield
+        self.assertEqual((yield tb.phy.skp_count), 0)
+
+    @simulation_test
+    def test_tx_fts(self, tb):
+        yield tb.phy.ts.valid.eq(1)
+        yield tb.phy.fts.eq(1)
+        yield
+        yield from self.assertReceive(tb, [
+            K(28,5), K(28,1), K(28,1), K(28,1),
+            K(28,5), K(28,1), K(28,1), K(28,1),
+        ])
+
+    @simulation_test
+    def test_tx_eios(self, tb):
+        yield tb.phy.ts.valid.eq(1)
+        yield tb.phy.eios.eq(1)
+        yield
+        self.assertEqual((yield tb.phy.comma), 1)
+        # The ordered set is completed even if Electrical Idle is requested right away.
+        yield tb.phy.eios.eq(0)
+        yield tb.phy.e_idle.eq(1)
+        yield from self.assertReceive(tb, [K(28,5), K(28,3), K(28,3), K(28,3)])
+        self.assertEqual((yield tb.lane.tx_e_idle), 1)
+
+    @simulation_test
+    def test_tx_skp_request(self, tb):
+        yield tb.phy.ts.valid.eq(1)
+        yield tb.phy.ts.n_fts.eq(0xff)
+        yield tb.phy.ts.rate.gen1.eq(1)
+        yield tb.phy.skp.eq(1)
+        yield
+        yield tb.phy.skp.eq(0)
+        symbols = yield from tb.receive(4 + 16 + 4)
+        self.assertEqual(symbols[0:4], [K(28,5), K(28,0), K(28,0), K(28,0)])
+        self.assertEqual(symbols[4:6], [K(28,5), K(23,7)])
+        self.assertEqual(symbols.count(K(28,0)), 3)
+
+    @simulation_test
+    def test_tx_skp_request_ts(self, tb):
+        yield tb.phy.ts.valid.eq(1)
+        yield tb.phy.ts.n_fts.eq(0xff)
+        yield tb.phy.ts.rate.gen1.eq(1)
+        yield
+        yield tb.phy.skp.eq(1)
+        yield
+        yield tb.phy.skp.eq(0)
+        # The TS1 ordered set that has already started is completed first.
+        symbols = yield from tb.receive(15 + 4 + 2)
+        self.assertEqual(symbols[15:19], [K(28,5), K(28,0), K(28,0), K(28,0)])
+        self.assertEqual(symbols[19:21], [K(28,5), K(23,7)])
+
+    @simulation_test
+    def test_tx_data(self, tb):
+        yield tb.phy.data_valid.eq(1)
+        yield tb.phy.data.eq(K(28,2))
+        yield
+        self.assertEqual((yield tb.phy.data_ready), 1)
+        yield tb.phy.data.eq(D(1,0))
+        yield
+        yield tb.phy.data_valid.eq(0)
+        yield from self.assertReceive(tb, [D(1,0), D(0,0)])
+        self.assertEqual((yield tb.phy.data_ready), 0)
+
+    @simulation_test
+    def test_tx_data_skp_hold(self, tb):
+        yield tb.phy.data_valid.eq(1)
+        yield tb.phy.data_hold.eq(1)
+        yield tb.phy.data.eq(D(1,0))
+        yield tb.phy.skp.eq(1)
+        yield
+        yield tb.phy.skp.eq(0)
+        # The SKP ordered set is postponed until the packet ends.
+        yield from self.assertReceive(tb, [D(1,0), D(1,0)])
+        yield tb.phy.data_hold.eq(0)
+        yield from self.assertReceive(tb, [D(1,0), K(28,5), K(28,0), K(28,0), K(28,0), D(1,0)])
+
+
+class PCIePHYTXGear1xGrayTestCase(PCIePHYTXGear1xTestCase):
+    def setUp(self):
+        self.tb = PCIePHYTXTestbench(state_encoding="gray")
+
+
+class PCIePHYTXGear1xOneHotTestCase(PCIePHYTXGear1xTestCase):
+    def setUp(self):
+        self.tb = PCIePHYTXTestbench(state_encoding="one-hot")
+
 
 class PCIePHYTXGear2xTestCase(_PCIePHYTXTestCase):
     def setUp(self):
@@ -125,3 +231,63 @@ class PCIePHYTXGear2xTestCase(_PCIePHYTXTestCase):
             (K(28,5), 0xaa), (0x01, 0xff), (0b0010, 0b0000),
                 *[(D(10,2), D(10,2)) for _ in range(5)],
         ])
+
+    @simulation_test
+    def test_tx_skp(self, tb):
+        yield tb.phy.ts.valid.eq(1)
+        yield tb.phy.ts.n_fts.eq(0xff)
+        yield tb.phy.ts.rate.gen1.eq(1)
+        yield
+        words  = yield from tb.receive((1180 + 16 + 4) // 2)
+        offset = (1180 // 16 * 16 + 16) // 2
+        self.assertEqual(words[offset:offset + 2], [(K(28,5), K(28,0)), (K(28,0), K(28,0))])
+        self.assertEqual((yield tb.phy.skp_count), 1)
+
+    def test_skp_interval(self):
+        with self.assertRaises(ValueError):
+            PCIePHYTX(PCIeSERDESInterface(ratio=2), skp_interval=1000)
+
+
+class PCIePHYTXGear4xTestCase(_PCIePHYTXTestCase):
+    def setUp(self):
+        self.tb = PCIePHYTXTestbench(ratio=4)
+
+    @simulation_test
+    def test_tx_ts1_link_lane(self, tb):
+        yield tb.phy.ts.valid.eq(1)
+        yield tb.phy.ts.link.valid.eq(1)
+        yield tb.phy.ts.link.number.eq(0xaa)
+        yield tb.phy.ts.lane.valid.eq(1)
+        yield tb.phy.ts.lane.number.eq(0x01)
+        yield tb.phy.ts.n_fts.eq(0xff)
+        yield tb.phy.ts.rate.gen1.eq(1)
+        yield
+        yield from self.assertReceive(tb, [
+            (K(28,5), 0xaa, 0x01, 0xff), (0b0010, 0b0000, D(10,2), D(10,2)),
+                *[(D(10,2), D(10,2), D(10,2), D(10,2)) for _ in range(2)],
+            (K(28,5), 0xaa, 0x01, 0xff),
+        ])
+
+    @simulation_test
+    def test_tx_skp(self, tb):
+        yield tb.phy.ts.valid.eq(1)
+        yield tb.phy.ts.n_fts.eq(0xff)
+        yield tb.phy.ts.rate.gen1.eq(1)
+        yield
+        words  = yield from tb.receive((1180 + 16 + 4) // 4)
+        offset = (1180 // 16 * 16 + 16) // 4
+        self.assertEqual(words[offset], (K(28,5), K(28,0), K(28,0), K(28,0)))
+        self.assertEqual((yield tb.phy.skp_count), 1)
+
+    @simulation_test
+    def test_tx_data_skp(self, tb):
+        yield tb.phy.data_valid.eq(1)
+        yield tb.phy.data.eq(Cat(C(K(28,2), 9), C(D(1,0), 9), C(D(2,0), 9), C(D(3,0), 9)))
+        yield tb.phy.skp.eq(1)
+        yield
+        yield tb.phy.skp.eq(0)
+        self.assertEqual((yield tb.phy.data_ready), 0)
+        yield from self.assertReceive(tb, [
+            (K(28,5), K(28,0), K(28,0), K(28,0)),
+            (K(28,2), D(1,0), D(2,0), D(3,0)),
+        ])
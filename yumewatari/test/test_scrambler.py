@@ -0,0 +1,105 @@
+import unittest
+from migen import *
+
+from ..gateware.serdes import K, D
+from ..gateware.scrambler import *
+from . import simulation_test
+
+
+def scramble(symbols):
+    lfsr     = [1] * 16
+    ts_left  = 0
+    prev_com = False
+    output   = []
+    for symbol in symbols:
+        ts_start = prev_com and (symbol < 0x100 or symbol == K(23,7))
+        key = 0
+        for n in range(8):
+            key |= lfsr[15] << n
+            if symbol != K(28,0):
+                lfsr = [lfsr[15], lfsr[0], lfsr[1], lfsr[2] ^ lfsr[15], lfsr[3] ^ lfsr[15],
+                        lfsr[4] ^ lfsr[15], *lfsr[5:15]]
+        if symbol == K(28,5):
+            lfsr = [1] * 16
+        if symbol >= 0x100 or ts_start or ts_left:
+            output.append(symbol)
+        else:
+            output.append(symbol ^ key)
+        if symbol == K(28,5):
+            ts_left = 0
+        elif ts_start:
+            ts_left = 14
+        elif ts_left:
+            ts_left -= 1
+        prev_com = symbol == K(28,5)
+    return output
+
+
+class ScrambleTestCase(unittest.TestCase):
+    def test_reference(self):
+        # Scrambled D0.0 sequence from the PCIe Base Specification.
+        self.assertEqual(scramble([K(28,5), K(28,0)] + [D(0,0)] * 8),
+                         [K(28,5), K(28,0), 0xff, 0x17, 0xc0, 0x14, 0xb2, 0xe7, 0x02, 0x82])
+
+
+class PCIeScramblerTestbench(Module):
+    def __init__(self, ratio):
+        self.ratio = ratio
+        self.submodules.scrambler   = PCIeScrambler(ratio)
+        self.submodules.descrambler = PCIeScrambler(ratio)
+        self.comb += self.descrambler.i.eq(self.scrambler.o)
+
+    def transfer(self, symbols):
+        scrambled   = []
+        descrambled = []
+        for offset in range(0, len(symbols) + 2 * self.ratio, self.ratio):
+            word = symbols[offset:offset + self.ratio]
+            word = word + [0] * (self.ratio - len(word))
+            yield self.scrambler.i.eq(Cat(C(symbol, 9) for symbol in word))
+            yield
+            for signal, symbols_o in ((self.scrambler.o,   scrambled),
+                                      (self.descrambler.o, descrambled)):
+                value = yield signal
+                symbols_o.extend((value >> (9 * n)) & 0x1ff for n in range(self.ratio))
+        return (scrambled[self.ratio:len(symbols) + self.ratio],
+                descrambled[2 * self.ratio:len(symbols) + 2 * self.ratio])
+
+
+class PCIeScramblerTestCase(unittest.TestCase):
+    ratio = 1
+
+    def setUp(self):
+        self.tb = PCIeScramblerTestbench(self.ratio)
+
+    symbols = [
+        K(28,5), K(28,0), *[D(n, 0) for n in range(20)],
+        # SKP ordered set
+        K(28,5), K(28,0), K(28,0), K(28,0), *[D(n, 1) for n in range(7)],
+        # TS1 ordered set
+        K(28,5), K(23,7), K(23,7), 0xff, 0b0010, 0b0000, *[D(10,2) for _ in range(10)],
+        # K symbols in data
+        *[D(n, 2) for n in range(5)], K(27,7), *[D(n, 3) for n in range(10)], K(29,7),
+        # TS2 ordered set with link and lane numbers
+        K(28,5), 0xaa, 0x01, 0xff, 0b0010, 0b0000, *[D(5,2) for _ in range(10)],
+        *[D(n, 4) for n in range(11)]
+    ]
+
+    @simulation_test
+    def test_scramble(self, tb):
+        scrambled, descrambled = yield from tb.transfer(self.symbols)
+        self.assertEqual(scrambled, scramble(self.symbols))
+        self.assertEqual(descrambled, self.symbols)
+
+    @simulation_test
+    def test_bypass(self, tb):
+        yield tb.scrambler.bypass.eq(1)
+        scrambled, _ = yield from tb.transfer(self.symbols)
+        self.assertEqual(scrambled, self.symbols)
+
+
+class PCIeScrambler2xTestCase(PCIeScramblerTestCase):
+    ratio = 2
+
+
+class PCIeScrambler4xTestCase(PCIeScramblerTestCase):
+    ratio = 4
@@ -0,0 +1,189 @@
+import unittest
+from migen import *
+
+from ..gateware.serdes import *
+from ..gateware.serdes import K, D
+from . import simulation_test
+
+
+class PCIeSERDESAlignerTestbench(Module):
+    def __init__(self, ratio):
+        self.submodules.lane    = PCIeSERDESInterface(ratio)
+        self.submodules.aligner = PCIeSERDESAligner(self.lane)
+
+    def transfer(self, symbols):
+        ratio = self.lane.ratio
+        received = []
+        for offset in range(0, len(symbols), ratio):
+            yield self.lane.rx_symbol.eq(Cat(C(symbol, 9) for symbol in
+                                             symbols[offset:offset + ratio]))
+            yield self.lane.rx_valid.eq((1 << ratio) - 1)
+            yield
+            word = yield self.aligner.rx_symbol
+            received.append(tuple((word >> (9 * n)) & 0x1ff for n in range(ratio)))
+        return received
+
+
+class PCIeSERDESAlignerTestCase(unittest.TestCase):
+    symbols = [
+        D(1,0), D(2,0),
+        K(28,5), K(28,0), K(28,0), K(28,0),
+        *[D(n, 0) for n in range(3, 13)],
+    ]
+
+    def test_2x(self):
+        tb = PCIeSERDESAlignerTestbench(ratio=2)
+        def testbench():
+            yield tb.lane.rx_align.eq(1)
+            received = yield from tb.transfer(self.symbols + [0] * 4)
+            start = received.index((K(28,5), K(28,0)))
+            self.assertEqual(received[start + 1], (K(28,0), K(28,0)))
+            self.assertEqual(received[start + 2], (D(3,0), D(4,0)))
+        run_simulation(tb, testbench())
+
+    def test_4x(self):
+        tb = PCIeSERDESAlignerTestbench(ratio=4)
+        def testbench():
+            yield tb.lane.rx_align.eq(1)
+            received = yield from tb.transfer(self.symbols + [0] * 8)
+            start = received.index((K(28,5), K(28,0), K(28,0), K(28,0)))
+            self.assertEqual(received[start + 1], (D(3,0), D(4,0), D(5,0), D(6,0)))
+            self.assertEqual(received[start + 2], (D(7,0), D(8,0), D(9,0), D(10,0)))
+        run_simulation(tb, testbench())
+
+
+class PCIeSERDESElasticBufferTestbench(Module):
+    def __init__(self, ratio=1, depth=16):
+        self.submodules.lane   = PCIeSERDESInterface(ratio)
+        self.submodules.buffer = PCIeSERDESElasticBuffer(self.lane, depth)
+
+
+class PCIeSERDESElasticBufferTestCase(unittest.TestCase):
+    def symbols(self, count, skp_every):
+        symbols = []
+        while len(symbols) < count:
+            symbols += [K(28,5), K(28,0), K(28,0), K(28,0)]
+            symbols += [D(n % 32, 0) for n in range(skp_every)]
+        return symbols[:count]
+
+    def transfer(self, ratio, symbols, write_period, read_period, read_count):
+        tb = PCIeSERDESElasticBufferTestbench(ratio)
+        received = []
+        def write():
+            for offset in range(0, len(symbols), ratio):
+                for n, symbol in enumerate(symbols[offset:offset + ratio]):
+                    yield tb.lane.rx_symbol.part(9 * n, 9).eq(symbol)
+                yield tb.lane.rx_valid.eq((1 << ratio) - 1)
+                yield
+        def read():
+            for _ in range(read_count):
+                yield
+                word  = yield tb.buffer.rx_symbol
+                valid = yield tb.buffer.rx_valid
+                if valid == (1 << ratio) - 1:
+                    received.extend((word >> (9 * n)) & 0x1ff for n in range(ratio))
+                else:
+                    self.assertEqual(valid, 0)
+            self.counts = ((yield tb.buffer.overflow_count),
+                           (yield tb.buffer.underflow_count))
+        run_simulation(tb, {"write": write(), "read": read()},
+                       clocks={"write": write_period, "read": read_period})
+        return received
+
+    def assertTransfer(self, ratio, write_period, read_period, count=800):
+        symbols  = self.symbols(count, skp_every=40)
+        received = self.transfer(ratio, symbols, write_period, read_period,
+                                 read_count=len(symbols) // ratio * write_period // read_period
+                                            - 20)
+        self.assertEqual(self.counts, (0, 0))
+        # Apart from the SKP symbols, the data must be received unchanged.
+        self.assertEqual([s for s in received if s != K(28,0)],
+                         [s for s in symbols if s != K(28,0)][:len(received) -
+                                                              received.count(K(28,0))])
+        # Every SKP ordered set must retain at least one SKP symbol.
+        for offset, symbol in enumerate(received[:-1]):
+            if symbol == K(28,5):
+                self.assertEqual(received[offset + 1], K(28,0))
+
+    def test_faster_write(self):
+        self.assertTransfer(ratio=1, write_period=100, read_period=103)
+
+    def test_faster_read(self):
+        self.assertTransfer(ratio=1, write_period=103, read_period=100)
+
+    def test_faster_write_2x(self):
+        self.assertTransfer(ratio=2, write_period=100, read_period=103)
+
+    def test_faster_read_2x(self):
+        self.assertTransfer(ratio=2, write_period=103, read_period=100)
+
+    def test_overflow(self):
+        symbols = [D(n % 32, 0) for n in range(200)]
+        self.transfer(1, symbols, write_period=100, read_period=110, read_count=150)
+        self.assertGreater(self.counts[0], 0)
+
+    def test_underflow(self):
+        symbols = [D(n % 32, 0) for n in range(200)]
+        self.transfer(1, symbols, write_period=110, read_period=100, read_count=200)
+        self.assertGreater(self.counts[1], 0)
+
+    # At 1:4 gearing, a single SKP symbol is removed or repeated per SKP ordered set, which
+    # compensates for a smaller difference in frequency.
+    def test_faster_write_4x(self):
+        self.assertTransfer(ratio=4, write_period=100, read_period=102, count=4000)
+
+    def test_faster_read_4x(self):
+        self.assertTransfer(ratio=4, write_period=102, read_period=100, count=4000)
+
+
+class PCIeSERDESDeskewTestbench(Module):
+    def __init__(self, skews):
+        self.skews = skews
+        self.submodules.lanes  = [PCIeSERDESInterface(ratio=1) for _ in skews]
+        self.submodules.deskew = PCIeSERDESDeskew(self.lanes)
+
+    def transfer(self, symbols):
+        received = [[] for _ in self.skews]
+        for cycle in range(len(symbols) + max(self.skews) + 6):
+            for lane, skew in zip(self.lanes, self.skews):
+                offset = cycle - skew
+                if 0 <= offset < len(symbols):
+                    yield lane.rx_symbol.eq(symbols[offset])
+                else:
+                    yield lane.rx_symbol.eq(0)
+                yield lane.rx_valid.eq(1)
+            yield
+            for lane, lane_received in zip(self.deskew.lanes, received):
+                lane_received.append((yield lane.rx_symbol))
+        return received
+
+
+class PCIeSERDESDeskewTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tb = PCIeSERDESDeskewTestbench(skews=[2, 0, 3, 1])
+
+    symbols = [
+        *[K(28,5), K(28,0), K(28,0), K(28,0)],
+        *[D(n, 0) for n in range(20)],
+        *[K(28,5), K(28,0), K(28,0), K(28,0)],
+        *[D(n, 1) for n in range(20)],
+    ]
+
+    @simulation_test
+    def test_deskew(self, tb):
+        received = yield from tb.transfer(self.symbols)
+        # After the first ordered set, all lanes are aligned to the most delayed lane.
+        for lane_received in received:
+            self.assertEqual(lane_received[8:len(self.symbols) + 4], self.symbols[4:])
+        self.assertEqual((yield tb.deskew.error), 0)
+
+    @simulation_test
+    def test_disabled_lane(self, tb):
+        yield tb.deskew.enable.eq(0b1011)
+        received = yield from tb.transfer(self.symbols)
+        for n in (0, 1, 3):
+            self.assertEqual(received[n][7:len(self.symbols) + 3], self.symbols[4:])
+
+    def test_max_skew(self):
+        with self.assertRaises(ValueError):
+            PCIeSERDESDeskew([PCIeSERDESInterface(ratio=2)], max_skew=8)
@@ -0,0 +1,157 @@
+import unittest
+from migen import *
+
+from ..gateware.tlp_stream import *
+from . import simulation_test
+
+
+def beats(tlp, dwords):
+    for offset in range(0, len(tlp), dwords):
+        chunk = tlp[offset:offset + dwords]
+        yield (sum(dword << (32 * n) for n, dword in enumerate(chunk)),
+               (1 << (4 * len(chunk))) - 1,
+               offset == 0,
+               offset + dwords >= len(tlp))
+
+
+class PCIeTLPStreamTXTestCase(unittest.TestCase):
+    tlps = [
+        [0x01000040, 0x000000ff, 0x00001000, 0x11111111],
+        [0x01000000, 0x000000ff, 0x00001000],
+        [0x05000040, 0x000000ff, 0x00001000, 1, 2, 3, 4, 5],
+    ]
+
+    def transfer(self, data_width, write_period, read_period, ready=lambda n: True):
+        dut = PCIeTLPStreamTX(data_width)
+        received = []
+        def write():
+            for tlp in self.tlps:
+                for data, be, start, end in beats(tlp, data_width // 32):
+                    yield dut.i.valid.eq(1)
+                    yield dut.i.data.eq(data)
+                    yield dut.i.be.eq(be)
+                    yield dut.i.start.eq(start)
+                    yield dut.i.end.eq(end)
+                    yield
+                    while not (yield dut.i_ready):
+                        yield
+            yield dut.i.valid.eq(0)
+            yield
+        def read():
+            data = []
+            for n in range(100):
+                yield dut.o_ready.eq(0)
+                yield
+                if (yield dut.o.valid) and ready(n):
+                    yield dut.o_ready.eq(1)
+                    data.append((yield dut.o.data))
+                    if (yield dut.o.last):
+                        received.append(data)
+                        data = []
+                    yield
+        run_simulation(dut, {"write": write(), "read": read()},
+                       clocks={"write": write_period, "read": read_period})
+        return received
+
+    def test_32(self):
+        self.assertEqual(self.transfer(32, 10, 10), self.tlps)
+
+    def test_64(self):
+        self.assertEqual(self.transfer(64, 23, 10), self.tlps)
+
+    def test_128(self):
+        self.assertEqual(self.transfer(128, 37, 10, ready=lambda n: n % 3 != 0), self.tlps)
+
+    def test_data_width(self):
+        with self.assertRaisesRegex(ValueError,
+                r"TLP stream data width must be 32, 64 or 128 bits, not 48"):
+            PCIeTLPStreamTX(48)
+
+
+class PCIeTLPStreamRXTestCase(unittest.TestCase):
+    tlps = PCIeTLPStreamTXTestCase.tlps
+    rx_credits = {"ph": 2, "pd": 2, "nph": 0, "npd": 0, "cplh": 0, "cpld": 0}
+
+    def transfer(self, data_width, tlps, write_period, read_period, ready=lambda n: True,
+                 depth=16, max_tlps=4):
+        dut = PCIeTLPStreamRX(data_width, depth, max_tlps, rx_credits=self.rx_credits)
+        received = []
+        released = []
+        def write():
+            def cycle():
+                yield
+                if (yield dut.release.ph):
+                    released.append((yield dut.release.pd))
+            for tlp, accept in tlps:
+                for dword in tlp:
+                    yield dut.i.valid.eq(1)
+                    yield dut.i.data.eq(dword)
+                    yield from cycle()
+                yield dut.i.valid.eq(0)
+                yield dut.i_end.eq(1)
+                yield dut.i_accept.eq(accept)
+                yield dut.i_credits.ph.eq(1)
+                yield dut.i_credits.pd.eq(len(tlp))
+                yield from cycle()
+                yield dut.i_end.eq(0)
+                yield dut.i_accept.eq(0)
+            for _ in range(100):
+                yield from cycle()
+            self.overflow_count = yield dut.overflow_count
+        def read():
+            data = []
+            for n in range(200):
+                yield dut.o_ready.eq(ready(n))
+                yield
+                if (yield dut.o.valid) and ready(n):
+                    be = yield dut.o.be
+                    if not data:
+                        self.assertEqual((yield dut.o.start), 1)
+                    for m in range(data_width // 32):
+                        if be & (1 << (4 * m)):
+                            data.append(((yield dut.o.data) >> (32 * m)) & 0xffffffff)
+                    if (yield dut.o.end):
+                        received.append(data)
+                        data = []
+        run_simulation(dut, {"write": write(), "read": read()},
+                       clocks={"write": write_period, "read": read_period})
+        return received, released
+
+    def test_32(self):
+        self.assertEqual(self.transfer(32, [(tlp, True) for tlp in self.tlps], 10, 10),
+                         (self.tlps, [4, 3, 8]))
+
+    def test_64(self):
+        self.assertEqual(self.transfer(64, [(tlp, True) for tlp in self.tlps], 10, 17,
+                                       ready=lambda n: n % 2 == 0),
+                         (self.tlps, [4, 3, 8]))
+
+    def test_128(self):
+        self.assertEqual(self.transfer(128, [(tlp, True) for tlp in self.tlps], 10, 41),
+                         (self.tlps, [4, 3, 8]))
+
+    def test_discard(self):
+        self.assertEqual(self.transfer(64, [(self.tlps[0], True), (self.tlps[2], False),
+                                            (self.tlps[1], True)], 10, 10),
+                         ([self.tlps[0], self.tlps[1]], [4, 3]))
+
+    def test_overflow(self):
+        # The link partner transmits TLPs in excess of the advertised credits.
+        tlps = [(self.tlps[2], True)] * 6
+        received, released = self.transfer(32, tlps, 10, 10, ready=lambda n: n > 60, depth=16)
+        self.assertEqual(received, [self.tlps[2]] * len(released))
+        self.assertGreater(self.overflow_count, 0)
+        self.assertEqual(len(released) + self.overflow_count, 6)
+
+    def test_credits(self):
+        PCIeTLPStreamRX(32)
+        with self.assertRaisesRegex(ValueError,
+                r"TLP stream buffer depth must be at least 704 dwords to hold the advertised "
+                r"credits, not 512"):
+            PCIeTLPStreamRX(32, depth=512)
+        with self.assertRaisesRegex(ValueError,
+                r"TLP stream buffer must hold at least 3 TLPs to hold the advertised credits, "
+                r"not 2"):
+            PCIeTLPStreamRX(32, depth=16, max_tlps=2,
+                            rx_credits={"ph": 1, "pd": 1, "nph": 1, "npd": 0,
+                                        "cplh": 1, "cpld": 0})
@@ -8,6 +8,7 @@ from microscope import *
 from ..gateware.platform.lattice_ecp5 import *
 from ..gateware.serdes import *
 from ..gateware.phy import *
+from ..gateware.debug import *
 from ..vendor.pads import *
 from ..vendor.uart import *
 
@@ -23,8 +24,8 @@ class LTSSMTestbench(Module):
         self.submodules.serdes  = serdes  = \
             LatticeECP5PCIeSERDES(self.platform.request("pcie_x1"))
         self.comb += [
-            self.cd_serdes.clk.eq(serdes.rx_clk_o),
-            serdes.rx_clk_i.eq(self.cd_serdes.clk),
+            self.cd_serdes.clk.eq(serdes.tx_clk_o),
+            serdes.rx_clk_i.eq(serdes.rx_clk_o),
             serdes.tx_clk_i.eq(self.cd_serdes.clk),
         ]
 
@@ -37,8 +38,11 @@ class LTSSMTestbench(Module):
 
         self.submodules.aligner = aligner = \
             ClockDomainsRenamer("rx")(PCIeSERDESAligner(serdes.lane))
+        self.submodules.buffer  = buffer  = \
+            ClockDomainsRenamer({"write": "rx", "read": "serdes"})(
+                PCIeSERDESElasticBuffer(aligner))
         self.submodules.phy = phy = \
-            ClockDomainsRenamer("rx")(PCIePHY(aligner, ms_cyc=125000))
+            ClockDomainsRenamer("serdes")(PCIePHY(buffer, ms_cyc=125000))
 
         led_att1 = self.platform.request("user_led")
         led_att2 = self.platform.request("user_led")
@@ -64,7 +68,7 @@ class LTSSMTestbench(Module):
 
         uart_pads = Pads(self.platform.request("serial"))
         self.submodules += uart_pads
-        self.submodules.uart = uart = ClockDomainsRenamer("rx")(
+        self.submodules.uart = uart = ClockDomainsRenamer("serdes")(
             UART(uart_pads, bit_cyc=uart_bit_cyc(125e6, 115200)[0])
         )
 
@@ -72,6 +76,16 @@ class LTSSMTestbench(Module):
             uart.rx_ack.eq(uart.rx_rdy),
         ]
 
+        # Once armed, capture the LTSSM transitions leading up to a link drop, and a few
+        # after it.
+        link_up_l = Signal()
+        self.sync.serdes += link_up_l.eq(phy.link_up)
+        self.comb += [
+            phy.ltssm_log.trigger_mode.eq(TRIGGER_EXTERNAL),
+            phy.ltssm_log.trigger_i.eq(link_up_l & ~phy.link_up),
+            phy.ltssm_log.post_trigger.eq(phy.ltssm_log.depth // 4),
+        ]
+
         index  = Signal(max=phy.ltssm_log.depth)
         offset = Signal(8)
         size   = Signal(16)
@@ -81,13 +95,36 @@ class LTSSMTestbench(Module):
             entry.eq(Cat(phy.ltssm_log.data_o, phy.ltssm_log.time_o)),
         ]
 
-        self.submodules.uart_fsm = ClockDomainsRenamer("rx")(FSM())
+        stats_header = Signal()
+        stats_index  = Signal(max=phy.ltssm_stats.states)
+        stats_entry  = Signal(48)
+        self.comb += [
+            phy.ltssm_stats.index.eq(stats_index),
+            If(stats_header,
+                stats_entry.eq(Cat(phy.ltssm_link_up_cycles, phy.ltssm_retries))
+            ).Else(
+                stats_entry.eq(Cat(phy.ltssm_stats.transitions_o, phy.ltssm_stats.cycles_o))
+            )
+        ]
+
+        self.submodules.uart_fsm = ClockDomainsRenamer("serdes")(FSM())
         self.uart_fsm.act("WAIT",
             NextValue(uart.tx_ack, 0),
             If(uart.rx_rdy,
-                NextValue(phy.ltssm_log.trigger, 1),
-                NextValue(offset, 1),
-                NextState("WIDTH")
+                If(uart.rx_data == 1,
+                    NextValue(stats_header, 1),
+                    NextValue(stats_index, 0),
+                    NextValue(offset, len(stats_entry) // 8 - 1),
+                    NextState("STATS")
+                ).Elif(uart.rx_data == 2,
+                    phy.ltssm_log.arm.eq(1)
+                ).Elif(uart.rx_data == 3,
+                    NextState("STATUS")
+                ).Else(
+                    NextValue(phy.ltssm_log.trigger, 1),
+                    NextValue(offset, 1),
+                    NextState("WIDTH")
+                )
             )
         )
         self.uart_fsm.act("WIDTH",
@@ -123,6 +160,35 @@ class LTSSMTestbench(Module):
                 )
             )
         )
+        self.uart_fsm.act("STATUS",
+            NextValue(uart.tx_ack, 0),
+            If(uart.tx_rdy & ~uart.tx_ack,
+                NextValue(uart.tx_data, Cat(phy.ltssm_log.armed,
+                                            phy.ltssm_log.triggered,
+                                            phy.ltssm_log.done)),
+                NextValue(uart.tx_ack, 1),
+                NextState("WAIT")
+            )
+        )
+        self.uart_fsm.act("STATS",
+            NextValue(uart.tx_ack, 0),
+            If(uart.tx_rdy & ~uart.tx_ack,
+                NextValue(uart.tx_data, stats_entry.part(offset << 3, 8)),
+                NextValue(uart.tx_ack, 1),
+                If(offset == 0,
+                    NextValue(offset, len(stats_entry) // 8 - 1),
+                    If(stats_header,
+                        NextValue(stats_header, 0)
+                    ).Elif(stats_index == phy.ltssm_stats.states - 1,
+                        NextState("WAIT")
+                    ).Else(
+                        NextValue(stats_index, stats_index + 1)
+                    )
+                ).Else(
+                    NextValue(offset, offset - 1)
+                )
+            )
+        )
 
 # -------------------------------------------------------------------------------------------------
 
@@ -162,11 +228,13 @@ if __name__ == "__main__":
             length, = struct.unpack(">H", port.read(2))
             data = port.read(length)
 
+            entry_size = design.phy.ltssm_log.width // 8
             offset = 0
             start  = None
             while offset < len(data):
-                time, state = struct.unpack_from(">LB", data, offset)
-                offset += struct.calcsize(">LB")
+                time, = struct.unpack_from(">L", data, offset)
+                state = int.from_bytes(data[offset + 4:offset + entry_size], "big")
+                offset += entry_size
 
                 if start is not None:
                     delta = time - start
@@ -178,3 +246,29 @@ if __name__ == "__main__":
 
                 start = time
 
+        if arg == "arm":
+            port = serial.Serial(port='/dev/ttyUSB1', baudrate=115200)
+            port.write(b"\x02")
+
+        if arg == "status":
+            port = serial.Serial(port='/dev/ttyUSB1', baudrate=115200)
+            port.write(b"\x03")
+            status, = port.read(1)
+            print("armed: %d, triggered: %d, done: %d" %
+                  (status & 1, (status >> 1) & 1, (status >> 2) & 1))
+
+        if arg == "stats":
+            design = LTSSMTestbench()
+            design.finalize()
+
+            port = serial.Serial(port='/dev/ttyUSB1', baudrate=115200)
+            port.write(b"\x01")
+            retries, link_up_cycles = struct.unpack(">HL", port.read(6))
+            print("retries: %d, link up after %d cyc (%d us)" %
+                  (retries, link_up_cycles, link_up_cycles / 125))
+
+            for state in design.phy.ltssm.actions:
+                cycles, transitions = struct.unpack(">LH", port.read(6))
+                print("%10d cyc (%10d us), %5d exits: %s" %
+                      (cycles, cycles / 125, transitions, state))
+